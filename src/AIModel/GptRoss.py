@@ -1,67 +1,37 @@
-
 """
-GPT-OSS-120B Fine-tuning Implementation
-A comprehensive Python script for loading, fine-tuning, and deploying OpenAI's GPT-OSS-120B model.
+GPT-OSS-120B Fine-tuning command line
+
+    python GptRoss.py prepare-data --sample ./data.jsonl
+    python GptRoss.py prepare-data --train_data ./data.jsonl --token_cache_dir ./token-cache
+    python GptRoss.py train --train_data ./data.jsonl --output_dir ./gpt-oss-120b-finetuned
+    python GptRoss.py generate --load_model ./gpt-oss-120b-finetuned --prompt "Hello"
+    python GptRoss.py batch-generate --load_model ./gpt-oss-120b-finetuned --input prompts.jsonl --output responses.jsonl
+    python GptRoss.py evaluate --load_model ./gpt-oss-120b-finetuned --eval_data eval.jsonl
+    python GptRoss.py serve --load_model ./gpt-oss-120b-finetuned --port 8000
+    python GptRoss.py plan-memory --num_gpus 2 --gpu_memory 80GiB --quantization nf4
+    python GptRoss.py export --adapter ./gpt-oss-120b-finetuned --output_dir ./gpt-oss-120b-merged
+    python GptRoss.py routing-stats --data ./data.jsonl --output ./routing_stats.json
 
-Author: AI Assistant
-Date: September 2025
-License: MIT
+Each subcommand imports only what it needs: torch, transformers and peft are
+loaded by train, generate, batch-generate, evaluate, serve, plan-memory, export and routing-stats (and prepare-data when it
+builds a token cache), and W&B only when train is given --wandb_project. The fine-tuning
+classes live in gptoss_finetune.py; importing them from this module still
+works and loads that stack on first access.
 
-Requirements:
-- PyTorch >= 2.0
-- Transformers >= 4.55.0
-- PEFT >= 0.17.0
-- Datasets
-- Wandb (optional, for experiment tracking)
-- Flash Attention 2 (recommended)
+The pre-subcommand form (``python GptRoss.py --train_data ...``) is still
+accepted and treated as ``train``, or as ``prepare-data`` for
+--create_sample_data.
 """
 
 import os
 import sys
 import json
 import time
-import math
 import logging
 import argparse
 import warnings
-from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union, Any
-from dataclasses import dataclass, field
 import traceback
-
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader, DistributedSampler
-from torch.nn.parallel import DistributedDataParallel as DDP
-import torch.distributed as dist
-
-import numpy as np
-from tqdm.auto import tqdm
-import wandb
-
-# Transformers and PEFT imports
-from transformers import (
-    AutoTokenizer, 
-    AutoModelForCausalLM,
-    AutoConfig,
-    TrainingArguments,
-    Trainer,
-    DataCollatorForLanguageModeling,
-    get_linear_schedule_with_warmup,
-    get_cosine_schedule_with_warmup
-)
-
-from peft import (
-    get_peft_model,
-    LoraConfig,
-    TaskType,
-    prepare_model_for_kbit_training,
-    PeftModel,
-    PeftConfig
-)
-
-from datasets import Dataset as HFDataset
+from typing import List, Optional
 
 # Configure logging
 logging.basicConfig(
@@ -74,542 +44,18 @@ logger = logging.getLogger(__name__)
 warnings.filterwarnings("ignore", category=UserWarning)
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-
-@dataclass
-class ModelConfig:
-    """Configuration class for GPT-OSS-120B model"""
-    model_name: str = "openai/gpt-oss-120b"
-    model_revision: str = "main"
-    cache_dir: Optional[str] = None
-    use_auth_token: Optional[str] = None
-    torch_dtype: str = "bfloat16"
-    device_map: str = "auto"
-    max_memory: Optional[Dict[int, str]] = None
-    offload_folder: Optional[str] = None
-    low_cpu_mem_usage: bool = True
-    trust_remote_code: bool = True
-    use_flash_attention: bool = True
-    attn_implementation: str = "flash_attention_2"
-
-
-@dataclass
-class LoRAConfig:
-    """Configuration for LoRA fine-tuning"""
-    r: int = 16
-    lora_alpha: int = 32
-    target_modules: List[str] = field(default_factory=lambda: [
-        "q_proj", "k_proj", "v_proj", "o_proj",
-        "gate_proj", "up_proj", "down_proj"
-    ])
-    lora_dropout: float = 0.05
-    bias: str = "none"
-    task_type: str = "CAUSAL_LM"
-    inference_mode: bool = False
-    modules_to_save: Optional[List[str]] = None
+COMMANDS = ["prepare-data", "train", "generate", "batch-generate", "evaluate", "serve", "plan-memory", "export", "routing-stats"]
 
 
-@dataclass
-class TrainingConfig:
-    """Training configuration"""
-    output_dir: str = "./gpt-oss-120b-finetuned"
-    num_train_epochs: int = 3
-    per_device_train_batch_size: int = 1
-    per_device_eval_batch_size: int = 1
-    gradient_accumulation_steps: int = 8
-    learning_rate: float = 2e-4
-    weight_decay: float = 0.01
-    adam_beta1: float = 0.9
-    adam_beta2: float = 0.999
-    adam_epsilon: float = 1e-8
-    max_grad_norm: float = 1.0
-    warmup_ratio: float = 0.1
-    lr_scheduler_type: str = "cosine"
-    logging_steps: int = 10
-    eval_steps: int = 500
-    save_steps: int = 1000
-    save_total_limit: int = 3
-    evaluation_strategy: str = "steps"
-    load_best_model_at_end: bool = True
-    metric_for_best_model: str = "eval_loss"
-    greater_is_better: bool = False
-    seed: int = 42
-    fp16: bool = False
-    bf16: bool = True
-    dataloader_num_workers: int = 4
-    remove_unused_columns: bool = False
-    report_to: str = "wandb"
-    run_name: Optional[str] = None
-    max_length: int = 2048
-    use_reasoning_tokens: bool = True
-    reasoning_level: str = "medium"  # low, medium, high
-
-
-class GPTOSSDataset(Dataset):
-    """Custom dataset for GPT-OSS-120B fine-tuning with harmony format support"""
-    
-    def __init__(
-        self,
-        data_path: str,
-        tokenizer,
-        max_length: int = 2048,
-        use_reasoning_tokens: bool = True,
-        reasoning_level: str = "medium"
-    ):
-        self.tokenizer = tokenizer
-        self.max_length = max_length
-        self.use_reasoning_tokens = use_reasoning_tokens
-        self.reasoning_level = reasoning_level
-        
-        # Load data
-        self.data = self._load_data(data_path)
-        logger.info(f"Loaded {len(self.data)} examples from {data_path}")
-        
-        # Set up special tokens
-        self._setup_special_tokens()
-        
-    def _load_data(self, data_path: str) -> List[Dict[str, str]]:
-        """Load data from JSONL file"""
-        data = []
-        with open(data_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    try:
-                        item = json.loads(line)
-                        data.append(item)
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"Failed to parse line: {line[:100]}... Error: {e}")
-                        continue
-        return data
-    
-    def _setup_special_tokens(self):
-        """Setup special tokens for harmony format"""
-        special_tokens = {
-            "pad_token": "<pad>",
-            "bos_token": "<s>",
-            "eos_token": "</s>",
-            "unk_token": "<unk>"
-        }
-        
-        # Add reasoning tokens if needed
-        if self.use_reasoning_tokens:
-            special_tokens.update({
-                "reasoning_start": "<reasoning>",
-                "reasoning_end": "</reasoning>",
-                "answer_start": "<answer>",
-                "answer_end": "</answer>"
-            })
-        
-        # Add tokens that don't exist
-        tokens_to_add = []
-        for token_name, token_value in special_tokens.items():
-            if not hasattr(self.tokenizer, token_name) or getattr(self.tokenizer, token_name) is None:
-                tokens_to_add.append(token_value)
-        
-        if tokens_to_add:
-            self.tokenizer.add_special_tokens({"additional_special_tokens": tokens_to_add})
-            
-    def _format_harmony_prompt(self, item: Dict[str, str]) -> str:
-        """Format prompt according to harmony format"""
-        system_prompt = item.get("system", "You are a helpful AI assistant.")
-        user_message = item.get("user", item.get("prompt", ""))
-        assistant_message = item.get("assistant", item.get("response", ""))
-        
-        # Add reasoning level to system prompt
-        if self.use_reasoning_tokens:
-            system_prompt = f"Reasoning: {self.reasoning_level}\n\n{system_prompt}"
-        
-        # Format according to harmony format
-        formatted = f"<s>System: {system_prompt}\n\n"
-        formatted += f"User: {user_message}\n\n"
-        
-        if self.use_reasoning_tokens and "reasoning" in item:
-            formatted += f"<reasoning>\n{item['reasoning']}\n</reasoning>\n\n"
-        
-        formatted += f"Assistant: {assistant_message}</s>"
-        
-        return formatted
-    
-    def __len__(self) -> int:
-        return len(self.data)
-    
-    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
-        item = self.data[idx]
-        
-        # Format the text according to harmony format
-        text = self._format_harmony_prompt(item)
-        
-        # Tokenize
-        encoding = self.tokenizer(
-            text,
-            truncation=True,
-            max_length=self.max_length,
-            padding="max_length",
-            return_tensors="pt"
-        )
-        
-        input_ids = encoding["input_ids"].squeeze()
-        attention_mask = encoding["attention_mask"].squeeze()
-        
-        # Labels are the same as input_ids for causal LM
-        labels = input_ids.clone()
-        
-        # Mask padding tokens in labels
-        labels[attention_mask == 0] = -100
-        
-        return {
-            "input_ids": input_ids,
-            "attention_mask": attention_mask,
-            "labels": labels
-        }
-
-
-class GPTOSSFineTuner:
-    """Main class for fine-tuning GPT-OSS-120B"""
-    
-    def __init__(
-        self,
-        model_config: ModelConfig,
-        lora_config: LoRAConfig,
-        training_config: TrainingConfig
-    ):
-        self.model_config = model_config
-        self.lora_config = lora_config
-        self.training_config = training_config
-        
-        self.tokenizer = None
-        self.model = None
-        self.trainer = None
-        
-        # Set up device and distributed training
-        self._setup_device()
-        
-    def _setup_device(self):
-        """Setup device and distributed training"""
-        if torch.cuda.is_available():
-            self.device = torch.device("cuda")
-            self.n_gpu = torch.cuda.device_count()
-            logger.info(f"Using {self.n_gpu} GPU(s)")
-        else:
-            self.device = torch.device("cpu")
-            self.n_gpu = 0
-            logger.warning("No GPU available, using CPU")
-        
-        # Initialize distributed training if multiple GPUs
-        if self.n_gpu > 1:
-            if not dist.is_initialized():
-                dist.init_process_group(backend='nccl')
-            self.local_rank = int(os.environ.get("LOCAL_RANK", 0))
-            torch.cuda.set_device(self.local_rank)
-        else:
-            self.local_rank = 0
-    
-    def load_tokenizer(self):
-        """Load and configure tokenizer"""
-        logger.info(f"Loading tokenizer from {self.model_config.model_name}")
-        
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.model_config.model_name,
-            revision=self.model_config.model_revision,
-            cache_dir=self.model_config.cache_dir,
-            use_auth_token=self.model_config.use_auth_token,
-            trust_remote_code=self.model_config.trust_remote_code
-        )
-        
-        # Ensure tokenizer has pad token
-        if self.tokenizer.pad_token is None:
-            self.tokenizer.pad_token = self.tokenizer.eos_token
-            
-        logger.info(f"Tokenizer loaded. Vocab size: {len(self.tokenizer)}")
-        
-    def load_model(self):
-        """Load and configure the base model"""
-        logger.info(f"Loading model from {self.model_config.model_name}")
-        
-        # Configure torch dtype
-        if self.model_config.torch_dtype == "float16":
-            torch_dtype = torch.float16
-        elif self.model_config.torch_dtype == "bfloat16":
-            torch_dtype = torch.bfloat16
-        else:
-            torch_dtype = torch.float32
-        
-        # Load model configuration
-        config = AutoConfig.from_pretrained(
-            self.model_config.model_name,
-            revision=self.model_config.model_revision,
-            cache_dir=self.model_config.cache_dir,
-            use_auth_token=self.model_config.use_auth_token,
-            trust_remote_code=self.model_config.trust_remote_code
-        )
-        
-        # Configure attention implementation
-        if self.model_config.use_flash_attention:
-            config._attn_implementation = self.model_config.attn_implementation
-        
-        # Load model
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.model_config.model_name,
-            config=config,
-            revision=self.model_config.model_revision,
-            cache_dir=self.model_config.cache_dir,
-            use_auth_token=self.model_config.use_auth_token,
-            torch_dtype=torch_dtype,
-            device_map=self.model_config.device_map,
-            max_memory=self.model_config.max_memory,
-            offload_folder=self.model_config.offload_folder,
-            low_cpu_mem_usage=self.model_config.low_cpu_mem_usage,
-            trust_remote_code=self.model_config.trust_remote_code
-        )
-        
-        # Resize token embeddings if necessary
-        if len(self.tokenizer) != self.model.config.vocab_size:
-            logger.info(f"Resizing token embeddings from {self.model.config.vocab_size} to {len(self.tokenizer)}")
-            self.model.resize_token_embeddings(len(self.tokenizer))
-        
-        logger.info(f"Model loaded. Parameters: {self.model.num_parameters():,}")
-        
-    def setup_lora(self):
-        """Setup LoRA for parameter-efficient fine-tuning"""
-        logger.info("Setting up LoRA")
-        
-        # Prepare model for k-bit training if using quantization
-        self.model = prepare_model_for_kbit_training(self.model)
-        
-        # Configure LoRA
-        lora_config = LoraConfig(
-            r=self.lora_config.r,
-            lora_alpha=self.lora_config.lora_alpha,
-            target_modules=self.lora_config.target_modules,
-            lora_dropout=self.lora_config.lora_dropout,
-            bias=self.lora_config.bias,
-            task_type=TaskType.CAUSAL_LM,
-            inference_mode=self.lora_config.inference_mode,
-            modules_to_save=self.lora_config.modules_to_save
-        )
-        
-        # Apply LoRA
-        self.model = get_peft_model(self.model, lora_config)
-        
-        # Print trainable parameters
-        self.model.print_trainable_parameters()
-        
-        logger.info("LoRA setup complete")
-        
-    def create_datasets(self, train_data_path: str, eval_data_path: Optional[str] = None) -> Tuple[GPTOSSDataset, Optional[GPTOSSDataset]]:
-        """Create training and evaluation datasets"""
-        logger.info("Creating datasets")
-        
-        train_dataset = GPTOSSDataset(
-            train_data_path,
-            self.tokenizer,
-            max_length=self.training_config.max_length,
-            use_reasoning_tokens=self.training_config.use_reasoning_tokens,
-            reasoning_level=self.training_config.reasoning_level
-        )
-        
-        eval_dataset = None
-        if eval_data_path:
-            eval_dataset = GPTOSSDataset(
-                eval_data_path,
-                self.tokenizer,
-                max_length=self.training_config.max_length,
-                use_reasoning_tokens=self.training_config.use_reasoning_tokens,
-                reasoning_level=self.training_config.reasoning_level
-            )
-            logger.info(f"Created evaluation dataset with {len(eval_dataset)} examples")
-        
-        logger.info(f"Created training dataset with {len(train_dataset)} examples")
-        return train_dataset, eval_dataset
-    
-    def setup_trainer(self, train_dataset: GPTOSSDataset, eval_dataset: Optional[GPTOSSDataset] = None):
-        """Setup the Hugging Face trainer"""
-        logger.info("Setting up trainer")
-        
-        # Create training arguments
-        training_args = TrainingArguments(
-            output_dir=self.training_config.output_dir,
-            num_train_epochs=self.training_config.num_train_epochs,
-            per_device_train_batch_size=self.training_config.per_device_train_batch_size,
-            per_device_eval_batch_size=self.training_config.per_device_eval_batch_size,
-            gradient_accumulation_steps=self.training_config.gradient_accumulation_steps,
-            learning_rate=self.training_config.learning_rate,
-            weight_decay=self.training_config.weight_decay,
-            adam_beta1=self.training_config.adam_beta1,
-            adam_beta2=self.training_config.adam_beta2,
-            adam_epsilon=self.training_config.adam_epsilon,
-            max_grad_norm=self.training_config.max_grad_norm,
-            warmup_ratio=self.training_config.warmup_ratio,
-            lr_scheduler_type=self.training_config.lr_scheduler_type,
-            logging_steps=self.training_config.logging_steps,
-            eval_steps=self.training_config.eval_steps if eval_dataset else None,
-            save_steps=self.training_config.save_steps,
-            save_total_limit=self.training_config.save_total_limit,
-            evaluation_strategy=self.training_config.evaluation_strategy if eval_dataset else "no",
-            load_best_model_at_end=self.training_config.load_best_model_at_end if eval_dataset else False,
-            metric_for_best_model=self.training_config.metric_for_best_model,
-            greater_is_better=self.training_config.greater_is_better,
-            seed=self.training_config.seed,
-            fp16=self.training_config.fp16,
-            bf16=self.training_config.bf16,
-            dataloader_num_workers=self.training_config.dataloader_num_workers,
-            remove_unused_columns=self.training_config.remove_unused_columns,
-            report_to=self.training_config.report_to,
-            run_name=self.training_config.run_name or f"gpt-oss-120b-{int(time.time())}",
-            ddp_find_unused_parameters=False,
-            dataloader_pin_memory=False,
-        )
-        
-        # Data collator
-        data_collator = DataCollatorForLanguageModeling(
-            tokenizer=self.tokenizer,
-            mlm=False,
-        )
-        
-        # Create trainer
-        self.trainer = Trainer(
-            model=self.model,
-            args=training_args,
-            train_dataset=train_dataset,
-            eval_dataset=eval_dataset,
-            tokenizer=self.tokenizer,
-            data_collator=data_collator,
-        )
-        
-        logger.info("Trainer setup complete")
-    
-    def train(self):
-        """Start training"""
-        logger.info("Starting training")
-        
-        try:
-            # Start training
-            result = self.trainer.train()
-            
-            # Save final model
-            self.trainer.save_model()
-            
-            # Log results
-            logger.info(f"Training completed. Final loss: {result.training_loss:.4f}")
-            
-            return result
-            
-        except Exception as e:
-            logger.error(f"Training failed: {e}")
-            traceback.print_exc()
-            raise
-    
-    def evaluate(self) -> Dict[str, float]:
-        """Evaluate the model"""
-        if self.trainer is None:
-            raise ValueError("Trainer not initialized. Call setup_trainer first.")
-        
-        logger.info("Starting evaluation")
-        results = self.trainer.evaluate()
-        
-        for key, value in results.items():
-            logger.info(f"{key}: {value}")
-        
-        return results
-    
-    def save_model(self, path: str):
-        """Save the fine-tuned model"""
-        logger.info(f"Saving model to {path}")
-        
-        os.makedirs(path, exist_ok=True)
-        
-        # Save model and tokenizer
-        self.model.save_pretrained(path)
-        self.tokenizer.save_pretrained(path)
-        
-        # Save configuration
-        config = {
-            "model_config": self.model_config.__dict__,
-            "lora_config": self.lora_config.__dict__,
-            "training_config": self.training_config.__dict__
-        }
-        
-        with open(os.path.join(path, "fine_tuning_config.json"), "w") as f:
-            json.dump(config, f, indent=2)
-        
-        logger.info(f"Model saved to {path}")
-    
-    def load_finetuned_model(self, path: str):
-        """Load a fine-tuned model"""
-        logger.info(f"Loading fine-tuned model from {path}")
-        
-        # Load base model first
-        self.load_model()
-        
-        # Load PEFT model
-        self.model = PeftModel.from_pretrained(self.model, path)
-        
-        logger.info("Fine-tuned model loaded")
-    
-    def generate(
-        self,
-        prompt: str,
-        max_length: int = 512,
-        temperature: float = 0.7,
-        top_p: float = 0.9,
-        do_sample: bool = True,
-        reasoning_level: str = "medium"
-    ) -> str:
-        """Generate text using the fine-tuned model"""
-        if self.model is None or self.tokenizer is None:
-            raise ValueError("Model and tokenizer must be loaded first")
-        
-        # Format prompt with reasoning level
-        if self.training_config.use_reasoning_tokens:
-            formatted_prompt = f"<s>System: Reasoning: {reasoning_level}\n\nYou are a helpful AI assistant.\n\nUser: {prompt}\n\nAssistant:"
-        else:
-            formatted_prompt = f"<s>User: {prompt}\n\nAssistant:"
-        
-        # Tokenize
-        inputs = self.tokenizer(
-            formatted_prompt,
-            return_tensors="pt",
-            truncation=True,
-            max_length=self.training_config.max_length
-        )
-        
-        # Move to device
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
-        
-        # Generate
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                max_length=max_length,
-                temperature=temperature,
-                top_p=top_p,
-                do_sample=do_sample,
-                pad_token_id=self.tokenizer.pad_token_id,
-                eos_token_id=self.tokenizer.eos_token_id
-            )
-        
-        # Decode
-        generated = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        
-        # Extract assistant response
-        if "Assistant:" in generated:
-            response = generated.split("Assistant:")[-1].strip()
-        else:
-            response = generated
-        
-        return response
-    
-    def merge_and_unload(self) -> AutoModelForCausalLM:
-        """Merge LoRA weights and unload adapters"""
-        logger.info("Merging LoRA weights and unloading adapters")
-        
-        if not hasattr(self.model, 'merge_and_unload'):
-            raise ValueError("Model does not have LoRA adapters to merge")
-        
-        merged_model = self.model.merge_and_unload()
-        logger.info("LoRA weights merged successfully")
-        
-        return merged_model
+def __getattr__(name: str):
+    """Resolve the fine-tuning classes (GPTOSSFineTuner, ModelConfig, ...) lazily"""
+    if name.startswith("__"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import gptoss_finetune
+    try:
+        return getattr(gptoss_finetune, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
 
 
 def create_sample_data(output_path: str, num_samples: int = 100):
@@ -651,122 +97,388 @@ def create_sample_data(output_path: str, num_samples: int = 100):
     logger.info(f"Sample data saved to {output_path}")
 
 
-def main():
-    """Main function"""
-    parser = argparse.ArgumentParser(description="Fine-tune GPT-OSS-120B model")
-    parser.add_argument("--train_data", type=str, required=True, help="Path to training data (JSONL)")
-    parser.add_argument("--eval_data", type=str, help="Path to evaluation data (JSONL)")
-    parser.add_argument("--output_dir", type=str, default="./gpt-oss-120b-finetuned", help="Output directory")
-    parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
-    parser.add_argument("--epochs", type=int, default=3, help="Number of training epochs")
-    parser.add_argument("--batch_size", type=int, default=1, help="Per device batch size")
-    parser.add_argument("--learning_rate", type=float, default=2e-4, help="Learning rate")
-    parser.add_argument("--max_length", type=int, default=2048, help="Maximum sequence length")
-    parser.add_argument("--lora_r", type=int, default=16, help="LoRA r parameter")
-    parser.add_argument("--lora_alpha", type=int, default=32, help="LoRA alpha parameter")
-    parser.add_argument("--reasoning_level", type=str, default="medium", choices=["low", "medium", "high"])
-    parser.add_argument("--create_sample_data", type=str, help="Create sample data and save to this path")
-    parser.add_argument("--load_model", type=str, help="Load fine-tuned model from this path")
-    parser.add_argument("--interactive", action="store_true", help="Run interactive mode after training")
-    parser.add_argument("--wandb_project", type=str, default="gpt-oss-120b-finetune", help="W&B project name")
+def prepare_data(args):
+    """Write sample data and/or build the token cache for the given JSONL files"""
+    if not args.sample and not args.token_cache_dir:
+        raise ValueError("Nothing to do: pass --sample and/or --token_cache_dir")
     
-    args = parser.parse_args()
+    if args.sample:
+        create_sample_data(args.sample, args.num_samples)
+        logger.info("Sample data created successfully")
     
-    # Initialize wandb if using
-    if args.wandb_project:
-        wandb.init(project=args.wandb_project)
-    
-    try:
-        # Create sample data if requested
-        if args.create_sample_data:
-            create_sample_data(args.create_sample_data, 100)
-            logger.info("Sample data created successfully")
-            return
+    if args.token_cache_dir:
+        train_data = args.train_data or args.sample
+        if not train_data:
+            raise ValueError("--token_cache_dir needs --train_data")
         
-        # Configure the fine-tuner
-        model_config = ModelConfig(
-            model_name=args.model_name,
-            torch_dtype="bfloat16",
-            device_map="auto"
-        )
-        
-        lora_config = LoRAConfig(
-            r=args.lora_r,
-            lora_alpha=args.lora_alpha
-        )
+        from gptoss_finetune import ModelConfig, LoRAConfig, TrainingConfig, GPTOSSFineTuner
         
         training_config = TrainingConfig(
-            output_dir=args.output_dir,
-            num_train_epochs=args.epochs,
-            per_device_train_batch_size=args.batch_size,
-            learning_rate=args.learning_rate,
             max_length=args.max_length,
             reasoning_level=args.reasoning_level,
-            run_name=f"gpt-oss-120b-finetune-{int(time.time())}"
+            token_cache_dir=args.token_cache_dir,
+            preprocessing_num_workers=args.preprocessing_workers,
+            deduplicate=not args.no_dedup,
+            report_to="none"
         )
-        
-        # Initialize fine-tuner
-        fine_tuner = GPTOSSFineTuner(model_config, lora_config, training_config)
-        
-        # Load model if specified, otherwise train new model
-        if args.load_model:
-            fine_tuner.load_tokenizer()
-            fine_tuner.load_finetuned_model(args.load_model)
-            logger.info("Model loaded successfully")
-        else:
-            # Load tokenizer and model
-            fine_tuner.load_tokenizer()
-            fine_tuner.load_model()
-            fine_tuner.setup_lora()
-            
-            # Create datasets
-            train_dataset, eval_dataset = fine_tuner.create_datasets(args.train_data, args.eval_data)
-            
-            # Setup trainer
-            fine_tuner.setup_trainer(train_dataset, eval_dataset)
-            
-            # Train the model
-            fine_tuner.train()
-            
-            # Evaluate if eval data provided
-            if eval_dataset:
-                fine_tuner.evaluate()
+        fine_tuner = GPTOSSFineTuner(ModelConfig(model_name=args.model_name), LoRAConfig(), training_config)
+        fine_tuner.load_tokenizer()
+        train_dataset, eval_dataset = fine_tuner.create_datasets(train_data, args.eval_data)
+        logger.info(f"Token cache ready in {args.token_cache_dir}")
+        
+        stats = {"train": train_dataset.token_cache.metadata.get("preprocessing")}
+        if eval_dataset is not None:
+            stats["eval"] = eval_dataset.token_cache.metadata.get("preprocessing")
+        print(json.dumps(stats, indent=2))
+
+
+def train(args):
+    """Fine-tune, evaluate and save, optionally followed by an interactive session"""
+    from gptoss_finetune import ModelConfig, LoRAConfig, TrainingConfig, GPTOSSFineTuner
+    
+    # Tracking is opt-in; the Trainer's W&B callback starts the run when training begins
+    report_to = "none"
+    if args.wandb_project:
+        os.environ["WANDB_PROJECT"] = args.wandb_project
+        report_to = "wandb"
+    
+    # Configure the fine-tuner
+    model_config = ModelConfig(
+        model_name=args.model_name,
+        torch_dtype="bfloat16",
+        device_map=args.device_map,
+        attn_implementation=args.attn_implementation,
+        draft_model_name=args.draft_model,
+        num_speculative_tokens=args.num_speculative_tokens,
+        quantization=args.quantization,
+        quantization_backend=args.quantization_backend,
+        quant_compute_dtype=args.quant_compute_dtype,
+        quant_double_quant=not args.no_double_quant,
+        mmap_weights=args.mmap_weights,
+        mmap_cache_dir=args.mmap_cache_dir
+    )
+    
+    lora_config = LoRAConfig(
+        r=args.lora_r,
+        lora_alpha=args.lora_alpha,
+        target_modules=args.target_modules,
+        expert_lora=args.expert_lora,
+        hot_experts=args.hot_experts,
+        routing_stats=args.routing_stats
+    )
+    
+    training_config = TrainingConfig(
+        output_dir=args.output_dir,
+        num_train_epochs=args.epochs,
+        per_device_train_batch_size=args.batch_size,
+        learning_rate=args.learning_rate,
+        max_length=args.max_length,
+        reasoning_level=args.reasoning_level,
+        dynamic_padding=args.padding == "longest",
+        group_by_length=not args.no_group_by_length,
+        packing=args.packing,
+        packing_attention=args.packing_attention,
+        token_cache_dir=args.token_cache_dir,
+        preprocessing_num_workers=args.preprocessing_workers,
+        deduplicate=not args.no_dedup,
+        streaming=args.streaming,
+        shuffle_buffer_size=args.shuffle_buffer_size,
+        instrument_steps=args.instrument,
+        profile_start_step=args.profile_steps[0] if args.profile_steps else None,
+        profile_num_steps=args.profile_steps[1] if args.profile_steps else 3,
+        profile_on_signal=args.profile_on_signal,
+        save_steps=args.save_steps,
+        async_checkpointing=not args.sync_checkpoints,
+        resume_from_checkpoint=args.resume,
+        gradient_checkpointing=args.gradient_checkpointing or args.checkpoint_policy is not None,
+        checkpoint_policy=args.checkpoint_policy or "full",
+        checkpoint_every_n=args.checkpoint_every_n,
+        offload_activations=args.offload_activations,
+        optimizer=args.optimizer,
+        optimizer_offload=args.optimizer_offload,
+        chunked_loss=args.chunked_loss,
+        loss_chunk_size=args.loss_chunk_size,
+        sharding=args.sharding,
+        sharding_strategy=args.sharding_strategy,
+        sharding_cpu_offload=args.sharding_cpu_offload,
+        distributed_backend=args.distributed_backend,
+        generation_eval_data=args.generation_eval_data,
+        generation_eval_steps=args.generation_eval_steps,
+        generation_eval_max_examples=args.generation_eval_max_examples,
+        generation_eval_device_map=args.generation_eval_device_map,
+        log_routing=args.log_routing,
+        report_to=report_to,
+        run_name=f"gpt-oss-120b-finetune-{int(time.time())}"
+    )
+    
+    # Initialize fine-tuner
+    fine_tuner = GPTOSSFineTuner(model_config, lora_config, training_config)
+    
+    # Load tokenizer and model
+    fine_tuner.load_tokenizer()
+    fine_tuner.load_model()
+    fine_tuner.setup_lora()
+    
+    # Create datasets
+    train_dataset, eval_dataset = fine_tuner.create_datasets(args.train_data, args.eval_data)
+    
+    # Setup trainer
+    fine_tuner.setup_trainer(train_dataset, eval_dataset)
+    
+    # Train the model
+    fine_tuner.train()
+    
+    # Evaluate if eval data provided
+    if eval_dataset:
+        fine_tuner.evaluate()
+    
+    # Save the model
+    fine_tuner.save_model(args.output_dir)
+    
+    if args.interactive:
+        interactive_session(fine_tuner, args.reasoning_level)
+    
+    logger.info("Fine-tuning process completed successfully!")
+
+
+def generate(args):
+    """Answer --prompt, or start an interactive session, with a base or fine-tuned model"""
+    from gptoss_finetune import ModelConfig, LoRAConfig, TrainingConfig, GPTOSSFineTuner
+    
+    model_config = ModelConfig(
+        model_name=args.model_name,
+        torch_dtype="bfloat16",
+        device_map="auto",
+        attn_implementation=args.attn_implementation,
+        draft_model_name=args.draft_model,
+        num_speculative_tokens=args.num_speculative_tokens,
+        quantization=args.quantization,
+        quantization_backend=args.quantization_backend,
+        quant_compute_dtype=args.quant_compute_dtype,
+        quant_double_quant=not args.no_double_quant,
+        mmap_weights=args.mmap_weights,
+        mmap_cache_dir=args.mmap_cache_dir
+    )
+    fine_tuner = GPTOSSFineTuner(model_config, LoRAConfig(inference_mode=True), TrainingConfig(report_to="none"))
+    fine_tuner.load_tokenizer()
+    if args.load_model:
+        fine_tuner.load_finetuned_model(args.load_model)
+        logger.info("Model loaded successfully")
+    else:
+        fine_tuner.load_model()
+    
+    if args.prompt is None:
+        interactive_session(fine_tuner, args.reasoning_level, args.system_prompt)
+        return
+    
+    for chunk in fine_tuner.generate_stream(
+        args.prompt,
+        max_length=args.max_length,
+        temperature=args.temperature,
+        reasoning_level=args.reasoning_level,
+        system_prompt=args.system_prompt
+    ):
+        print(chunk, end="", flush=True)
+    print()
+
+
+def interactive_session(fine_tuner, reasoning_level: str = "medium", system_prompt: Optional[str] = None):
+    """Read prompts from stdin and stream the responses until 'quit'"""
+    logger.info("Entering interactive mode. Type 'quit' to exit.")
+    while True:
+        try:
+            prompt = input("\nUser: ").strip()
+            if prompt.lower() in ['quit', 'exit', 'q']:
+                break
             
-            # Save the model
-            fine_tuner.save_model(args.output_dir)
-        
-        # Interactive mode
-        if args.interactive:
-            logger.info("Entering interactive mode. Type 'quit' to exit.")
-            while True:
-                try:
-                    prompt = input("\nUser: ").strip()
-                    if prompt.lower() in ['quit', 'exit', 'q']:
-                        break
-                    
-                    if prompt:
-                        response = fine_tuner.generate(
-                            prompt,
-                            reasoning_level=args.reasoning_level,
-                            temperature=0.7
-                        )
-                        print(f"Assistant: {response}")
-                
-                except KeyboardInterrupt:
-                    break
-                except Exception as e:
-                    logger.error(f"Error during generation: {e}")
-        
-        logger.info("Fine-tuning process completed successfully!")
-        
+            if prompt:
+                print("Assistant: ", end="", flush=True)
+                for chunk in fine_tuner.generate_stream(
+                    prompt,
+                    reasoning_level=reasoning_level,
+                    system_prompt=system_prompt,
+                    temperature=0.7
+                ):
+                    print(chunk, end="", flush=True)
+                print()
+        
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            logger.error(f"Error during generation: {e}")
+
+
+def _legacy_argv(argv: List[str]) -> List[str]:
+    """Map the pre-subcommand flags onto prepare-data or train"""
+    if "--create_sample_data" in argv:
+        index = argv.index("--create_sample_data")
+        return ["prepare-data", "--sample"] + argv[index + 1:index + 2]
+    logger.warning("Running without a subcommand is deprecated; use 'python GptRoss.py train ...'")
+    if "--load_model" in argv:
+        # --load_model used to skip training and only chat with the loaded model
+        shared = {"--load_model", "--model_name", "--reasoning_level", "--draft_model", "--num_speculative_tokens"}
+        generate_argv = ["generate"]
+        for flag, value in zip(argv, argv[1:]):
+            if flag in shared:
+                generate_argv += [flag, value]
+        return generate_argv
+    return ["train"] + list(argv)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Fine-tune GPT-OSS-120B model")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    data_parser = subparsers.add_parser("prepare-data", help="Create sample data and pre-tokenize datasets")
+    data_parser.add_argument("--sample", type=str, help="Create sample data and save to this path")
+    data_parser.add_argument("--num_samples", type=int, default=100, help="Sample conversations to write")
+    data_parser.add_argument("--train_data", type=str, help="Training JSONL to pre-tokenize (default: the --sample file)")
+    data_parser.add_argument("--eval_data", type=str, help="Evaluation JSONL to pre-tokenize")
+    data_parser.add_argument("--token_cache_dir", type=str, help="Build the pre-tokenized, memory-mapped dataset cache here")
+    data_parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model whose tokenizer is used")
+    data_parser.add_argument("--max_length", type=int, default=2048, help="Maximum sequence length")
+    data_parser.add_argument("--reasoning_level", type=str, default="medium", choices=["low", "medium", "high"])
+    data_parser.add_argument("--preprocessing_workers", type=int, help="Processes used to build the token cache (default: all cores)")
+    data_parser.add_argument("--no_dedup", action="store_true", help="Keep exact duplicate conversations in the token cache")
+    
+    train_parser = subparsers.add_parser("train", help="Fine-tune with LoRA")
+    train_parser.add_argument("--train_data", type=str, required=True, help="Path to training data (JSONL)")
+    train_parser.add_argument("--eval_data", type=str, help="Path to evaluation data (JSONL)")
+    train_parser.add_argument("--output_dir", type=str, default="./gpt-oss-120b-finetuned", help="Output directory")
+    train_parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    train_parser.add_argument("--epochs", type=int, default=3, help="Number of training epochs")
+    train_parser.add_argument("--batch_size", type=int, default=1, help="Per device batch size")
+    train_parser.add_argument("--learning_rate", type=float, default=2e-4, help="Learning rate")
+    train_parser.add_argument("--max_length", type=int, default=2048, help="Maximum sequence length")
+    train_parser.add_argument("--lora_r", type=int, default=16, help="LoRA r parameter")
+    train_parser.add_argument("--lora_alpha", type=int, default=32, help="LoRA alpha parameter")
+    train_parser.add_argument("--target_modules", type=str, nargs="+", default=["auto"], help="Module names to wrap with LoRA ('auto': the attention and dense MLP projections found in the model)")
+    train_parser.add_argument("--expert_lora", type=str, default="none", choices=["none", "all", "hot"], help="Also adapt the MoE experts: all of them, or the most used ones per layer")
+    train_parser.add_argument("--hot_experts", type=int, default=4, help="Experts adapted per layer with --expert_lora hot")
+    train_parser.add_argument("--routing_stats", type=str, help="routing-stats output that picks the experts for --expert_lora hot")
+    train_parser.add_argument("--log_routing", action="store_true", help="Log router load imbalance and entropy, and save routing_stats.json with the adapter")
+    train_parser.add_argument("--reasoning_level", type=str, default="medium", choices=["low", "medium", "high"])
+    train_parser.add_argument("--padding", type=str, default="longest", choices=["longest", "max_length"], help="Pad batches to their longest sequence or to max_length")
+    train_parser.add_argument("--no_group_by_length", action="store_true", help="Disable length-grouped batching")
+    train_parser.add_argument("--packing", action="store_true", help="Pack several conversations into each max_length window")
+    train_parser.add_argument("--packing_attention", type=str, default="auto", choices=["auto", "position_ids", "block_mask"], help="How packed documents are isolated from each other")
+    train_parser.add_argument("--token_cache_dir", type=str, help="Directory for the pre-tokenized, memory-mapped dataset cache")
+    train_parser.add_argument("--preprocessing_workers", type=int, help="Processes used to build the token cache (default: all cores)")
+    train_parser.add_argument("--no_dedup", action="store_true", help="Keep exact duplicate conversations in the token cache")
+    train_parser.add_argument("--streaming", action="store_true", help="Stream the training JSONL from disk instead of loading it into memory")
+    train_parser.add_argument("--shuffle_buffer_size", type=int, default=10000, help="Shuffle buffer size for streaming mode")
+    train_parser.add_argument("--instrument", action="store_true", help="Record per-step forward/backward/optimizer/dataloader timings as JSON")
+    train_parser.add_argument("--profile_steps", type=int, nargs=2, metavar=("START", "NUM"), help="Capture a torch.profiler Chrome trace of NUM steps from step START")
+    train_parser.add_argument("--profile_on_signal", action="store_true", help="Capture a torch.profiler Chrome trace after SIGUSR1")
+    train_parser.add_argument("--save_steps", type=int, default=1000, help="Checkpoint every this many optimizer steps")
+    train_parser.add_argument("--sync_checkpoints", action="store_true", help="Write checkpoints on the training thread instead of in the background")
+    train_parser.add_argument("--resume", type=str, nargs="?", const="latest", help="Resume from this checkpoint, or from the newest one in --output_dir")
+    train_parser.add_argument("--device_map", type=str, default="auto", choices=["auto", "plan"], help="'plan' places layers with the memory planner")
+    train_parser.add_argument("--gradient_checkpointing", action="store_true", help="Recompute activations in the backward pass to save memory")
+    train_parser.add_argument("--checkpoint_policy", type=str, choices=["full", "every_n", "selective"], help="What to recompute (implies --gradient_checkpointing; default: full)")
+    train_parser.add_argument("--checkpoint_every_n", type=int, default=2, help="Recompute every n-th decoder layer with --checkpoint_policy every_n")
+    train_parser.add_argument("--offload_activations", action="store_true", help="Keep activations saved for backward in host memory")
+    train_parser.add_argument("--optimizer", type=str, default="adamw", choices=["adamw", "adamw_8bit"], help="adamw_8bit stores the optimizer moments as blockwise 8-bit codes")
+    train_parser.add_argument("--optimizer_offload", action="store_true", help="Keep optimizer state in host memory and run the update on the CPU")
+    train_parser.add_argument("--chunked_loss", action="store_true", help="Compute the LM head and loss in chunks instead of materializing full-vocabulary logits")
+    train_parser.add_argument("--loss_chunk_size", type=int, default=1024, help="Positions per chunk with --chunked_loss")
+    train_parser.add_argument("--sharding", type=str, default="none", choices=["none", "fsdp"], help="fsdp partitions parameters, gradients and optimizer state across torchrun ranks")
+    train_parser.add_argument("--sharding_strategy", type=str, default="full_shard", choices=["full_shard", "shard_grad_op", "hybrid_shard", "no_shard"], help="What --sharding fsdp partitions (full_shard: everything, ZeRO-3)")
+    train_parser.add_argument("--sharding_cpu_offload", action="store_true", help="Keep parameter shards in host memory between uses")
+    train_parser.add_argument("--distributed_backend", type=str, default="auto", choices=["auto", "nccl", "gloo"], help="Process group backend under torchrun (auto: nccl with GPUs, gloo without)")
+    train_parser.add_argument("--generation_eval_data", type=str, help="Eval JSONL scored by generation (exact match, tag format) in a background process during training")
+    train_parser.add_argument("--generation_eval_steps", type=int, default=500, help="Run the generation eval every this many optimizer steps")
+    train_parser.add_argument("--generation_eval_max_examples", type=int, help="Score only the first N examples of --generation_eval_data")
+    train_parser.add_argument("--generation_eval_device_map", type=str, help="Where the eval process loads its model copy, e.g. cpu or cuda:1 (default: --device_map)")
+    train_parser.add_argument("--attn_implementation", type=str, default="flash_attention_2", help="Attention implementation")
+    train_parser.add_argument("--draft_model", type=str, help="Small model sharing the tokenizer, used for speculative decoding")
+    train_parser.add_argument("--num_speculative_tokens", type=int, default=4, help="Tokens the draft model proposes per verification pass")
+    train_parser.add_argument("--quantization", type=str, choices=["int8", "nf4", "fp4"], help="Load the base model with weight-only quantization (QLoRA)")
+    train_parser.add_argument("--quantization_backend", type=str, default="auto", choices=["auto", "bitsandbytes", "reference"], help="bitsandbytes needs CUDA; reference runs anywhere")
+    train_parser.add_argument("--quant_compute_dtype", type=str, choices=["bfloat16", "float16", "float32"], help="Dtype quantized layers compute in (default: the model dtype)")
+    train_parser.add_argument("--no_double_quant", action="store_true", help="Keep the 4-bit block scales in full precision")
+    train_parser.add_argument("--mmap_weights", action="store_true", help="Map the base weights from safetensors, shared by all ranks on a node")
+    train_parser.add_argument("--mmap_cache_dir", type=str, help="With --mmap_weights, convert checkpoints that cannot be mapped as they are (other dtype, MXFP4) here once")
+    train_parser.add_argument("--interactive", action="store_true", help="Run interactive mode after training")
+    train_parser.add_argument("--wandb_project", type=str, help="Log to this W&B project (tracking is off without it)")
+    
+    generate_parser = subparsers.add_parser("generate", help="Generate from a base or fine-tuned model")
+    generate_parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    generate_parser.add_argument("--load_model", type=str, help="Load fine-tuned model from this path")
+    generate_parser.add_argument("--prompt", type=str, help="Prompt to answer (default: interactive mode)")
+    generate_parser.add_argument("--system_prompt", type=str, help="System prompt")
+    generate_parser.add_argument("--max_length", type=int, default=512, help="Maximum total length (prompt + generated tokens)")
+    generate_parser.add_argument("--temperature", type=float, default=0.7)
+    generate_parser.add_argument("--reasoning_level", type=str, default="medium", choices=["low", "medium", "high"])
+    generate_parser.add_argument("--attn_implementation", type=str, default="flash_attention_2", help="Attention implementation")
+    generate_parser.add_argument("--draft_model", type=str, help="Small model sharing the tokenizer, used for speculative decoding")
+    generate_parser.add_argument("--num_speculative_tokens", type=int, default=4, help="Tokens the draft model proposes per verification pass")
+    generate_parser.add_argument("--quantization", type=str, choices=["int8", "nf4", "fp4"], help="Load the base model with weight-only quantization (QLoRA)")
+    generate_parser.add_argument("--quantization_backend", type=str, default="auto", choices=["auto", "bitsandbytes", "reference"], help="bitsandbytes needs CUDA; reference runs anywhere")
+    generate_parser.add_argument("--quant_compute_dtype", type=str, choices=["bfloat16", "float16", "float32"], help="Dtype quantized layers compute in (default: the model dtype)")
+    generate_parser.add_argument("--no_double_quant", action="store_true", help="Keep the 4-bit block scales in full precision")
+    generate_parser.add_argument("--mmap_weights", action="store_true", help="Map the base weights from safetensors instead of copying them")
+    generate_parser.add_argument("--mmap_cache_dir", type=str, help="With --mmap_weights, convert checkpoints that cannot be mapped as they are (other dtype, MXFP4) here once")
+    
+    # Options (including --help) are parsed by gptoss_batch.py
+    subparsers.add_parser("batch-generate", add_help=False, help="Generate for a JSONL file of prompts in sorted, padded batches (see gptoss_batch.py --help)")
+    # Options (including --help) are parsed by gptoss_eval.py
+    subparsers.add_parser("evaluate", add_help=False, help="Score generated responses on an eval JSONL, with an output cache (see gptoss_eval.py --help)")
+    # Options (including --help) are parsed by gptoss_serving.py serve
+    subparsers.add_parser("serve", add_help=False, help="Start the continuous-batching HTTP server (see gptoss_serving.py serve --help)")
+    # Options (including --help) are parsed by gptoss_memory.py
+    subparsers.add_parser("plan-memory", add_help=False, help="Print a device_map/max_memory plan without loading weights (see gptoss_memory.py --help)")
+    # Options (including --help) are parsed by gptoss_export.py merge
+    subparsers.add_parser("export", add_help=False, help="Merge the adapter into the base checkpoint shard by shard (see gptoss_export.py merge --help)")
+    # Options (including --help) are parsed by gptoss_moe.py
+    subparsers.add_parser("routing-stats", add_help=False, help="Measure expert load and router entropy over a dataset (see gptoss_moe.py --help)")
+    
+    return parser
+
+
+def main(argv: Optional[List[str]] = None):
+    """Main function"""
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] not in COMMANDS and argv[0] not in ("-h", "--help"):
+        argv = _legacy_argv(argv)
+    
+    parser = build_parser()
+    args, extra = parser.parse_known_args(argv)
+    
+    if args.command == "serve":
+        import gptoss_serving
+        gptoss_serving.main(["serve"] + extra)
+        return
+    if args.command == "batch-generate":
+        import gptoss_batch
+        gptoss_batch.main(extra)
+        return
+    if args.command == "evaluate":
+        import gptoss_eval
+        gptoss_eval.main(extra)
+        return
+    if args.command == "plan-memory":
+        import gptoss_memory
+        gptoss_memory.main(extra)
+        return
+    if args.command == "export":
+        import gptoss_export
+        gptoss_export.main(["merge"] + extra)
+        return
+    if args.command == "routing-stats":
+        import gptoss_moe
+        gptoss_moe.main(extra)
+        return
+    if extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    
+    commands = {"prepare-data": prepare_data, "train": train, "generate": generate}
+    try:
+        commands[args.command](args)
     except Exception as e:
         logger.error(f"An error occurred: {e}")
         traceback.print_exc()
         sys.exit(1)
-    
-    finally:
-        if wandb.run:
-            wandb.finish()
 
 
 if __name__ == "__main__":
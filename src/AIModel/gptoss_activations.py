@@ -0,0 +1,129 @@
+"""
+Activation memory strategies for GPT-OSS LoRA fine-tuning.
+
+Recomputation trades a second forward pass through part of the model for not
+storing its activations until backward. The checkpoint policies choose which
+part:
+
+- ``full``: every decoder layer; only the layer inputs are kept
+- ``every_n``: every n-th decoder layer, the others keep their activations,
+  for a memory/time point between no recomputation and ``full``
+- ``selective``: only the named submodules of every layer (by default the
+  MLP, whose routed-expert activations dominate a GPT-OSS layer) while the
+  cheaper attention activations are kept
+
+Activation offload keeps large tensors saved for backward in host memory from
+the forward pass until backward uses them. Recomputed regions only keep their
+inputs, so offload mostly helps the layers that are not recomputed; combine it
+with ``every_n`` or ``selective``, or use it without recomputation.
+
+All recomputation uses non-reentrant torch.utils.checkpoint, which propagates
+gradients to the LoRA weights even though the frozen embeddings produce inputs
+that do not require grad.
+"""
+
+import logging
+from functools import partial
+from typing import Dict, Iterable, List
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+from transformers.modeling_layers import GradientCheckpointingLayer
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_POLICIES = ("full", "every_n", "selective")
+
+
+def decoder_layers(model: nn.Module) -> List[nn.Module]:
+    """The model's decoder layers, in order"""
+    return [module for module in model.modules() if isinstance(module, GradientCheckpointingLayer)]
+
+
+def _recomputed_forward(module: nn.Module):
+    forward = module.forward
+    
+    def forward_with_recompute(*args, **kwargs):
+        if module.training and torch.is_grad_enabled():
+            return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+        return forward(*args, **kwargs)
+    
+    return forward_with_recompute
+
+
+def apply_checkpoint_policy(
+    model: nn.Module,
+    policy: str = "full",
+    every_n: int = 2,
+    modules: Iterable[str] = ("mlp",)
+) -> int:
+    """Turn on recomputation in ``model`` according to ``policy``; returns the number of recomputed modules
+    
+    ``every_n`` recomputes layers 0, n, 2n, ...; ``modules`` names the
+    children of each decoder layer that ``selective`` recomputes.
+    """
+    if policy not in CHECKPOINT_POLICIES:
+        raise ValueError(f"Unknown checkpoint policy {policy!r}, expected one of {CHECKPOINT_POLICIES}")
+    layers = decoder_layers(model)
+    if not layers:
+        raise ValueError(f"{type(model).__name__} has no decoder layers that support gradient checkpointing")
+    
+    if policy == "selective":
+        modules = set(modules)
+        count = 0
+        for layer in layers:
+            for name, child in layer.named_children():
+                if name in modules and not getattr(child, "_recomputed", False):
+                    child.forward = _recomputed_forward(child)
+                    child._recomputed = True
+                    count += 1
+        if not count:
+            raise ValueError(f"No decoder layer has a child named one of {sorted(modules)}")
+        return count
+    
+    selected = layers if policy == "full" else layers[::max(1, every_n)]
+    checkpoint_func = partial(checkpoint, use_reentrant=False)
+    for layer in selected:
+        layer.gradient_checkpointing = True
+        layer._gradient_checkpointing_func = checkpoint_func
+    return len(selected)
+
+
+class ActivationOffload:
+    """saved_tensors_hooks that move large activations to host memory until backward
+    
+    Only tensors on an accelerator that are part of the gradient path and at
+    least ``min_bytes`` large are moved; frozen weights saved by the base
+    model's layers stay where they are. On a CPU-only machine nothing moves.
+    
+    Usage::
+        
+        with offload.hooks():
+            loss = model(**batch).loss
+        loss.backward()
+    """
+    
+    def __init__(self, min_bytes: int = 1024 * 1024, pin_memory: bool = True):
+        self.min_bytes = min_bytes
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.stats: Dict[str, int] = {"offloaded_tensors": 0, "offloaded_bytes": 0}
+    
+    def _pack(self, tensor: torch.Tensor):
+        num_bytes = tensor.numel() * tensor.element_size()
+        if tensor.device.type == "cpu" or not tensor.requires_grad or num_bytes < self.min_bytes:
+            return tensor
+        host = torch.empty(tensor.size(), dtype=tensor.dtype, layout=tensor.layout, pin_memory=self.pin_memory)
+        host.copy_(tensor, non_blocking=self.pin_memory)
+        self.stats["offloaded_tensors"] += 1
+        self.stats["offloaded_bytes"] += num_bytes
+        return tensor.device, host
+    
+    def _unpack(self, packed):
+        if isinstance(packed, tuple):
+            device, host = packed
+            return host.to(device, non_blocking=self.pin_memory)
+        return packed
+    
+    def hooks(self) -> torch.autograd.graph.saved_tensors_hooks:
+        return torch.autograd.graph.saved_tensors_hooks(self._pack, self._unpack)
@@ -0,0 +1,167 @@
+"""
+Multi-LoRA adapter registry for GPT-OSS fine-tunes.
+
+One copy of the base model serves any number of LoRA fine-tunes. Adapters are
+registered by name and path, loaded on first use and evicted least recently
+used once more than ``max_loaded`` are resident. Adapters that in-flight
+requests hold are pinned and never evicted. Requests without an adapter use
+the registry's default adapter (the one load_finetuned_model loaded, or the
+bare base model), which is reloaded if it was evicted, so eviction never
+changes what they run through. Selecting an adapter, for a single
+request or per row of a mixed batch through PEFT's ``adapter_names`` forward
+argument, only picks between small LoRA matrices and never reloads the base
+weights.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from peft import PeftModel
+
+from gptoss_moe import load_expert_lora
+
+logger = logging.getLogger(__name__)
+
+# Name PEFT accepts in ``adapter_names`` for rows that should use the bare base model
+BASE_ADAPTER = "__base__"
+
+
+class AdapterRegistry:
+    """Loads, pins and evicts LoRA adapters on top of a fine-tuner's base model
+    
+    The fine-tuner's ``model`` is wrapped in a ``PeftModel`` the first time an
+    adapter is loaded; later adapters are added to that same wrapper.
+    """
+    
+    def __init__(self, fine_tuner, max_loaded: int = 8):
+        if max_loaded < 1:
+            raise ValueError("max_loaded must be at least 1")
+        self.fine_tuner = fine_tuner
+        self.max_loaded = max_loaded
+        self._paths: Dict[str, str] = {}
+        # Loaded adapters in least- to most-recently used order, with their pin counts
+        self._loaded: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._stats = {"loads": 0, "evictions": 0, "hits": 0, "load_time_s": 0.0}
+        # Adapter of requests that name none; BASE_ADAPTER for the bare base model
+        self.default = BASE_ADAPTER
+        
+        # Adapters that are already on the model (e.g. from load_finetuned_model) count as loaded
+        if isinstance(fine_tuner.model, PeftModel):
+            for name in fine_tuner.model.peft_config:
+                self._loaded[name] = 0
+            self.default = fine_tuner.model.active_adapter
+    
+    @property
+    def names(self) -> List[str]:
+        return list(self._paths)
+    
+    @property
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._loaded)
+    
+    def register(self, name: str, path: str):
+        """Make an adapter available under ``name``; it is loaded on first use"""
+        if name == BASE_ADAPTER:
+            raise ValueError(f"{BASE_ADAPTER} is reserved for the base model")
+        with self._lock:
+            if name in self._loaded and self._paths.get(name) != path:
+                raise ValueError(f"Adapter {name} is already loaded from a different path")
+            self._paths[name] = path
+    
+    def set_default(self, name: str):
+        """Use adapter ``name`` (registered, or BASE_ADAPTER) for requests that name none"""
+        with self._lock:
+            if name != BASE_ADAPTER and name not in self._paths and name not in self._loaded:
+                raise KeyError(f"Unknown adapter: {name}")
+            self.default = name
+    
+    def resolve(self, name: Optional[str]) -> str:
+        """Map a request's adapter (None meaning the default) to the name PEFT uses"""
+        return self.default if name is None else name
+    
+    def acquire(self, name: Optional[str]) -> str:
+        """Load the adapter if needed and pin it until release(); returns the resolved name"""
+        name = self.resolve(name)
+        if name == BASE_ADAPTER:
+            return name
+        
+        with self._lock:
+            if name in self._loaded:
+                self._stats["hits"] += 1
+            else:
+                if name not in self._paths:
+                    raise KeyError(f"Unknown adapter: {name}")
+                self._load(name)
+            self._loaded[name] += 1
+            self._loaded.move_to_end(name)
+            self._evict()
+        return name
+    
+    def release(self, name: str):
+        if name == BASE_ADAPTER:
+            return
+        with self._lock:
+            if self._loaded.get(name, 0) > 0:
+                self._loaded[name] -= 1
+    
+    def forward_kwargs(self, names: List[str]) -> Dict[str, Any]:
+        """Extra model arguments that route each batch row through its own adapter"""
+        model = self.fine_tuner.model
+        if not isinstance(model, PeftModel):
+            return {}
+        # The active adapter needs no routing; mixed batches are split per adapter by PEFT
+        if all(name == model.active_adapter for name in names):
+            return {}
+        return {"adapter_names": list(names)}
+    
+    def _load(self, name: str):
+        path = self._paths[name]
+        start = time.perf_counter()
+        model = self.fine_tuner.model
+        # Expert LoRA blocks are not a PEFT target type; install them so PEFT finds their weights
+        load_expert_lora(model, path, name)
+        if isinstance(model, PeftModel):
+            model.load_adapter(path, adapter_name=name, is_trainable=False)
+        else:
+            self.fine_tuner.model = PeftModel.from_pretrained(model, path, adapter_name=name, is_trainable=False)
+        self.fine_tuner.model.eval()
+        elapsed = time.perf_counter() - start
+        
+        self._loaded[name] = 0
+        self._stats["loads"] += 1
+        self._stats["load_time_s"] += elapsed
+        logger.info(f"Loaded adapter {name} from {path} in {elapsed * 1000:.1f} ms")
+    
+    def _evict(self):
+        """Delete least recently used, unpinned adapters until within budget"""
+        model = self.fine_tuner.model
+        while len(self._loaded) > self.max_loaded:
+            victim = next((name for name, pins in self._loaded.items() if pins == 0), None)
+            if victim is None:
+                logger.warning(f"All {len(self._loaded)} loaded adapters are in use; exceeding max_loaded={self.max_loaded}")
+                return
+            if victim == model.active_adapter:
+                # PEFT cannot delete the active adapter. Requests are routed by name, so which one is active only
+                # saves the routing for its own rows
+                model.set_adapter(next(reversed(self._loaded)))
+            model.delete_adapter(victim)
+            del self._loaded[victim]
+            self._stats["evictions"] += 1
+            logger.info(f"Evicted adapter {victim}")
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "registered": len(self._paths),
+                "loaded": list(self._loaded),
+                "pinned": {name: pins for name, pins in self._loaded.items() if pins},
+                "max_loaded": self.max_loaded,
+                "default": self.default,
+            })
+        return stats
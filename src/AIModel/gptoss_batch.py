@@ -0,0 +1,345 @@
+"""
+Offline batched inference over JSONL prompt files.
+
+Prompts are read in windows, sorted by token length within each window and
+cut into left-padded batches, so batches pad little and the model generates
+for a whole batch at once instead of one prompt at a time. Results go to the
+output JSONL in input order through a reorder buffer. A progress file next to
+the output records how many results are safely on disk, so an interrupted run
+picks up where it stopped.
+
+Input lines need a "prompt" (or "user") field and may set "system",
+"reasoning_level" and "id". Each output line carries the input index and id,
+the response, token counts and the finish reason ("stop" or "length"); lines
+that cannot be read produce an "error" instead.
+
+Usage:
+    python gptoss_batch.py --load_model ./gpt-oss-120b-finetuned --input prompts.jsonl --output responses.jsonl --batch_size 32
+    python GptRoss.py batch-generate --load_model ./gpt-oss-120b-finetuned --input prompts.jsonl --output responses.jsonl  # same
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import traceback
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_SUFFIX = ".progress.json"
+
+
+@dataclass
+class BatchInferenceConfig:
+    """Batching and sampling settings for run_batch_inference"""
+    batch_size: int = 16
+    max_batch_tokens: Optional[int] = None  # cap on rows x (longest prompt + max_new_tokens) per batch
+    sort_window: int = 4096  # prompts read and sorted by length together
+    max_new_tokens: int = 256
+    temperature: float = 0.7
+    top_p: float = 0.9
+    do_sample: bool = True
+    reasoning_level: str = "medium"  # for lines without a "reasoning_level" field
+    system_prompt: Optional[str] = None  # for lines without a "system" field
+    adapter_name: Optional[str] = None
+    resume: bool = True
+
+
+class ReorderBuffer:
+    """Holds results that finished out of order until every earlier one is done"""
+    
+    def __init__(self, next_index: int = 0):
+        self.next_index = next_index
+        self._pending: Dict[int, Dict[str, Any]] = {}
+    
+    def __len__(self) -> int:
+        return len(self._pending)
+    
+    def add(self, index: int, record: Dict[str, Any]):
+        self._pending[index] = record
+    
+    def pop_ready(self) -> List[Dict[str, Any]]:
+        """Results that can be written now, in input order"""
+        ready = []
+        while self.next_index in self._pending:
+            ready.append(self._pending.pop(self.next_index))
+            self.next_index += 1
+        return ready
+
+
+def progress_path(output_path: str) -> str:
+    return output_path + PROGRESS_SUFFIX
+
+
+def _input_fingerprint(input_path: str) -> Dict[str, Any]:
+    stat = os.stat(input_path)
+    return {"path": os.path.abspath(input_path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _save_progress(output_path: str, progress: Dict[str, Any]):
+    tmp_path = progress_path(output_path) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path(output_path))
+
+
+def _load_progress(input_path: str, output_path: str, config: BatchInferenceConfig) -> Optional[Dict[str, Any]]:
+    """Progress of an earlier run with the same input, or None to start over"""
+    if not config.resume or not os.path.isfile(progress_path(output_path)) or not os.path.isfile(output_path):
+        return None
+    with open(progress_path(output_path)) as f:
+        progress = json.load(f)
+    if progress["input"] != _input_fingerprint(input_path):
+        raise ValueError(f"{input_path} changed since {output_path} was started; remove {progress_path(output_path)} or disable resume")
+    if progress["config"] != asdict(config):
+        logger.warning(f"Resuming {output_path} with different settings than it was started with")
+    return progress
+
+
+def read_prompts(input_path: str, start: int = 0) -> Iterator[Tuple[int, Optional[Dict[str, Any]], Optional[str]]]:
+    """Yield (index, item, error) for every non-empty line from the ``start``-th on"""
+    index = 0
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if index >= start:
+                try:
+                    item = json.loads(line)
+                    if not isinstance(item, dict) or not isinstance(item.get("prompt", item.get("user")), str):
+                        raise ValueError("expected an object with a 'prompt' or 'user' string")
+                    yield index, item, None
+                except ValueError as e:
+                    yield index, None, f"Invalid line: {e}"
+            index += 1
+
+
+def make_batches(lengths: List[Tuple[int, int]], config: BatchInferenceConfig) -> List[List[int]]:
+    """Group (index, prompt length) pairs into batches of similar length, longest first
+    
+    Starting with the longest prompts makes a batch that does not fit in
+    memory fail at the beginning of a window rather than at its end.
+    """
+    batches: List[List[int]] = []
+    width = 0
+    for index, length in sorted(lengths, key=lambda pair: pair[1], reverse=True):
+        batch = batches[-1] if batches else None
+        fits = batch is not None and len(batch) < config.batch_size and (
+            config.max_batch_tokens is None
+            or (len(batch) + 1) * (width + config.max_new_tokens) <= config.max_batch_tokens
+        )
+        if fits:
+            batch.append(index)
+        else:
+            batches.append([index])
+            width = length
+    return batches
+
+
+def run_batch_inference(
+    fine_tuner,
+    input_path: str,
+    output_path: str,
+    config: Optional[BatchInferenceConfig] = None
+) -> Dict[str, Any]:
+    """Generate a response for every prompt in ``input_path`` and write them to ``output_path``
+    
+    ``fine_tuner`` is a GPTOSSFineTuner with its model and tokenizer loaded.
+    Returns throughput statistics for the prompts processed by this call.
+    """
+    config = config or BatchInferenceConfig()
+    if fine_tuner.model is None or fine_tuner.tokenizer is None:
+        raise ValueError("Model and tokenizer must be loaded first")
+    
+    progress = _load_progress(input_path, output_path, config)
+    if progress is not None:
+        completed = progress["completed"]
+        with open(output_path, "r+b") as f:
+            # Drop anything written after the last recorded progress
+            f.truncate(progress["output_bytes"])
+        logger.info(f"Resuming {output_path} after {completed} results")
+    else:
+        completed = 0
+        progress = {"input": _input_fingerprint(input_path), "config": asdict(config), "completed": 0, "output_bytes": 0}
+        open(output_path, "w").close()
+    
+    stats = {
+        "prompts": 0,
+        "batches": 0,
+        "errors": 0,
+        "prompt_tokens": 0,
+        "padded_prompt_tokens": 0,
+        "completion_tokens": 0,
+        "generate_s": 0.0,
+    }
+    buffer = ReorderBuffer(completed)
+    start = time.perf_counter()
+    adapter_name = fine_tuner._acquire_adapter(config.adapter_name)
+    try:
+        with open(output_path, "a", encoding="utf-8") as output:
+            
+            def write_ready():
+                for record in buffer.pop_ready():
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                os.fsync(output.fileno())
+                progress["completed"] = buffer.next_index
+                progress["output_bytes"] = output.tell()
+                _save_progress(output_path, progress)
+            
+            prompts = read_prompts(input_path, completed)
+            while True:
+                window = []
+                for entry in prompts:
+                    window.append(entry)
+                    if len(window) >= config.sort_window:
+                        break
+                if not window:
+                    break
+                
+                encoded = {}
+                for index, item, error in window:
+                    if error is not None:
+                        buffer.add(index, {"index": index, "error": error})
+                        stats["errors"] += 1
+                        continue
+                    encoded[index] = (item, fine_tuner._encode_generation_prompt(
+                        item.get("prompt", item.get("user")),
+                        item.get("reasoning_level", config.reasoning_level),
+                        item.get("system", config.system_prompt)
+                    ))
+                
+                for batch in make_batches([(index, len(ids)) for index, (_, ids) in encoded.items()], config):
+                    batch_ids = [encoded[index][1] for index in batch]
+                    batch_start = time.perf_counter()
+                    results = fine_tuner._generate_batch_ids(
+                        batch_ids,
+                        max_new_tokens=config.max_new_tokens,
+                        temperature=config.temperature,
+                        top_p=config.top_p,
+                        do_sample=config.do_sample,
+                        adapter_name=adapter_name
+                    )
+                    stats["generate_s"] += time.perf_counter() - batch_start
+                    stats["batches"] += 1
+                    stats["prompt_tokens"] += sum(len(ids) for ids in batch_ids)
+                    stats["padded_prompt_tokens"] += len(batch_ids) * max(len(ids) for ids in batch_ids)
+                    
+                    for index, ids, (completion, finish_reason) in zip(batch, batch_ids, results):
+                        item = encoded[index][0]
+                        buffer.add(index, {
+                            "index": index,
+                            "id": item.get("id"),
+                            "response": fine_tuner.tokenizer.decode(completion, skip_special_tokens=True).strip(),
+                            "prompt_tokens": len(ids),
+                            "completion_tokens": len(completion),
+                            "finish_reason": finish_reason,
+                        })
+                        stats["prompts"] += 1
+                        stats["completion_tokens"] += len(completion)
+                    write_ready()
+                write_ready()
+                
+                elapsed = time.perf_counter() - start
+                logger.info(
+                    f"{buffer.next_index} results written, {stats['prompts'] / elapsed:.2f} prompts/s, "
+                    f"{stats['completion_tokens'] / elapsed:.1f} generated tokens/s"
+                )
+    finally:
+        fine_tuner._release_adapter(adapter_name)
+    
+    elapsed = time.perf_counter() - start
+    stats.update({
+        "completed": buffer.next_index,
+        "elapsed_s": elapsed,
+        "prompts_per_s": stats["prompts"] / elapsed if elapsed else 0.0,
+        "completion_tokens_per_s": stats["completion_tokens"] / elapsed if elapsed else 0.0,
+        "padding_efficiency": stats["prompt_tokens"] / stats["padded_prompt_tokens"] if stats["padded_prompt_tokens"] else 1.0,
+    })
+    return stats
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Generate responses for a JSONL file of prompts in sorted, padded batches")
+    parser.add_argument("--input", type=str, required=True, help="JSONL with 'prompt' or 'user' fields")
+    parser.add_argument("--output", type=str, required=True, help="JSONL the responses are written to, in input order")
+    parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    parser.add_argument("--load_model", type=str, help="Load fine-tuned adapters from this path")
+    parser.add_argument("--adapter", type=str, metavar="NAME=PATH", help="Generate with this LoRA adapter")
+    parser.add_argument("--merge", action="store_true", help="Merge LoRA weights into the base model first")
+    parser.add_argument("--torch_dtype", type=str, default="bfloat16", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--attn_implementation", type=str, default="flash_attention_2", help="Attention implementation")
+    parser.add_argument("--quantization", type=str, choices=["int8", "nf4", "fp4"], help="Load the base model with weight-only quantization")
+    parser.add_argument("--quantization_backend", type=str, default="auto", choices=["auto", "bitsandbytes", "reference"], help="bitsandbytes needs CUDA; reference runs anywhere")
+    parser.add_argument("--mmap_weights", action="store_true", help="Map the base weights from safetensors, shared by all jobs on a node")
+    parser.add_argument("--mmap_cache_dir", type=str, help="With --mmap_weights, convert checkpoints that cannot be mapped as they are (other dtype, MXFP4) here once")
+    parser.add_argument("--batch_size", type=int, default=16, help="Prompts generated together")
+    parser.add_argument("--max_batch_tokens", type=int, help="Cap on batch rows x (longest prompt + max_new_tokens)")
+    parser.add_argument("--sort_window", type=int, default=4096, help="Prompts read and sorted by length together")
+    parser.add_argument("--max_prompt_length", type=int, default=2048, help="Prompts are truncated to this many tokens")
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--top_p", type=float, default=0.9)
+    parser.add_argument("--greedy", action="store_true", help="Decode greedily instead of sampling")
+    parser.add_argument("--reasoning_level", type=str, default="medium", choices=["low", "medium", "high"])
+    parser.add_argument("--system_prompt", type=str, help="System prompt for lines without a 'system' field")
+    parser.add_argument("--no_resume", action="store_true", help="Start over even if the output has progress to resume")
+    args = parser.parse_args(argv)
+    
+    from gptoss_finetune import ModelConfig, LoRAConfig, TrainingConfig, GPTOSSFineTuner
+    
+    try:
+        model_config = ModelConfig(
+            model_name=args.model_name,
+            torch_dtype=args.torch_dtype,
+            attn_implementation=args.attn_implementation,
+            prefix_cache_mb=0,
+            quantization=args.quantization,
+            quantization_backend=args.quantization_backend,
+            mmap_weights=args.mmap_weights,
+            mmap_cache_dir=args.mmap_cache_dir
+        )
+        training_config = TrainingConfig(max_length=args.max_prompt_length, report_to="none")
+        fine_tuner = GPTOSSFineTuner(model_config, LoRAConfig(inference_mode=True), training_config)
+        fine_tuner.load_tokenizer()
+        if args.load_model:
+            fine_tuner.load_finetuned_model(args.load_model)
+            if args.merge:
+                fine_tuner.model = fine_tuner.merge_and_unload()
+        else:
+            fine_tuner.load_model()
+        adapter_name = None
+        if args.adapter:
+            adapter_name, sep, path = args.adapter.partition("=")
+            if not sep:
+                raise ValueError(f"--adapter expects NAME=PATH, got {args.adapter}")
+            fine_tuner.register_adapter(adapter_name, path)
+        fine_tuner.model.eval()
+        
+        config = BatchInferenceConfig(
+            batch_size=args.batch_size,
+            max_batch_tokens=args.max_batch_tokens,
+            sort_window=args.sort_window,
+            max_new_tokens=args.max_new_tokens,
+            temperature=args.temperature,
+            top_p=args.top_p,
+            do_sample=not args.greedy,
+            reasoning_level=args.reasoning_level,
+            system_prompt=args.system_prompt,
+            adapter_name=adapter_name,
+            resume=not args.no_resume
+        )
+        stats = run_batch_inference(fine_tuner, args.input, args.output, config)
+        print(json.dumps(stats, indent=2))
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1201 @@
+"""
+Training-loop benchmark for GPT-OSS fine-tuning.
+
+Runs a fixed number of optimizer steps through GPTOSSFineTuner, with the same
+datasets, collators, sampler and Trainer a real run uses, and reports
+throughput, step-time percentiles, dataloader wait and peak memory. Results
+are written as JSON together with the configuration and git commit, so runs
+can be compared across commits and settings (padding, packing, LoRA targets).
+
+The activations benchmark runs the same training loop once per activation
+memory strategy (recomputation policy, activation offload), each in a fresh
+process so peak memory is not shared, and reports memory against step time.
+The optimizers benchmark does the same for the optimizer configurations
+(8-bit moments, CPU offload) and also reports where the optimizer state lives.
+
+The weights benchmark starts several worker processes on the same base model,
+one after another and kept alive together like DDP ranks or server replicas,
+once with from_pretrained and once with memory-mapped weights, and reports
+each worker's startup time and host memory (RSS, and PSS, which splits pages
+shared between the workers).
+
+The batch-inference benchmark runs gptoss_batch over the same prompts at
+several batch sizes and reports how prompt and token throughput scale.
+
+The distributed check trains the tiny model for a few steps with several
+torchrun ranks (gloo by default, so it runs on one CPU machine) and in a
+single process with the same global batch, and fails unless the logged loss
+and gradient norm of every step agree.
+
+The adapters check loads a fine-tune as the default adapter with room for
+a single resident adapter, generates through a second adapter so the default
+is evicted, and fails unless generation without an adapter is unchanged.
+
+The startup benchmark times CLI invocations in fresh interpreters and records
+which heavy libraries each one imported, so that commands which need no model
+stay fast.
+
+Usage:
+    # CPU-sized model with the GPT-OSS architecture on synthetic data
+    python gptoss_benchmark.py run --tiny --steps 30 --output bench.json
+    # The real model on real data
+    python gptoss_benchmark.py run --model_name openai/gpt-oss-120b --train_data data.jsonl --steps 50 --output bench.json
+    # Memory vs step time of the gradient checkpointing and offload strategies
+    python gptoss_benchmark.py activations --tiny --batch_size 8 --max_length 512 --output activations.json
+    # Memory vs step time of 8-bit and offloaded optimizer state
+    python gptoss_benchmark.py optimizers --tiny --lora_r 64 --output optimizers.json
+    # Startup time and host memory per worker, copied vs memory-mapped weights
+    python gptoss_benchmark.py weights --model_name ./gpt-oss-20b --workers 4 --output weights.json
+    # Offline generation throughput per batch size
+    python gptoss_benchmark.py batch-inference --tiny --batch_sizes 1 4 16 --output batch.json
+    # Loss and gradient norm of 2 gloo ranks against one process (exits 1 on a mismatch)
+    python gptoss_benchmark.py distributed --world_size 2 --sharding none
+    # Generation without an adapter survives evicting the default adapter (exits 1 otherwise)
+    python gptoss_benchmark.py adapters
+    # CLI startup time and imported libraries per subcommand
+    python gptoss_benchmark.py startup --repeats 5 --output startup.json
+    # Compare two result files
+    python gptoss_benchmark.py compare base.json candidate.json
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional
+
+import torch
+import transformers
+from transformers import TrainerCallback
+
+from GptRoss import create_sample_data
+from gptoss_finetune import ModelConfig, LoRAConfig, TrainingConfig, GPTOSSFineTuner
+from gptoss_profiling import TimedDataLoader, percentiles
+from gptoss_mmap import memory_usage
+from gptoss_batch import BatchInferenceConfig, run_batch_inference
+from gptoss_optim import optimizer_state_memory
+
+logger = logging.getLogger(__name__)
+
+# Tokenizer and model sizes of the --tiny configuration
+TINY_VOCAB_SIZE = 1000
+TINY_MODEL_KWARGS = {
+    "hidden_size": 64,
+    "intermediate_size": 64,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 4,
+    "num_key_value_heads": 2,
+    "head_dim": 16,
+    "num_local_experts": 4,
+    "num_experts_per_tok": 2,
+    "sliding_window": 128,
+    "layer_types": ["sliding_attention", "full_attention"],
+}
+
+
+def build_tiny_model(output_dir: str, data_path: str) -> str:
+    """Save a tokenizer trained on ``data_path`` and a randomly initialized tiny GPT-OSS model"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import AutoModelForCausalLM, GptOssConfig, PreTrainedTokenizerFast
+    
+    with open(data_path, "r", encoding="utf-8") as f:
+        texts = [" ".join(str(value) for value in json.loads(line).values()) for line in f if line.strip()]
+    
+    special_tokens = ["<pad>", "<s>", "</s>", "<unk>"]
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(texts, trainers.BpeTrainer(
+        vocab_size=TINY_VOCAB_SIZE,
+        special_tokens=special_tokens,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    ))
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<pad>",
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+        model_input_names=["input_ids", "attention_mask"]
+    )
+    
+    torch.manual_seed(0)
+    model = AutoModelForCausalLM.from_config(GptOssConfig(vocab_size=len(tokenizer), **TINY_MODEL_KWARGS))
+    model.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    return output_dir
+
+
+class BenchmarkCallback(TrainerCallback):
+    """Collects per-optimizer-step wall time, dataloader wait and token counts
+    
+    A step spans from the end of the previous optimizer step to the end of this
+    one, so it includes the batch fetches the Trainer does before the forward
+    pass. The first ``warmup_steps`` steps are excluded from the summary.
+    """
+    
+    def __init__(self, pad_token_id: Optional[int], warmup_steps: int = 3):
+        self.pad_token_id = pad_token_id
+        self.warmup_steps = warmup_steps
+        self.steps: List[Dict[str, float]] = []
+        self._reset_step()
+        self._last_step_end = None
+    
+    def _reset_step(self):
+        self._wait = 0.0
+        self._tokens = 0
+        self._padded_tokens = 0
+        self._samples = 0
+    
+    def wrap(self, trainer):
+        """Route the trainer's training dataloader through the batch timer"""
+        get_train_dataloader = trainer.get_train_dataloader
+        trainer.get_train_dataloader = lambda: TimedDataLoader(get_train_dataloader(), self.record_batch)
+    
+    def record_batch(self, batch: Dict[str, torch.Tensor], wait: float):
+        input_ids = batch["input_ids"]
+        attention_mask = batch.get("attention_mask")
+        if attention_mask is not None and attention_mask.dim() == 2:
+            tokens = int(attention_mask.sum())
+        elif self.pad_token_id is not None:
+            tokens = int((input_ids != self.pad_token_id).sum())
+        else:
+            tokens = input_ids.numel()
+        self._wait += wait
+        self._tokens += tokens
+        self._padded_tokens += input_ids.numel()
+        self._samples += input_ids.shape[0]
+    
+    @staticmethod
+    def _synchronize():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    
+    def on_train_begin(self, args, state, control, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        reset_peak_rss()
+        self._synchronize()
+        self._last_step_end = time.perf_counter()
+    
+    def on_step_end(self, args, state, control, **kwargs):
+        self._synchronize()
+        now = time.perf_counter()
+        self.steps.append({
+            "time": now - self._last_step_end,
+            "dataloader_wait": self._wait,
+            "tokens": self._tokens,
+            "padded_tokens": self._padded_tokens,
+            "samples": self._samples,
+        })
+        self._last_step_end = now
+        self._reset_step()
+    
+    def summary(self) -> Dict[str, Any]:
+        measured = self.steps[self.warmup_steps:] or self.steps
+        total_time = sum(step["time"] for step in measured)
+        total_wait = sum(step["dataloader_wait"] for step in measured)
+        tokens = sum(step["tokens"] for step in measured)
+        padded_tokens = sum(step["padded_tokens"] for step in measured)
+        samples = sum(step["samples"] for step in measured)
+        return {
+            "steps": len(self.steps),
+            "measured_steps": len(measured),
+            "tokens_per_s": tokens / max(total_time, 1e-9),
+            "padded_tokens_per_s": padded_tokens / max(total_time, 1e-9),
+            "samples_per_s": samples / max(total_time, 1e-9),
+            "padding_efficiency": tokens / max(padded_tokens, 1),
+            "step_time_ms": percentiles([step["time"] * 1000 for step in measured]),
+            "dataloader_wait_ms": percentiles([step["dataloader_wait"] * 1000 for step in measured]),
+            "dataloader_wait_fraction": total_wait / max(total_time, 1e-9),
+        }
+
+
+def reset_peak_rss():
+    """Restart the process's peak RSS from its current RSS, so loading the model does not hide the training peak
+    
+    Only Linux can reset it; elsewhere the peak covers the whole process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def peak_memory() -> Dict[str, float]:
+    """Peak device memory and process RSS since training started"""
+    memory = {
+        "process_peak_rss_mb": _peak_rss_mb(),
+    }
+    if torch.cuda.is_available():
+        memory["cuda_peak_allocated_mb"] = torch.cuda.max_memory_allocated() / 1024 ** 2
+        memory["cuda_peak_reserved_mb"] = torch.cuda.max_memory_reserved() / 1024 ** 2
+    return memory
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _environment() -> Dict[str, Any]:
+    environment = {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "device": "cuda" if torch.cuda.is_available() else "cpu",
+        "num_threads": torch.get_num_threads(),
+    }
+    if torch.cuda.is_available():
+        environment["gpu"] = torch.cuda.get_device_name(0)
+        environment["gpu_count"] = torch.cuda.device_count()
+    return environment
+
+
+def run_benchmark(
+    model_config: ModelConfig,
+    lora_config: LoRAConfig,
+    training_config: TrainingConfig,
+    train_data: str,
+    warmup_steps: int = 3,
+    label: Optional[str] = None
+) -> Dict[str, Any]:
+    """Train for ``training_config.max_steps`` steps and return the benchmark report"""
+    fine_tuner = GPTOSSFineTuner(model_config, lora_config, training_config)
+    
+    load_start = time.perf_counter()
+    fine_tuner.load_tokenizer()
+    fine_tuner.load_model()
+    fine_tuner.setup_lora()
+    train_dataset, _ = fine_tuner.create_datasets(train_data)
+    fine_tuner.setup_trainer(train_dataset)
+    setup_time = time.perf_counter() - load_start
+    
+    callback = BenchmarkCallback(fine_tuner.tokenizer.pad_token_id, warmup_steps=warmup_steps)
+    callback.wrap(fine_tuner.trainer)
+    fine_tuner.trainer.add_callback(callback)
+    
+    train_start = time.perf_counter()
+    fine_tuner.trainer.train()
+    train_time = time.perf_counter() - train_start
+    
+    losses = [entry["loss"] for entry in fine_tuner.trainer.state.log_history if "loss" in entry]
+    results = callback.summary()
+    results.update({
+        "setup_time_s": setup_time,
+        "train_time_s": train_time,
+        "final_loss": losses[-1] if losses else None,
+        "trainable_parameters": sum(p.numel() for p in fine_tuner.model.parameters() if p.requires_grad),
+        "peak_memory": peak_memory(),
+        "optimizer_state_mb": {device: size / 1024 ** 2 for device, size in optimizer_state_memory(fine_tuner.trainer.optimizer).items()},
+    })
+    if fine_tuner.profiler is not None:
+        results["step_breakdown"] = fine_tuner.profiler.summary()
+    
+    return {
+        "label": label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": _git_commit(),
+        "environment": _environment(),
+        "config": {
+            "model": asdict(model_config),
+            "lora": asdict(lora_config),
+            "training": asdict(training_config),
+            "train_data": train_data,
+            "warmup_steps": warmup_steps,
+        },
+        "results": results,
+        "per_step": callback.steps,
+    }
+
+
+# Activation memory strategies compared by the activations benchmark, as extra run arguments;
+# the chunked loss ones never materialize the full-vocabulary logits
+ACTIVATION_STRATEGIES = {
+    "none": [],
+    "full": ["--checkpoint_policy", "full"],
+    "every_2": ["--checkpoint_policy", "every_n", "--checkpoint_every_n", "2"],
+    "selective_mlp": ["--checkpoint_policy", "selective", "--checkpoint_modules", "mlp"],
+    "offload": ["--offload_activations"],
+    "every_2_offload": ["--checkpoint_policy", "every_n", "--checkpoint_every_n", "2", "--offload_activations"],
+    "chunked_loss": ["--chunked_loss"],
+    "full_chunked_loss": ["--checkpoint_policy", "full", "--chunked_loss"],
+}
+
+
+# Optimizer configurations compared by the optimizers benchmark, as extra run arguments
+OPTIMIZER_STRATEGIES = {
+    "adamw": [],
+    "adamw_8bit": ["--optimizer", "adamw_8bit"],
+    "adamw_offload": ["--optimizer_offload"],
+    "adamw_8bit_offload": ["--optimizer", "adamw_8bit", "--optimizer_offload"],
+}
+
+
+def run_strategy_benchmark(run_args: List[str], strategies: Dict[str, List[str]], label: Optional[str] = None) -> Dict[str, Any]:
+    """Run ``run`` with ``run_args`` plus each strategy's arguments in a fresh process and tabulate memory against step time
+    
+    Peak memory is the CUDA peak allocation on a GPU and the process's peak
+    RSS otherwise; changes are relative to the first strategy.
+    """
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="gptoss-strategies-") as work_dir:
+        for name, strategy_args in strategies.items():
+            output = os.path.join(work_dir, f"{name}.json")
+            command = [sys.executable, os.path.abspath(__file__), "run", *run_args, *strategy_args, "--label", name, "--output", output]
+            logger.info(f"Benchmarking {name}")
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                raise RuntimeError(f"Strategy {name} failed:\n{completed.stderr[-4000:]}")
+            with open(output) as f:
+                results = json.load(f)["results"]
+            memory = results["peak_memory"]
+            rows.append({
+                "strategy": name,
+                "peak_memory_mb": memory.get("cuda_peak_allocated_mb", memory["process_peak_rss_mb"]),
+                "step_time_ms_p50": results["step_time_ms"]["p50"],
+                "tokens_per_s": results["tokens_per_s"],
+                "final_loss": results["final_loss"],
+                "optimizer_state_mb": results["optimizer_state_mb"],
+            })
+    
+    base = rows[0] if rows else None
+    for row in rows:
+        row["memory_change"] = row["peak_memory_mb"] / base["peak_memory_mb"] - 1
+        row["step_time_change"] = row["step_time_ms_p50"] / base["step_time_ms_p50"] - 1
+    return {
+        "label": label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": _git_commit(),
+        "environment": _environment(),
+        "config": {"run_args": run_args, "strategies": strategies},
+        "results": rows,
+    }
+
+
+def load_worker(model_name: str, torch_dtype: str, mmap_weights: bool, mmap_cache_dir: Optional[str] = None):
+    """One worker of the weights benchmark: load the model on the host, run it once and report its memory
+    
+    The forward pass faults in every weight, so mapped weights that were never
+    read do not look free. Prints one JSON line when done and another, with
+    the memory at that point, for every line read from stdin until stdin is
+    closed.
+    """
+    model_config = ModelConfig(
+        model_name=model_name,
+        torch_dtype=torch_dtype,
+        device_map=None,
+        use_flash_attention=False,
+        prefix_cache_mb=0,
+        mmap_weights=mmap_weights,
+        mmap_cache_dir=mmap_cache_dir
+    )
+    fine_tuner = GPTOSSFineTuner(model_config, LoRAConfig(inference_mode=True), TrainingConfig(report_to="none"))
+    fine_tuner.load_tokenizer()
+    memory_before = memory_usage()
+    start = time.perf_counter()
+    fine_tuner.load_model()
+    load_time = time.perf_counter() - start
+    inputs = fine_tuner.tokenizer("Hello", return_tensors="pt")
+    with torch.no_grad():
+        fine_tuner.model(**inputs)
+    forward_time = time.perf_counter() - start - load_time
+    report = {"load_s": load_time, "first_forward_s": forward_time, "memory_before_load": memory_before, "memory": memory_usage()}
+    print(json.dumps(report), flush=True)
+    for _ in sys.stdin:
+        print(json.dumps({"memory": memory_usage()}), flush=True)
+
+
+def _start_worker(command: List[str], log_path: str) -> subprocess.Popen:
+    with open(log_path, "w") as log:
+        return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=log, text=True)
+
+
+def _read_report(worker: subprocess.Popen, log_path: str) -> Dict[str, Any]:
+    line = worker.stdout.readline()
+    if not line:
+        with open(log_path) as f:
+            raise RuntimeError(f"Benchmark worker exited with code {worker.wait()}:\n{f.read()[-4000:]}")
+    return json.loads(line)
+
+
+def run_weights_benchmark(
+    model_name: str,
+    workers: int = 4,
+    torch_dtype: str = "bfloat16",
+    modes: List[str] = ("from_pretrained", "mmap"),
+    mmap_cache_dir: Optional[str] = None,
+    label: Optional[str] = None
+) -> Dict[str, Any]:
+    """Start ``workers`` processes loading ``model_name`` per mode and report startup time and host memory
+    
+    Workers start one after another and stay alive until all are loaded, so
+    the later ones see the files in the page cache and the final memory
+    reading reflects pages shared between all of them. The model is loaded
+    on the host in every mode. ``model_rss_mb`` is a worker's RSS growth from
+    loading and running the model; PSS is only comparable between workers
+    alive at the same time, since it also splits the shared libraries.
+    With ``mmap_cache_dir`` the first mmap worker converts a checkpoint that
+    cannot be mapped as it is and the others map the converted copy.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="gptoss-weights-") as work_dir:
+        for mode in modes:
+            command = [sys.executable, os.path.abspath(__file__), "load-worker", "--model_name", model_name, "--torch_dtype", torch_dtype]
+            if mode == "mmap":
+                command.append("--mmap_weights")
+                if mmap_cache_dir:
+                    command += ["--mmap_cache_dir", mmap_cache_dir]
+            
+            running = []
+            rows = []
+            try:
+                for index in range(workers):
+                    log_path = os.path.join(work_dir, f"{mode}-{index}.log")
+                    start = time.perf_counter()
+                    worker = _start_worker(command, log_path)
+                    running.append((worker, log_path))
+                    row = _read_report(worker, log_path)
+                    row["startup_s"] = time.perf_counter() - start
+                    rows.append(row)
+                    logger.info(
+                        f"{mode} worker {index}: ready in {row['startup_s']:.2f}s, model loaded in {row['load_s']:.2f}s, "
+                        f"first forward {row['first_forward_s']:.2f}s"
+                    )
+                for (worker, log_path), row in zip(running, rows):
+                    worker.stdin.write("\n")
+                    worker.stdin.flush()
+                    row["memory_all_loaded"] = _read_report(worker, log_path)["memory"]
+            finally:
+                for worker, _ in running:
+                    worker.stdin.close()
+                    worker.wait()
+            
+            for row in rows:
+                row["model_rss_mb"] = row["memory"]["rss_mb"] - row["memory_before_load"]["rss_mb"]
+            results[mode] = {
+                "workers": rows,
+                "first_startup_s": rows[0]["startup_s"],
+                "later_startup_s": percentiles([row["startup_s"] for row in rows[1:]]) if workers > 1 else None,
+                "total_rss_mb": sum(row["memory_all_loaded"]["rss_mb"] for row in rows),
+                "total_pss_mb": sum(row["memory_all_loaded"].get("pss_mb", 0.0) for row in rows),
+            }
+    
+    return {
+        "label": label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": _git_commit(),
+        "environment": _environment(),
+        "config": {"model_name": model_name, "workers": workers, "torch_dtype": torch_dtype, "modes": list(modes), "mmap_cache_dir": mmap_cache_dir},
+        "results": results,
+    }
+
+
+def write_benchmark_prompts(output_path: str, source_path: str, num_prompts: int):
+    """Write ``num_prompts`` prompts of varying length built from the user turns in ``source_path``"""
+    with open(source_path, "r", encoding="utf-8") as f:
+        users = [json.loads(line)["user"] for line in f if line.strip()]
+    with open(output_path, "w", encoding="utf-8") as f:
+        for index in range(num_prompts):
+            prompt = " ".join([users[index % len(users)]] * (1 + index % 7))
+            f.write(json.dumps({"id": f"prompt-{index}", "prompt": prompt}) + "\n")
+
+
+def run_batch_inference_benchmark(
+    fine_tuner: GPTOSSFineTuner,
+    prompts_path: str,
+    batch_sizes: List[int],
+    max_new_tokens: int = 32,
+    label: Optional[str] = None
+) -> Dict[str, Any]:
+    """Generate greedily for every prompt once per batch size and report throughput"""
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="gptoss-batch-") as work_dir:
+        for batch_size in batch_sizes:
+            config = BatchInferenceConfig(batch_size=batch_size, max_new_tokens=max_new_tokens, do_sample=False, resume=False)
+            stats = run_batch_inference(fine_tuner, prompts_path, os.path.join(work_dir, f"bs{batch_size}.jsonl"), config)
+            rows.append({"batch_size": batch_size, **stats})
+            logger.info(f"Batch size {batch_size}: {stats['prompts_per_s']:.2f} prompts/s, {stats['completion_tokens_per_s']:.1f} tokens/s")
+    
+    for row in rows:
+        row["speedup"] = row["completion_tokens_per_s"] / rows[0]["completion_tokens_per_s"] if rows[0]["completion_tokens_per_s"] else None
+    return {
+        "label": label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": _git_commit(),
+        "environment": _environment(),
+        "config": {"model": fine_tuner.model_config.model_name, "prompts": prompts_path, "batch_sizes": batch_sizes, "max_new_tokens": max_new_tokens},
+        "results": rows,
+    }
+
+
+def run_parity_worker(
+    model_name: str,
+    train_data: str,
+    output_dir: str,
+    batch_size: int,
+    steps: int = 2,
+    sharding: str = "none",
+    backend: str = "gloo"
+) -> Optional[List[Dict[str, float]]]:
+    """One process of the distributed check: train the tiny model and return the logged loss and gradient norm per step
+    
+    Returns None on every rank but the first. Sampling is not grouped by
+    length and there is no dropout, so the global batch of each step is the
+    same for any number of ranks.
+    """
+    model_config = ModelConfig(
+        model_name=model_name,
+        torch_dtype="float32",
+        device_map=None,
+        trust_remote_code=False,
+        use_flash_attention=False,
+        prefix_cache_mb=0
+    )
+    training_config = TrainingConfig(
+        output_dir=output_dir,
+        max_steps=steps,
+        per_device_train_batch_size=batch_size,
+        max_length=256,
+        group_by_length=False,
+        sharding=sharding,
+        distributed_backend=backend,
+        bf16=False,
+        logging_steps=1,
+        save_steps=steps + 1,
+        report_to="none"
+    )
+    fine_tuner = GPTOSSFineTuner(model_config, LoRAConfig(lora_dropout=0.0), training_config)
+    fine_tuner.load_tokenizer()
+    fine_tuner.load_model()
+    # The launcher consumes random numbers differently with and without torchrun; start LoRA from the same weights
+    transformers.set_seed(training_config.seed)
+    fine_tuner.setup_lora()
+    train_dataset, _ = fine_tuner.create_datasets(train_data)
+    fine_tuner.setup_trainer(train_dataset)
+    fine_tuner.trainer.train()
+    if fine_tuner.rank != 0:
+        return None
+    return [
+        {"step": entry["step"], "loss": entry["loss"], "grad_norm": entry["grad_norm"]}
+        for entry in fine_tuner.trainer.state.log_history if "loss" in entry
+    ]
+
+
+def run_distributed_check(
+    world_size: int = 2,
+    batch_size: int = 2,
+    steps: int = 2,
+    sharding: str = "none",
+    backend: str = "gloo",
+    tolerance: float = 1e-4,
+    label: Optional[str] = None
+) -> Dict[str, Any]:
+    """Train with ``world_size`` torchrun ranks and in one process with the same global batch and compare every step
+    
+    A step passes when its loss and gradient norm differ by at most
+    ``tolerance`` relative to the single process.
+    """
+    runs = {}
+    with tempfile.TemporaryDirectory(prefix="gptoss-distributed-") as work_dir:
+        train_data = os.path.join(work_dir, "train.jsonl")
+        create_sample_data(train_data, max(64, world_size * batch_size * steps))
+        model_name = build_tiny_model(os.path.join(work_dir, "tiny-gptoss"), train_data)
+        launchers = {
+            "single": ([sys.executable, os.path.abspath(__file__)], batch_size * world_size, "none"),
+            "distributed": ([sys.executable, "-m", "torch.distributed.run", "--standalone", "--nproc_per_node", str(world_size), os.path.abspath(__file__)], batch_size, sharding),
+        }
+        for name, (launcher, run_batch_size, run_sharding) in launchers.items():
+            output = os.path.join(work_dir, f"{name}.json")
+            command = [
+                *launcher, "parity-worker",
+                "--model_name", model_name,
+                "--train_data", train_data,
+                "--output_dir", os.path.join(work_dir, name),
+                "--batch_size", str(run_batch_size),
+                "--steps", str(steps),
+                "--sharding", run_sharding,
+                "--backend", backend,
+                "--output", output,
+            ]
+            logger.info(f"Training {name}")
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                raise RuntimeError(f"The {name} run failed:\n{completed.stderr[-4000:]}")
+            with open(output) as f:
+                runs[name] = json.load(f)
+    
+    rows = []
+    for single, distributed in zip(runs["single"], runs["distributed"]):
+        row = {"step": single["step"]}
+        for metric in ("loss", "grad_norm"):
+            row[metric] = single[metric]
+            row[f"distributed_{metric}"] = distributed[metric]
+            row[f"{metric}_difference"] = abs(distributed[metric] - single[metric]) / max(abs(single[metric]), 1e-12)
+        row["passed"] = row["loss_difference"] <= tolerance and row["grad_norm_difference"] <= tolerance
+        rows.append(row)
+    return {
+        "label": label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": _git_commit(),
+        "environment": _environment(),
+        "config": {"world_size": world_size, "batch_size": batch_size, "steps": steps, "sharding": sharding, "backend": backend, "tolerance": tolerance},
+        "results": rows,
+        "passed": len(rows) == steps and all(row["passed"] for row in rows),
+    }
+
+
+def save_random_adapter(model_name: str, output_dir: str, seed: int) -> str:
+    """Save a LoRA adapter for ``model_name`` whose weights are random, so it changes the model's output"""
+    from peft import LoraConfig, get_peft_model
+    from transformers import AutoModelForCausalLM
+    
+    torch.manual_seed(seed)
+    model = get_peft_model(AutoModelForCausalLM.from_pretrained(model_name), LoraConfig(r=4, target_modules=["q_proj", "v_proj"]))
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if "lora_B" in name:
+                param.normal_(0, 1.0)
+    model.save_pretrained(output_dir)
+    return output_dir
+
+
+def run_adapter_eviction_check(prompts: List[str], max_new_tokens: int = 16, label: Optional[str] = None) -> Dict[str, Any]:
+    """Generate without an adapter before and after the default adapter was evicted and reloaded"""
+    with tempfile.TemporaryDirectory(prefix="gptoss-adapters-") as work_dir:
+        sample_data = os.path.join(work_dir, "sample.jsonl")
+        create_sample_data(sample_data, 100)
+        model_name = build_tiny_model(os.path.join(work_dir, "tiny-gptoss"), sample_data)
+        model_config = ModelConfig(
+            model_name=model_name,
+            torch_dtype="float32",
+            device_map=None,
+            trust_remote_code=False,
+            use_flash_attention=False,
+            max_loaded_adapters=1
+        )
+        fine_tuner = GPTOSSFineTuner(model_config, LoRAConfig(inference_mode=True), TrainingConfig(report_to="none"))
+        fine_tuner.load_tokenizer()
+        fine_tuner.load_finetuned_model(save_random_adapter(model_name, os.path.join(work_dir, "default"), seed=1))
+        fine_tuner.register_adapter("other", save_random_adapter(model_name, os.path.join(work_dir, "other"), seed=2))
+        
+        # generate() takes the total length
+        max_length = len(fine_tuner.tokenizer(fine_tuner._format_generation_prompt(prompts[0]))["input_ids"]) + max_new_tokens
+        
+        def generate(adapter_name: Optional[str]) -> Dict[str, Any]:
+            return {
+                "resolved": fine_tuner.adapters.resolve(adapter_name),
+                "batch": fine_tuner.generate_batch(prompts, max_new_tokens=max_new_tokens, do_sample=False, adapter_name=adapter_name),
+                "single": fine_tuner.generate(prompts[0], max_length=max_length, do_sample=False, adapter_name=adapter_name),
+            }
+        
+        before = generate(None)
+        other = generate("other")
+        after = generate(None)
+        stats = fine_tuner.adapters.stats()
+    
+    results = {
+        "default": before["resolved"],
+        "evictions": stats["evictions"],
+        "resolved_after_eviction": after["resolved"],
+        "other_adapter_differs": other["batch"] != before["batch"],
+        "batch_unchanged": after["batch"] == before["batch"],
+        "single_unchanged": after["single"] == before["single"],
+    }
+    results["passed"] = (
+        results["evictions"] >= 2
+        and results["resolved_after_eviction"] == results["default"]
+        and results["other_adapter_differs"]
+        and results["batch_unchanged"]
+        and results["single_unchanged"]
+    )
+    return {
+        "label": label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": _git_commit(),
+        "environment": _environment(),
+        "config": {"prompts": prompts, "max_new_tokens": max_new_tokens},
+        "results": results,
+    }
+
+
+# Fresh-interpreter commands timed by the startup benchmark; {work_dir} is a scratch directory
+STARTUP_SCENARIOS = {
+    "cli_help": ["GptRoss.py", "--help"],
+    "prepare_data_sample": ["GptRoss.py", "prepare-data", "--sample", "{work_dir}/sample.jsonl"],
+    "import_cli": ["-c", "import GptRoss"],
+    "import_finetune": ["-c", "import gptoss_finetune"],
+}
+HEAVY_MODULES = ["torch", "transformers", "peft", "datasets", "wandb"]
+
+
+def _imported_modules(importtime_output: str) -> List[Dict[str, Any]]:
+    """Parse ``python -X importtime`` output into module names with cumulative import times"""
+    modules = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append({"name": name.strip(), "cumulative_ms": int(cumulative) / 1000})
+    return modules
+
+
+def run_startup_benchmark(repeats: int = 5, label: Optional[str] = None) -> Dict[str, Any]:
+    """Time every startup scenario ``repeats`` times and record what each one imports"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="gptoss-startup-") as work_dir:
+        for scenario, arguments in STARTUP_SCENARIOS.items():
+            command = [sys.executable] + [argument.format(work_dir=work_dir) for argument in arguments]
+            
+            wall_ms = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                subprocess.run(command, cwd=script_dir, capture_output=True, check=True)
+                wall_ms.append((time.perf_counter() - start) * 1000)
+            
+            # One more run with -X importtime to see what the command pulled in
+            traced = subprocess.run(
+                [command[0], "-X", "importtime"] + command[1:],
+                cwd=script_dir,
+                capture_output=True,
+                text=True,
+                check=True
+            )
+            modules = _imported_modules(traced.stderr)
+            names = {module["name"] for module in modules}
+            top_level = sorted((module for module in modules if "." not in module["name"]), key=lambda module: module["cumulative_ms"], reverse=True)
+            
+            results[scenario] = {
+                "command": " ".join(arguments),
+                "wall_ms": percentiles(wall_ms),
+                "heavy_modules": [name for name in HEAVY_MODULES if name in names],
+                "modules_imported": len(names),
+                "top_imports_ms": {module["name"]: module["cumulative_ms"] for module in top_level[:10]},
+            }
+            logger.info(f"{scenario}: {results[scenario]['wall_ms']['p50']:.0f} ms, heavy imports: {results[scenario]['heavy_modules'] or 'none'}")
+    
+    return {
+        "label": label,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": _git_commit(),
+        "environment": _environment(),
+        "config": {"repeats": repeats},
+        "results": results,
+    }
+
+
+# Metrics shown by compare, and whether higher values are better
+COMPARED_METRICS = [
+    ("tokens_per_s", True),
+    ("samples_per_s", True),
+    ("padding_efficiency", True),
+    ("step_time_ms.p50", False),
+    ("step_time_ms.p90", False),
+    ("dataloader_wait_fraction", False),
+    ("peak_memory.process_peak_rss_mb", False),
+    ("peak_memory.cuda_peak_allocated_mb", False),
+] + [(f"{scenario}.wall_ms.p50", False) for scenario in STARTUP_SCENARIOS]
+
+
+def _lookup(results: Dict[str, Any], dotted: str) -> Optional[float]:
+    value: Any = results
+    for key in dotted.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare_reports(base: Dict[str, Any], candidate: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Relative change of the headline metrics from ``base`` to ``candidate``"""
+    rows = []
+    for metric, higher_is_better in COMPARED_METRICS:
+        before = _lookup(base["results"], metric)
+        after = _lookup(candidate["results"], metric)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before if before else 0.0
+        rows.append({
+            "metric": metric,
+            "base": before,
+            "candidate": after,
+            "change": change,
+            "better": change > 0 if higher_is_better else change < 0,
+        })
+    return rows
+
+
+def main():
+    """Main function"""
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    
+    parser = argparse.ArgumentParser(description="Benchmark the GPT-OSS fine-tuning loop")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    run_parser = subparsers.add_parser("run", help="Run a fixed number of training steps and report throughput")
+    run_parser.add_argument("--tiny", action="store_true", help="Use a tiny randomly initialized GPT-OSS model that runs on CPU")
+    run_parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    run_parser.add_argument("--train_data", type=str, help="Training JSONL (default: synthetic data from create_sample_data)")
+    run_parser.add_argument("--num_samples", type=int, default=512, help="Synthetic examples to generate")
+    run_parser.add_argument("--steps", type=int, default=20, help="Optimizer steps to run")
+    run_parser.add_argument("--warmup_steps", type=int, default=3, help="Leading steps left out of the summary")
+    run_parser.add_argument("--batch_size", type=int, default=1, help="Per device batch size")
+    run_parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
+    run_parser.add_argument("--max_length", type=int, default=2048, help="Maximum sequence length")
+    run_parser.add_argument("--padding", type=str, default="longest", choices=["longest", "max_length"])
+    run_parser.add_argument("--no_group_by_length", action="store_true", help="Disable length-grouped batching")
+    run_parser.add_argument("--packing", action="store_true", help="Pack several conversations into each max_length window")
+    run_parser.add_argument("--packing_attention", type=str, default="auto", choices=["auto", "position_ids", "block_mask"])
+    run_parser.add_argument("--lora_r", type=int, default=16, help="LoRA r parameter")
+    run_parser.add_argument("--target_modules", type=str, nargs="+", help="LoRA target modules")
+    run_parser.add_argument("--modules_to_save", type=str, nargs="+", help="Modules trained in full next to LoRA, e.g. lm_head")
+    run_parser.add_argument("--dataloader_workers", type=int, default=0)
+    run_parser.add_argument("--torch_dtype", type=str, help="Model dtype (default: bfloat16, float32 for --tiny)")
+    run_parser.add_argument("--checkpoint_policy", type=str, choices=["none", "full", "every_n", "selective"], default="none", help="Activation recomputation policy")
+    run_parser.add_argument("--checkpoint_every_n", type=int, default=2, help="Recompute every n-th decoder layer with --checkpoint_policy every_n")
+    run_parser.add_argument("--checkpoint_modules", type=str, nargs="+", default=["mlp"], help="Decoder layer children recomputed with --checkpoint_policy selective")
+    run_parser.add_argument("--offload_activations", action="store_true", help="Keep activations saved for backward in host memory")
+    run_parser.add_argument("--chunked_loss", action="store_true", help="Compute the LM head and loss in chunks instead of materializing full-vocabulary logits")
+    run_parser.add_argument("--loss_chunk_size", type=int, default=1024, help="Positions per chunk with --chunked_loss")
+    run_parser.add_argument("--optimizer", type=str, default="adamw", choices=["adamw", "adamw_8bit"], help="adamw_8bit stores the optimizer moments as blockwise 8-bit codes")
+    run_parser.add_argument("--optimizer_offload", action="store_true", help="Keep optimizer state in host memory and run the update on the CPU")
+    run_parser.add_argument("--instrument", action="store_true", help="Also record the per-step forward/backward/optimizer breakdown")
+    run_parser.add_argument("--profile_steps", type=int, nargs=2, metavar=("START", "NUM"), help="Capture a torch.profiler Chrome trace of NUM steps from step START")
+    run_parser.add_argument("--profiling_dir", type=str, default="./gptoss-profiling", help="Where step timings and traces are written")
+    run_parser.add_argument("--label", type=str, help="Free-form label stored with the results")
+    run_parser.add_argument("--output", type=str, help="Write the report to this JSON file")
+    
+    startup_parser = subparsers.add_parser("startup", help="Time CLI startup per subcommand in fresh interpreters")
+    startup_parser.add_argument("--repeats", type=int, default=5, help="Timed runs per command")
+    startup_parser.add_argument("--label", type=str, help="Free-form label stored with the results")
+    startup_parser.add_argument("--output", type=str, help="Write the report to this JSON file")
+    
+    activations_parser = subparsers.add_parser("activations", help="Compare memory and step time of activation memory strategies")
+    activations_parser.add_argument("--tiny", action="store_true", help="Use a tiny randomly initialized GPT-OSS model that runs on CPU")
+    activations_parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    activations_parser.add_argument("--train_data", type=str, help="Training JSONL (default: synthetic data from create_sample_data)")
+    activations_parser.add_argument("--steps", type=int, default=10, help="Optimizer steps per strategy")
+    activations_parser.add_argument("--warmup_steps", type=int, default=2, help="Leading steps left out of the summary")
+    activations_parser.add_argument("--batch_size", type=int, default=4, help="Per device batch size")
+    activations_parser.add_argument("--max_length", type=int, default=2048, help="Maximum sequence length")
+    activations_parser.add_argument("--padding", type=str, default="max_length", choices=["longest", "max_length"], help="max_length makes every step the same size")
+    activations_parser.add_argument("--strategies", type=str, nargs="+", default=list(ACTIVATION_STRATEGIES), choices=list(ACTIVATION_STRATEGIES))
+    activations_parser.add_argument("--label", type=str, help="Free-form label stored with the results")
+    activations_parser.add_argument("--output", type=str, help="Write the report to this JSON file")
+    
+    optimizers_parser = subparsers.add_parser("optimizers", help="Compare memory and step time of optimizer configurations")
+    optimizers_parser.add_argument("--tiny", action="store_true", help="Use a tiny randomly initialized GPT-OSS model that runs on CPU")
+    optimizers_parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    optimizers_parser.add_argument("--train_data", type=str, help="Training JSONL (default: synthetic data from create_sample_data)")
+    optimizers_parser.add_argument("--steps", type=int, default=10, help="Optimizer steps per configuration")
+    optimizers_parser.add_argument("--warmup_steps", type=int, default=2, help="Leading steps left out of the summary")
+    optimizers_parser.add_argument("--batch_size", type=int, default=4, help="Per device batch size")
+    optimizers_parser.add_argument("--max_length", type=int, default=2048, help="Maximum sequence length")
+    optimizers_parser.add_argument("--padding", type=str, default="max_length", choices=["longest", "max_length"], help="max_length makes every step the same size")
+    optimizers_parser.add_argument("--lora_r", type=int, default=16, help="LoRA r parameter; the optimizer state grows with it")
+    optimizers_parser.add_argument("--modules_to_save", type=str, nargs="+", help="Modules trained in full next to LoRA, e.g. lm_head")
+    optimizers_parser.add_argument("--strategies", type=str, nargs="+", default=list(OPTIMIZER_STRATEGIES), choices=list(OPTIMIZER_STRATEGIES))
+    optimizers_parser.add_argument("--label", type=str, help="Free-form label stored with the results")
+    optimizers_parser.add_argument("--output", type=str, help="Write the report to this JSON file")
+    
+    batch_parser = subparsers.add_parser("batch-inference", help="Measure offline generation throughput per batch size")
+    batch_parser.add_argument("--tiny", action="store_true", help="Use a tiny randomly initialized GPT-OSS model that runs on CPU")
+    batch_parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    batch_parser.add_argument("--prompts", type=str, help="Prompts JSONL (default: synthetic prompts of varying length)")
+    batch_parser.add_argument("--num_prompts", type=int, default=64, help="Synthetic prompts to generate for")
+    batch_parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16, 32])
+    batch_parser.add_argument("--max_new_tokens", type=int, default=32)
+    batch_parser.add_argument("--label", type=str, help="Free-form label stored with the results")
+    batch_parser.add_argument("--output", type=str, help="Write the report to this JSON file")
+    
+    weights_parser = subparsers.add_parser("weights", help="Compare worker startup time and host memory with copied vs memory-mapped weights")
+    weights_parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    weights_parser.add_argument("--workers", type=int, default=4, help="Worker processes loading the model per mode")
+    weights_parser.add_argument("--torch_dtype", type=str, default="bfloat16", choices=["float32", "float16", "bfloat16"], help="Use the checkpoint's dtype so mapped weights need no copy")
+    weights_parser.add_argument("--modes", type=str, nargs="+", default=["from_pretrained", "mmap"], choices=["from_pretrained", "mmap"])
+    weights_parser.add_argument("--mmap_cache_dir", type=str, help="Let mmap workers convert a checkpoint in another dtype here once and map the copy")
+    weights_parser.add_argument("--label", type=str, help="Free-form label stored with the results")
+    weights_parser.add_argument("--output", type=str, help="Write the report to this JSON file")
+    
+    worker_parser = subparsers.add_parser("load-worker", help="One worker process of the weights benchmark")
+    worker_parser.add_argument("--model_name", type=str, required=True)
+    worker_parser.add_argument("--torch_dtype", type=str, default="bfloat16")
+    worker_parser.add_argument("--mmap_weights", action="store_true")
+    worker_parser.add_argument("--mmap_cache_dir", type=str)
+    
+    distributed_parser = subparsers.add_parser("distributed", help="Check that torchrun ranks train like one process with the same global batch")
+    distributed_parser.add_argument("--world_size", type=int, default=2, help="torchrun ranks")
+    distributed_parser.add_argument("--batch_size", type=int, default=2, help="Per rank batch size; the single process uses world_size times as many")
+    distributed_parser.add_argument("--steps", type=int, default=2, help="Optimizer steps compared")
+    distributed_parser.add_argument("--sharding", type=str, default="none", choices=["none", "fsdp"], help="Sharding of the distributed run")
+    distributed_parser.add_argument("--backend", type=str, default="gloo", choices=["auto", "gloo", "nccl"], help="Process group backend")
+    distributed_parser.add_argument("--tolerance", type=float, default=1e-4, help="Largest relative loss and gradient norm difference")
+    distributed_parser.add_argument("--label", type=str, help="Free-form label stored with the results")
+    distributed_parser.add_argument("--output", type=str, help="Write the report to this JSON file")
+    
+    adapters_parser = subparsers.add_parser("adapters", help="Check that evicting the default adapter does not change generation without an adapter")
+    adapters_parser.add_argument("--prompts", type=str, nargs="+", default=["hello there", "What are the benefits of exercise?"])
+    adapters_parser.add_argument("--max_new_tokens", type=int, default=16)
+    adapters_parser.add_argument("--label", type=str, help="Free-form label stored with the results")
+    adapters_parser.add_argument("--output", type=str, help="Write the report to this JSON file")
+    
+    parity_parser = subparsers.add_parser("parity-worker", help="One run of the distributed check")
+    parity_parser.add_argument("--model_name", type=str, required=True)
+    parity_parser.add_argument("--train_data", type=str, required=True)
+    parity_parser.add_argument("--output_dir", type=str, required=True)
+    parity_parser.add_argument("--batch_size", type=int, required=True)
+    parity_parser.add_argument("--steps", type=int, default=2)
+    parity_parser.add_argument("--sharding", type=str, default="none")
+    parity_parser.add_argument("--backend", type=str, default="gloo")
+    parity_parser.add_argument("--output", type=str, required=True)
+    
+    compare_parser = subparsers.add_parser("compare", help="Compare two benchmark reports")
+    compare_parser.add_argument("base", type=str)
+    compare_parser.add_argument("candidate", type=str)
+    
+    args = parser.parse_args()
+    
+    if args.command == "compare":
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.candidate) as f:
+            candidate = json.load(f)
+        for row in compare_reports(base, candidate):
+            marker = "+" if row["better"] else "-" if row["change"] else " "
+            print(f"{marker} {row['metric']:<40} {row['base']:>12.2f} -> {row['candidate']:>12.2f} ({row['change']:+.1%})")
+        return
+    
+    if args.command == "load-worker":
+        load_worker(args.model_name, args.torch_dtype, args.mmap_weights, args.mmap_cache_dir)
+        return
+    
+    if args.command == "parity-worker":
+        steps = run_parity_worker(args.model_name, args.train_data, args.output_dir, args.batch_size, args.steps, args.sharding, args.backend)
+        if steps is not None:
+            with open(args.output, "w") as f:
+                json.dump(steps, f)
+        return
+    
+    if args.command == "distributed":
+        report = run_distributed_check(args.world_size, args.batch_size, args.steps, args.sharding, args.backend, args.tolerance, label=args.label)
+        print(f"{'step':>5}{'loss':>12}{'ranks loss':>12}{'grad norm':>12}{'ranks norm':>12}")
+        for row in report["results"]:
+            print(
+                f"{row['step']:>5}{row['loss']:>12.5f}{row['distributed_loss']:>12.5f}"
+                f"{row['grad_norm']:>12.5f}{row['distributed_grad_norm']:>12.5f}{'' if row['passed'] else '  MISMATCH'}"
+            )
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Distributed report written to {args.output}")
+        if not report["passed"]:
+            sys.exit(1)
+        return
+    
+    if args.command == "adapters":
+        report = run_adapter_eviction_check(args.prompts, args.max_new_tokens, label=args.label)
+        print(json.dumps(report["results"], indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Adapters report written to {args.output}")
+        if not report["results"]["passed"]:
+            sys.exit(1)
+        return
+    
+    if args.command == "batch-inference":
+        with tempfile.TemporaryDirectory(prefix="gptoss-bench-") as work_dir:
+            sample_data = os.path.join(work_dir, "sample.jsonl")
+            create_sample_data(sample_data, 100)
+            prompts_path = args.prompts
+            if prompts_path is None:
+                prompts_path = os.path.join(work_dir, "prompts.jsonl")
+                write_benchmark_prompts(prompts_path, sample_data, args.num_prompts)
+            model_name = build_tiny_model(os.path.join(work_dir, "tiny-gptoss"), sample_data) if args.tiny else args.model_name
+            
+            model_config = ModelConfig(
+                model_name=model_name,
+                torch_dtype="float32" if args.tiny else "bfloat16",
+                device_map=None if args.tiny else "auto",
+                trust_remote_code=not args.tiny,
+                use_flash_attention=not args.tiny,
+                prefix_cache_mb=0
+            )
+            fine_tuner = GPTOSSFineTuner(model_config, LoRAConfig(inference_mode=True), TrainingConfig(report_to="none"))
+            fine_tuner.load_tokenizer()
+            fine_tuner.load_model()
+            fine_tuner.model.eval()
+            report = run_batch_inference_benchmark(fine_tuner, prompts_path, args.batch_sizes, args.max_new_tokens, label=args.label)
+        
+        print(f"{'batch size':>10}{'prompts/s':>12}{'tokens/s':>12}{'padding':>10}{'speedup':>10}")
+        for row in report["results"]:
+            print(
+                f"{row['batch_size']:>10}{row['prompts_per_s']:>12.2f}{row['completion_tokens_per_s']:>12.1f}"
+                f"{row['padding_efficiency']:>10.1%}{row['speedup']:>9.2f}x"
+            )
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Batch inference report written to {args.output}")
+        return
+    
+    if args.command == "weights":
+        report = run_weights_benchmark(args.model_name, args.workers, args.torch_dtype, args.modes, args.mmap_cache_dir, label=args.label)
+        print(f"{'mode':<17}{'worker':>7}{'ready':>9}{'load':>9}{'forward':>9}{'model RSS':>12}{'RSS':>11}{'PSS':>11}")
+        for mode, result in report["results"].items():
+            for index, row in enumerate(result["workers"]):
+                memory = row["memory_all_loaded"]
+                print(
+                    f"{mode:<17}{index:>7}{row['startup_s']:>8.2f}s{row['load_s']:>8.2f}s{row['first_forward_s']:>8.2f}s"
+                    f"{row['model_rss_mb']:>9.0f} MB{memory['rss_mb']:>8.0f} MB{memory.get('pss_mb', float('nan')):>8.0f} MB"
+                )
+            print(f"{mode:<17}{'total':>7}{'':>39}{result['total_rss_mb']:>8.0f} MB{result['total_pss_mb']:>8.0f} MB")
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Weights report written to {args.output}")
+        return
+    
+    if args.command in ("activations", "optimizers"):
+        run_args = [
+            "--model_name", args.model_name,
+            "--steps", str(args.steps),
+            "--warmup_steps", str(args.warmup_steps),
+            "--batch_size", str(args.batch_size),
+            "--max_length", str(args.max_length),
+            "--padding", args.padding,
+        ]
+        if args.tiny:
+            run_args.append("--tiny")
+        if args.train_data:
+            run_args += ["--train_data", args.train_data]
+        table = ACTIVATION_STRATEGIES
+        if args.command == "optimizers":
+            table = OPTIMIZER_STRATEGIES
+            run_args += ["--lora_r", str(args.lora_r)]
+            if args.modules_to_save:
+                run_args += ["--modules_to_save", *args.modules_to_save]
+        report = run_strategy_benchmark(run_args, {name: table[name] for name in args.strategies}, label=args.label)
+        print(f"{'strategy':<20}{'peak memory':>14}{'step p50':>12}{'tokens/s':>12}{'memory':>9}{'time':>9}  optimizer state")
+        for row in report["results"]:
+            state = ", ".join(f"{size:.1f} MB {device}" for device, size in row["optimizer_state_mb"].items())
+            print(
+                f"{row['strategy']:<20}{row['peak_memory_mb']:>11.1f} MB{row['step_time_ms_p50']:>9.1f} ms"
+                f"{row['tokens_per_s']:>12.1f}{row['memory_change']:>+9.1%}{row['step_time_change']:>+9.1%}  {state}"
+            )
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"{args.command.capitalize()} report written to {args.output}")
+        return
+    
+    if args.command == "startup":
+        report = run_startup_benchmark(repeats=args.repeats, label=args.label)
+        print(json.dumps({"label": report["label"], "git_commit": report["git_commit"], "results": report["results"]}, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Startup report written to {args.output}")
+        return
+    
+    with tempfile.TemporaryDirectory(prefix="gptoss-bench-") as work_dir:
+        train_data = args.train_data
+        if train_data is None:
+            train_data = os.path.join(work_dir, "train.jsonl")
+            create_sample_data(train_data, args.num_samples)
+        
+        model_name = args.model_name
+        if args.tiny:
+            model_name = build_tiny_model(os.path.join(work_dir, "tiny-gptoss"), train_data)
+        
+        model_config = ModelConfig(
+            model_name=model_name,
+            torch_dtype=args.torch_dtype or ("float32" if args.tiny else "bfloat16"),
+            device_map=None if args.tiny else "auto",
+            trust_remote_code=not args.tiny,
+            use_flash_attention=not args.tiny
+        )
+        lora_config = LoRAConfig(r=args.lora_r, lora_alpha=2 * args.lora_r, modules_to_save=args.modules_to_save)
+        if args.target_modules:
+            lora_config.target_modules = args.target_modules
+        training_config = TrainingConfig(
+            output_dir=os.path.join(work_dir, "output"),
+            max_steps=args.steps,
+            per_device_train_batch_size=args.batch_size,
+            gradient_accumulation_steps=args.gradient_accumulation_steps,
+            max_length=args.max_length,
+            dynamic_padding=args.padding == "longest",
+            group_by_length=not args.no_group_by_length,
+            packing=args.packing,
+            packing_attention=args.packing_attention,
+            dataloader_num_workers=args.dataloader_workers,
+            gradient_checkpointing=args.checkpoint_policy != "none",
+            checkpoint_policy=args.checkpoint_policy if args.checkpoint_policy != "none" else "full",
+            checkpoint_every_n=args.checkpoint_every_n,
+            checkpoint_modules=args.checkpoint_modules,
+            offload_activations=args.offload_activations,
+            optimizer=args.optimizer,
+            optimizer_offload=args.optimizer_offload,
+            chunked_loss=args.chunked_loss,
+            loss_chunk_size=args.loss_chunk_size,
+            bf16=torch.cuda.is_available() and not args.tiny,
+            logging_steps=1,
+            save_steps=args.steps + 1,
+            instrument_steps=args.instrument,
+            profile_start_step=args.profile_steps[0] if args.profile_steps else None,
+            profile_num_steps=args.profile_steps[1] if args.profile_steps else 3,
+            profiling_dir=args.profiling_dir,
+            report_to="none",
+            run_name=args.label
+        )
+        
+        report = run_benchmark(
+            model_config,
+            lora_config,
+            training_config,
+            train_data,
+            warmup_steps=args.warmup_steps,
+            label=args.label
+        )
+    
+    print(json.dumps({"label": report["label"], "git_commit": report["git_commit"], "results": report["results"]}, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Benchmark report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
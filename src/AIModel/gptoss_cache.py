@@ -0,0 +1,149 @@
+"""
+Pre-tokenized, memory-mapped dataset cache for GPT-OSS fine-tuning.
+
+The JSONL corpus is formatted and tokenized once, in parallel (see
+gptoss_preprocess), and written to a cache entry that later runs and epochs
+read without touching the tokenizer:
+
+    tokens.bin   flat uint32 token ids of every example, back to back
+    offsets.npy  int64 array of length N + 1; example i is tokens[offsets[i]:offsets[i + 1]]
+    meta.json    the inputs that make up the cache key plus summary statistics
+
+Entries live in a directory named after the cache key, which hashes the data
+file identity, the tokenizer and every formatting option that changes the
+token ids, so a change to any of them produces a fresh entry.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+from typing import Dict, Optional, Tuple, Any
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+TOKENS_FILE = "tokens.bin"
+OFFSETS_FILE = "offsets.npy"
+META_FILE = "meta.json"
+TOKEN_DTYPE = np.uint32
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Hash everything about a tokenizer that can change the produced token ids"""
+    hasher = hashlib.sha256()
+    hasher.update(type(tokenizer).__name__.encode("utf-8"))
+    hasher.update(str(getattr(tokenizer, "name_or_path", "")).encode("utf-8"))
+    hasher.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode("utf-8"))
+    hasher.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode("utf-8"))
+    hasher.update(str(getattr(tokenizer, "truncation_side", "right")).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def compute_cache_key(
+    data_path: str,
+    tokenizer,
+    max_length: int,
+    use_reasoning_tokens: bool,
+    reasoning_level: str,
+    deduplicate: bool = False
+) -> Tuple[str, Dict[str, Any]]:
+    """Return the cache key and the inputs it was derived from"""
+    stat = os.stat(data_path)
+    key_inputs = {
+        "format_version": CACHE_FORMAT_VERSION,
+        "data_path": os.path.abspath(data_path),
+        "data_size": stat.st_size,
+        "data_mtime_ns": stat.st_mtime_ns,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "max_length": max_length,
+        "use_reasoning_tokens": use_reasoning_tokens,
+        "reasoning_level": reasoning_level,
+        "deduplicate": deduplicate,
+    }
+    key = hashlib.sha256(json.dumps(key_inputs, sort_keys=True).encode("utf-8")).hexdigest()[:24]
+    return key, key_inputs
+
+
+def write_cache_index(
+    directory: str,
+    lengths: np.ndarray,
+    max_length: int,
+    metadata: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Write the offsets and meta.json for a token file already in ``directory``"""
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(os.path.join(directory, OFFSETS_FILE), offsets)
+    
+    meta = dict(metadata or {})
+    meta.update({
+        "num_examples": int(len(lengths)),
+        "num_tokens": int(offsets[-1]),
+        "max_length": max_length,
+        "num_truncated": int((lengths >= max_length).sum()),
+        "mean_length": float(lengths.mean()) if len(lengths) else 0.0,
+    })
+    with open(os.path.join(directory, META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def publish_cache_entry(tmp_dir: str, output_dir: str):
+    """Rename a finished entry into place unless another process already published it"""
+    try:
+        os.replace(tmp_dir, output_dir)
+    except OSError:
+        # Another process finished the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not TokenCache.exists(output_dir):
+            raise
+
+
+class TokenCache:
+    """Read-only, memory-mapped view over a token cache entry
+    
+    Indexing returns a numpy view into the mapped token file, so reading an
+    example copies nothing until the caller converts it.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._open()
+    
+    def _open(self):
+        self.offsets = np.load(os.path.join(self.path, OFFSETS_FILE), mmap_mode="r")
+        num_tokens = int(self.offsets[-1])
+        if num_tokens:
+            self.tokens = np.memmap(
+                os.path.join(self.path, TOKENS_FILE), dtype=TOKEN_DTYPE, mode="r", shape=(num_tokens,)
+            )
+        else:
+            self.tokens = np.zeros(0, dtype=TOKEN_DTYPE)
+        with open(os.path.join(self.path, META_FILE), "r") as f:
+            self.metadata = json.load(f)
+    
+    @staticmethod
+    def exists(path: str) -> bool:
+        return all(os.path.isfile(os.path.join(path, name)) for name in (TOKENS_FILE, OFFSETS_FILE, META_FILE))
+    
+    def __getstate__(self):
+        # Re-map in dataloader workers instead of pickling the token array
+        return {"path": self.path}
+    
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._open()
+    
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, idx: int) -> np.ndarray:
+        return self.tokens[self.offsets[idx]:self.offsets[idx + 1]]
+    
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
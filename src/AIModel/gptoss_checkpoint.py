@@ -0,0 +1,272 @@
+"""
+Asynchronous, sharded checkpointing for GPT-OSS LoRA fine-tuning.
+
+A checkpoint only stalls training for as long as it takes to copy the
+trainable LoRA weights and the optimizer state into host memory. A background
+thread then serializes the copies as safetensors (the optimizer state in
+shards of bounded size), writes the scheduler and trainer state, renames the
+finished directory into place and applies the checkpoint retention limit.
+
+Checkpoints use the file names the Hugging Face Trainer resumes from
+(adapter_model.safetensors, scheduler.pt, rng_state.pth, trainer_state.json),
+plus an optimizer index next to the shards, so resuming restores the adapter,
+optimizer, scheduler and RNG state and skips the batches already seen.
+"""
+
+import os
+import re
+import copy
+import json
+import time
+import shutil
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from safetensors.torch import load_file, save_file
+from peft import PeftModel, get_peft_model_state_dict
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PREFIX = "checkpoint"
+STAGING_SUFFIX = ".staging"
+ADAPTER_WEIGHTS_FILE = "adapter_model.safetensors"
+OPTIMIZER_INDEX_FILE = "optimizer.safetensors.index.json"
+SCHEDULER_FILE = "scheduler.pt"
+TRAINER_STATE_FILE = "trainer_state.json"
+
+_CHECKPOINT_RE = re.compile(rf"^{CHECKPOINT_PREFIX}-(\d+)$")
+
+
+def staging_dir(checkpoint_dir: str) -> str:
+    """Directory a checkpoint is assembled in before it is renamed to ``checkpoint_dir``"""
+    return checkpoint_dir + STAGING_SUFFIX
+
+
+def list_checkpoints(output_dir: str) -> List[Tuple[int, str]]:
+    """Finished checkpoints in ``output_dir`` as (step, path), oldest first"""
+    if not os.path.isdir(output_dir):
+        return []
+    checkpoints = []
+    for name in os.listdir(output_dir):
+        match = _CHECKPOINT_RE.match(name)
+        path = os.path.join(output_dir, name)
+        if match and os.path.isfile(os.path.join(path, TRAINER_STATE_FILE)):
+            checkpoints.append((int(match.group(1)), path))
+    return sorted(checkpoints)
+
+
+def latest_checkpoint(output_dir: str) -> Optional[str]:
+    checkpoints = list_checkpoints(output_dir)
+    return checkpoints[-1][1] if checkpoints else None
+
+
+def rotate_checkpoints(output_dir: str, save_total_limit: Optional[int], keep: Optional[str] = None):
+    """Delete the oldest checkpoints beyond ``save_total_limit``, never ``keep`` (the best one)"""
+    if not save_total_limit or save_total_limit <= 0:
+        return
+    checkpoints = [path for _, path in list_checkpoints(output_dir)]
+    keep = os.path.abspath(keep) if keep else None
+    excess = len(checkpoints) - save_total_limit
+    for path in checkpoints:
+        if excess <= 0:
+            break
+        if keep is not None and os.path.abspath(path) == keep:
+            continue
+        logger.info(f"Deleting older checkpoint {path} due to save_total_limit={save_total_limit}")
+        shutil.rmtree(path, ignore_errors=True)
+        excess -= 1
+
+
+def flatten_optimizer_state(state_dict: Dict[str, Any]) -> Tuple[Dict[str, torch.Tensor], Dict[str, Any]]:
+    """Split an optimizer state dict into named tensors and a JSON-serializable remainder"""
+    tensors = {}
+    state = {}
+    for param_id, param_state in state_dict["state"].items():
+        state[str(param_id)] = {}
+        for name, value in param_state.items():
+            if isinstance(value, torch.Tensor):
+                key = f"state.{param_id}.{name}"
+                tensors[key] = value
+                state[str(param_id)][name] = {"tensor": key}
+            else:
+                state[str(param_id)][name] = {"value": value}
+    return tensors, {"state": state, "param_groups": state_dict["param_groups"]}
+
+
+def unflatten_optimizer_state(tensors: Dict[str, torch.Tensor], meta: Dict[str, Any]) -> Dict[str, Any]:
+    state = {}
+    for param_id, param_state in meta["state"].items():
+        state[int(param_id)] = {
+            name: tensors[entry["tensor"]] if "tensor" in entry else entry["value"]
+            for name, entry in param_state.items()
+        }
+    return {"state": state, "param_groups": meta["param_groups"]}
+
+
+def save_sharded(tensors: Dict[str, torch.Tensor], directory: str, prefix: str, max_shard_bytes: int) -> Dict[str, str]:
+    """Write tensors as safetensors shards of at most ``max_shard_bytes`` each; returns key -> file"""
+    shards: List[Dict[str, torch.Tensor]] = [{}]
+    shard_bytes = 0
+    for key, tensor in tensors.items():
+        size = tensor.numel() * tensor.element_size()
+        if shards[-1] and shard_bytes + size > max_shard_bytes:
+            shards.append({})
+            shard_bytes = 0
+        shards[-1][key] = tensor
+        shard_bytes += size
+    
+    weight_map = {}
+    for index, shard in enumerate(shards):
+        filename = f"{prefix}-{index + 1:05d}-of-{len(shards):05d}.safetensors"
+        save_file(shard, os.path.join(directory, filename))
+        weight_map.update(dict.fromkeys(shard, filename))
+    return weight_map
+
+
+def has_sharded_optimizer(checkpoint_dir: str) -> bool:
+    return os.path.isfile(os.path.join(checkpoint_dir, OPTIMIZER_INDEX_FILE))
+
+
+def load_optimizer_state(checkpoint_dir: str) -> Dict[str, Any]:
+    """Read back an optimizer state dict written by AsyncCheckpointer"""
+    with open(os.path.join(checkpoint_dir, OPTIMIZER_INDEX_FILE)) as f:
+        index = json.load(f)
+    tensors = {}
+    for filename in sorted(set(index["weight_map"].values())):
+        tensors.update(load_file(os.path.join(checkpoint_dir, filename)))
+    return unflatten_optimizer_state(tensors, index["optimizer"])
+
+
+class AsyncCheckpointer:
+    """Snapshots adapter and optimizer state to host memory and writes it in the background
+    
+    Only one write is in flight at a time: a checkpoint requested while the
+    previous one is still being written first waits for it, which keeps host
+    memory bounded and lets the host buffers be reused. Errors from the
+    background write are raised by the next ``save`` or ``wait``.
+    
+    Args:
+        max_shard_bytes: upper bound on the size of each optimizer shard file
+        pin_memory: copy CUDA tensors into pinned buffers so the copy is fast
+            and the writer never touches device memory
+    """
+    
+    def __init__(self, max_shard_bytes: int = 2 * 1024 ** 3, pin_memory: bool = True):
+        self.max_shard_bytes = max_shard_bytes
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._buffers: Dict[str, torch.Tensor] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+        self.stats = {"checkpoints": 0, "wait_s": 0.0, "snapshot_s": 0.0, "write_s": 0.0, "bytes": 0}
+    
+    def _to_host(self, key: str, tensor: torch.Tensor) -> torch.Tensor:
+        tensor = tensor.detach()
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=self.pin_memory and tensor.is_cuda)
+            self._buffers[key] = buffer
+        buffer.copy_(tensor, non_blocking=buffer.is_pinned())
+        return buffer
+    
+    def save(
+        self,
+        checkpoint_dir: str,
+        model: PeftModel,
+        optimizer: Optional[torch.optim.Optimizer],
+        lr_scheduler: Optional[Any],
+        trainer_state: str,
+        save_total_limit: Optional[int] = None,
+        keep: Optional[str] = None
+    ):
+        """Copy the checkpoint state to host memory and write it to ``checkpoint_dir`` in the background
+        
+        Files already placed in ``staging_dir(checkpoint_dir)`` (such as the
+        per-rank RNG states) become part of the checkpoint.
+        """
+        start = time.perf_counter()
+        self.wait()
+        snapshot_start = time.perf_counter()
+        
+        adapter_weights = {
+            f"adapter.{name}": tensor for name, tensor in get_peft_model_state_dict(model).items()
+        }
+        optimizer_tensors, optimizer_meta = flatten_optimizer_state(optimizer.state_dict()) if optimizer is not None else ({}, None)
+        host = {key: self._to_host(key, tensor) for key, tensor in {**adapter_weights, **optimizer_tensors}.items()}
+        if self.pin_memory:
+            torch.cuda.synchronize()
+        
+        snapshot = {
+            "adapter": {key[len("adapter."):]: host[key] for key in adapter_weights},
+            "adapter_config": copy.deepcopy(model.peft_config[model.active_adapter]),
+            "optimizer": {key: host[key] for key in optimizer_tensors},
+            # Serialized now so a non-JSON optimizer setting fails the save instead of the writer
+            "optimizer_meta": json.dumps(optimizer_meta) if optimizer_meta is not None else None,
+            "scheduler": copy.deepcopy(lr_scheduler.state_dict()) if lr_scheduler is not None else None,
+            "trainer_state": trainer_state,
+        }
+        
+        now = time.perf_counter()
+        self.stats["wait_s"] += snapshot_start - start
+        self.stats["snapshot_s"] += now - snapshot_start
+        logger.info(
+            f"Checkpoint snapshot for {checkpoint_dir} took {(now - start) * 1000:.0f} ms "
+            f"({(snapshot_start - start) * 1000:.0f} ms waiting for the previous write)"
+        )
+        
+        # Not a daemon thread, so the interpreter finishes the write before exiting
+        self._thread = threading.Thread(
+            target=self._write,
+            args=(snapshot, checkpoint_dir, save_total_limit, keep),
+            name="checkpoint-writer"
+        )
+        self._thread.start()
+    
+    def wait(self):
+        """Block until the in-flight write, if any, is on disk"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing the previous checkpoint failed") from error
+    
+    def _write(self, snapshot: Dict[str, Any], checkpoint_dir: str, save_total_limit: Optional[int], keep: Optional[str]):
+        try:
+            start = time.perf_counter()
+            tmp_dir = staging_dir(checkpoint_dir)
+            os.makedirs(tmp_dir, exist_ok=True)
+            
+            save_file(snapshot["adapter"], os.path.join(tmp_dir, ADAPTER_WEIGHTS_FILE), metadata={"format": "pt"})
+            snapshot["adapter_config"].save_pretrained(tmp_dir)
+            
+            if snapshot["optimizer_meta"] is not None:
+                weight_map = save_sharded(snapshot["optimizer"], tmp_dir, "optimizer", self.max_shard_bytes)
+                with open(os.path.join(tmp_dir, OPTIMIZER_INDEX_FILE), "w") as f:
+                    f.write(f'{{"weight_map": {json.dumps(weight_map)}, "optimizer": {snapshot["optimizer_meta"]}}}')
+            if snapshot["scheduler"] is not None:
+                torch.save(snapshot["scheduler"], os.path.join(tmp_dir, SCHEDULER_FILE))
+            
+            # The trainer state goes last; checkpoints without it are never resumed from
+            with open(os.path.join(tmp_dir, TRAINER_STATE_FILE), "w") as f:
+                f.write(snapshot["trainer_state"])
+            
+            if os.path.isdir(checkpoint_dir):
+                shutil.rmtree(checkpoint_dir)
+            os.replace(tmp_dir, checkpoint_dir)
+            
+            elapsed = time.perf_counter() - start
+            num_bytes = sum(
+                tensor.numel() * tensor.element_size()
+                for tensor in list(snapshot["adapter"].values()) + list(snapshot["optimizer"].values())
+            )
+            self.stats["checkpoints"] += 1
+            self.stats["write_s"] += elapsed
+            self.stats["bytes"] += num_bytes
+            logger.info(f"Wrote checkpoint {checkpoint_dir} ({num_bytes / 1024 ** 2:.1f} MB) in the background in {elapsed:.2f}s")
+            
+            rotate_checkpoints(os.path.dirname(checkpoint_dir), save_total_limit, keep=keep)
+        except BaseException as e:
+            logger.error(f"Failed to write checkpoint {checkpoint_dir}: {e}")
+            self._error = e
@@ -0,0 +1,190 @@
+"""
+Sharded data-parallel (FSDP, ZeRO-3 style) training for GPT-OSS LoRA fine-tuning.
+
+With ``device_map="auto"`` every rank holds the whole model spread over its
+devices, so adding ranks adds throughput but no capacity. In sharded mode
+each rank is launched by torchrun and owns 1/world_size of every parameter,
+gradient and optimizer state; a decoder layer's weights are all-gathered just
+before its forward and backward pass and freed again afterwards.
+
+Frozen base weights and trainable LoRA weights are wrapped separately: every
+decoder layer is one FSDP unit for its frozen weights, and every LoRA
+projection is a unit of its own, so the frozen units never carry gradients or
+optimizer state. Parameters keep their original names and objects
+(``use_orig_params``), so the Trainer builds its optimizer as usual.
+
+Checkpoints are shard-aware: each rank writes its part of the optimizer state
+with torch.distributed.checkpoint (resumable with a different number of
+ranks), and the small LoRA weights are gathered unit by unit into a regular
+adapter_model.safetensors, without ever materializing the full base model.
+
+Every rank loads the base model on the host before it is sharded; load it with
+``mmap_weights`` so the ranks on a node share one copy of the weights in the
+page cache. With the gloo backend everything runs on CPU, so a sharded run can
+be tested on one machine:
+
+    torchrun --nproc_per_node 2 GptRoss.py train --sharding fsdp --distributed_backend gloo ...
+"""
+
+import os
+import logging
+import functools
+from contextlib import ExitStack
+from dataclasses import dataclass
+from typing import Dict, Tuple
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.distributed.checkpoint as dcp
+from torch.distributed.checkpoint.state_dict import StateDictOptions, get_optimizer_state_dict, set_optimizer_state_dict
+from torch.distributed.fsdp import BackwardPrefetch, CPUOffload, FullyShardedDataParallel as FSDP, ShardingStrategy
+from torch.distributed.fsdp.wrap import _or_policy, lambda_auto_wrap_policy, transformer_auto_wrap_policy
+
+from gptoss_activations import decoder_layers
+
+logger = logging.getLogger(__name__)
+
+SHARDING_STRATEGIES = {
+    "full_shard": ShardingStrategy.FULL_SHARD,  # parameters, gradients and optimizer state (ZeRO-3)
+    "shard_grad_op": ShardingStrategy.SHARD_GRAD_OP,  # gradients and optimizer state; parameters stay gathered between forward and backward (ZeRO-2)
+    "hybrid_shard": ShardingStrategy.HYBRID_SHARD,  # full_shard within a node, replicated across nodes
+    "no_shard": ShardingStrategy.NO_SHARD,  # plain data parallelism, for comparison
+}
+
+DISTRIBUTED_OPTIMIZER_DIR = "optimizer_distributed"
+
+# Prefix FSDP inserts into the names of the modules it wraps
+FSDP_WRAPPED_MODULE = "_fsdp_wrapped_module."
+
+
+@dataclass
+class ShardingConfig:
+    """How the model is partitioned across ranks"""
+    strategy: str = "full_shard"  # full_shard, shard_grad_op, hybrid_shard, no_shard
+    cpu_offload: bool = False  # keep parameter shards and their gradients in host memory between uses
+    forward_prefetch: bool = False  # issue the next layer's all-gather before the current forward finishes
+
+
+def init_distributed(backend: str = "auto") -> Tuple[int, int, int]:
+    """Join the process group torchrun describes in the environment
+    
+    ``backend`` "auto" uses nccl when GPUs are available and gloo otherwise.
+    Without a torchrun environment (RANK and WORLD_SIZE unset) nothing is
+    initialized. Returns (rank, world_size, local_rank).
+    """
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ and not dist.is_initialized():
+        if backend == "auto":
+            backend = "nccl" if torch.cuda.is_available() else "gloo"
+        dist.init_process_group(backend=backend)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+    if dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size(), local_rank
+    return 0, 1, local_rank
+
+
+def _is_trainable_leaf(module: nn.Module) -> bool:
+    """A module without children whose own parameters all train: LoRA A/B projections, modules_to_save"""
+    params = list(module.parameters(recurse=False))
+    return bool(params) and not any(True for _ in module.children()) and all(p.requires_grad for p in params)
+
+
+def lora_auto_wrap_policy(model: nn.Module):
+    """Wrap every trainable LoRA projection as its own unit and every decoder layer as a frozen unit"""
+    layer_classes = {type(layer) for layer in decoder_layers(model)}
+    if not layer_classes:
+        raise ValueError(f"{type(model).__name__} has no decoder layers to shard")
+    return functools.partial(
+        _or_policy,
+        policies=[
+            functools.partial(lambda_auto_wrap_policy, lambda_fn=_is_trainable_leaf),
+            functools.partial(transformer_auto_wrap_policy, transformer_layer_cls=layer_classes),
+        ]
+    )
+
+
+def _collective_device() -> torch.device:
+    if dist.get_backend() == "nccl":
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
+def broadcast_trainable(model: nn.Module):
+    """Give every rank rank 0's trainable weights; LoRA is initialized randomly on each rank"""
+    device = _collective_device()
+    for param in model.parameters():
+        if param.requires_grad:
+            buffer = param.data.to(device)
+            dist.broadcast(buffer, src=0)
+            param.data.copy_(buffer)
+
+
+def shard_model(model: nn.Module, config: ShardingConfig) -> FSDP:
+    """Partition ``model`` across the ranks of the default process group"""
+    if config.strategy not in SHARDING_STRATEGIES:
+        raise ValueError(f"Unknown sharding strategy {config.strategy!r}, expected one of {sorted(SHARDING_STRATEGIES)}")
+    if config.strategy == "hybrid_shard" and not torch.cuda.is_available():
+        raise ValueError("hybrid_shard derives its node groups from the GPUs per node and needs CUDA")
+    if not dist.is_initialized():
+        raise ValueError("Sharded training needs a process group; launch with torchrun")
+    
+    broadcast_trainable(model)
+    device = torch.device("cuda", torch.cuda.current_device()) if torch.cuda.is_available() else torch.device("cpu")
+    sharded = FSDP(
+        model,
+        auto_wrap_policy=lora_auto_wrap_policy(model),
+        sharding_strategy=SHARDING_STRATEGIES[config.strategy],
+        cpu_offload=CPUOffload(offload_params=config.cpu_offload),
+        backward_prefetch=BackwardPrefetch.BACKWARD_PRE,
+        forward_prefetch=config.forward_prefetch,
+        device_id=device,
+        use_orig_params=True,
+        limit_all_gathers=True
+    )
+    
+    units = FSDP.fsdp_modules(sharded)
+    trainable_units = sum(_is_trainable_leaf(unit.module) for unit in units)
+    local = sum(p.numel() for p in sharded.parameters())
+    logger.info(
+        f"Sharded the model over {dist.get_world_size()} ranks ({config.strategy}): {len(units) - trainable_units} frozen "
+        f"and {trainable_units} trainable units, {local:,} parameters held by this rank"
+    )
+    return sharded
+
+
+def gather_trainable_state_dict(sharded: FSDP) -> Dict[str, torch.Tensor]:
+    """Full host copies of the trainable parameters, named as in the unwrapped model
+    
+    Only the units of trainable LoRA weights are gathered. Every rank has to
+    call this, as it all-gathers.
+    """
+    state_dict = {}
+    with ExitStack() as stack:
+        for unit in FSDP.fsdp_modules(sharded):
+            if _is_trainable_leaf(unit.module):
+                stack.enter_context(FSDP.summon_full_params(unit, recurse=False, writeback=False))
+        for name, param in sharded.module.named_parameters():
+            if param.requires_grad:
+                state_dict[name.replace(FSDP_WRAPPED_MODULE, "")] = param.detach().to("cpu", copy=True)
+    return state_dict
+
+
+def has_distributed_optimizer(checkpoint: str) -> bool:
+    return os.path.isdir(os.path.join(checkpoint, DISTRIBUTED_OPTIMIZER_DIR))
+
+
+def save_distributed_optimizer(sharded: FSDP, optimizer: torch.optim.Optimizer, checkpoint: str):
+    """Each rank writes its shards of the optimizer state into ``checkpoint``"""
+    state = {"optimizer": get_optimizer_state_dict(sharded, optimizer, options=StateDictOptions(ignore_frozen_params=True))}
+    dcp.save(state, checkpoint_id=os.path.join(checkpoint, DISTRIBUTED_OPTIMIZER_DIR))
+
+
+def load_distributed_optimizer(sharded: FSDP, optimizer: torch.optim.Optimizer, checkpoint: str):
+    """Restore the optimizer state written by ``save_distributed_optimizer``, resharded to this world size"""
+    options = StateDictOptions(ignore_frozen_params=True)
+    # The template initializes the optimizer state, so loading knows every tensor's shape
+    state = {"optimizer": get_optimizer_state_dict(sharded, optimizer, options=options)}
+    dcp.load(state, checkpoint_id=os.path.join(checkpoint, DISTRIBUTED_OPTIMIZER_DIR))
+    set_optimizer_state_dict(sharded, optimizer, state["optimizer"], options=options)
@@ -0,0 +1,595 @@
+"""
+Generation-based evaluation for GPT-OSS fine-tunes.
+
+The trainer's evaluation only reports loss. This module generates a response
+for every example of an eval JSONL, in length-sorted batches with greedy
+decoding, and scores it:
+
+- exact match of the answer (the <answer> tag of the response if present,
+  else the whole response) against the reference ("answer" field, else the
+  <answer> tag of or the whole "assistant" response), after normalizing case
+  and whitespace
+- reasoning-format compliance: the response consists of the required tags in
+  order, by default <reasoning>...</reasoning> then <answer>...</answer>,
+  plus how often each tag appears at all
+- completion length statistics and how often generation hit max_new_tokens
+
+Per-example outputs are cached in SQLite, keyed by a fingerprint of the base
+model, tokenizer and adapter weights together with the prompt token ids and
+generation settings. Re-evaluating an unchanged checkpoint, or any subset of
+an evaluated set, generates nothing. Metrics are recomputed from the cached
+responses, so changing how responses are scored needs no regeneration.
+
+During training, GenerationEvalCallback copies the adapter to host memory
+every few steps and evaluates it in a separate process, so the training step
+never waits for generation; results are logged as gen_eval_* metrics once the
+process finishes.
+
+Usage:
+    python gptoss_eval.py --load_model ./gpt-oss-120b-finetuned --eval_data eval.jsonl --output metrics.json
+    python GptRoss.py evaluate --load_model ./gpt-oss-120b-finetuned --eval_data eval.jsonl  # same
+"""
+
+import os
+import re
+import sys
+import copy
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+import dataclasses
+import traceback
+import subprocess
+from dataclasses import dataclass, field, asdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import torch
+from safetensors.torch import save_file
+from peft import PeftModel, get_peft_model_state_dict
+from transformers import TrainerCallback
+
+from gptoss_batch import BatchInferenceConfig, make_batches
+from gptoss_cache import tokenizer_fingerprint
+from gptoss_profiling import percentiles
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+
+
+@dataclass
+class GenerationEvalConfig:
+    """What to generate for and how to score it"""
+    batch_size: int = 16
+    max_new_tokens: int = 512
+    max_examples: Optional[int] = None  # evaluate only the first N examples
+    reasoning_level: str = "medium"  # for examples without a "reasoning_level" field
+    required_tags: List[str] = field(default_factory=lambda: ["reasoning", "answer"])
+    cache_path: Optional[str] = None  # SQLite file of per-example outputs, None disables caching
+
+
+class GenerationCache:
+    """Generated responses in an SQLite file, shared safely by concurrent evaluations"""
+    
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "key TEXT PRIMARY KEY, response TEXT, completion_tokens INTEGER, finish_reason TEXT, created REAL)"
+        )
+        self.connection.commit()
+    
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        keys = list(keys)
+        found = {}
+        # SQLite limits the number of bound parameters per statement
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT key, response, completion_tokens, finish_reason FROM outputs WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+            for key, response, completion_tokens, finish_reason in rows:
+                found[key] = {"response": response, "completion_tokens": completion_tokens, "finish_reason": finish_reason}
+        return found
+    
+    def put_many(self, records: Dict[str, Dict[str, Any]]):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)",
+                [(key, r["response"], r["completion_tokens"], r["finish_reason"], now) for key, r in records.items()]
+            )
+    
+    def close(self):
+        self.connection.close()
+
+
+def _hash_tensors(hasher, tensors: Dict[str, torch.Tensor]):
+    for name in sorted(tensors):
+        tensor = tensors[name].detach().to("cpu").contiguous()
+        hasher.update(name.encode("utf-8"))
+        hasher.update(str(tensor.dtype).encode("utf-8"))
+        hasher.update(tensor.view(torch.uint8).numpy().tobytes())
+
+
+def _json_default(value):
+    # Sets (peft's target_modules) print in a per-process order
+    return sorted(value, key=str) if isinstance(value, (set, frozenset)) else str(value)
+
+
+def model_fingerprint(fine_tuner) -> str:
+    """Hash the base model identity, the tokenizer and the active adapter's weights
+    
+    A model with merged adapters is no longer a PeftModel and is identified
+    by its base model only, so evaluate it without a cache.
+    """
+    model_config = fine_tuner.model_config
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps({
+        "format_version": CACHE_FORMAT_VERSION,
+        "model_name": model_config.model_name,
+        "model_revision": model_config.model_revision,
+        "torch_dtype": model_config.torch_dtype,
+        "quantization": model_config.quantization,
+    }, sort_keys=True).encode("utf-8"))
+    hasher.update(tokenizer_fingerprint(fine_tuner.tokenizer).encode("utf-8"))
+    model = fine_tuner.model
+    if isinstance(model, PeftModel):
+        adapter = model.active_adapter
+        hasher.update(json.dumps(model.peft_config[adapter].to_dict(), sort_keys=True, default=_json_default).encode("utf-8"))
+        _hash_tensors(hasher, get_peft_model_state_dict(model, adapter_name=adapter))
+    return hasher.hexdigest()
+
+
+def example_key(fingerprint: str, prompt_ids: List[int], max_new_tokens: int) -> str:
+    payload = json.dumps({"model": fingerprint, "prompt": prompt_ids, "max_new_tokens": max_new_tokens, "greedy": True})
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def extract_tag(text: str, tag: str) -> Optional[str]:
+    """Content of the first <tag>...</tag> in ``text``"""
+    match = re.search(rf"<{tag}>(.*?)</{tag}>", text, re.DOTALL)
+    return match.group(1).strip() if match else None
+
+
+def normalize_answer(text: str) -> str:
+    return " ".join(text.lower().split()).rstrip(".")
+
+
+def follows_format(text: str, required_tags: List[str]) -> bool:
+    """Whether ``text`` is exactly the required tags, in order, each with content"""
+    pattern = r"\s*".join(rf"<{tag}>\s*\S.*?</{tag}>" for tag in required_tags)
+    return re.fullmatch(rf"\s*{pattern}\s*", text, re.DOTALL) is not None
+
+
+def reference_answer(item: Dict[str, Any]) -> str:
+    if "answer" in item:
+        return str(item["answer"])
+    reference = item.get("assistant", item.get("response", ""))
+    return extract_tag(reference, "answer") or reference
+
+
+def score_example(item: Dict[str, Any], output: Dict[str, Any], required_tags: List[str]) -> Dict[str, Any]:
+    """Per-example metrics of one generated response"""
+    response = output["response"]
+    predicted = extract_tag(response, "answer")
+    scores = {
+        "exact_match": normalize_answer(predicted if predicted is not None else response) == normalize_answer(reference_answer(item)),
+        "format_compliant": follows_format(response, required_tags),
+        "completion_tokens": output["completion_tokens"],
+        "response_chars": len(response),
+        "truncated": output["finish_reason"] == "length",
+    }
+    for tag in required_tags:
+        scores[f"has_{tag}"] = extract_tag(response, tag) is not None
+    return scores
+
+
+def aggregate_scores(scores: List[Dict[str, Any]], required_tags: List[str]) -> Dict[str, Any]:
+    if not scores:
+        return {"examples": 0}
+    
+    def rate(name: str) -> float:
+        return sum(bool(score[name]) for score in scores) / len(scores)
+    
+    metrics = {
+        "examples": len(scores),
+        "exact_match": rate("exact_match"),
+        "format_compliance": rate("format_compliant"),
+        "truncated_rate": rate("truncated"),
+        "completion_tokens": percentiles([score["completion_tokens"] for score in scores]),
+        "response_chars_mean": sum(score["response_chars"] for score in scores) / len(scores),
+    }
+    for tag in required_tags:
+        metrics[f"{tag}_tag_rate"] = rate(f"has_{tag}")
+    return metrics
+
+
+def read_eval_examples(eval_path: str, max_examples: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Eval items that have a user prompt and a reference, in file order"""
+    examples = []
+    skipped = 0
+    with open(eval_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if max_examples is not None and len(examples) >= max_examples:
+                break
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                skipped += 1
+                continue
+            if not isinstance(item, dict) or not isinstance(item.get("user", item.get("prompt")), str) or not any(
+                key in item for key in ("answer", "assistant", "response")
+            ):
+                skipped += 1
+                continue
+            examples.append(item)
+    if skipped:
+        logger.warning(f"Skipped {skipped} eval lines without a prompt and a reference")
+    return examples
+
+
+def evaluate_generation(
+    fine_tuner,
+    eval_path: str,
+    config: Optional[GenerationEvalConfig] = None,
+    examples_output: Optional[str] = None
+) -> Dict[str, Any]:
+    """Generate for the examples of ``eval_path`` with the loaded model and score the responses
+    
+    Returns the aggregate metrics plus how many responses came from the cache.
+    ``examples_output`` receives one JSON line per example with its response
+    and scores.
+    """
+    config = config or GenerationEvalConfig()
+    if fine_tuner.model is None or fine_tuner.tokenizer is None:
+        raise ValueError("Model and tokenizer must be loaded first")
+    start = time.perf_counter()
+    
+    examples = read_eval_examples(eval_path, config.max_examples)
+    prompt_ids = [
+        fine_tuner._encode_generation_prompt(
+            item.get("user", item.get("prompt")),
+            item.get("reasoning_level", config.reasoning_level),
+            item.get("system")
+        )
+        for item in examples
+    ]
+    fingerprint = model_fingerprint(fine_tuner)
+    keys = [example_key(fingerprint, ids, config.max_new_tokens) for ids in prompt_ids]
+    
+    cache = GenerationCache(config.cache_path) if config.cache_path else None
+    outputs = cache.get_many(set(keys)) if cache is not None else {}
+    missing = {}
+    for index, key in enumerate(keys):
+        if key not in outputs and key not in missing:
+            missing[key] = index
+    cached = sum(key in outputs for key in keys)
+    
+    model = fine_tuner.model
+    was_training = model.training
+    model.eval()
+    try:
+        batch_config = BatchInferenceConfig(batch_size=config.batch_size, max_new_tokens=config.max_new_tokens)
+        for batch in make_batches([(index, len(prompt_ids[index])) for index in missing.values()], batch_config):
+            results = fine_tuner._generate_batch_ids(
+                [prompt_ids[index] for index in batch],
+                max_new_tokens=config.max_new_tokens,
+                do_sample=False
+            )
+            generated = {
+                keys[index]: {
+                    "response": fine_tuner.tokenizer.decode(completion, skip_special_tokens=True).strip(),
+                    "completion_tokens": len(completion),
+                    "finish_reason": finish_reason,
+                }
+                for index, (completion, finish_reason) in zip(batch, results)
+            }
+            outputs.update(generated)
+            # Stored per batch so an interrupted evaluation keeps what it generated
+            if cache is not None:
+                cache.put_many(generated)
+    finally:
+        if was_training:
+            model.train()
+        if cache is not None:
+            cache.close()
+    
+    scores = [score_example(item, outputs[key], config.required_tags) for item, key in zip(examples, keys)]
+    metrics = aggregate_scores(scores, config.required_tags)
+    metrics.update({
+        "cached": cached,
+        "generated": len(missing),
+        "elapsed_s": time.perf_counter() - start,
+    })
+    
+    if examples_output:
+        with open(examples_output, "w", encoding="utf-8") as f:
+            for index, (item, key, score) in enumerate(zip(examples, keys, scores)):
+                record = {"index": index, "id": item.get("id"), **outputs[key], **score}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    
+    logger.info(
+        f"Generation eval on {metrics['examples']} examples ({cached} cached, {len(missing)} generated): "
+        f"exact match {metrics.get('exact_match', 0):.2%}, format compliance {metrics.get('format_compliance', 0):.2%}"
+    )
+    return metrics
+
+
+class GenerationEvalCallback(TrainerCallback):
+    """Runs the generation eval on snapshots of the adapter in a background process
+    
+    Every ``eval_steps`` optimizer steps the adapter weights are copied to host
+    memory on the training thread; a background thread writes them out and
+    runs ``gptoss_eval.py`` on them with its own copy of the base model (map
+    the weights with ``mmap_weights`` to share host memory, and give it a
+    spare device with ``device_map``). Only one evaluation runs at a time: a
+    due evaluation is skipped while the previous one is still running. Results
+    are logged as gen_eval_* entries from the training thread once available,
+    and the evaluation still running when training ends is waited for.
+    
+    Args:
+        model_config: ModelConfig the evaluation process loads its base model with
+        eval_path: eval JSONL
+        eval_steps: evaluate every this many optimizer steps
+        work_dir: where adapter snapshots, results and the history are written
+        config: generation eval settings; the cache defaults to work_dir/cache.sqlite
+        max_prompt_length: prompts are truncated to this many tokens
+        use_reasoning_tokens: format prompts with the reasoning-level system preamble
+        tokenizer: the training tokenizer, saved for the evaluation process when
+            it differs from the base model's (added special tokens)
+    """
+    
+    def __init__(
+        self,
+        model_config,
+        eval_path: str,
+        eval_steps: int,
+        work_dir: str,
+        config: Optional[GenerationEvalConfig] = None,
+        max_prompt_length: int = 2048,
+        use_reasoning_tokens: bool = True,
+        tokenizer=None
+    ):
+        self.model_config = model_config
+        self.eval_path = eval_path
+        self.eval_steps = eval_steps
+        self.work_dir = work_dir
+        self.config = config or GenerationEvalConfig()
+        if self.config.cache_path is None:
+            self.config.cache_path = os.path.join(work_dir, "cache.sqlite")
+        self.max_prompt_length = max_prompt_length
+        self.use_reasoning_tokens = use_reasoning_tokens
+        self.tokenizer = tokenizer
+        self.trainer = None
+        self._thread: Optional[threading.Thread] = None
+        self._finished: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self.history: List[Dict[str, Any]] = []
+    
+    def attach(self, trainer):
+        self.trainer = trainer
+        trainer.add_callback(self)
+    
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+    
+    def _snapshot(self, model: PeftModel) -> Tuple[Dict[str, torch.Tensor], Any]:
+        adapter = model.active_adapter
+        if getattr(self.trainer, "sharded_model", None) is not None:
+            weights = self.trainer.adapter_state_dict()
+        else:
+            weights = {name: tensor.detach().to("cpu", copy=True) for name, tensor in get_peft_model_state_dict(model, adapter_name=adapter).items()}
+        adapter_config = copy.deepcopy(model.peft_config[adapter])
+        adapter_config.inference_mode = True
+        return weights, adapter_config
+    
+    def _command(self, step_dir: str) -> List[str]:
+        command = [
+            sys.executable, os.path.abspath(__file__),
+            "--model_config", os.path.join(self.work_dir, "model_config.json"),
+            "--load_model", os.path.join(step_dir, "adapter"),
+            "--eval_data", self.eval_path,
+            "--cache", self.config.cache_path,
+            "--output", os.path.join(step_dir, "metrics.json"),
+            "--examples_output", os.path.join(step_dir, "examples.jsonl"),
+            "--batch_size", str(self.config.batch_size),
+            "--max_new_tokens", str(self.config.max_new_tokens),
+            "--max_prompt_length", str(self.max_prompt_length),
+            "--reasoning_level", self.config.reasoning_level,
+            "--required_tags", *self.config.required_tags,
+        ]
+        if self.tokenizer is not None:
+            command += ["--tokenizer", os.path.join(self.work_dir, "tokenizer")]
+        if self.config.max_examples is not None:
+            command += ["--max_examples", str(self.config.max_examples)]
+        if not self.use_reasoning_tokens:
+            command.append("--no_reasoning_tokens")
+        return command
+    
+    def _run(self, step: int, weights: Dict[str, torch.Tensor], adapter_config):
+        step_dir = os.path.join(self.work_dir, f"step-{step}")
+        result = {"step": step}
+        try:
+            adapter_dir = os.path.join(step_dir, "adapter")
+            os.makedirs(adapter_dir, exist_ok=True)
+            save_file(weights, os.path.join(adapter_dir, "adapter_model.safetensors"), metadata={"format": "pt"})
+            adapter_config.save_pretrained(adapter_dir)
+            
+            # The Hugging Face token reaches the evaluation process through its environment, never a file
+            env = dict(os.environ)
+            if isinstance(self.model_config.use_auth_token, str):
+                env["HF_TOKEN"] = self.model_config.use_auth_token
+            
+            start = time.perf_counter()
+            with open(os.path.join(step_dir, "eval.log"), "w") as log:
+                completed = subprocess.run(self._command(step_dir), stdout=log, stderr=subprocess.STDOUT, env=env)
+            if completed.returncode != 0:
+                raise RuntimeError(f"exited with code {completed.returncode}, see {os.path.join(step_dir, 'eval.log')}")
+            with open(os.path.join(step_dir, "metrics.json")) as f:
+                result["metrics"] = json.load(f)
+            result["wall_s"] = time.perf_counter() - start
+        except Exception as e:
+            logger.error(f"Generation eval of step {step} failed: {e}")
+            result["error"] = str(e)
+        with self._lock:
+            self._finished.append(result)
+    
+    def _start(self, step: int, weights: Dict[str, torch.Tensor], adapter_config):
+        if self.running:
+            logger.warning(f"Skipping the generation eval of step {step}: the previous one is still running")
+            return
+        self._thread = threading.Thread(target=self._run, args=(step, weights, adapter_config), name="generation-eval")
+        self._thread.start()
+    
+    def _log_finished(self):
+        with self._lock:
+            finished, self._finished = self._finished, []
+        for result in finished:
+            self.history.append(result)
+            with open(os.path.join(self.work_dir, "history.jsonl"), "a") as f:
+                f.write(json.dumps(result) + "\n")
+            metrics = result.get("metrics")
+            if metrics is None or self.trainer is None:
+                continue
+            logs = {"gen_eval_step": result["step"]}
+            for name, value in metrics.items():
+                if isinstance(value, dict):
+                    logs.update({f"gen_eval_{name}_{stat}": v for stat, v in value.items()})
+                else:
+                    logs[f"gen_eval_{name}"] = value
+            self.trainer.log(logs)
+    
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        if not state.is_world_process_zero:
+            return
+        os.makedirs(self.work_dir, exist_ok=True)
+        model_config = asdict(self.model_config)
+        # The output directory is routinely copied or pushed; _run passes the token as HF_TOKEN instead
+        model_config.pop("use_auth_token", None)
+        with open(os.path.join(self.work_dir, "model_config.json"), "w") as f:
+            json.dump(model_config, f, indent=2)
+        if self.tokenizer is not None:
+            self.tokenizer.save_pretrained(os.path.join(self.work_dir, "tokenizer"))
+    
+    def on_step_end(self, args, state, control, model=None, **kwargs):
+        sharded = getattr(self.trainer, "sharded_model", None) is not None
+        if state.is_world_process_zero:
+            self._log_finished()
+        # With a sharded model every rank takes part in gathering the adapter
+        if not (state.is_world_process_zero or sharded) or self.eval_steps <= 0 or state.global_step % self.eval_steps:
+            return
+        if not isinstance(model, PeftModel):
+            logger.warning("The generation eval callback needs a model with LoRA adapters")
+            return
+        weights, adapter_config = self._snapshot(model)
+        if state.is_world_process_zero:
+            self._start(state.global_step, weights, adapter_config)
+    
+    def on_train_end(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+        if self._thread is not None:
+            self._thread.join()
+        self._log_finished()
+
+
+def _load_model_config(path: str, model_config_cls):
+    with open(path) as f:
+        fields = json.load(f)
+    if isinstance(fields.get("max_memory"), dict):
+        # JSON turned GPU indices into strings
+        fields["max_memory"] = {int(k) if str(k).isdigit() else k: v for k, v in fields["max_memory"].items()}
+    return model_config_cls(**fields)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Score a model's generations on an eval JSONL (exact match, tag format, lengths)")
+    parser.add_argument("--eval_data", type=str, required=True, help="JSONL with 'user' or 'prompt' and 'answer' or 'assistant' fields")
+    parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    parser.add_argument("--model_config", type=str, help="JSON file of ModelConfig fields; overrides the model options")
+    parser.add_argument("--load_model", type=str, help="Load fine-tuned adapters from this path")
+    parser.add_argument("--tokenizer", type=str, help="Tokenizer path (default: the one saved with --load_model, else the base model's)")
+    parser.add_argument("--torch_dtype", type=str, default="bfloat16", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--attn_implementation", type=str, default="flash_attention_2", help="Attention implementation")
+    parser.add_argument("--mmap_weights", action="store_true", help="Map the base weights from safetensors")
+    parser.add_argument("--batch_size", type=int, default=16, help="Prompts generated together")
+    parser.add_argument("--max_new_tokens", type=int, default=512)
+    parser.add_argument("--max_examples", type=int, help="Evaluate only the first N examples")
+    parser.add_argument("--max_prompt_length", type=int, default=2048, help="Prompts are truncated to this many tokens")
+    parser.add_argument("--reasoning_level", type=str, default="medium", choices=["low", "medium", "high"])
+    parser.add_argument("--no_reasoning_tokens", action="store_true", help="Format prompts without the reasoning-level preamble")
+    parser.add_argument("--required_tags", type=str, nargs="+", default=["reasoning", "answer"], help="Tags a compliant response consists of, in order")
+    parser.add_argument("--cache", type=str, default="./generation_eval.sqlite", help="SQLite cache of per-example outputs")
+    parser.add_argument("--no_cache", action="store_true", help="Generate everything and cache nothing")
+    parser.add_argument("--output", type=str, help="Write the metrics to this JSON file")
+    parser.add_argument("--examples_output", type=str, help="Write per-example responses and scores to this JSONL file")
+    args = parser.parse_args(argv)
+    
+    from gptoss_finetune import ModelConfig, LoRAConfig, TrainingConfig, GPTOSSFineTuner
+    
+    try:
+        if args.model_config:
+            model_config = _load_model_config(args.model_config, ModelConfig)
+        else:
+            model_config = ModelConfig(
+                model_name=args.model_name,
+                torch_dtype=args.torch_dtype,
+                attn_implementation=args.attn_implementation,
+                mmap_weights=args.mmap_weights
+            )
+        model_config.prefix_cache_mb = 0
+        training_config = TrainingConfig(
+            max_length=args.max_prompt_length,
+            use_reasoning_tokens=not args.no_reasoning_tokens,
+            report_to="none"
+        )
+        fine_tuner = GPTOSSFineTuner(model_config, LoRAConfig(inference_mode=True), training_config)
+        tokenizer_path = args.tokenizer
+        if tokenizer_path is None and args.load_model and os.path.isfile(os.path.join(args.load_model, "tokenizer_config.json")):
+            tokenizer_path = args.load_model
+        if tokenizer_path:
+            # A tokenizer with added special tokens; load_model resizes the embeddings to match it
+            fine_tuner.model_config = dataclasses.replace(model_config, model_name=tokenizer_path)
+            fine_tuner.load_tokenizer()
+            fine_tuner.model_config = model_config
+        else:
+            fine_tuner.load_tokenizer()
+        if args.load_model:
+            fine_tuner.load_finetuned_model(args.load_model)
+        else:
+            fine_tuner.load_model()
+        
+        config = GenerationEvalConfig(
+            batch_size=args.batch_size,
+            max_new_tokens=args.max_new_tokens,
+            max_examples=args.max_examples,
+            reasoning_level=args.reasoning_level,
+            required_tags=args.required_tags,
+            cache_path=None if args.no_cache else args.cache
+        )
+        metrics = evaluate_generation(fine_tuner, args.eval_data, config, examples_output=args.examples_output)
+        print(json.dumps(metrics, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(metrics, f, indent=2)
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
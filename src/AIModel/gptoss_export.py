@@ -0,0 +1,450 @@
+"""
+Streaming export of a base checkpoint with a LoRA adapter merged into it.
+
+``GPTOSSFineTuner.merge_and_unload`` merges in place on the loaded model, so
+exporting a merged GPT-OSS-120B needs the whole model resident. This exporter
+never loads the model: it rewrites the base checkpoint's safetensors files one
+at a time, in a pool of worker processes (one file per task):
+
+- tensors no adapter weight touches are copied byte for byte
+- LoRA targets get ``scaling * B @ A`` added in fp32, ``chunk_mb`` of rows
+  at a time, and are written back in their stored dtype
+- expert LoRA blocks (``gptoss_moe.ExpertLoRA``) add their per-expert update
+  to the adapted experts of the stacked ``[experts, in, out]`` tensors. This
+  needs dense expert weights: the released gpt-oss checkpoints store experts
+  as MXFP4 ``*_blocks``/``*_scales``, which are rejected before anything is
+  written; export against a dequantized copy of the base model instead
+- ``modules_to_save`` weights replace the base tensors
+
+Each worker holds one row chunk and the adapter weights of its file, so peak
+memory is well below one shard per worker regardless of the shard size.
+
+Every file is written under a temporary name while its SHA-256 is computed,
+read back and checked against that digest, and only then renamed into place.
+The digests go to ``checksums.sha256`` (``sha256sum -c`` format), which
+``verify`` checks again later, e.g. after copying the export elsewhere.
+
+    python gptoss_export.py merge --base_model openai/gpt-oss-120b --adapter ./gpt-oss-120b-finetuned --output_dir ./merged --workers 8
+    python gptoss_export.py verify ./merged
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+
+from gptoss_mmap import SAFETENSORS_DTYPES, SAFETENSORS_FILE, SAFETENSORS_INDEX_FILE, resolve_model_dir, safetensors_files
+
+logger = logging.getLogger(__name__)
+
+ADAPTER_CONFIG_FILE = "adapter_config.json"
+ADAPTER_WEIGHTS_FILE = "adapter_model.safetensors"
+CHECKSUMS_FILE = "checksums.sha256"
+# Files of the adapter directory that replace the base model's
+TOKENIZER_FILES = ("tokenizer.json", "tokenizer_config.json", "special_tokens_map.json", "chat_template.jinja")
+# Prefix of the adapter's tensor names in front of the base model's
+PEFT_PREFIX = "base_model.model."
+
+# Bytes copied at a time for tensors that are not merged
+COPY_BUFFER_BYTES = 16 * 1024 * 1024
+SAFETENSORS_DTYPE_NAMES = {dtype: name for name, dtype in SAFETENSORS_DTYPES.items()}
+
+
+@dataclass
+class ExportConfig:
+    """How the merged checkpoint is written"""
+    workers: int = 4  # files merged in parallel, one process each
+    chunk_mb: int = 256  # rows of a merged tensor processed at a time
+    verify: bool = True  # read every written file back and check its SHA-256
+
+
+@dataclass
+class Merge:
+    """What happens to one base tensor"""
+    kind: Optional[str] = None  # lora (W += scaling * B @ A), transposed (W += scaling * (B @ A).T), bias (b += scaling * B.bias), experts (W[e] += scaling * (B[i] @ A[i]).T) or None
+    keys: Tuple[str, ...] = ()  # adapter tensors the update reads; experts: A, B and the adapted expert indices
+    scaling: float = 1.0
+    base: Optional[str] = None  # adapter tensor saved in full that replaces the stored one before the update
+
+
+def _pattern_value(patterns: Dict[str, Any], module: str, default: Any) -> Any:
+    """rank_pattern/alpha_pattern lookup as PEFT does it: the first pattern that matches the end of the module name"""
+    for pattern, value in patterns.items():
+        if re.match(rf"(.*\.)?({pattern})$", module):
+            return value
+    return default
+
+
+def _scaling(config: Dict[str, Any], module: str) -> float:
+    r = _pattern_value(config.get("rank_pattern") or {}, module, config["r"])
+    alpha = _pattern_value(config.get("alpha_pattern") or {}, module, config["lora_alpha"])
+    return alpha / (r ** 0.5 if config.get("use_rslora") else r)
+
+
+def plan_merges(adapter_dir: str) -> Dict[str, Merge]:
+    """Base tensor name -> the merge it needs, from an adapter saved by ``save_model``"""
+    with open(os.path.join(adapter_dir, ADAPTER_CONFIG_FILE)) as f:
+        config = json.load(f)
+    if config.get("peft_type", "LORA") != "LORA":
+        raise ValueError(f"Only LoRA adapters can be merged, got {config['peft_type']}")
+    for option in ("use_dora", "target_parameters", "trainable_token_indices", "layer_replication"):
+        if config.get(option):
+            raise ValueError(f"Merging adapters with {option} is not supported by the streaming exporter; use merge_and_unload")
+    
+    with safe_open(os.path.join(adapter_dir, ADAPTER_WEIGHTS_FILE), framework="pt") as f:
+        keys = list(f.keys())
+    
+    merges, full = {}, {}
+    for key in keys:
+        name = key[len(PEFT_PREFIX):] if key.startswith(PEFT_PREFIX) else key
+        match = re.match(r"(.+)\.lora_A\.([^.]+)$", name)
+        if match and match.group(2) != "weight":
+            # Expert block: <module>.lora_A.<weight> adapts the stacked <module>.<weight>
+            module, weight = match.groups()
+            b_key, experts_key = key.replace(".lora_A.", ".lora_B."), key[:-len(f".lora_A.{weight}")] + ".lora_experts"
+            if b_key not in keys or experts_key not in keys:
+                raise ValueError(f"{key} has no matching {b_key} and {experts_key} in {adapter_dir}")
+            merges[f"{module}.{weight}"] = Merge("experts", (key, b_key, experts_key), _scaling(config, module))
+            continue
+        match = re.match(r"(.+)\.(lora_A|lora_embedding_A)(?:\.weight)?$", name)
+        if match:
+            module, kind = match.groups()
+            b_key = key.replace(".lora_A", ".lora_B").replace(".lora_embedding_A", ".lora_embedding_B")
+            if b_key not in keys:
+                raise ValueError(f"{key} has no matching {b_key} in {adapter_dir}")
+            scaling = _scaling(config, module)
+            transposed = kind == "lora_embedding_A" or config.get("fan_in_fan_out", False)
+            merges[f"{module}.weight"] = Merge("transposed" if transposed else "lora", (key, b_key), scaling)
+            bias_key = b_key[:-len(".weight")] + ".bias" if b_key.endswith(".weight") else None
+            if bias_key in keys:
+                merges[f"{module}.bias"] = Merge("bias", (bias_key,), scaling)
+        elif not re.search(r"\.lora_(B|embedding_B)(\.[^.]+)?$|\.lora_experts$", name):
+            # modules_to_save, and embedding layers saved in full as <module>.base_layer.weight
+            full[name.replace(".base_layer.", ".")] = key
+    for name, key in full.items():
+        merges.setdefault(name, Merge()).base = key
+    return merges
+
+
+def _read_header(path: str) -> Tuple[Dict[str, Any], int]:
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+
+def _encode_header(header: Dict[str, Any]) -> bytes:
+    encoded = json.dumps(header, separators=(",", ":")).encode()
+    # Pad so the tensor data starts 8-byte aligned
+    encoded += b" " * ((-len(encoded)) % 8)
+    return len(encoded).to_bytes(8, "little") + encoded
+
+
+class _HashingWriter:
+    """File writer that feeds every byte into a SHA-256"""
+    
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+    
+    def write(self, data):
+        self.f.write(data)
+        self.sha256.update(data)
+        self.bytes += memoryview(data).nbytes
+
+
+def _tensor_bytes(tensor: torch.Tensor) -> memoryview:
+    return memoryview(tensor.contiguous().view(torch.uint8).numpy())
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(COPY_BUFFER_BYTES)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _init_worker(threads: int):
+    torch.set_num_threads(threads)
+
+
+def _log_file(result: Dict[str, Any]) -> Dict[str, Any]:
+    logger.info(f"{result['file']}: {result['merged']} tensors merged, {result['bytes'] / 1024 ** 2:.0f} MB in {result['seconds']:.1f}s")
+    return result
+
+
+def merge_file(source: str, target: str, adapter_path: str, merges: Dict[str, Merge], chunk_mb: int = 256, verify: bool = True) -> Dict[str, Any]:
+    """Write ``source`` with ``merges`` applied to ``target``; runs in a worker process"""
+    start = time.perf_counter()
+    header, data_start = _read_header(source)
+    metadata = header.pop("__metadata__", None)
+    names = sorted(header, key=lambda name: header[name]["data_offsets"][0])
+    
+    with safe_open(adapter_path, framework="pt") as f:
+        adapter = {
+            key: f.get_tensor(key)
+            for name in names if name in merges
+            for key in merges[name].keys + ((merges[name].base,) if merges[name].base else ())
+        }
+    
+    # Replaced tensors may change shape (embeddings resized for added tokens)
+    out_header = {} if metadata is None else {"__metadata__": metadata}
+    offset = 0
+    for name in names:
+        dtype_name, shape = header[name]["dtype"], header[name]["shape"]
+        if name in merges and merges[name].base:
+            shape = list(adapter[merges[name].base].shape)
+        size = SAFETENSORS_DTYPES[dtype_name].itemsize
+        for dim in shape:
+            size *= dim
+        out_header[name] = {"dtype": dtype_name, "shape": shape, "data_offsets": [offset, offset + size]}
+        offset += size
+    
+    tmp_path = target + ".tmp"
+    with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+        writer = _HashingWriter(dst)
+        writer.write(_encode_header(out_header))
+        for name in names:
+            info = header[name]
+            begin, end = (data_start + position for position in info["data_offsets"])
+            merge = merges.get(name)
+            if merge is None:
+                src.seek(begin)
+                remaining = end - begin
+                while remaining:
+                    data = src.read(min(remaining, COPY_BUFFER_BYTES))
+                    writer.write(data)
+                    remaining -= len(data)
+                continue
+            
+            dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+            if dtype is None or not dtype.is_floating_point:
+                raise ValueError(f"Cannot merge into {name}: it is stored as {info['dtype']}")
+            if merge.kind is None:
+                writer.write(_tensor_bytes(adapter[merge.base].to(dtype)))
+                continue
+            
+            shape = out_header[name]["shape"]
+            row_numel = 1
+            for size in shape[1:]:
+                row_numel *= size
+            rows_per_chunk = max(1, chunk_mb * 1024 * 1024 // (4 * max(row_numel, 1)))
+            row_bytes = row_numel * dtype.itemsize
+            src.seek(begin)
+            for row in range(0, shape[0], rows_per_chunk):
+                rows = min(rows_per_chunk, shape[0] - row)
+                if merge.base:
+                    values = adapter[merge.base][row:row + rows].float()
+                else:
+                    values = torch.frombuffer(bytearray(src.read(rows * row_bytes)), dtype=dtype).float().view(rows, *shape[1:])
+                if merge.kind == "bias":
+                    values += merge.scaling * adapter[merge.keys[0]][row:row + rows].float()
+                elif merge.kind == "experts":
+                    lora_a, lora_b, experts = (adapter[key] for key in merge.keys)
+                    for i, expert in enumerate(experts.tolist()):
+                        if row <= expert < row + rows:
+                            values[expert - row] += merge.scaling * (lora_b[i].float() @ lora_a[i].float()).T
+                elif merge.kind == "lora":
+                    lora_a, lora_b = (adapter[key].float() for key in merge.keys)
+                    values += merge.scaling * (lora_b[row:row + rows] @ lora_a).view_as(values)
+                else:
+                    lora_a, lora_b = (adapter[key].float() for key in merge.keys)
+                    values += merge.scaling * (lora_b @ lora_a[:, row:row + rows]).T.reshape(values.shape)
+                writer.write(_tensor_bytes(values.to(dtype)))
+    
+    digest = writer.sha256.hexdigest()
+    if verify and file_sha256(tmp_path) != digest:
+        os.remove(tmp_path)
+        raise IOError(f"{target} does not read back as written (SHA-256 mismatch)")
+    os.replace(tmp_path, target)
+    return {
+        "file": os.path.basename(target),
+        "sha256": digest,
+        "bytes": writer.bytes,
+        "tensor_bytes": offset,
+        "merged": sum(name in merges for name in names),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _added_vocab_size(adapter_dir: str) -> Optional[int]:
+    """Size of the vocabulary the adapter was trained with, from its tokenizer.json"""
+    path = os.path.join(adapter_dir, "tokenizer.json")
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        tokenizer = json.load(f)
+    ids = list(tokenizer.get("model", {}).get("vocab", {}).values()) + [token["id"] for token in tokenizer.get("added_tokens", [])]
+    return max(ids) + 1 if ids else None
+
+
+def export_merged(base_model: str, adapter_dir: str, output_dir: str, config: Optional[ExportConfig] = None) -> Dict[str, Any]:
+    """Write ``base_model`` with the LoRA adapter in ``adapter_dir`` merged into ``output_dir``; returns a summary"""
+    config = config or ExportConfig()
+    start = time.perf_counter()
+    base_dir = resolve_model_dir(base_model)
+    files = safetensors_files(base_dir)
+    merges = plan_merges(adapter_dir)
+    
+    tensor_files = {}
+    for path in files:
+        header, _ = _read_header(path)
+        for name in header:
+            if name != "__metadata__":
+                tensor_files[name] = path
+    missing = sorted(name for name in merges if name not in tensor_files)
+    mxfp4 = [name for name in missing if f"{name}_blocks" in tensor_files]
+    if mxfp4:
+        raise ValueError(
+            f"{base_dir} stores the adapted expert weights as MXFP4 blocks and scales (e.g. {mxfp4[0]}_blocks), "
+            f"which cannot be merged into; export against a dequantized copy, e.g. the model saved with "
+            f"save_pretrained after loading it with Mxfp4Config(dequantize=True)"
+        )
+    if missing:
+        raise ValueError(f"{len(missing)} adapter targets are not in {base_dir}, e.g. {missing[:3]}")
+    
+    os.makedirs(output_dir, exist_ok=True)
+    # Config, generation config and tokenizer of the base model, then the tokenizer the adapter was trained with
+    for source_dir, names in ((base_dir, None), (adapter_dir, TOKENIZER_FILES)):
+        for name in sorted(os.listdir(source_dir)):
+            path = os.path.join(source_dir, name)
+            if not os.path.isfile(path) or name.endswith(".safetensors") or name in (SAFETENSORS_INDEX_FILE, CHECKSUMS_FILE):
+                continue
+            if names is None or name in names:
+                shutil.copyfile(path, os.path.join(output_dir, name))
+    
+    config_path = os.path.join(output_dir, "config.json")
+    if os.path.isfile(config_path):
+        with open(config_path) as f:
+            model_config = json.load(f)
+        with safe_open(os.path.join(adapter_dir, ADAPTER_WEIGHTS_FILE), framework="pt") as f:
+            embedding_rows = {f.get_slice(merge.base).get_shape()[0] for name, merge in merges.items() if merge.base and "embed" in name}
+        if embedding_rows and embedding_rows != {model_config.get("vocab_size")}:
+            # Embeddings saved after resizing for added tokens
+            logger.info(f"vocab_size {model_config.get('vocab_size')} -> {max(embedding_rows)}")
+            model_config["vocab_size"] = max(embedding_rows)
+            with open(config_path, "w") as f:
+                json.dump(model_config, f, indent=2)
+        vocab_size = _added_vocab_size(adapter_dir)
+        if vocab_size is not None and vocab_size > model_config.get("vocab_size", vocab_size):
+            logger.warning(
+                f"The adapter's tokenizer has {vocab_size} tokens but the merged embeddings only {model_config['vocab_size']}; "
+                f"resize them after loading, as load_model does"
+            )
+    
+    adapter_path = os.path.join(adapter_dir, ADAPTER_WEIGHTS_FILE)
+    file_merges = {path: {name: merge for name, merge in merges.items() if tensor_files[name] == path} for path in files}
+    workers = max(1, min(config.workers, len(files)))
+    logger.info(f"Merging {len(merges)} adapter tensors into {len(files)} files with {workers} workers")
+    
+    # Largest files first, so one big file does not start last
+    order = sorted(files, key=os.path.getsize, reverse=True)
+    tasks = [
+        (path, os.path.join(output_dir, os.path.basename(path)), adapter_path, file_merges[path], config.chunk_mb, config.verify)
+        for path in order
+    ]
+    results = []
+    if workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(max(1, (os.cpu_count() or 1) // workers),)
+        ) as executor:
+            for result in executor.map(merge_file, *zip(*tasks)):
+                _log_file(result)
+                results.append(result)
+    else:
+        for task in tasks:
+            results.append(_log_file(merge_file(*task)))
+    results.sort(key=lambda result: result["file"])
+    
+    # The weight map is unchanged; total_size follows resized tensors
+    if len(files) > 1 or not files[0].endswith(SAFETENSORS_FILE):
+        with open(os.path.join(base_dir, SAFETENSORS_INDEX_FILE)) as f:
+            index = json.load(f)
+        index["metadata"] = {**index.get("metadata", {}), "total_size": sum(result["tensor_bytes"] for result in results)}
+        with open(os.path.join(output_dir, SAFETENSORS_INDEX_FILE), "w") as f:
+            json.dump(index, f, indent=2)
+    with open(os.path.join(output_dir, CHECKSUMS_FILE), "w") as f:
+        for result in results:
+            f.write(f"{result['sha256']}  {result['file']}\n")
+    
+    return {
+        "base_model": base_dir,
+        "adapter": adapter_dir,
+        "output_dir": output_dir,
+        "merged_tensors": len(merges),
+        "files": results,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def verify_export(output_dir: str, workers: int = 4) -> List[str]:
+    """Files of an export whose SHA-256 no longer matches checksums.sha256; empty when all match"""
+    with open(os.path.join(output_dir, CHECKSUMS_FILE)) as f:
+        expected = dict(reversed(line.rstrip("\n").split("  ", 1)) for line in f if line.strip())
+    paths = [os.path.join(output_dir, name) for name in expected]
+    # hashlib releases the GIL on large buffers, so threads read and hash files in parallel
+    with ThreadPoolExecutor(max(1, min(workers, len(paths)))) as executor:
+        digests = dict(zip(expected, executor.map(file_sha256, paths)))
+    return [name for name, digest in digests.items() if digest != expected[name]]
+
+
+def main(argv: Optional[List[str]] = None):
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description="Merge a LoRA adapter into a base checkpoint shard by shard, without loading the model")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    merge_parser = subparsers.add_parser("merge", help="Write the base checkpoint with the adapter merged in")
+    merge_parser.add_argument("--base_model", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    merge_parser.add_argument("--adapter", type=str, required=True, help="Directory written by save_model (adapter_config.json, adapter_model.safetensors)")
+    merge_parser.add_argument("--output_dir", type=str, required=True)
+    merge_parser.add_argument("--workers", type=int, default=4, help="Files merged in parallel, one process each")
+    merge_parser.add_argument("--chunk_mb", type=int, default=256, help="Rows of a merged tensor processed at a time, per worker")
+    merge_parser.add_argument("--no_verify", action="store_true", help="Skip reading every written file back to check its SHA-256")
+    
+    verify_parser = subparsers.add_parser("verify", help=f"Check an export's files against its {CHECKSUMS_FILE}")
+    verify_parser.add_argument("output_dir", type=str)
+    verify_parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args(argv)
+    
+    try:
+        if args.command == "verify":
+            mismatched = verify_export(args.output_dir, args.workers)
+            if mismatched:
+                logger.error(f"SHA-256 mismatch: {', '.join(mismatched)}")
+                sys.exit(1)
+            logger.info(f"All files of {args.output_dir} match {CHECKSUMS_FILE}")
+            return
+        
+        config = ExportConfig(workers=args.workers, chunk_mb=args.chunk_mb, verify=not args.no_verify)
+        summary = export_merged(args.base_model, args.adapter, args.output_dir, config)
+        logger.info(f"Merged {summary['merged_tensors']} tensors into {len(summary['files'])} files in {summary['seconds']:.1f}s")
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
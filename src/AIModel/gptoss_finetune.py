@@ -0,0 +1,2199 @@
+
+"""
+GPT-OSS-120B Fine-tuning Implementation
+Loading, fine-tuning, and deploying OpenAI's GPT-OSS-120B model.
+
+This module holds the torch/transformers/peft stack; the command line lives in
+GptRoss.py, which imports it only for the subcommands that need a model.
+
+Author: AI Assistant
+Date: September 2025
+License: MIT
+
+Requirements:
+- PyTorch >= 2.0
+- Transformers >= 4.55.0
+- PEFT >= 0.17.0
+- Wandb (optional, for experiment tracking through the Trainer)
+- Flash Attention 2 (recommended)
+"""
+
+import os
+import json
+import time
+import math
+import shutil
+import logging
+import warnings
+import bisect
+import asyncio
+import threading
+from pathlib import Path
+from contextlib import ExitStack
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union, Any
+import dataclasses
+from dataclasses import dataclass, field
+import traceback
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import Dataset, IterableDataset, DataLoader, DistributedSampler, Sampler, get_worker_info
+from torch.nn.parallel import DistributedDataParallel as DDP
+import torch.distributed as dist
+
+import numpy as np
+
+# Transformers and PEFT imports
+from transformers import (
+    AutoTokenizer, 
+    AutoModelForCausalLM,
+    AutoConfig,
+    TrainingArguments,
+    Trainer,
+    DataCollatorForLanguageModeling,
+    get_linear_schedule_with_warmup,
+    get_cosine_schedule_with_warmup
+)
+
+from transformers.trainer import TRAINING_ARGS_NAME
+from transformers.trainer_callback import ExportableState
+
+from peft import (
+    get_peft_model,
+    LoraConfig,
+    TaskType,
+    prepare_model_for_kbit_training,
+    PeftModel,
+    PeftConfig,
+    get_peft_model_state_dict
+)
+
+from gptoss_cache import TokenCache, compute_cache_key
+from gptoss_preprocess import format_harmony_prompt, is_valid_item, preprocess_jsonl, text_hash
+from gptoss_adapters import AdapterRegistry, BASE_ADAPTER
+from gptoss_profiling import TrainingProfiler
+from gptoss_eval import GenerationEvalConfig, GenerationEvalCallback, evaluate_generation
+from gptoss_memory import MemoryPlanConfig, plan_memory
+from gptoss_activations import ActivationOffload, apply_checkpoint_policy
+from gptoss_loss import ChunkedCrossEntropy
+from gptoss_optim import optimizer_cls_and_kwargs
+from gptoss_moe import (
+    EXPERT_LORA_MODES,
+    ROUTING_STATS_FILE,
+    RoutingStatsCallback,
+    add_expert_lora,
+    hot_experts,
+    load_routing_stats,
+    resolve_target_modules,
+)
+from gptoss_mmap import load_model_mmap, mmap_cache_path, write_mmap_cache, dispatch_mmap_model, memory_usage
+from gptoss_quant import (
+    resolve_backend,
+    bitsandbytes_config,
+    quantize_model,
+    dequantize_model,
+    weight_memory,
+)
+from gptoss_checkpoint import (
+    AsyncCheckpointer,
+    latest_checkpoint,
+    staging_dir,
+    has_sharded_optimizer,
+    load_optimizer_state,
+    rotate_checkpoints,
+    SCHEDULER_FILE,
+    TRAINER_STATE_FILE,
+    CHECKPOINT_PREFIX,
+)
+from gptoss_distributed import (
+    ShardingConfig,
+    init_distributed,
+    shard_model,
+    gather_trainable_state_dict,
+    has_distributed_optimizer,
+    save_distributed_optimizer,
+    load_distributed_optimizer,
+)
+from gptoss_inference import (
+    PrefixKVCache,
+    IncrementalDetokenizer,
+    StopStringMatcher,
+    SpeculativeStats,
+    cache_from_legacy,
+    sample_next_tokens,
+    speculative_decode,
+)
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Suppress warnings
+warnings.filterwarnings("ignore", category=UserWarning)
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+
+@dataclass
+class ModelConfig:
+    """Configuration class for GPT-OSS-120B model"""
+    model_name: str = "openai/gpt-oss-120b"
+    model_revision: str = "main"
+    cache_dir: Optional[str] = None
+    use_auth_token: Optional[str] = None
+    torch_dtype: str = "bfloat16"
+    device_map: Optional[Union[str, Dict[str, Any]]] = "auto"  # "plan" derives device_map and max_memory with gptoss_memory
+    max_memory: Optional[Dict[Union[int, str], str]] = None  # with device_map="plan", the budgets to plan within
+    offload_folder: Optional[str] = None
+    low_cpu_mem_usage: bool = True
+    trust_remote_code: bool = True
+    use_flash_attention: bool = True
+    attn_implementation: str = "flash_attention_2"
+    prefix_cache_mb: int = 1024  # memory budget for cached system-prompt key/values, 0 disables
+    draft_model_name: Optional[str] = None  # small model sharing the tokenizer, enables speculative decoding
+    num_speculative_tokens: int = 4
+    max_loaded_adapters: int = 8  # LoRA adapters kept resident on the shared base model
+    quantization: Optional[str] = None  # weight-only base model quantization: "int8", "nf4" or "fp4"
+    quantization_backend: str = "auto"  # "bitsandbytes" (CUDA), "reference" (pure PyTorch, runs on CPU) or "auto"
+    quant_compute_dtype: Optional[str] = None  # dtype quantized layers compute in, defaults to torch_dtype
+    quant_double_quant: bool = True  # also quantize the block scales of 4-bit weights
+    quant_block_size: int = 64  # weights sharing one scale, reference backend only
+    quant_skip_modules: List[str] = field(default_factory=lambda: ["lm_head"])
+    mmap_weights: bool = False  # map base weights from safetensors, shared with other processes through the page cache
+    mmap_cache_dir: Optional[str] = None  # converted copies of checkpoints that cannot be mapped as they are
+
+
+@dataclass
+class LoRAConfig:
+    """Configuration for LoRA fine-tuning"""
+    r: int = 16
+    lora_alpha: int = 32
+    # "auto": the attention and dense MLP projections the model has (q/k/v/o_proj on GPT-OSS, plus gate/up/down_proj on dense models)
+    target_modules: List[str] = field(default_factory=lambda: ["auto"])
+    lora_dropout: float = 0.05
+    bias: str = "none"
+    task_type: str = "CAUSAL_LM"
+    inference_mode: bool = False
+    modules_to_save: Optional[List[str]] = None
+    expert_lora: str = "none"  # none, all (LoRA on the weights of every expert), hot (only the most-routed experts of each layer)
+    hot_experts: int = 4  # experts per layer adapted with expert_lora="hot"
+    routing_stats: Optional[str] = None  # routing_stats.json the hot experts are taken from
+
+
+@dataclass
+class TrainingConfig:
+    """Training configuration"""
+    output_dir: str = "./gpt-oss-120b-finetuned"
+    num_train_epochs: int = 3
+    max_steps: int = -1  # when positive, overrides num_train_epochs
+    per_device_train_batch_size: int = 1
+    per_device_eval_batch_size: int = 1
+    gradient_accumulation_steps: int = 8
+    learning_rate: float = 2e-4
+    weight_decay: float = 0.01
+    adam_beta1: float = 0.9
+    adam_beta2: float = 0.999
+    adam_epsilon: float = 1e-8
+    optimizer: str = "adamw"  # adamw, adamw_8bit (blockwise 8-bit moments)
+    optimizer_backend: str = "auto"  # auto (bitsandbytes for on-device 8-bit on a GPU when installed), bitsandbytes, reference
+    optimizer_offload: bool = False  # keep optimizer state and fp32 master weights in host memory and update on the CPU
+    max_grad_norm: float = 1.0
+    warmup_ratio: float = 0.1
+    lr_scheduler_type: str = "cosine"
+    logging_steps: int = 10
+    eval_steps: int = 500
+    save_steps: int = 1000
+    save_total_limit: int = 3
+    evaluation_strategy: str = "steps"
+    load_best_model_at_end: bool = True
+    metric_for_best_model: str = "eval_loss"
+    greater_is_better: bool = False
+    seed: int = 42
+    fp16: bool = False
+    bf16: bool = True
+    dataloader_num_workers: int = 4
+    remove_unused_columns: bool = False
+    report_to: str = "wandb"
+    run_name: Optional[str] = None
+    max_length: int = 2048
+    use_reasoning_tokens: bool = True
+    reasoning_level: str = "medium"  # low, medium, high
+    dynamic_padding: bool = True  # pad each batch to its longest sequence instead of max_length
+    pad_to_multiple_of: Optional[int] = 8
+    group_by_length: bool = True  # batch examples of similar token length together
+    length_grouping_mega_batch_mult: int = 50
+    packing: bool = False  # concatenate several conversations into full max_length windows
+    packing_attention: str = "auto"  # auto, position_ids, block_mask
+    token_cache_dir: Optional[str] = None  # pre-tokenized, memory-mapped dataset cache
+    preprocessing_num_workers: Optional[int] = None  # defaults to all cores
+    deduplicate: bool = True  # drop exact duplicate conversations (not in streaming mode, which keeps no per-example state)
+    streaming: bool = False  # read the training JSONL lazily instead of loading it into memory
+    shuffle_buffer_size: int = 10000
+    streaming_index_dir: Optional[str] = None  # where byte-offset indexes are stored, defaults to next to the data
+    instrument_steps: bool = False  # time dataloader, host-to-device, forward, backward and optimizer per step
+    profile_start_step: Optional[int] = None  # capture a torch.profiler window starting at this step
+    profile_num_steps: int = 3
+    profile_on_signal: bool = False  # capture a torch.profiler window after SIGUSR1
+    profiling_dir: Optional[str] = None  # defaults to <output_dir>/profiling
+    log_routing: bool = False  # log router entropy and expert load imbalance, and write routing_stats.json to output_dir
+    async_checkpointing: bool = True  # snapshot to host memory and write checkpoints in a background thread
+    checkpoint_shard_mb: int = 2048  # maximum size of each optimizer state shard
+    resume_from_checkpoint: Optional[str] = None  # checkpoint directory, or "latest" for the newest in output_dir
+    gradient_checkpointing: bool = False  # recompute activations in the backward pass instead of storing them
+    checkpoint_policy: str = "full"  # full, every_n (every checkpoint_every_n-th layer), selective (checkpoint_modules of each layer)
+    checkpoint_every_n: int = 2
+    checkpoint_modules: List[str] = field(default_factory=lambda: ["mlp"])
+    offload_activations: bool = False  # keep large tensors saved for backward in host memory
+    offload_min_bytes: int = 1024 * 1024
+    chunked_loss: bool = False  # LM head and cross-entropy in chunks of loss_chunk_size positions, without full-vocabulary logits
+    loss_chunk_size: int = 1024
+    sharding: str = "none"  # none, fsdp (partition parameters, gradients and optimizer state across torchrun ranks)
+    sharding_strategy: str = "full_shard"  # full_shard (ZeRO-3), shard_grad_op (ZeRO-2), hybrid_shard, no_shard
+    sharding_cpu_offload: bool = False  # keep parameter shards in host memory between uses
+    distributed_backend: str = "auto"  # nccl with GPUs, gloo without (gloo also runs several CPU processes on one machine)
+    generation_eval_data: Optional[str] = None  # eval JSONL scored by generation in a background process during training
+    generation_eval_steps: int = 500
+    generation_eval_max_examples: Optional[int] = None
+    generation_eval_max_new_tokens: int = 512
+    generation_eval_device_map: Optional[str] = None  # where the eval process loads its model, e.g. "cpu" or "cuda:1"; defaults to device_map
+    generation_eval_dir: Optional[str] = None  # snapshots, results and output cache, defaults to <output_dir>/generation_eval
+
+
+class HarmonyFormatMixin:
+    """Harmony-format prompt construction shared by the map-style and streaming datasets"""
+    
+    def _setup_special_tokens(self):
+        """Setup special tokens for harmony format"""
+        special_tokens = {
+            "pad_token": "<pad>",
+            "bos_token": "<s>",
+            "eos_token": "</s>",
+            "unk_token": "<unk>"
+        }
+        
+        # Add reasoning tokens if needed
+        if self.use_reasoning_tokens:
+            special_tokens.update({
+                "reasoning_start": "<reasoning>",
+                "reasoning_end": "</reasoning>",
+                "answer_start": "<answer>",
+                "answer_end": "</answer>"
+            })
+        
+        # Add tokens that don't exist
+        tokens_to_add = []
+        for token_name, token_value in special_tokens.items():
+            if not hasattr(self.tokenizer, token_name) or getattr(self.tokenizer, token_name) is None:
+                tokens_to_add.append(token_value)
+        
+        if tokens_to_add:
+            self.tokenizer.add_special_tokens({"additional_special_tokens": tokens_to_add})
+            
+    def _format_harmony_prompt(self, item: Dict[str, str]) -> str:
+        """Format prompt according to harmony format"""
+        return format_harmony_prompt(item, self.use_reasoning_tokens, self.reasoning_level)
+    
+    def _parse_line(self, line: str) -> Optional[Dict[str, str]]:
+        """Parse one JSONL line, returning None for blank or malformed lines
+        
+        Conversations without a user message or assistant response are
+        dropped too, as the token cache pipeline drops them.
+        """
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Failed to parse line: {line[:100]}... Error: {e}")
+            return None
+        if not is_valid_item(item):
+            logger.warning(f"Skipping conversation without a user message and assistant response: {line[:100]}...")
+            return None
+        return item
+    
+    def _make_example(self, input_ids: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """Build model inputs from unpadded token ids, padding to max_length if configured"""
+        attention_mask = torch.ones_like(input_ids)
+        
+        if self.padding == "max_length":
+            pad = self.max_length - len(input_ids)
+            input_ids = F.pad(input_ids, (0, pad), value=self.tokenizer.pad_token_id)
+            attention_mask = F.pad(attention_mask, (0, pad), value=0)
+        
+        labels = input_ids.clone()
+        labels[attention_mask == 0] = -100
+        
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": labels
+        }
+
+
+class GPTOSSDataset(HarmonyFormatMixin, Dataset):
+    """Custom dataset for GPT-OSS-120B fine-tuning with harmony format support"""
+    
+    def __init__(
+        self,
+        data_path: str,
+        tokenizer,
+        max_length: int = 2048,
+        use_reasoning_tokens: bool = True,
+        reasoning_level: str = "medium",
+        padding: str = "max_length",
+        cache_dir: Optional[str] = None,
+        num_proc: Optional[int] = None,
+        deduplicate: bool = True
+    ):
+        if padding not in ("max_length", "longest"):
+            raise ValueError(f"Unsupported padding mode: {padding}. Use 'max_length' or 'longest'")
+        
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.use_reasoning_tokens = use_reasoning_tokens
+        self.reasoning_level = reasoning_level
+        self.padding = padding
+        self.deduplicate = deduplicate
+        self._lengths: Optional[List[int]] = None
+        self.token_cache: Optional[TokenCache] = None
+        
+        # Set up special tokens
+        self._setup_special_tokens()
+        
+        # Load data, or only the pre-tokenized cache when one exists
+        if cache_dir:
+            self.data = None
+            self.token_cache = self._load_token_cache(data_path, cache_dir, num_proc)
+            logger.info(f"Loaded {len(self.token_cache)} cached examples for {data_path}")
+        else:
+            self.data = self._load_data(data_path)
+            logger.info(f"Loaded {len(self.data)} examples from {data_path}")
+        
+    def _iter_data(self, data_path: str):
+        """Yield examples from a JSONL file one at a time"""
+        with open(data_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                item = self._parse_line(line)
+                if item is not None:
+                    yield item
+    
+    def _load_data(self, data_path: str) -> List[Dict[str, str]]:
+        """Load data from JSONL file, dropping exact duplicates like the token cache does"""
+        data = list(self._iter_data(data_path))
+        if not self.deduplicate:
+            return data
+        seen = set()
+        unique = []
+        for item in data:
+            digest = text_hash(self._format_harmony_prompt(item))
+            if digest not in seen:
+                seen.add(digest)
+                unique.append(item)
+        if len(unique) < len(data):
+            logger.info(f"Dropped {len(data) - len(unique)} duplicate conversations from {data_path}")
+        return unique
+    
+    def _load_token_cache(self, data_path: str, cache_dir: str, num_proc: Optional[int]) -> TokenCache:
+        """Open the token cache for this file and formatting, building it on first use"""
+        key, key_inputs = compute_cache_key(
+            data_path,
+            self.tokenizer,
+            max_length=self.max_length,
+            use_reasoning_tokens=self.use_reasoning_tokens,
+            reasoning_level=self.reasoning_level,
+            deduplicate=self.deduplicate
+        )
+        cache_path = os.path.join(cache_dir, key)
+        is_main_process = not dist.is_initialized() or dist.get_rank() == 0
+        
+        if is_main_process and not TokenCache.exists(cache_path):
+            logger.info(f"Building token cache for {data_path} at {cache_path}")
+            os.makedirs(cache_dir, exist_ok=True)
+            preprocess_jsonl(
+                data_path,
+                self.tokenizer,
+                cache_path,
+                max_length=self.max_length,
+                use_reasoning_tokens=self.use_reasoning_tokens,
+                reasoning_level=self.reasoning_level,
+                num_workers=num_proc,
+                deduplicate=self.deduplicate,
+                metadata=key_inputs
+            )
+        
+        # Other ranks wait for the main process to finish writing the cache
+        if dist.is_initialized():
+            dist.barrier()
+        
+        return TokenCache(cache_path)
+    
+    def __len__(self) -> int:
+        if self.token_cache is not None:
+            return len(self.token_cache)
+        return len(self.data)
+    
+    def encode(self, idx: int) -> List[int]:
+        """Tokenize a single example without padding"""
+        if self.token_cache is not None:
+            return self.token_cache[idx].tolist()
+        
+        text = self._format_harmony_prompt(self.data[idx])
+        encoding = self.tokenizer(text, truncation=True, max_length=self.max_length)
+        return encoding["input_ids"]
+    
+    @property
+    def lengths(self) -> List[int]:
+        """Token length of every example, computed once for length-grouped sampling"""
+        if self._lengths is None and self.token_cache is not None:
+            self._lengths = self.token_cache.lengths.tolist()
+        elif self._lengths is None:
+            self._lengths = []
+            for start in range(0, len(self.data), 1024):
+                texts = [self._format_harmony_prompt(item) for item in self.data[start:start + 1024]]
+                encodings = self.tokenizer(texts, truncation=True, max_length=self.max_length)
+                self._lengths.extend(len(ids) for ids in encodings["input_ids"])
+        return self._lengths
+    
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        # Cached token ids come straight from the memory-mapped file, no tokenizer work
+        if self.token_cache is not None:
+            return self._make_example(torch.from_numpy(self.token_cache[idx].astype(np.int64)))
+        
+        # Without max_length padding the collator pads each batch to its own longest sequence
+        if self.padding == "longest":
+            return self._make_example(torch.tensor(self.encode(idx), dtype=torch.long))
+        
+        # Format the text according to harmony format
+        text = self._format_harmony_prompt(self.data[idx])
+        
+        # Tokenize
+        encoding = self.tokenizer(
+            text,
+            truncation=True,
+            max_length=self.max_length,
+            padding="max_length",
+            return_tensors="pt"
+        )
+        
+        input_ids = encoding["input_ids"].squeeze()
+        attention_mask = encoding["attention_mask"].squeeze()
+        
+        # Labels are the same as input_ids for causal LM
+        labels = input_ids.clone()
+        
+        # Mask padding tokens in labels
+        labels[attention_mask == 0] = -100
+        
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": labels
+        }
+
+
+class StreamingGPTOSSDataset(HarmonyFormatMixin, IterableDataset):
+    """Streaming dataset that reads a JSONL corpus lazily from a byte-offset index
+    
+    Only a memory-mapped array of line offsets is kept, so resident memory does
+    not grow with the corpus. Each epoch shuffles blocks of consecutive lines,
+    splits them evenly across DDP ranks and then dataloader workers, and mixes
+    examples through a bounded shuffle buffer.
+    """
+    
+    def __init__(
+        self,
+        data_path: str,
+        tokenizer,
+        max_length: int = 2048,
+        use_reasoning_tokens: bool = True,
+        reasoning_level: str = "medium",
+        padding: str = "longest",
+        shuffle: bool = True,
+        shuffle_buffer_size: int = 10000,
+        block_size: int = 1024,
+        seed: int = 42,
+        index_dir: Optional[str] = None,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None
+    ):
+        if padding not in ("max_length", "longest"):
+            raise ValueError(f"Unsupported padding mode: {padding}. Use 'max_length' or 'longest'")
+        
+        self.data_path = data_path
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.use_reasoning_tokens = use_reasoning_tokens
+        self.reasoning_level = reasoning_level
+        self.padding = padding
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.block_size = block_size
+        self.seed = seed
+        self.epoch = 0
+        self.rank = rank
+        self.world_size = world_size
+        
+        self._setup_special_tokens()
+        
+        self.index_path = self._build_index(index_dir)
+        self.offsets = np.load(self.index_path, mmap_mode="r")
+        logger.info(f"Indexed {len(self.offsets)} usable lines in {data_path} for streaming")
+    
+    def _build_index(self, index_dir: Optional[str]) -> str:
+        """Write the byte offset of every usable line to a .npy file, once per file version
+        
+        Lines ``_parse_line`` would drop (blank, malformed, no user message or
+        assistant response) are left out here, so ``__len__`` counts exactly
+        the examples the ranks yield.
+        """
+        stat = os.stat(self.data_path)
+        index_dir = index_dir or os.path.dirname(os.path.abspath(self.data_path))
+        index_name = f"{os.path.basename(self.data_path)}.{stat.st_size}-{stat.st_mtime_ns}.usable.offsets.npy"
+        index_path = os.path.join(index_dir, index_name)
+        if os.path.exists(index_path):
+            return index_path
+        
+        os.makedirs(index_dir, exist_ok=True)
+        offsets, chunk = [], []
+        position = 0
+        with open(self.data_path, "rb") as f:
+            for line in f:
+                try:
+                    usable = self._parse_line(line.decode("utf-8")) is not None
+                except UnicodeDecodeError:
+                    logger.warning(f"Skipping line at byte {position} that is not valid UTF-8")
+                    usable = False
+                if usable:
+                    chunk.append(position)
+                    # Flush to a compact array so resident memory stays at 8 bytes per line
+                    if len(chunk) >= 1 << 20:
+                        offsets.append(np.asarray(chunk, dtype=np.uint64))
+                        chunk = []
+                position += len(line)
+        offsets.append(np.asarray(chunk, dtype=np.uint64))
+        
+        offsets = np.concatenate(offsets)
+        tmp_path = f"{index_path}.tmp-{os.getpid()}.npy"
+        np.save(tmp_path, offsets)
+        os.replace(tmp_path, index_path)
+        return index_path
+    
+    def _distributed_context(self) -> Tuple[int, int]:
+        """Resolve this process' rank and world size, lazily so the Trainer can initialize DDP first"""
+        if self.rank is not None and self.world_size is not None:
+            return self.rank, self.world_size
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+    
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+    
+    def __len__(self) -> int:
+        """Examples per rank; every rank gets the same count so DDP steps stay in lockstep"""
+        _, world_size = self._distributed_context()
+        return len(self.offsets) // world_size
+    
+    def _shard_indices(self):
+        """Yield the line indices owned by this rank and dataloader worker for the current epoch"""
+        rank, world_size = self._distributed_context()
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info else (1, 0)
+        
+        num_lines = len(self.offsets)
+        usable = num_lines - num_lines % world_size
+        num_blocks = math.ceil(num_lines / self.block_size)
+        
+        rng = np.random.default_rng([self.seed, self.epoch])
+        block_order = rng.permutation(num_blocks) if self.shuffle else np.arange(num_blocks)
+        
+        # Walk the shuffled global line order; rank r owns positions r, r + world_size, ...
+        # and worker w owns every num_workers-th of those
+        position = 0
+        for block in block_order:
+            block_indices = np.arange(block * self.block_size, min((block + 1) * self.block_size, num_lines))
+            positions = position + np.arange(len(block_indices))
+            position += len(block_indices)
+            
+            owned = (positions < usable) & (positions % world_size == rank)
+            owned &= (positions // world_size) % num_workers == worker_id
+            yield from block_indices[owned].tolist()
+    
+    def _read_items(self, indices):
+        """Seek to each indexed line and parse it"""
+        with open(self.data_path, "rb") as f:
+            for idx in indices:
+                f.seek(int(self.offsets[idx]))
+                item = self._parse_line(f.readline().decode("utf-8"))
+                if item is not None:
+                    yield item
+    
+    def _shuffle_buffer(self, items):
+        """Mix examples through a fixed-size buffer"""
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info else 0
+        rank, _ = self._distributed_context()
+        rng = np.random.default_rng([self.seed, self.epoch, rank, worker_id])
+        
+        buffer = []
+        for item in items:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(item)
+                continue
+            i = int(rng.integers(len(buffer)))
+            yield buffer[i]
+            buffer[i] = item
+        
+        rng.shuffle(buffer)
+        yield from buffer
+    
+    def __iter__(self):
+        items = self._read_items(self._shard_indices())
+        if self.shuffle and self.shuffle_buffer_size > 1:
+            items = self._shuffle_buffer(items)
+        
+        for item in items:
+            text = self._format_harmony_prompt(item)
+            encoding = self.tokenizer(text, truncation=True, max_length=self.max_length)
+            yield self._make_example(torch.tensor(encoding["input_ids"], dtype=torch.long))
+
+
+class StreamingDataLoader(DataLoader):
+    """DataLoader that forwards set_epoch to a streaming dataset"""
+    
+    def set_epoch(self, epoch: int):
+        self.dataset.set_epoch(epoch)
+
+
+@dataclass
+class DataCollatorForHarmony:
+    """Pads each batch only to its longest sequence (dynamic padding)"""
+    pad_token_id: int
+    label_pad_token_id: int = -100
+    pad_to_multiple_of: Optional[int] = None
+    
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        sequences = [torch.as_tensor(f["input_ids"], dtype=torch.long) for f in features]
+        max_len = max(len(seq) for seq in sequences)
+        if self.pad_to_multiple_of:
+            max_len = math.ceil(max_len / self.pad_to_multiple_of) * self.pad_to_multiple_of
+        
+        input_ids = torch.full((len(features), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(features), max_len), dtype=torch.long)
+        labels = torch.full((len(features), max_len), self.label_pad_token_id, dtype=torch.long)
+        
+        for i, (feature, seq) in enumerate(zip(features, sequences)):
+            length = len(seq)
+            input_ids[i, :length] = seq
+            if "attention_mask" in feature:
+                attention_mask[i, :length] = torch.as_tensor(feature["attention_mask"], dtype=torch.long)
+            else:
+                attention_mask[i, :length] = 1
+            if "labels" in feature:
+                labels[i, :length] = torch.as_tensor(feature["labels"], dtype=torch.long)
+            else:
+                labels[i, :length] = seq
+        
+        # Never train on padding, even if the dataset was already padded
+        labels[attention_mask == 0] = self.label_pad_token_id
+        
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": labels
+        }
+
+
+class LengthGroupedSampler(Sampler):
+    """Sampler that groups examples of similar token length into the same batch
+    
+    Indices are shuffled, split into mega-batches of ``batch_size * mega_batch_mult``
+    examples, and each mega-batch is sorted by length so that consecutive batches
+    need little padding. Batch order is shuffled again so training still sees a
+    random mix of lengths, with the longest batch first to surface OOMs early.
+    """
+    
+    def __init__(
+        self,
+        lengths: List[int],
+        batch_size: int,
+        mega_batch_mult: int = 50,
+        seed: int = 42
+    ):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.mega_batch_mult = mega_batch_mult
+        self.seed = seed
+        self.epoch = 0
+    
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+    
+    def __len__(self) -> int:
+        return len(self.lengths)
+    
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        
+        indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        mega_batch_size = self.batch_size * self.mega_batch_mult
+        
+        batches = []
+        for start in range(0, len(indices), mega_batch_size):
+            mega_batch = sorted(
+                indices[start:start + mega_batch_size],
+                key=lambda i: self.lengths[i],
+                reverse=True
+            )
+            batches.extend(
+                mega_batch[j:j + self.batch_size] for j in range(0, len(mega_batch), self.batch_size)
+            )
+        
+        if not batches:
+            return iter([])
+        
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        batches = [batches[i] for i in order]
+        longest = max(range(len(batches)), key=lambda b: self.lengths[batches[b][0]])
+        batches[0], batches[longest] = batches[longest], batches[0]
+        
+        return iter([idx for batch in batches for idx in batch])
+
+
+class PackedGPTOSSDataset(Dataset):
+    """Packs several harmony-formatted conversations into full max_length windows
+    
+    Examples are assigned to windows with best-fit decreasing bin packing over
+    their token lengths. Each window carries ``position_ids`` that restart at
+    every document boundary so the collator can keep documents from attending
+    to each other, and the first label of every document is masked because it
+    would otherwise be predicted from the previous document's last token.
+    """
+    
+    def __init__(self, dataset: GPTOSSDataset, max_length: Optional[int] = None):
+        self.dataset = dataset
+        self.max_length = max_length or dataset.max_length
+        self.windows = self._pack(dataset.lengths)
+        
+        total_tokens = sum(dataset.lengths)
+        efficiency = total_tokens / max(1, len(self.windows) * self.max_length)
+        logger.info(
+            f"Packed {len(dataset)} examples into {len(self.windows)} windows "
+            f"of {self.max_length} tokens ({efficiency:.1%} utilization)"
+        )
+    
+    def _pack(self, lengths: List[int]) -> List[List[int]]:
+        """Best-fit decreasing bin packing of example indices into windows"""
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+        windows: List[List[int]] = []
+        # Sorted (remaining capacity, window index) pairs for open windows
+        open_windows: List[Tuple[int, int]] = []
+        
+        for idx in order:
+            length = min(lengths[idx], self.max_length)
+            pos = bisect.bisect_left(open_windows, (length, -1))
+            if pos < len(open_windows):
+                remaining, window_idx = open_windows.pop(pos)
+                windows[window_idx].append(idx)
+            else:
+                remaining, window_idx = self.max_length, len(windows)
+                windows.append([idx])
+            remaining -= length
+            if remaining > 0:
+                bisect.insort(open_windows, (remaining, window_idx))
+        
+        return windows
+    
+    def __len__(self) -> int:
+        return len(self.windows)
+    
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        input_ids: List[int] = []
+        labels: List[int] = []
+        position_ids: List[int] = []
+        
+        for example_idx in self.windows[idx]:
+            ids = self.dataset.encode(example_idx)[:self.max_length - len(input_ids)]
+            input_ids.extend(ids)
+            # The first token of a document must not be predicted from the previous one
+            labels.extend([-100] + ids[1:])
+            position_ids.extend(range(len(ids)))
+        
+        input_ids_tensor = torch.tensor(input_ids, dtype=torch.long)
+        return {
+            "input_ids": input_ids_tensor,
+            "attention_mask": torch.ones_like(input_ids_tensor),
+            "labels": torch.tensor(labels, dtype=torch.long),
+            "position_ids": torch.tensor(position_ids, dtype=torch.long)
+        }
+
+
+@dataclass
+class DataCollatorForPacking:
+    """Collates packed windows while keeping their documents isolated
+    
+    With ``attention="position_ids"`` only the restarting position ids are
+    emitted and no attention mask, which flash attention 2 turns into varlen
+    attention over each document. With ``attention="block_mask"`` a 4D
+    additive block-diagonal causal mask is built for eager/SDPA attention.
+    """
+    pad_token_id: int
+    label_pad_token_id: int = -100
+    pad_to_multiple_of: Optional[int] = None
+    attention: str = "position_ids"
+    mask_dtype: torch.dtype = torch.bfloat16
+    
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        max_len = max(len(f["input_ids"]) for f in features)
+        if self.pad_to_multiple_of:
+            max_len = math.ceil(max_len / self.pad_to_multiple_of) * self.pad_to_multiple_of
+        
+        batch_size = len(features)
+        input_ids = torch.full((batch_size, max_len), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, max_len), self.label_pad_token_id, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, max_len), dtype=torch.long)
+        
+        for i, feature in enumerate(features):
+            length = len(feature["input_ids"])
+            input_ids[i, :length] = torch.as_tensor(feature["input_ids"], dtype=torch.long)
+            labels[i, :length] = torch.as_tensor(feature["labels"], dtype=torch.long)
+            position_ids[i, :length] = torch.as_tensor(feature["position_ids"], dtype=torch.long)
+            # Trailing padding becomes its own short document
+            position_ids[i, length:] = torch.arange(max_len - length)
+        
+        batch = {
+            "input_ids": input_ids,
+            "labels": labels,
+            "position_ids": position_ids
+        }
+        if self.attention == "block_mask":
+            batch["attention_mask"] = self._block_causal_mask(position_ids)
+        
+        return batch
+    
+    def _block_causal_mask(self, position_ids: torch.Tensor) -> torch.Tensor:
+        """Build a [batch, 1, seq, seq] additive mask from restarting position ids"""
+        # Document ids increase every time the position counter restarts at 0
+        doc_ids = torch.cumsum((position_ids == 0).long(), dim=-1)
+        same_doc = doc_ids.unsqueeze(-1) == doc_ids.unsqueeze(-2)
+        seq_len = position_ids.size(-1)
+        causal = torch.ones(seq_len, seq_len, dtype=torch.bool).tril()
+        allowed = same_doc & causal
+        
+        mask = torch.zeros(allowed.shape, dtype=self.mask_dtype)
+        mask.masked_fill_(~allowed, torch.finfo(self.mask_dtype).min)
+        return mask.unsqueeze(1)
+
+
+class GPTOSSTrainer(Trainer):
+    """Trainer with token-length-grouped sampling, asynchronous checkpoints, activation offload, chunked loss and sharding for GPT-OSS"""
+    
+    def __init__(
+        self,
+        *args,
+        group_by_token_length: bool = False,
+        mega_batch_mult: int = 50,
+        checkpointer: Optional[AsyncCheckpointer] = None,
+        activation_offload: Optional[ActivationOffload] = None,
+        chunked_loss: Optional[ChunkedCrossEntropy] = None,
+        sharding: Optional[ShardingConfig] = None,
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.group_by_token_length = group_by_token_length
+        self.mega_batch_mult = mega_batch_mult
+        self.checkpointer = checkpointer
+        self.activation_offload = activation_offload
+        self.chunked_loss = chunked_loss
+        self.sharding = sharding
+        self.sharded_model = None
+    
+    def create_optimizer(self):
+        # Sharding replaces every parameter's data with this rank's shard, so it happens before the optimizer is built
+        if self.sharding is not None and self.sharded_model is None:
+            self.sharded_model = shard_model(self.model, self.sharding)
+            self.model_wrapped = self.sharded_model
+            # Each rank only holds its gradient shards; FSDP reduces the norm over all of them
+            self.accelerator.clip_grad_norm_ = lambda parameters, max_norm, norm_type=2: self.sharded_model.clip_grad_norm_(max_norm, norm_type)
+        optimizer = super().create_optimizer()
+        if getattr(optimizer, "offload", False):
+            # An offloaded optimizer steps with its host copies of the gradients, so those are the ones to clip
+            self.accelerator.clip_grad_norm_ = lambda parameters, max_norm, norm_type=2: optimizer.clip_grad_norm_(max_norm, norm_type)
+        return optimizer
+    
+    def _wrap_model(self, model, training=True, dataloader=None):
+        # Evaluation also has to go through the sharded model, which gathers the weights
+        if self.sharded_model is not None:
+            return self.sharded_model
+        return super()._wrap_model(model, training, dataloader)
+    
+    def adapter_state_dict(self) -> Dict[str, torch.Tensor]:
+        """Host copies of the active adapter's weights as PEFT saves them; every rank calls this when sharded"""
+        if self.sharded_model is not None:
+            return get_peft_model_state_dict(self.model, state_dict=gather_trainable_state_dict(self.sharded_model))
+        return {name: tensor.detach().to("cpu", copy=True) for name, tensor in get_peft_model_state_dict(self.model).items()}
+    
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        with ExitStack() as stack:
+            if self.activation_offload is not None and model.training:
+                # Tensors saved for backward during this forward pass go to host memory
+                stack.enter_context(self.activation_offload.hooks())
+            if self.chunked_loss is not None and "labels" in inputs:
+                stack.enter_context(self.chunked_loss.active())
+            return super().compute_loss(model, inputs, *args, **kwargs)
+    
+    def train(self, *args, **kwargs):
+        try:
+            return super().train(*args, **kwargs)
+        finally:
+            if self.checkpointer is not None:
+                self.checkpointer.wait()
+    
+    def _save_checkpoint(self, model, trial):
+        if self.sharded_model is not None:
+            return self._save_sharded_checkpoint(trial)
+        if self.checkpointer is None or not isinstance(self.model, PeftModel) or self.args.save_only_model:
+            return super()._save_checkpoint(model, trial)
+        
+        if self.hp_search_backend is None and trial is None:
+            self.store_flos()
+        
+        run_dir = self._get_output_dir(trial=trial)
+        checkpoint_dir = os.path.join(run_dir, f"{CHECKPOINT_PREFIX}-{self.state.global_step}")
+        
+        # The best checkpoint may be the one being written right now
+        if self.state.best_global_step:
+            best_dir = os.path.join(run_dir, f"{CHECKPOINT_PREFIX}-{self.state.best_global_step}")
+            if self.state.best_global_step == self.state.global_step or os.path.exists(best_dir):
+                self.state.best_model_checkpoint = best_dir
+        
+        # Every rank drops its RNG state into the staging directory before the main process snapshots
+        self._save_rng_state(staging_dir(checkpoint_dir))
+        self._save_scaler(staging_dir(checkpoint_dir))
+        if dist.is_initialized():
+            dist.barrier()
+        
+        if self.args.should_save:
+            self.checkpointer.save(
+                checkpoint_dir,
+                self.model,
+                self.optimizer,
+                self.lr_scheduler,
+                self._trainer_state_json(),
+                save_total_limit=self.args.save_total_limit,
+                keep=self.state.best_model_checkpoint
+            )
+    
+    def _trainer_state_json(self) -> str:
+        for callback in self.callback_handler.callbacks + [self.control]:
+            if isinstance(callback, ExportableState):
+                name = callback.__class__.__name__
+                if isinstance(self.state.stateful_callbacks.get(name), list):
+                    self.state.stateful_callbacks[name].append(callback.state())
+                else:
+                    self.state.stateful_callbacks[name] = callback.state()
+        return json.dumps(dataclasses.asdict(self.state), indent=2, sort_keys=True) + "\n"
+    
+    def _save_sharded_checkpoint(self, trial):
+        """Every rank writes its optimizer shards; the main process adds the gathered adapter and the trainer state"""
+        if self.hp_search_backend is None and trial is None:
+            self.store_flos()
+        
+        run_dir = self._get_output_dir(trial=trial)
+        checkpoint_dir = os.path.join(run_dir, f"{CHECKPOINT_PREFIX}-{self.state.global_step}")
+        staging = staging_dir(checkpoint_dir)
+        if self.state.best_global_step:
+            best_dir = os.path.join(run_dir, f"{CHECKPOINT_PREFIX}-{self.state.best_global_step}")
+            if self.state.best_global_step == self.state.global_step or os.path.exists(best_dir):
+                self.state.best_model_checkpoint = best_dir
+        
+        adapter_weights = gather_trainable_state_dict(self.sharded_model)
+        self._save_rng_state(staging)
+        save_distributed_optimizer(self.sharded_model, self.optimizer, staging)
+        if self.args.should_save:
+            self.model.save_pretrained(staging, state_dict=adapter_weights)
+            torch.save(self.lr_scheduler.state_dict(), os.path.join(staging, SCHEDULER_FILE))
+            with open(os.path.join(staging, TRAINER_STATE_FILE), "w") as f:
+                f.write(self._trainer_state_json())
+        dist.barrier()
+        
+        if self.args.should_save:
+            if os.path.isdir(checkpoint_dir):
+                shutil.rmtree(checkpoint_dir)
+            os.rename(staging, checkpoint_dir)
+            rotate_checkpoints(run_dir, self.args.save_total_limit, keep=self.state.best_model_checkpoint)
+        dist.barrier()
+    
+    def _load_optimizer_and_scheduler(self, checkpoint):
+        if checkpoint is not None and self.sharded_model is not None and has_distributed_optimizer(checkpoint):
+            load_distributed_optimizer(self.sharded_model, self.optimizer, checkpoint)
+        elif checkpoint is not None and has_sharded_optimizer(checkpoint):
+            self.optimizer.load_state_dict(load_optimizer_state(checkpoint))
+        else:
+            return super()._load_optimizer_and_scheduler(checkpoint)
+        scheduler_path = os.path.join(checkpoint, SCHEDULER_FILE)
+        if os.path.isfile(scheduler_path):
+            self.lr_scheduler.load_state_dict(torch.load(scheduler_path, weights_only=True))
+    
+    def save_model(self, output_dir: Optional[str] = None, _internal_call: bool = False):
+        if self.sharded_model is None:
+            return super().save_model(output_dir, _internal_call)
+        # Gathering the adapter is collective; only the main process writes
+        output_dir = output_dir or self.args.output_dir
+        adapter_weights = gather_trainable_state_dict(self.sharded_model)
+        if self.args.should_save:
+            os.makedirs(output_dir, exist_ok=True)
+            self.model.save_pretrained(output_dir, state_dict=adapter_weights)
+            if self.processing_class is not None:
+                self.processing_class.save_pretrained(output_dir)
+            torch.save(self.args, os.path.join(output_dir, TRAINING_ARGS_NAME))
+    
+    def _load_best_model(self):
+        # The best checkpoint may still be in flight
+        if self.checkpointer is not None:
+            self.checkpointer.wait()
+        return super()._load_best_model()
+    
+    def _get_train_sampler(self, *args, **kwargs):
+        if self.group_by_token_length and hasattr(self.train_dataset, "lengths"):
+            return LengthGroupedSampler(
+                self.train_dataset.lengths,
+                batch_size=self.args.per_device_train_batch_size,
+                mega_batch_mult=self.mega_batch_mult,
+                seed=self.args.seed
+            )
+        return super()._get_train_sampler(*args, **kwargs)
+    
+    def get_train_dataloader(self) -> DataLoader:
+        # Streaming datasets shard themselves across ranks and workers, so they
+        # bypass the accelerate wrapper that would re-shard or dispatch batches
+        if isinstance(self.train_dataset, StreamingGPTOSSDataset):
+            return StreamingDataLoader(
+                self.train_dataset,
+                batch_size=self.args.per_device_train_batch_size,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+        return super().get_train_dataloader()
+
+
+class GPTOSSFineTuner:
+    """Main class for fine-tuning GPT-OSS-120B"""
+    
+    def __init__(
+        self,
+        model_config: ModelConfig,
+        lora_config: LoRAConfig,
+        training_config: TrainingConfig
+    ):
+        self.model_config = model_config
+        self.lora_config = lora_config
+        self.training_config = training_config
+        
+        self.tokenizer = None
+        self.model = None
+        self.trainer = None
+        self.profiler: Optional[TrainingProfiler] = None
+        self.generation_eval: Optional[GenerationEvalCallback] = None
+        self.routing_stats: Optional[RoutingStatsCallback] = None
+        self.draft_model = None
+        self.last_speculative_stats = None
+        self.quantization_stats: Optional[Dict[str, Any]] = None
+        self.memory_plan = None
+        self.mmap_stats: Optional[Dict[str, Any]] = None
+        self.adapters: Optional[AdapterRegistry] = None
+        self.prefix_cache = (
+            PrefixKVCache(model_config.prefix_cache_mb * 1024 * 1024)
+            if model_config.prefix_cache_mb > 0 else None
+        )
+        
+        # Set up device and distributed training
+        self._setup_device()
+        
+    def _setup_device(self):
+        """Setup device and distributed training"""
+        if torch.cuda.is_available():
+            self.device = torch.device("cuda")
+            self.n_gpu = torch.cuda.device_count()
+            logger.info(f"Using {self.n_gpu} GPU(s)")
+        else:
+            self.device = torch.device("cpu")
+            self.n_gpu = 0
+            logger.warning("No GPU available, using CPU")
+        
+        # Join the process group when launched by torchrun; a single process spreads the model with device_map
+        self.rank, self.world_size, self.local_rank = init_distributed(self.training_config.distributed_backend)
+        if self.training_config.sharding != "none" and self.world_size == 1:
+            logger.warning("Sharded training runs on a single rank; launch with torchrun to partition the model")
+    
+    def load_tokenizer(self):
+        """Load and configure tokenizer"""
+        logger.info(f"Loading tokenizer from {self.model_config.model_name}")
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            self.model_config.model_name,
+            revision=self.model_config.model_revision,
+            cache_dir=self.model_config.cache_dir,
+            use_auth_token=self.model_config.use_auth_token,
+            trust_remote_code=self.model_config.trust_remote_code
+        )
+        
+        # Ensure tokenizer has pad token
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+            
+        logger.info(f"Tokenizer loaded. Vocab size: {len(self.tokenizer)}")
+        
+    def _clear_prefix_cache(self):
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
+    
+    def _torch_dtype(self, name: Optional[str] = None) -> torch.dtype:
+        """Resolve the configured torch dtype"""
+        name = name or self.model_config.torch_dtype
+        if name == "float16":
+            return torch.float16
+        elif name == "bfloat16":
+            return torch.bfloat16
+        return torch.float32
+    
+    def load_model(self):
+        """Load and configure the base model"""
+        logger.info(f"Loading model from {self.model_config.model_name}")
+        
+        # Configure torch dtype
+        torch_dtype = self._torch_dtype()
+        
+        # Load model configuration
+        config = AutoConfig.from_pretrained(
+            self.model_config.model_name,
+            revision=self.model_config.model_revision,
+            cache_dir=self.model_config.cache_dir,
+            use_auth_token=self.model_config.use_auth_token,
+            trust_remote_code=self.model_config.trust_remote_code
+        )
+        
+        # Configure attention implementation
+        if self.model_config.use_flash_attention:
+            config._attn_implementation = self.model_config.attn_implementation
+        
+        quantization = self.model_config.quantization
+        compute_dtype = self._torch_dtype(self.model_config.quant_compute_dtype)
+        backend = resolve_backend(self.model_config.quantization_backend) if quantization else None
+        quantization_kwargs = {}
+        if backend == "bitsandbytes":
+            quantization_kwargs["quantization_config"] = bitsandbytes_config(
+                quantization,
+                compute_dtype,
+                double_quant=self.model_config.quant_double_quant,
+                skip_modules=self.model_config.quant_skip_modules
+            )
+        
+        device_map = self.model_config.device_map
+        max_memory = self.model_config.max_memory
+        if self.training_config.sharding != "none":
+            if quantization:
+                raise ValueError("Sharded training needs unquantized base weights")
+            # Every rank loads on the host; sharding then moves each rank's part to its device
+            device_map = None
+        if device_map == "plan":
+            self.memory_plan = plan_memory(config, self._memory_plan_config(backend))
+            logger.info(f"Memory plan:\n{self.memory_plan.format()}")
+            if not self.memory_plan.fits:
+                logger.warning("The memory plan exceeds the device budgets; loading may run out of memory")
+            device_map, max_memory = self.memory_plan.device_map, None
+            if self.memory_plan.gradient_checkpointing and not self.training_config.gradient_checkpointing:
+                logger.info("Enabling gradient checkpointing as planned")
+                self.training_config.gradient_checkpointing = True
+        
+        mmap_weights = self.model_config.mmap_weights
+        if mmap_weights and backend == "bitsandbytes":
+            logger.warning("bitsandbytes quantizes while loading; ignoring mmap_weights")
+            mmap_weights = False
+        
+        # Load model
+        model = self._load_mapped_model(config, torch_dtype) if mmap_weights else None
+        if model is None:
+            model = AutoModelForCausalLM.from_pretrained(
+                self.model_config.model_name,
+                config=config,
+                revision=self.model_config.model_revision,
+                cache_dir=self.model_config.cache_dir,
+                use_auth_token=self.model_config.use_auth_token,
+                torch_dtype=torch_dtype,
+                device_map=device_map,
+                max_memory=max_memory,
+                offload_folder=self.model_config.offload_folder,
+                low_cpu_mem_usage=self.model_config.low_cpu_mem_usage,
+                trust_remote_code=self.model_config.trust_remote_code,
+                **quantization_kwargs
+            )
+            # This process keeps its own copy; the next ones map the converted weights
+            if mmap_weights and self.model_config.mmap_cache_dir and getattr(model, "hf_quantizer", None) is None:
+                cache_path = mmap_cache_path(self.model_config.mmap_cache_dir, self.model_config.model_name, self.model_config.model_revision, torch_dtype)
+                logger.info(f"Writing the {torch_dtype} weights to {cache_path} for other processes to map")
+                write_mmap_cache(model, cache_path)
+        elif device_map is not None and torch.cuda.is_available():
+            model = dispatch_mmap_model(model, device_map, max_memory, self.model_config.offload_folder)
+        self.model = model
+        
+        if backend == "reference":
+            self.quantization_stats = quantize_model(
+                self.model,
+                quantization,
+                compute_dtype,
+                block_size=self.model_config.quant_block_size,
+                double_quant=self.model_config.quant_double_quant,
+                skip_modules=self.model_config.quant_skip_modules
+            )
+        elif backend == "bitsandbytes":
+            bytes_after, bytes_before = weight_memory(self.model, torch_dtype)
+            self.quantization_stats = {
+                "backend": backend,
+                "quantization": quantization,
+                "double_quant": self.model_config.quant_double_quant and quantization != "int8",
+                "bytes_before": bytes_before,
+                "bytes_after": bytes_after,
+            }
+        if quantization:
+            stats = self.quantization_stats
+            logger.info(
+                f"Base model quantized to {quantization} with {backend}: weights "
+                f"{stats['bytes_before'] / 1024 ** 3:.2f} GB -> {stats['bytes_after'] / 1024 ** 3:.2f} GB "
+                f"({1 - stats['bytes_after'] / max(stats['bytes_before'], 1):.0%} saved)"
+            )
+        
+        # Resize token embeddings if necessary
+        if len(self.tokenizer) != self.model.config.vocab_size:
+            logger.info(f"Resizing token embeddings from {self.model.config.vocab_size} to {len(self.tokenizer)}")
+            self.model.resize_token_embeddings(len(self.tokenizer))
+        
+        logger.info(f"Model loaded. Parameters: {self.model.num_parameters():,}")
+        
+        if self.model_config.draft_model_name:
+            self.load_draft_model()
+    
+    def _load_mapped_model(self, config: AutoConfig, torch_dtype: torch.dtype) -> Optional[nn.Module]:
+        """Map the base weights from the checkpoint, or from its converted copy in mmap_cache_dir
+        
+        Returns None if the weights cannot be mapped; with a cache directory,
+        a checkpoint in another dtype counts as unmappable so that it gets
+        converted instead of cast in every process.
+        """
+        source = self.model_config.model_name
+        cache_dir = self.model_config.mmap_cache_dir
+        if cache_dir:
+            cache_path = mmap_cache_path(cache_dir, source, self.model_config.model_revision, torch_dtype)
+            if os.path.isdir(cache_path):
+                source = cache_path
+        try:
+            model, self.mmap_stats = load_model_mmap(
+                source,
+                config,
+                torch_dtype,
+                revision=self.model_config.model_revision,
+                cache_dir=self.model_config.cache_dir,
+                token=self.model_config.use_auth_token,
+                trust_remote_code=self.model_config.trust_remote_code,
+                allow_cast=not cache_dir
+            )
+        except ValueError as e:
+            logger.warning(f"Cannot map the weights of {source}, loading with from_pretrained: {e}")
+            return None
+        
+        stats = self.mmap_stats
+        logger.info(
+            f"Mapped {stats['mapped_bytes'] / 1024 ** 3:.2f} GB of weights from {stats['files']} file(s) of {source} "
+            f"in {stats['load_s']:.2f}s ({stats['copied_bytes'] / 1024 ** 3:.2f} GB copied); "
+            f"host memory: " + ", ".join(f"{name} {value:.0f}" for name, value in memory_usage().items())
+        )
+        return model
+    
+    def _memory_plan_config(self, quantization_backend: Optional[str] = None) -> MemoryPlanConfig:
+        """Describe the configured run to the memory planner"""
+        return MemoryPlanConfig(
+            batch_size=self.training_config.per_device_train_batch_size,
+            max_length=self.training_config.max_length,
+            gradient_accumulation_steps=self.training_config.gradient_accumulation_steps,
+            torch_dtype=self.model_config.torch_dtype,
+            attn_implementation=self.model_config.attn_implementation if self.model_config.use_flash_attention else "sdpa",
+            training=not self.lora_config.inference_mode,
+            # Left to the planner unless checkpointing was asked for; the planner models the full policy
+            gradient_checkpointing=True if self.training_config.gradient_checkpointing else None,
+            quantization=self.model_config.quantization,
+            quantization_backend=quantization_backend or self.model_config.quantization_backend,
+            quant_block_size=self.model_config.quant_block_size,
+            quant_double_quant=self.model_config.quant_double_quant,
+            quant_skip_modules=self.model_config.quant_skip_modules,
+            lora_r=self.lora_config.r,
+            lora_target_modules=self.lora_config.target_modules,
+            lora_experts={"none": 0, "all": -1}.get(self.lora_config.expert_lora, self.lora_config.hot_experts),
+            lora_dropout=self.lora_config.lora_dropout,
+            max_memory=self.model_config.max_memory,
+            offload_folder=self.model_config.offload_folder,
+            trust_remote_code=self.model_config.trust_remote_code,
+        )
+    
+    def load_draft_model(self, model_name: Optional[str] = None):
+        """Load a small causal LM that shares the tokenizer to speculate tokens for generation"""
+        model_name = model_name or self.model_config.draft_model_name
+        logger.info(f"Loading draft model from {model_name}")
+        
+        draft_tokenizer = AutoTokenizer.from_pretrained(
+            model_name,
+            cache_dir=self.model_config.cache_dir,
+            use_auth_token=self.model_config.use_auth_token,
+            trust_remote_code=self.model_config.trust_remote_code
+        )
+        vocab = self.tokenizer.get_vocab()
+        if any(vocab.get(token) != idx for token, idx in draft_tokenizer.get_vocab().items()):
+            raise ValueError(f"Draft model {model_name} does not share the tokenizer of {self.model_config.model_name}")
+        
+        self.draft_model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            cache_dir=self.model_config.cache_dir,
+            use_auth_token=self.model_config.use_auth_token,
+            torch_dtype=self._torch_dtype(),
+            device_map=self.model_config.device_map,
+            low_cpu_mem_usage=self.model_config.low_cpu_mem_usage,
+            trust_remote_code=self.model_config.trust_remote_code
+        )
+        if self.model_config.device_map is None:
+            self.draft_model.to(self.device)
+        
+        # Special tokens added for the harmony format must exist for the draft too
+        if len(self.tokenizer) > self.draft_model.get_input_embeddings().num_embeddings:
+            self.draft_model.resize_token_embeddings(len(self.tokenizer))
+        self.draft_model.eval()
+        
+        logger.info(f"Draft model loaded. Parameters: {self.draft_model.num_parameters():,}")
+        
+    def setup_lora(self):
+        """Setup LoRA for parameter-efficient fine-tuning"""
+        logger.info("Setting up LoRA")
+        
+        # Only bitsandbytes models need this; on a full-precision model it would upcast every weight to fp32
+        if getattr(self.model, "is_loaded_in_8bit", False) or getattr(self.model, "is_loaded_in_4bit", False):
+            self.model = prepare_model_for_kbit_training(self.model)
+        
+        if self.lora_config.expert_lora not in EXPERT_LORA_MODES:
+            raise ValueError(f"Unknown expert_lora {self.lora_config.expert_lora!r}, expected one of {EXPERT_LORA_MODES}")
+        target_modules = resolve_target_modules(self.model, self.lora_config.target_modules)
+        logger.info(f"LoRA target modules: {', '.join(target_modules)}")
+        
+        # Configure LoRA
+        lora_config = LoraConfig(
+            r=self.lora_config.r,
+            lora_alpha=self.lora_config.lora_alpha,
+            target_modules=target_modules,
+            lora_dropout=self.lora_config.lora_dropout,
+            bias=self.lora_config.bias,
+            task_type=TaskType.CAUSAL_LM,
+            inference_mode=self.lora_config.inference_mode,
+            modules_to_save=self.lora_config.modules_to_save
+        )
+        
+        # Apply LoRA
+        self.model = get_peft_model(self.model, lora_config)
+        if self.lora_config.expert_lora != "none":
+            self._setup_expert_lora()
+        self._clear_prefix_cache()
+        
+        # Print trainable parameters
+        self.model.print_trainable_parameters()
+        
+        logger.info("LoRA setup complete")
+    
+    def _setup_expert_lora(self):
+        """Add LoRA to the mixture-of-experts weights, of every expert or of the most-routed ones"""
+        experts = None
+        if self.lora_config.expert_lora == "hot":
+            if not self.lora_config.routing_stats:
+                raise ValueError(
+                    f"expert_lora='hot' needs routing_stats, a {ROUTING_STATS_FILE} written by the routing-stats command "
+                    f"or by a training run with log_routing"
+                )
+            experts = hot_experts(load_routing_stats(self.lora_config.routing_stats), self.lora_config.hot_experts)
+        
+        blocks = add_expert_lora(self.model, self.lora_config.r, self.lora_config.lora_alpha, experts)
+        if not blocks:
+            raise ValueError(f"expert_lora={self.lora_config.expert_lora!r}, but the model has no mixture-of-experts weights")
+        if experts is None:
+            logger.info(f"Expert LoRA on all experts of {blocks} layers")
+        else:
+            logger.info(f"Expert LoRA on the {self.lora_config.hot_experts} most-routed experts of {blocks} layers")
+        
+    def create_datasets(self, train_data_path: str, eval_data_path: Optional[str] = None) -> Tuple[GPTOSSDataset, Optional[GPTOSSDataset]]:
+        """Create training and evaluation datasets"""
+        logger.info("Creating datasets")
+        
+        padding = "longest" if self.training_config.dynamic_padding else "max_length"
+        
+        if self.training_config.streaming:
+            if self.training_config.packing or self.training_config.token_cache_dir:
+                raise ValueError("Streaming cannot be combined with packing or the token cache")
+            
+            train_dataset = StreamingGPTOSSDataset(
+                train_data_path,
+                self.tokenizer,
+                max_length=self.training_config.max_length,
+                use_reasoning_tokens=self.training_config.use_reasoning_tokens,
+                reasoning_level=self.training_config.reasoning_level,
+                padding=padding,
+                shuffle_buffer_size=self.training_config.shuffle_buffer_size,
+                seed=self.training_config.seed,
+                index_dir=self.training_config.streaming_index_dir
+            )
+        else:
+            train_dataset = GPTOSSDataset(
+                train_data_path,
+                self.tokenizer,
+                max_length=self.training_config.max_length,
+                use_reasoning_tokens=self.training_config.use_reasoning_tokens,
+                reasoning_level=self.training_config.reasoning_level,
+                padding=padding,
+                cache_dir=self.training_config.token_cache_dir,
+                num_proc=self.training_config.preprocessing_num_workers,
+                deduplicate=self.training_config.deduplicate
+            )
+        
+        eval_dataset = None
+        if eval_data_path:
+            eval_dataset = GPTOSSDataset(
+                eval_data_path,
+                self.tokenizer,
+                max_length=self.training_config.max_length,
+                use_reasoning_tokens=self.training_config.use_reasoning_tokens,
+                reasoning_level=self.training_config.reasoning_level,
+                padding=padding,
+                cache_dir=self.training_config.token_cache_dir,
+                num_proc=self.training_config.preprocessing_num_workers,
+                deduplicate=self.training_config.deduplicate
+            )
+            logger.info(f"Created evaluation dataset with {len(eval_dataset)} examples")
+        
+        logger.info(f"Created training dataset with {len(train_dataset)} examples")
+        
+        if self.training_config.packing:
+            train_dataset = PackedGPTOSSDataset(train_dataset)
+            if eval_dataset is not None:
+                eval_dataset = PackedGPTOSSDataset(eval_dataset)
+        
+        # The datasets may have added harmony special tokens the embeddings don't cover yet
+        if self.model is not None and len(self.tokenizer) > self.model.get_input_embeddings().num_embeddings:
+            logger.info(f"Resizing token embeddings to {len(self.tokenizer)} for added special tokens")
+            self.model.resize_token_embeddings(len(self.tokenizer))
+        
+        return train_dataset, eval_dataset
+    
+    def _packing_attention(self) -> str:
+        """Resolve how packed documents are kept from attending to each other"""
+        if self.training_config.packing_attention != "auto":
+            return self.training_config.packing_attention
+        if self.model_config.use_flash_attention and "flash_attention" in self.model_config.attn_implementation:
+            return "position_ids"
+        return "block_mask"
+    
+    def setup_trainer(self, train_dataset: GPTOSSDataset, eval_dataset: Optional[GPTOSSDataset] = None):
+        """Setup the Hugging Face trainer"""
+        logger.info("Setting up trainer")
+        
+        sharded = self.training_config.sharding != "none"
+        if sharded and self.training_config.sharding != "fsdp":
+            raise ValueError(f"Unknown sharding mode {self.training_config.sharding!r}, expected none or fsdp")
+        optimizer = optimizer_cls_and_kwargs(
+            self.training_config.optimizer,
+            backend=self.training_config.optimizer_backend,
+            offload=self.training_config.optimizer_offload,
+            lr=self.training_config.learning_rate,
+            betas=(self.training_config.adam_beta1, self.training_config.adam_beta2),
+            eps=self.training_config.adam_epsilon
+        )
+        if sharded and optimizer is not None:
+            # The distributed optimizer checkpoints assume state shaped like the parameter shards
+            raise ValueError("Sharded training shards the plain AdamW state already; use sharding_cpu_offload instead of a low-memory optimizer")
+        
+        # Newer transformers releases renamed evaluation_strategy to eval_strategy
+        strategy_arg = "eval_strategy" if "eval_strategy" in TrainingArguments.__dataclass_fields__ else "evaluation_strategy"
+        
+        # Create training arguments
+        training_args = TrainingArguments(
+            output_dir=self.training_config.output_dir,
+            num_train_epochs=self.training_config.num_train_epochs,
+            max_steps=self.training_config.max_steps,
+            per_device_train_batch_size=self.training_config.per_device_train_batch_size,
+            per_device_eval_batch_size=self.training_config.per_device_eval_batch_size,
+            gradient_accumulation_steps=self.training_config.gradient_accumulation_steps,
+            learning_rate=self.training_config.learning_rate,
+            weight_decay=self.training_config.weight_decay,
+            adam_beta1=self.training_config.adam_beta1,
+            adam_beta2=self.training_config.adam_beta2,
+            adam_epsilon=self.training_config.adam_epsilon,
+            max_grad_norm=self.training_config.max_grad_norm,
+            warmup_ratio=self.training_config.warmup_ratio,
+            lr_scheduler_type=self.training_config.lr_scheduler_type,
+            logging_steps=self.training_config.logging_steps,
+            eval_steps=self.training_config.eval_steps if eval_dataset else None,
+            save_steps=self.training_config.save_steps,
+            save_total_limit=self.training_config.save_total_limit,
+            **{strategy_arg: self.training_config.evaluation_strategy if eval_dataset else "no"},
+            # Loading the best adapter back into sharded weights is not supported
+            load_best_model_at_end=self.training_config.load_best_model_at_end if eval_dataset and not sharded else False,
+            metric_for_best_model=self.training_config.metric_for_best_model,
+            greater_is_better=self.training_config.greater_is_better,
+            seed=self.training_config.seed,
+            fp16=self.training_config.fp16,
+            bf16=self.training_config.bf16,
+            dataloader_num_workers=self.training_config.dataloader_num_workers,
+            remove_unused_columns=self.training_config.remove_unused_columns,
+            report_to=self.training_config.report_to,
+            run_name=self.training_config.run_name or f"gpt-oss-120b-{int(time.time())}",
+            ddp_find_unused_parameters=False,
+            # The process group _setup_device joined. Accelerate only treats CPU ranks as one run (MULTI_CPU) when told
+            # to use the CPU; otherwise it stays undistributed but still scales the loss by the number of processes
+            ddp_backend=dist.get_backend() if dist.is_initialized() else None,
+            use_cpu=self.n_gpu == 0 and self.world_size > 1,
+            dataloader_pin_memory=False,
+        )
+        
+        # Activation memory strategy; the Trainer's own gradient_checkpointing would always recompute every layer
+        if self.training_config.gradient_checkpointing:
+            num_recomputed = apply_checkpoint_policy(
+                self.model,
+                self.training_config.checkpoint_policy,
+                every_n=self.training_config.checkpoint_every_n,
+                modules=self.training_config.checkpoint_modules
+            )
+            logger.info(f"Gradient checkpointing ({self.training_config.checkpoint_policy}) recomputes {num_recomputed} modules")
+        activation_offload = None
+        if self.training_config.offload_activations:
+            activation_offload = ActivationOffload(min_bytes=self.training_config.offload_min_bytes)
+            if not torch.cuda.is_available():
+                logger.warning("Activation offload has no effect without a GPU")
+        chunked_loss = None
+        if self.training_config.chunked_loss:
+            chunked_loss = ChunkedCrossEntropy(chunk_size=self.training_config.loss_chunk_size)
+            chunked_loss.attach(self.model)
+        
+        # Data collator
+        if self.training_config.packing:
+            data_collator = DataCollatorForPacking(
+                pad_token_id=self.tokenizer.pad_token_id,
+                pad_to_multiple_of=self.training_config.pad_to_multiple_of,
+                attention=self._packing_attention(),
+                mask_dtype=self._torch_dtype()
+            )
+        elif self.training_config.dynamic_padding:
+            data_collator = DataCollatorForHarmony(
+                pad_token_id=self.tokenizer.pad_token_id,
+                pad_to_multiple_of=self.training_config.pad_to_multiple_of
+            )
+        else:
+            data_collator = DataCollatorForLanguageModeling(
+                tokenizer=self.tokenizer,
+                mlm=False,
+            )
+        
+        # Create trainer
+        self.trainer = GPTOSSTrainer(
+            model=self.model,
+            args=training_args,
+            train_dataset=train_dataset,
+            eval_dataset=eval_dataset,
+            tokenizer=self.tokenizer,
+            data_collator=data_collator,
+            group_by_token_length=self.training_config.group_by_length,
+            mega_batch_mult=self.training_config.length_grouping_mega_batch_mult,
+            checkpointer=AsyncCheckpointer(
+                max_shard_bytes=self.training_config.checkpoint_shard_mb * 1024 * 1024
+            ) if self.training_config.async_checkpointing else None,
+            activation_offload=activation_offload,
+            chunked_loss=chunked_loss,
+            optimizer_cls_and_kwargs=optimizer,
+            sharding=ShardingConfig(
+                strategy=self.training_config.sharding_strategy,
+                cpu_offload=self.training_config.sharding_cpu_offload
+            ) if sharded else None,
+        )
+        
+        # Step timing and profiler capture
+        if (
+            self.training_config.instrument_steps
+            or self.training_config.profile_start_step is not None
+            or self.training_config.profile_on_signal
+        ):
+            self.profiler = TrainingProfiler(
+                self.training_config.profiling_dir or os.path.join(self.training_config.output_dir, "profiling"),
+                profile_start_step=self.training_config.profile_start_step,
+                profile_num_steps=self.training_config.profile_num_steps,
+                profile_on_signal=self.training_config.profile_on_signal
+            )
+            self.profiler.attach(self.trainer)
+        
+        # Expert load and router entropy of the training batches
+        if self.training_config.log_routing:
+            self.routing_stats = RoutingStatsCallback(os.path.join(self.training_config.output_dir, ROUTING_STATS_FILE))
+            self.routing_stats.attach(self.trainer)
+        
+        # Generation-based eval of adapter snapshots, off the training thread
+        if self.training_config.generation_eval_data:
+            eval_model_config = dataclasses.replace(
+                self.model_config,
+                device_map=self.training_config.generation_eval_device_map or self.model_config.device_map,
+                prefix_cache_mb=0
+            )
+            self.generation_eval = GenerationEvalCallback(
+                eval_model_config,
+                self.training_config.generation_eval_data,
+                self.training_config.generation_eval_steps,
+                self.training_config.generation_eval_dir or os.path.join(self.training_config.output_dir, "generation_eval"),
+                GenerationEvalConfig(
+                    batch_size=self.training_config.per_device_eval_batch_size * 8,
+                    max_new_tokens=self.training_config.generation_eval_max_new_tokens,
+                    max_examples=self.training_config.generation_eval_max_examples,
+                    reasoning_level=self.training_config.reasoning_level
+                ),
+                max_prompt_length=self.training_config.max_length,
+                use_reasoning_tokens=self.training_config.use_reasoning_tokens,
+                tokenizer=self.tokenizer
+            )
+            self.generation_eval.attach(self.trainer)
+        
+        logger.info("Trainer setup complete")
+    
+    def _resolve_checkpoint(self, resume_from_checkpoint: Optional[str]) -> Optional[str]:
+        """Map "latest" to the newest finished checkpoint in output_dir, if there is one"""
+        if resume_from_checkpoint != "latest":
+            return resume_from_checkpoint
+        checkpoint = latest_checkpoint(self.training_config.output_dir)
+        if checkpoint is None:
+            logger.info(f"No checkpoint found in {self.training_config.output_dir}, starting from scratch")
+        return checkpoint
+    
+    def train(self, resume_from_checkpoint: Optional[str] = None):
+        """Start training, or resume from a checkpoint directory ("latest" for the newest one)"""
+        checkpoint = self._resolve_checkpoint(resume_from_checkpoint or self.training_config.resume_from_checkpoint)
+        if checkpoint:
+            logger.info(f"Resuming training from {checkpoint}")
+        else:
+            logger.info("Starting training")
+        
+        try:
+            # Start training
+            result = self.trainer.train(resume_from_checkpoint=checkpoint)
+            
+            # Save final model
+            self.trainer.save_model()
+            
+            # Cached prompt key/values were computed with the pre-training weights
+            self._clear_prefix_cache()
+            
+            # Log results
+            logger.info(f"Training completed. Final loss: {result.training_loss:.4f}")
+            
+            return result
+            
+        except Exception as e:
+            logger.error(f"Training failed: {e}")
+            traceback.print_exc()
+            raise
+    
+    def evaluate(self) -> Dict[str, float]:
+        """Evaluate the model"""
+        if self.trainer is None:
+            raise ValueError("Trainer not initialized. Call setup_trainer first.")
+        
+        logger.info("Starting evaluation")
+        results = self.trainer.evaluate()
+        
+        for key, value in results.items():
+            logger.info(f"{key}: {value}")
+        
+        return results
+    
+    def evaluate_generation(
+        self,
+        eval_path: str,
+        config: Optional[GenerationEvalConfig] = None,
+        examples_output: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Score generated responses on an eval JSONL (exact match, tag format, lengths)
+        
+        See gptoss_eval.py; responses are cached when ``config.cache_path`` is set.
+        """
+        return evaluate_generation(self, eval_path, config, examples_output)
+    
+    def save_model(self, path: str):
+        """Save the fine-tuned model"""
+        logger.info(f"Saving model to {path}")
+        
+        os.makedirs(path, exist_ok=True)
+        
+        # Save model and tokenizer
+        if self.trainer is not None and self.trainer.sharded_model is not None:
+            # Every rank takes part in gathering the adapter shards; the main process writes them
+            self.trainer.save_model(path)
+            if not self.trainer.args.should_save:
+                return
+        else:
+            self.model.save_pretrained(path)
+        self.tokenizer.save_pretrained(path)
+        
+        # Save configuration
+        config = {
+            "model_config": self.model_config.__dict__,
+            "lora_config": self.lora_config.__dict__,
+            "training_config": self.training_config.__dict__
+        }
+        
+        with open(os.path.join(path, "fine_tuning_config.json"), "w") as f:
+            json.dump(config, f, indent=2)
+        
+        logger.info(f"Model saved to {path}")
+    
+    def load_finetuned_model(self, path: str, adapter_name: str = "default"):
+        """Load a fine-tuned model
+        
+        The base model is only loaded if it is not resident yet; loading a
+        second fine-tune adds its adapter next to the first one and makes it
+        the default adapter of generation without ``adapter_name``.
+        """
+        logger.info(f"Loading fine-tuned model from {path}")
+        
+        # Load base model first
+        if self.model is None:
+            self.load_model()
+        
+        # Load PEFT adapter
+        self.register_adapter(adapter_name, path)
+        self.adapters.release(self.adapters.acquire(adapter_name))
+        self.model.set_adapter(adapter_name)
+        self.adapters.set_default(adapter_name)
+        self._clear_prefix_cache()
+        
+        logger.info("Fine-tuned model loaded")
+    
+    def register_adapter(self, name: str, path: str):
+        """Make a LoRA adapter available to generate(adapter_name=...) and the serving engine"""
+        if self.model is None:
+            raise ValueError("Model must be loaded first")
+        if self.adapters is None:
+            self.adapters = AdapterRegistry(self, max_loaded=self.model_config.max_loaded_adapters)
+        self.adapters.register(name, path)
+    
+    def _acquire_adapter(self, adapter_name: Optional[str]) -> Optional[str]:
+        """Pin an adapter, or the registry's default for None, for the duration of one generation"""
+        if self.adapters is None:
+            if adapter_name is not None:
+                raise ValueError("No adapters registered")
+            return None
+        return self.adapters.acquire(adapter_name)
+    
+    def _release_adapter(self, adapter_name: Optional[str]):
+        if adapter_name is not None:
+            self.adapters.release(adapter_name)
+    
+    def _generation_prompt_parts(
+        self,
+        prompt: str,
+        reasoning_level: str = "medium",
+        system_prompt: Optional[str] = None
+    ) -> Tuple[str, str]:
+        """Split a generation prompt into the shared system preamble and the user suffix"""
+        if self.training_config.use_reasoning_tokens:
+            system_prompt = system_prompt or "You are a helpful AI assistant."
+            prefix = f"<s>System: Reasoning: {reasoning_level}\n\n{system_prompt}\n\n"
+        elif system_prompt:
+            prefix = f"<s>System: {system_prompt}\n\n"
+        else:
+            prefix = "<s>"
+        return prefix, f"User: {prompt}\n\nAssistant:"
+    
+    def _format_generation_prompt(
+        self,
+        prompt: str,
+        reasoning_level: str = "medium",
+        system_prompt: Optional[str] = None
+    ) -> str:
+        """Format a user prompt for generation in harmony format"""
+        prefix, suffix = self._generation_prompt_parts(prompt, reasoning_level, system_prompt)
+        return prefix + suffix
+    
+    def _prefix_cache_namespace(self, adapter_name: Optional[str] = None) -> Tuple[int, Any]:
+        """Identify the weights cached key/values were computed with"""
+        return id(self.model), adapter_name or getattr(self.model, "active_adapter", None)
+    
+    def _tokenize_with_prefix(
+        self,
+        prompt: str,
+        reasoning_level: str = "medium",
+        system_prompt: Optional[str] = None
+    ) -> Tuple[List[int], List[int]]:
+        """Tokenize the system preamble and user suffix separately so the preamble can be cached"""
+        prefix, suffix = self._generation_prompt_parts(prompt, reasoning_level, system_prompt)
+        prefix_ids = self.tokenizer(prefix)["input_ids"]
+        suffix_ids = self.tokenizer(suffix, add_special_tokens=False)["input_ids"]
+        return prefix_ids, suffix_ids
+    
+    def _prepare_generation_inputs(
+        self,
+        prompt: str,
+        reasoning_level: str = "medium",
+        system_prompt: Optional[str] = None,
+        adapter_name: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Tokenize a prompt for generate(), reusing cached preamble key/values when possible
+        
+        With ``adapter_name`` (already acquired) the returned inputs also route
+        the forward pass through that adapter.
+        """
+        adapter_kwargs = self.adapters.forward_kwargs([adapter_name]) if adapter_name is not None else {}
+        
+        if self.prefix_cache is not None:
+            prefix_ids, suffix_ids = self._tokenize_with_prefix(prompt, reasoning_level, system_prompt)
+            input_ids = prefix_ids + suffix_ids
+            if suffix_ids and len(input_ids) <= self.training_config.max_length:
+                prefix_kv = self.prefix_cache.get(
+                    self.model,
+                    prefix_ids,
+                    self.device,
+                    namespace=self._prefix_cache_namespace(adapter_name),
+                    **adapter_kwargs
+                )
+                input_tensor = torch.tensor([input_ids], dtype=torch.long, device=self.device)
+                return {
+                    "input_ids": input_tensor,
+                    "attention_mask": torch.ones_like(input_tensor),
+                    # Only the suffix is prefilled; the cached preamble is never written to
+                    "past_key_values": cache_from_legacy(prefix_kv),
+                    **adapter_kwargs
+                }
+        
+        # Tokenize
+        inputs = self.tokenizer(
+            self._format_generation_prompt(prompt, reasoning_level, system_prompt),
+            return_tensors="pt",
+            truncation=True,
+            max_length=self.training_config.max_length
+        )
+        
+        # Move to device
+        return {**{k: v.to(self.device) for k, v in inputs.items()}, **adapter_kwargs}
+    
+    def generate(
+        self,
+        prompt: str,
+        max_length: int = 512,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        do_sample: bool = True,
+        reasoning_level: str = "medium",
+        system_prompt: Optional[str] = None,
+        adapter_name: Optional[str] = None
+    ) -> str:
+        """Generate text using the fine-tuned model
+        
+        ``adapter_name`` selects one of the registered LoRA adapters for this
+        call only; by default the registry's default adapter (the one
+        load_finetuned_model loaded last) is used.
+        """
+        if self.model is None or self.tokenizer is None:
+            raise ValueError("Model and tokenizer must be loaded first")
+        
+        if self.draft_model is not None:
+            return "".join(self.generate_stream(
+                prompt,
+                max_length=max_length,
+                temperature=temperature,
+                top_p=top_p,
+                do_sample=do_sample,
+                reasoning_level=reasoning_level,
+                system_prompt=system_prompt,
+                adapter_name=adapter_name
+            ))
+        
+        adapter_name = self._acquire_adapter(adapter_name)
+        try:
+            # Format and tokenize the prompt with reasoning level
+            inputs = self._prepare_generation_inputs(prompt, reasoning_level, system_prompt, adapter_name)
+            
+            # Generate
+            with torch.no_grad():
+                outputs = self.model.generate(
+                    **inputs,
+                    max_length=max_length,
+                    temperature=temperature,
+                    top_p=top_p,
+                    do_sample=do_sample,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    eos_token_id=self.tokenizer.eos_token_id
+                )
+        finally:
+            self._release_adapter(adapter_name)
+        
+        # Decode
+        generated = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+        
+        # Extract assistant response
+        if "Assistant:" in generated:
+            response = generated.split("Assistant:")[-1].strip()
+        else:
+            response = generated
+        
+        return response
+    
+    def _encode_generation_prompt(
+        self,
+        prompt: str,
+        reasoning_level: str = "medium",
+        system_prompt: Optional[str] = None
+    ) -> List[int]:
+        """Token ids generate() would feed the model for this prompt"""
+        return self.tokenizer(
+            self._format_generation_prompt(prompt, reasoning_level, system_prompt),
+            truncation=True,
+            max_length=self.training_config.max_length
+        )["input_ids"]
+    
+    def _generate_batch_ids(
+        self,
+        batch_ids: List[List[int]],
+        max_new_tokens: int = 256,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        do_sample: bool = True,
+        adapter_name: Optional[str] = None
+    ) -> List[Tuple[List[int], str]]:
+        """Generate for tokenized prompts as one left-padded batch
+        
+        Returns the completion ids (without EOS) and the finish reason,
+        "stop" or "length", of every prompt. ``adapter_name`` must already be
+        acquired.
+        """
+        width = max(len(ids) for ids in batch_ids)
+        input_ids = torch.full((len(batch_ids), width), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, ids in enumerate(batch_ids):
+            input_ids[row, width - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, width - len(ids):] = 1
+        adapter_kwargs = self.adapters.forward_kwargs([adapter_name] * len(batch_ids)) if adapter_name is not None else {}
+        
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device),
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                do_sample=do_sample,
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_id=self.tokenizer.eos_token_id,
+                **adapter_kwargs
+            )
+        
+        results = []
+        for completion in outputs[:, width:].tolist():
+            if self.tokenizer.eos_token_id in completion:
+                results.append((completion[:completion.index(self.tokenizer.eos_token_id)], "stop"))
+            else:
+                results.append((completion, "length"))
+        return results
+    
+    def generate_batch(
+        self,
+        prompts: List[str],
+        max_new_tokens: int = 256,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        do_sample: bool = True,
+        reasoning_level: str = "medium",
+        system_prompt: Optional[str] = None,
+        adapter_name: Optional[str] = None
+    ) -> List[str]:
+        """Generate responses for several prompts in one padded batch
+        
+        For files of prompts, gptoss_batch.py sorts prompts by length into
+        batches and writes the results as it goes.
+        """
+        if self.model is None or self.tokenizer is None:
+            raise ValueError("Model and tokenizer must be loaded first")
+        
+        batch_ids = [self._encode_generation_prompt(prompt, reasoning_level, system_prompt) for prompt in prompts]
+        adapter_name = self._acquire_adapter(adapter_name)
+        try:
+            results = self._generate_batch_ids(batch_ids, max_new_tokens, temperature, top_p, do_sample, adapter_name)
+        finally:
+            self._release_adapter(adapter_name)
+        return [self.tokenizer.decode(ids, skip_special_tokens=True).strip() for ids, _ in results]
+    
+    def generate_stream(
+        self,
+        prompt: str,
+        max_length: int = 512,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        do_sample: bool = True,
+        reasoning_level: str = "medium",
+        system_prompt: Optional[str] = None,
+        stop: Optional[List[str]] = None,
+        adapter_name: Optional[str] = None
+    ) -> Iterator[str]:
+        """Yield the assistant response piece by piece as tokens are generated
+        
+        Stops at the EOS token, at the first occurrence of any ``stop`` string
+        (which is not included in the output) or once the sequence reaches
+        ``max_length`` tokens. Uses speculative decoding when a draft model is
+        loaded.
+        """
+        if self.model is None or self.tokenizer is None:
+            raise ValueError("Model and tokenizer must be loaded first")
+        
+        adapter_name = self._acquire_adapter(adapter_name)
+        try:
+            inputs = self._prepare_generation_inputs(prompt, reasoning_level, system_prompt, adapter_name)
+            input_ids = inputs["input_ids"]
+            
+            detokenizer = IncrementalDetokenizer(self.tokenizer, prompt_ids=input_ids[0].tolist())
+            matcher = StopStringMatcher(stop)
+            started = False
+            
+            for token_id in self._generate_token_ids(inputs, max_length - input_ids.shape[1], temperature, top_p, do_sample):
+                if token_id == self.tokenizer.eos_token_id:
+                    break
+                
+                text, stopped = matcher.feed(detokenizer.add(token_id))
+                if not started:
+                    text = text.lstrip()
+                    started = bool(text)
+                if text:
+                    yield text
+                if stopped:
+                    return
+            
+            text, stopped = matcher.feed(detokenizer.flush())
+            if not stopped:
+                text += matcher.flush()
+            if not started:
+                text = text.lstrip()
+            if text:
+                yield text
+        finally:
+            self._release_adapter(adapter_name)
+    
+    def _generate_token_ids(
+        self,
+        inputs: Dict[str, Any],
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        do_sample: bool
+    ) -> Iterator[int]:
+        """Yield generated token ids one at a time, speculatively when a draft model is loaded"""
+        input_ids = inputs["input_ids"]
+        past_key_values = inputs.get("past_key_values")
+        model_kwargs = {"adapter_names": inputs["adapter_names"]} if "adapter_names" in inputs else {}
+        
+        if self.draft_model is not None:
+            stats = SpeculativeStats()
+            try:
+                yield from speculative_decode(
+                    self.model,
+                    self.draft_model,
+                    input_ids[0].tolist(),
+                    max_new_tokens,
+                    num_speculative_tokens=self.model_config.num_speculative_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    do_sample=do_sample,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    target_cache=past_key_values,
+                    target_kwargs=model_kwargs,
+                    stats=stats
+                )
+            finally:
+                self.last_speculative_stats = stats
+                logger.info(
+                    f"Speculative decoding: {stats.generated} tokens in {stats.target_forwards} target passes, "
+                    f"acceptance rate {stats.acceptance_rate:.2%}, estimated speedup {stats.estimated_speedup:.2f}x"
+                )
+            return
+        
+        # With a cached preamble only the rest of the prompt has to be run
+        next_input = input_ids[:, past_key_values.get_seq_length():] if past_key_values is not None else input_ids
+        temperature_t = torch.tensor([temperature], device=self.device)
+        top_p_t = torch.tensor([top_p], device=self.device)
+        do_sample_t = torch.tensor([do_sample], device=self.device)
+        
+        for _ in range(max_new_tokens):
+            # Grad mode is thread-global, so it must not stay disabled across yields
+            with torch.no_grad():
+                outputs = self.model(input_ids=next_input, past_key_values=past_key_values, use_cache=True, **model_kwargs)
+                next_token = sample_next_tokens(outputs.logits[:, -1, :], temperature_t, top_p_t, do_sample_t)
+            past_key_values = outputs.past_key_values
+            yield int(next_token[0])
+            next_input = next_token.view(1, 1)
+    
+    async def agenerate_stream(self, prompt: str, **kwargs) -> AsyncIterator[str]:
+        """Async variant of generate_stream; the model runs in a worker thread
+        
+        Accepts the same keyword arguments as generate_stream. Closing the
+        iterator early stops generation after the current token.
+        """
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue()
+        finished = object()
+        cancelled = threading.Event()
+        
+        def produce():
+            try:
+                for chunk in self.generate_stream(prompt, **kwargs):
+                    if cancelled.is_set():
+                        break
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            except Exception as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, finished)
+        
+        producer = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                item = await chunks.get()
+                if item is finished:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+            await producer
+    
+    def merge_and_unload(self) -> AutoModelForCausalLM:
+        """Merge LoRA weights and unload adapters"""
+        logger.info("Merging LoRA weights and unloading adapters")
+        
+        if not hasattr(self.model, 'merge_and_unload'):
+            raise ValueError("Model does not have LoRA adapters to merge")
+        
+        # Eviction may have made another adapter active; merge the default one, reloading it if it was evicted
+        if self.adapters is not None and self.adapters.default != BASE_ADAPTER:
+            self.adapters.release(self.adapters.acquire(None))
+            self.model.set_adapter(self.adapters.default)
+        
+        # LoRA deltas cannot be added to reference-quantized weights, so merge into dequantized ones
+        if dequantize_model(self.model):
+            logger.info("Dequantized the base model weights for merging")
+        
+        merged_model = self.model.merge_and_unload()
+        self._clear_prefix_cache()
+        # Only the active adapter survives the merge
+        self.adapters = None
+        logger.info("LoRA weights merged successfully")
+        
+        return merged_model
@@ -0,0 +1,479 @@
+"""
+Inference building blocks for GPT-OSS models.
+
+Helpers shared by generation, serving and offline inference: conversion of
+key/value caches to and from the per-layer (key, value) layout, batch-level
+cache surgery (left padding, row selection, concatenation), vectorized
+per-row sampling, an LRU cache of prompt-prefix key/values, incremental
+detokenization with stop strings for streamed output and speculative
+decoding with a draft model.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+logger = logging.getLogger(__name__)
+
+# Per-layer (key, value) tensors shaped [batch, heads, seq, head_dim]
+LegacyCache = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+def cache_to_legacy(past_key_values) -> LegacyCache:
+    """Convert a transformers cache object into a list of per-layer (key, value) tensors"""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    return [(layer[0], layer[1]) for layer in past_key_values]
+
+
+def cache_from_legacy(legacy: LegacyCache):
+    """Wrap per-layer (key, value) tensors in the cache class the model expects
+    
+    Every layer becomes a full-length layer. Sliding-window layers still attend
+    correctly because their window is applied through the attention mask.
+    """
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return tuple(legacy) or None
+    return DynamicCache.from_legacy_cache(tuple(legacy))
+
+
+def empty_cache():
+    """Fresh cache whose layers all keep the full history
+    
+    Passing this to a prefill, instead of letting the model build a config-aware
+    cache that truncates sliding-window layers, keeps every layer the same
+    length so rows can be padded, stacked and split uniformly.
+    """
+    return cache_from_legacy([])
+
+
+def cache_length(legacy: LegacyCache) -> int:
+    return legacy[0][0].shape[-2] if legacy else 0
+
+
+def left_pad_cache(legacy: LegacyCache, pad: int) -> LegacyCache:
+    """Prepend ``pad`` empty positions to every layer so rows can share a batch"""
+    if pad <= 0:
+        return legacy
+    return [(F.pad(key, (0, 0, pad, 0)), F.pad(value, (0, 0, pad, 0))) for key, value in legacy]
+
+
+def trim_cache_left(legacy: LegacyCache, start: int) -> LegacyCache:
+    """Drop the first ``start`` positions of every layer"""
+    if start <= 0:
+        return legacy
+    return [(key[:, :, start:], value[:, :, start:]) for key, value in legacy]
+
+
+def select_cache_rows(legacy: LegacyCache, index: torch.Tensor) -> LegacyCache:
+    """Keep only the given batch rows"""
+    return [(key.index_select(0, index), value.index_select(0, index)) for key, value in legacy]
+
+
+def concat_caches(first: LegacyCache, second: LegacyCache) -> LegacyCache:
+    """Stack two caches along the batch dimension, left-padding the shorter one"""
+    if not first:
+        return second
+    if not second:
+        return first
+    first_len, second_len = cache_length(first), cache_length(second)
+    first = left_pad_cache(first, second_len - first_len)
+    second = left_pad_cache(second, first_len - second_len)
+    return [
+        (torch.cat([k1, k2], dim=0), torch.cat([v1, v2], dim=0))
+        for (k1, v1), (k2, v2) in zip(first, second)
+    ]
+
+
+def sample_next_tokens(
+    logits: torch.Tensor,
+    temperature: torch.Tensor,
+    top_p: torch.Tensor,
+    do_sample: torch.Tensor,
+    generator: Optional[torch.Generator] = None
+) -> torch.Tensor:
+    """Pick the next token for every row with its own temperature / top-p settings
+    
+    Args:
+        logits: [batch, vocab] logits for the last position
+        temperature: [batch] sampling temperatures
+        top_p: [batch] nucleus sampling thresholds
+        do_sample: [batch] bool; rows set to False (or with temperature <= 0) decode greedily
+    """
+    logits = logits.float()
+    greedy = logits.argmax(dim=-1)
+    
+    sample_rows = do_sample & (temperature > 0)
+    if not bool(sample_rows.any()):
+        return greedy
+    
+    probs = sampling_probs(logits, temperature, top_p)
+    sampled = torch.multinomial(probs, num_samples=1, generator=generator).squeeze(-1)
+    return torch.where(sample_rows, sampled, greedy)
+
+
+def sampling_probs(logits: torch.Tensor, temperature: torch.Tensor, top_p: torch.Tensor) -> torch.Tensor:
+    """Temperature-scaled, top-p filtered next-token distribution for every row"""
+    scaled = logits.float() / temperature.clamp(min=1e-5).unsqueeze(-1)
+    sorted_logits, sorted_indices = torch.sort(scaled, descending=True, dim=-1)
+    sorted_probs = sorted_logits.softmax(dim=-1)
+    # Drop tokens once the mass before them already exceeds top_p (always keep the first)
+    cumulative = sorted_probs.cumsum(dim=-1) - sorted_probs
+    sorted_logits = sorted_logits.masked_fill(cumulative > top_p.unsqueeze(-1), float("-inf"))
+    filtered = torch.full_like(scaled, float("-inf")).scatter(-1, sorted_indices, sorted_logits)
+    return filtered.softmax(dim=-1)
+
+
+def cache_nbytes(legacy: LegacyCache) -> int:
+    return sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in legacy)
+
+
+class PrefixKVCache:
+    """LRU cache of past key/values for shared prompt prefixes, bounded by a memory budget
+    
+    Entries are keyed by the prefix token ids plus a caller-supplied namespace
+    (for example the active adapter), and hold batch-size-1 caches. Handing an
+    entry to a model is zero-copy: cache updates concatenate into new tensors
+    and never write into the stored ones.
+    """
+    
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[Hashable, Tuple[int, ...]], LegacyCache]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, model, prefix_ids: List[int], device, namespace: Hashable = None, **model_kwargs) -> LegacyCache:
+        """Return the cached key/values for ``prefix_ids``, computing them on a miss
+        
+        ``model_kwargs`` are passed to the model on a miss, e.g. to select an adapter.
+        """
+        key = (namespace, tuple(prefix_ids))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        
+        with torch.no_grad():
+            outputs = model(
+                input_ids=torch.tensor([prefix_ids], dtype=torch.long, device=device),
+                past_key_values=empty_cache(),
+                use_cache=True,
+                **model_kwargs
+            )
+        legacy = cache_to_legacy(outputs.past_key_values)
+        size = cache_nbytes(legacy)
+        
+        with self._lock:
+            if size <= self.max_bytes and key not in self._entries:
+                self._entries[key] = legacy
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= cache_nbytes(evicted)
+        return legacy
+    
+    def clear(self):
+        """Drop every entry, e.g. after the weights they were computed with changed"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class IncrementalDetokenizer:
+    """Turn a growing list of token ids into text deltas
+    
+    Decoding tokens one at a time breaks multi-byte characters split across
+    tokens and drops the leading spaces some tokenizers attach to word pieces.
+    Instead, every step decodes a short window ending at the newest token and
+    emits only the text beyond what the same window decoded to before. Text
+    that still ends in an incomplete character is held back until the next
+    token completes it.
+    """
+    
+    def __init__(self, tokenizer, prompt_ids: Optional[List[int]] = None, context_tokens: int = 5, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        # A few prompt tokens give the first generated token its left context
+        self.token_ids = list(prompt_ids[-context_tokens:]) if prompt_ids else []
+        self.prefix_offset = 0
+        self.read_offset = len(self.token_ids)
+    
+    def _decode(self, ids: List[int]) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+    
+    def add(self, token_id: int) -> str:
+        """Append a token and return the newly completed text (possibly empty)"""
+        self.token_ids.append(token_id)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
+    
+    def flush(self) -> str:
+        """Return whatever text is still held back, even if incomplete"""
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class StopStringMatcher:
+    """Find stop strings in streamed text without emitting any part of them
+    
+    Text that could still turn out to be the start of a stop string is held
+    back until the next chunk either completes the stop string or rules it out.
+    """
+    
+    def __init__(self, stop: Optional[List[str]] = None):
+        self.stop = [s for s in (stop or []) if s]
+        self._pending = ""
+    
+    def feed(self, text: str) -> Tuple[str, bool]:
+        """Consume a chunk; return the text that is safe to emit and whether a stop string was hit"""
+        if not self.stop:
+            return text, False
+        self._pending += text
+        
+        matches = [i for i in (self._pending.find(s) for s in self.stop) if i != -1]
+        if matches:
+            emitted = self._pending[:min(matches)]
+            self._pending = ""
+            return emitted, True
+        
+        hold = 0
+        for s in self.stop:
+            for k in range(min(len(s) - 1, len(self._pending)), hold, -1):
+                if self._pending.endswith(s[:k]):
+                    hold = k
+                    break
+        emitted = self._pending[:len(self._pending) - hold]
+        self._pending = self._pending[len(self._pending) - hold:]
+        return emitted, False
+    
+    def flush(self) -> str:
+        emitted, self._pending = self._pending, ""
+        return emitted
+
+
+@dataclass
+class SpeculativeStats:
+    """Counters for one speculative decoding run (prefill excluded)"""
+    rounds: int = 0
+    proposed: int = 0
+    accepted: int = 0
+    generated: int = 0
+    target_forwards: int = 0
+    draft_forwards: int = 0
+    target_time: float = 0.0
+    draft_time: float = 0.0
+    wall_time: float = 0.0
+    
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed else 0.0
+    
+    @property
+    def tokens_per_target_forward(self) -> float:
+        return self.generated / self.target_forwards if self.target_forwards else 0.0
+    
+    @property
+    def estimated_speedup(self) -> float:
+        """Wall time plain decoding would need, relative to the time actually spent
+        
+        Plain decoding runs one target forward per token. A verification pass
+        over k + 1 tokens costs about as much as a single-token pass when
+        decoding is memory-bound, so the measured time per verification pass
+        stands in for the cost of one plain decoding step.
+        """
+        if not self.target_forwards or not self.wall_time:
+            return 0.0
+        return self.generated * (self.target_time / self.target_forwards) / self.wall_time
+    
+    def as_dict(self) -> Dict[str, Any]:
+        stats = asdict(self)
+        stats.update({
+            "acceptance_rate": self.acceptance_rate,
+            "tokens_per_target_forward": self.tokens_per_target_forward,
+            "estimated_speedup": self.estimated_speedup,
+        })
+        return stats
+
+
+def _fit_vocab(logits: torch.Tensor, vocab_size: int) -> torch.Tensor:
+    """Cut or -inf-pad draft logits to the target vocabulary so it never proposes unknown ids"""
+    if logits.shape[-1] < vocab_size:
+        return F.pad(logits, (0, vocab_size - logits.shape[-1]), value=float("-inf"))
+    return logits[..., :vocab_size]
+
+
+def speculative_decode(
+    target,
+    draft,
+    input_ids: List[int],
+    max_new_tokens: int,
+    num_speculative_tokens: int = 4,
+    temperature: float = 0.7,
+    top_p: float = 0.9,
+    do_sample: bool = True,
+    eos_token_id: Optional[int] = None,
+    target_cache=None,
+    target_kwargs: Optional[Dict[str, Any]] = None,
+    stats: Optional[SpeculativeStats] = None
+) -> Iterator[int]:
+    """Yield tokens of ``target`` sampled with the help of a smaller ``draft`` model
+    
+    Each round the draft proposes up to ``num_speculative_tokens`` tokens one
+    at a time and the target scores all of them in a single forward pass.
+    Draft tokens are accepted with probability min(1, p/q); the first rejected
+    one is replaced by a sample from the normalized residual max(0, p - q),
+    and when every proposal is accepted the target's next-token distribution
+    yields one extra token. The output therefore follows exactly the target's
+    temperature / top-p distribution (or its greedy choice when not sampling).
+    
+    Args:
+        target_cache: optional cache already holding a prefix of ``input_ids``
+            for the target, e.g. from a PrefixKVCache
+        target_kwargs: extra arguments for every target forward, e.g. ``adapter_names``
+        stats: optional SpeculativeStats updated in place while decoding
+    """
+    stats = stats if stats is not None else SpeculativeStats()
+    target_kwargs = target_kwargs or {}
+    target_device = next(target.parameters()).device
+    draft_device = next(draft.parameters()).device
+    sampling = do_sample and temperature > 0
+    vocab_size = target.get_input_embeddings().num_embeddings
+    temperature_t = torch.tensor([temperature], device=target_device)
+    top_p_t = torch.tensor([top_p], device=target_device)
+    
+    ids = list(input_ids)
+    # Both caches keep every layer full-length so they can be cropped after a rejection
+    target_cache = target_cache if target_cache is not None else empty_cache()
+    draft_cache = empty_cache()
+    
+    def forward(model, cache, device, tokens: List[int], **kwargs) -> torch.Tensor:
+        with torch.no_grad():
+            outputs = model(
+                input_ids=torch.tensor([tokens], dtype=torch.long, device=device),
+                past_key_values=cache,
+                use_cache=True,
+                **kwargs
+            )
+        return outputs.logits[0].float()
+    
+    def distribution(logits: torch.Tensor) -> torch.Tensor:
+        rows = logits.shape[0]
+        return sampling_probs(logits, temperature_t.expand(rows), top_p_t.expand(rows))
+    
+    # Prefill everything but the last token, which each round feeds itself
+    if len(ids) - 1 > target_cache.get_seq_length():
+        forward(target, target_cache, target_device, ids[target_cache.get_seq_length():-1], **target_kwargs)
+    if len(ids) > 1:
+        forward(draft, draft_cache, draft_device, ids[:-1])
+    
+    started = time.perf_counter()
+    produced = 0
+    try:
+        while produced < max_new_tokens:
+            # Leave room for the token the target adds after verification
+            k = min(num_speculative_tokens, max_new_tokens - produced - 1)
+            
+            draft_start = time.perf_counter()
+            proposals, proposal_probs = [], []
+            for _ in range(k):
+                sequence = ids + proposals
+                logits = forward(draft, draft_cache, draft_device, sequence[draft_cache.get_seq_length():])[-1:]
+                logits = _fit_vocab(logits, vocab_size)
+                if sampling:
+                    probs = sampling_probs(
+                        logits, temperature_t.to(draft_device), top_p_t.to(draft_device)
+                    )[0].to(target_device)
+                    token = int(torch.multinomial(probs, num_samples=1))
+                    proposal_probs.append(probs)
+                else:
+                    token = int(logits[0].argmax())
+                proposals.append(token)
+                if token == eos_token_id:
+                    break
+            stats.draft_time += time.perf_counter() - draft_start
+            stats.draft_forwards += len(proposals)
+            
+            target_start = time.perf_counter()
+            sequence = ids + proposals
+            logits = forward(target, target_cache, target_device, sequence[target_cache.get_seq_length():], **target_kwargs)
+            # Row j is the target's prediction for the position of proposals[j]
+            logits = logits[-(len(proposals) + 1):]
+            probs = distribution(logits) if sampling else None
+            
+            accepted, correction = [], None
+            for j, token in enumerate(proposals):
+                if sampling:
+                    q = proposal_probs[j]
+                    if float(torch.rand(())) < float(probs[j, token]) / float(q[token]):
+                        accepted.append(token)
+                        continue
+                    residual = (probs[j] - q).clamp(min=0)
+                    if float(residual.sum()) <= 0:
+                        residual = probs[j]
+                    correction = int(torch.multinomial(residual / residual.sum(), num_samples=1))
+                else:
+                    best = int(logits[j].argmax())
+                    if best == token:
+                        accepted.append(token)
+                        continue
+                    correction = best
+                break
+            
+            if correction is None and (not accepted or accepted[-1] != eos_token_id):
+                # Every proposal was accepted: the last row gives one more token for free
+                if sampling:
+                    correction = int(torch.multinomial(probs[-1], num_samples=1))
+                else:
+                    correction = int(logits[-1].argmax())
+            stats.target_time += time.perf_counter() - target_start
+            
+            new_tokens = accepted + ([correction] if correction is not None else [])
+            stats.rounds += 1
+            stats.target_forwards += 1
+            stats.proposed += len(proposals)
+            stats.accepted += len(accepted)
+            stats.generated += len(new_tokens)
+            
+            # Drop the key/values of rejected proposals; both caches end just
+            # before the last accepted token, which the next round feeds
+            target_cache.crop(len(ids) + len(accepted))
+            draft_cache.crop(min(draft_cache.get_seq_length(), len(ids) + len(accepted)))
+            ids.extend(new_tokens)
+            produced += len(new_tokens)
+            
+            for token in new_tokens:
+                yield token
+                if token == eos_token_id:
+                    return
+    finally:
+        stats.wall_time += time.perf_counter() - started
@@ -0,0 +1,127 @@
+"""
+Chunked cross-entropy for GPT-OSS fine-tuning.
+
+The default causal LM loss projects every position onto the full vocabulary
+and upcasts the result to fp32 before the cross-entropy: a [batch, seq, vocab]
+tensor that, at 2048 tokens and GPT-OSS's ~200k vocabulary, is larger than
+all activations of a decoder layer. The chunked loss never builds it:
+
+- positions whose label is -100 (padding, masked prompt tokens, the last
+  position of every sequence) are dropped before the LM head runs
+- the remaining hidden states go through the LM head and the cross-entropy
+  ``chunk_size`` positions at a time, so at most [chunk_size, vocab] logits
+  exist at once
+- every chunk is recomputed in backward (non-reentrant torch.utils.checkpoint)
+  instead of keeping its logits for the gradient
+
+The loss is the same as the default path's, including the ``num_items_in_batch``
+normalization the Trainer uses with gradient accumulation and the router aux
+loss the model adds on top.
+
+It works by patching the model's LM head and loss function in place, so the
+loss still runs inside the model's forward (and inside the root FSDP unit
+when sharded) and state dict names do not change. Outside ``active()`` both
+behave as before, so generation is unaffected. Inside it, the ``logits`` the
+model returns are the final hidden states.
+"""
+
+import logging
+from contextlib import contextmanager
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+logger = logging.getLogger(__name__)
+
+
+def _chunk_loss(head_forward, hidden: torch.Tensor, targets: torch.Tensor) -> torch.Tensor:
+    return F.cross_entropy(head_forward(hidden).float(), targets, reduction="sum")
+
+
+class ChunkedCrossEntropy:
+    """Causal LM loss computed ``chunk_size`` positions at a time without full-vocabulary logits
+    
+    Usage::
+        
+        loss_fn = ChunkedCrossEntropy(chunk_size=1024)
+        loss_fn.attach(model)
+        with loss_fn.active():
+            loss = model(**batch).loss
+        loss.backward()
+    """
+    
+    def __init__(self, chunk_size: int = 1024):
+        if chunk_size < 1:
+            raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+        self.chunk_size = chunk_size
+        self._active = False
+        self._head_forward = None
+        self._default_loss = None
+    
+    def attach(self, model: nn.Module):
+        """Patch the LM head and loss function of ``model`` (a PEFT model or a causal LM)"""
+        base = model.get_base_model() if hasattr(model, "get_base_model") else model
+        head = base.get_output_embeddings()
+        if head is None:
+            raise ValueError(f"{type(base).__name__} has no LM head to chunk")
+        self._head_forward = head.forward
+        self._default_loss = base.loss_function
+        head.forward = self._head
+        base.loss_function = self._loss
+        logger.info(f"Chunked cross-entropy over {self.chunk_size} positions at a time")
+    
+    @contextmanager
+    def active(self):
+        """Compute the loss of forward passes in this context chunk by chunk"""
+        self._active = True
+        try:
+            yield
+        finally:
+            self._active = False
+    
+    def _head(self, hidden_states: torch.Tensor, *args, **kwargs) -> torch.Tensor:
+        # The loss function runs the head itself, chunk by chunk
+        if self._active:
+            return hidden_states
+        return self._head_forward(hidden_states, *args, **kwargs)
+    
+    def _loss(
+        self,
+        logits: torch.Tensor,
+        labels: torch.Tensor,
+        vocab_size: int,
+        num_items_in_batch: Optional[torch.Tensor] = None,
+        ignore_index: int = -100,
+        shift_labels: Optional[torch.Tensor] = None,
+        **kwargs
+    ) -> torch.Tensor:
+        if not self._active:
+            return self._default_loss(
+                logits, labels, vocab_size,
+                num_items_in_batch=num_items_in_batch, ignore_index=ignore_index, shift_labels=shift_labels, **kwargs
+            )
+        
+        hidden_states = logits
+        if shift_labels is None:
+            # Shift so that tokens < n predict n
+            shift_labels = F.pad(labels, (0, 1), value=ignore_index)[..., 1:]
+        shift_labels = shift_labels.to(hidden_states.device)
+        keep = shift_labels != ignore_index
+        hidden_states = hidden_states[keep]
+        targets = shift_labels[keep]
+        
+        recompute = torch.is_grad_enabled() and hidden_states.requires_grad
+        loss = torch.zeros((), dtype=torch.float32, device=hidden_states.device)
+        for start in range(0, targets.numel(), self.chunk_size):
+            chunk = (self._head_forward, hidden_states[start:start + self.chunk_size], targets[start:start + self.chunk_size])
+            loss = loss + (checkpoint(_chunk_loss, *chunk, use_reentrant=False) if recompute else _chunk_loss(*chunk))
+        
+        # Same normalization as the default loss: the Trainer's token count, or the mean over this batch
+        if num_items_in_batch is None:
+            return loss / targets.numel()
+        if torch.is_tensor(num_items_in_batch):
+            num_items_in_batch = num_items_in_batch.to(loss.device)
+        return loss / num_items_in_batch
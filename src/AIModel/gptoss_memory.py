@@ -0,0 +1,480 @@
+"""
+Memory planner for GPT-OSS LoRA fine-tuning.
+
+Derives a device_map and max_memory for ``from_pretrained`` before any weight
+is loaded. The model is instantiated on the meta device from its config, and
+every placement unit (decoder layer, embeddings, final norm, LM head) gets an
+estimate of:
+
+- weights, at their quantized size when the base model is quantized
+- LoRA adapters with their gradients and AdamW state (fp32, 16 bytes per parameter)
+- activations kept for the backward pass of one micro-batch (only the layer
+  inputs with gradient checkpointing), plus the transient peak of the layer
+  being computed: its full activations, the logits and loss of the LM head,
+  and reference-quantized weights dequantized for the forward pass
+
+Units are placed in order on the GPUs, then on the CPU, then on disk. Units
+offloaded to the CPU or disk still compute on the first GPU, so their
+activations are charged to it. With ``gradient_checkpointing=None`` the
+planner turns checkpointing on when that keeps more weights on the GPUs.
+
+Gradient accumulation does not change the peak, since every micro-batch frees
+its activations before the next starts; it only appears in the report.
+
+Dry run on a machine without the GPUs:
+
+    python GptRoss.py plan-memory --model_name openai/gpt-oss-120b --num_gpus 2 --gpu_memory 80GiB --quantization nf4
+"""
+
+import sys
+import json
+import logging
+import argparse
+from dataclasses import dataclass, field, asdict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import torch
+import torch.nn as nn
+from accelerate.utils import convert_file_size_to_int, get_max_memory
+from transformers import AutoConfig, AutoModelForCausalLM
+
+from gptoss_quant import is_gptoss_experts, resolve_backend, quantized_bytes_per_element
+
+logger = logging.getLogger(__name__)
+
+DTYPE_BYTES = {"float32": 4, "bfloat16": 2, "float16": 2}
+# LoRA weight, gradient and the two AdamW moments, all fp32
+LORA_BYTES_PER_PARAM = 16
+
+Device = Union[int, str]
+
+
+@dataclass
+class MemoryPlanConfig:
+    """What the planner needs to know about the run"""
+    batch_size: int = 1  # per-device micro-batch
+    max_length: int = 2048
+    gradient_accumulation_steps: int = 1
+    torch_dtype: str = "bfloat16"
+    attn_implementation: str = "flash_attention_2"
+    training: bool = True  # False plans for generation: no LoRA state, a KV cache instead of saved activations
+    gradient_checkpointing: Optional[bool] = None  # None: enable it only when it keeps more weights on the GPUs
+    quantization: Optional[str] = None  # "int8", "nf4" or "fp4"
+    quantization_backend: str = "auto"
+    quant_block_size: int = 64
+    quant_double_quant: bool = True
+    quant_skip_modules: List[str] = field(default_factory=lambda: ["lm_head"])
+    lora_r: int = 16
+    lora_target_modules: List[str] = field(default_factory=lambda: ["auto"])  # "auto": the model's attention and dense MLP projections
+    lora_experts: int = 0  # experts per layer whose weights get LoRA (expert_lora), -1 for all
+    lora_dropout: float = 0.05
+    max_memory: Optional[Dict[Device, Union[int, str]]] = None  # device budgets, detected when None
+    headroom: float = 0.1  # fraction of each budget kept free for the allocator and CUDA context
+    offload_folder: Optional[str] = None  # allows placing units on disk
+    trust_remote_code: bool = True
+
+
+@dataclass
+class MemoryPlan:
+    """A device_map and max_memory for from_pretrained plus the estimates behind them"""
+    device_map: Dict[str, Device]
+    max_memory: Dict[Device, int]
+    gradient_checkpointing: bool
+    fits: bool
+    devices: Dict[str, Dict[str, int]]
+    units: List[Dict[str, Any]]
+    settings: Dict[str, Any]
+    notes: List[str] = field(default_factory=list)
+    
+    def to_dict(self) -> Dict[str, Any]:
+        plan = asdict(self)
+        plan["max_memory"] = {str(device): size for device, size in self.max_memory.items()}
+        return plan
+    
+    def format(self, per_unit: bool = False) -> str:
+        settings = self.settings
+        lines = [
+            f"Memory plan for {settings['model']}: micro-batch {settings['batch_size']} x {settings['max_length']} tokens, "
+            f"{settings['gradient_accumulation_steps']} accumulation steps ({settings['tokens_per_step']:,} tokens per optimizer step), "
+            f"{settings['torch_dtype']}, weights {settings['quantization'] or 'not quantized'}, "
+            f"gradient checkpointing {'on' if self.gradient_checkpointing else 'off'}",
+            f"{'device':<8}{'budget':>12}{'weights':>12}{'lora+optim':>12}{'activations':>13}{'peak':>12}{'total':>12}  units",
+        ]
+        for device, usage in self.devices.items():
+            lines.append(
+                f"{device:<8}{_gib(usage['budget']):>12}{_gib(usage['weights']):>12}{_gib(usage['lora']):>12}"
+                f"{_gib(usage['activations']):>13}{_gib(usage['transient']):>12}{_gib(usage['total']):>12}  {usage['units']}"
+            )
+        if per_unit:
+            lines.append(f"{'unit':<32}{'device':>8}{'weights':>12}{'lora+optim':>12}{'activations':>13}{'peak':>12}")
+            for unit in self.units:
+                lines.append(
+                    f"{unit['name']:<32}{str(unit['device']):>8}{_gib(unit['weights']):>12}{_gib(unit['lora']):>12}"
+                    f"{_gib(unit['activations']):>13}{_gib(unit['transient']):>12}"
+                )
+        lines.append("Plan fits the budgets" if self.fits else "Plan does NOT fit the budgets")
+        lines.extend(f"Note: {note}" for note in self.notes)
+        return "\n".join(lines)
+
+
+def _gib(num_bytes: int) -> str:
+    return f"{num_bytes / 1024 ** 3:.2f} GiB"
+
+
+def _matches(name: str, suffixes: List[str]) -> bool:
+    return any(name == suffix or name.endswith("." + suffix) for suffix in suffixes)
+
+
+def _placement_units(module: nn.Module, no_split: List[str], prefix: str = ""):
+    """Modules that are placed on one device as a whole, in execution order"""
+    for name, child in module.named_children():
+        full_name = prefix + name
+        if type(child).__name__ in no_split or not list(child.children()):
+            yield full_name, child
+        else:
+            yield from _placement_units(child, no_split, full_name + ".")
+
+
+def _config_dims(config) -> Dict[str, int]:
+    hidden = config.hidden_size
+    heads = config.num_attention_heads
+    return {
+        "hidden": hidden,
+        "heads": heads,
+        "kv_heads": getattr(config, "num_key_value_heads", None) or heads,
+        "head_dim": getattr(config, "head_dim", None) or hidden // heads,
+        "intermediate": getattr(config, "intermediate_size", 4 * hidden),
+        "experts": getattr(config, "num_local_experts", None) or getattr(config, "num_experts", None) or 0,
+        "experts_per_token": getattr(config, "num_experts_per_tok", None) or getattr(config, "experts_per_token", None) or 0,
+        "vocab": config.vocab_size,
+    }
+
+
+def layer_activation_bytes(dims: Dict[str, int], batch_size: int, seq_len: int, dtype_bytes: int, attn_implementation: str) -> int:
+    """Activations one decoder layer keeps for its backward pass"""
+    tokens = batch_size * seq_len
+    hidden, heads, kv_heads, head_dim = dims["hidden"], dims["heads"], dims["kv_heads"], dims["head_dim"]
+    
+    # Norm input and its fp32 copy, projection input, q/k/v before and after rotary, attention and o_proj input
+    attention = tokens * (
+        hidden * (2 * dtype_bytes + 4)
+        + 2 * (heads + 2 * kv_heads) * head_dim * dtype_bytes
+        + 2 * heads * head_dim * dtype_bytes
+        + heads * 4
+    )
+    if attn_implementation == "eager":
+        # Scores and fp32 softmax probabilities
+        attention += batch_size * heads * seq_len * seq_len * (dtype_bytes + 4)
+    
+    mlp = tokens * hidden * (2 * dtype_bytes + 4)
+    intermediate = dims["intermediate"]
+    if dims["experts"]:
+        # Router logits, then per routed token: expert input, gate/up output, activation and down projection
+        routed = tokens * dims["experts_per_token"]
+        mlp += tokens * dims["experts"] * 4 + routed * (2 * hidden + 5 * intermediate) * dtype_bytes
+    else:
+        mlp += tokens * 4 * intermediate * dtype_bytes
+    return attention + mlp
+
+
+def _estimate_units(model: nn.Module, plan_config: MemoryPlanConfig, backend: Optional[str]) -> List[Dict[str, Any]]:
+    config = model.config
+    dims = _config_dims(config)
+    dtype_bytes = DTYPE_BYTES[plan_config.torch_dtype]
+    tokens = plan_config.batch_size * plan_config.max_length
+    no_split = list(getattr(model, "_no_split_modules", None) or [])
+    quantization = plan_config.quantization
+    quantized_bytes = (
+        quantized_bytes_per_element(quantization, plan_config.quant_block_size, plan_config.quant_double_quant)
+        if quantization else None
+    )
+    
+    target_modules = plan_config.lora_target_modules
+    if "auto" in target_modules:
+        from gptoss_moe import resolve_target_modules
+        target_modules = resolve_target_modules(model, target_modules)
+    
+    units = []
+    seen = set()
+    for unit_name, unit in _placement_units(model, no_split):
+        weights = lora_params = lora_inputs = dequantized = 0
+        for name, module in unit.named_modules():
+            full_name = f"{unit_name}.{name}" if name else unit_name
+            skipped = _matches(full_name, plan_config.quant_skip_modules)
+            expert_bytes = 0
+            for param in module.parameters(recurse=False):
+                if id(param) in seen:
+                    continue
+                seen.add(id(param))
+                numel = param.numel()
+                is_linear_weight = type(module) is nn.Linear and param is module.weight
+                if quantization and not skipped and (is_linear_weight or (param.dim() >= 3 and backend == "reference")):
+                    weights += int(numel * quantized_bytes)
+                    if backend == "reference":
+                        # Dequantized in the compute dtype for one matmul, and again for its backward; autograd saves
+                        # only the quantized weight, so this is transient. GPT-OSS experts are dequantized one at a time
+                        if is_linear_weight:
+                            dequantized = max(dequantized, numel * dtype_bytes)
+                        elif is_gptoss_experts(module):
+                            dequantized = max(dequantized, numel // param.shape[0] * dtype_bytes)
+                        else:
+                            expert_bytes += numel * dtype_bytes
+                else:
+                    weights += numel * dtype_bytes
+                if plan_config.training and plan_config.lora_experts and param.dim() == 3:
+                    # A and B of every adapted expert; the update is applied to the routed tokens, which keep their
+                    # fp32 input to A (when upcast) and A's output, as if every token went to adapted experts
+                    adapted = param.shape[0] if plan_config.lora_experts < 0 else min(plan_config.lora_experts, param.shape[0])
+                    lora_params += adapted * plan_config.lora_r * (param.shape[1] + param.shape[2])
+                    lora_inputs += tokens * dims["experts_per_token"] * (plan_config.lora_r + (param.shape[1] if dtype_bytes != 4 else 0)) * 4
+            dequantized = max(dequantized, expert_bytes)
+            if plan_config.training and isinstance(module, nn.Linear) and _matches(full_name, target_modules):
+                lora_params += plan_config.lora_r * (module.in_features + module.out_features)
+                # lora_dropout keeps a dropped copy of the input, lora_A its output
+                lora_inputs += tokens * plan_config.lora_r * dtype_bytes
+                if plan_config.lora_dropout > 0:
+                    lora_inputs += tokens * module.in_features * dtype_bytes
+        
+        is_layer = type(unit).__name__ in no_split
+        if not plan_config.training:
+            # Generation keeps a key/value cache per layer instead of activations
+            full = tokens * dims["hidden"] * dtype_bytes
+            saved = 2 * tokens * dims["kv_heads"] * dims["head_dim"] * dtype_bytes if is_layer else 0
+            transient = full if is_layer else 0
+        elif is_layer:
+            full = layer_activation_bytes(dims, plan_config.batch_size, plan_config.max_length, dtype_bytes, plan_config.attn_implementation) + lora_inputs
+            saved = full
+            transient = full
+        else:
+            full = saved = transient = 0
+        
+        if unit_name.endswith("lm_head"):
+            # Logits, their fp32 upcast for the loss and its gradient (training) or the last position's logits
+            logit_tokens = tokens if plan_config.training else plan_config.batch_size
+            transient = logit_tokens * dims["vocab"] * (dtype_bytes + (8 if plan_config.training else 4))
+        
+        units.append({
+            "name": unit_name,
+            "is_layer": is_layer,
+            "weights": weights,
+            "lora": lora_params * LORA_BYTES_PER_PARAM,
+            "lora_params": lora_params,
+            "activations": saved,
+            "checkpointed_activations": tokens * dims["hidden"] * dtype_bytes if is_layer and plan_config.training else saved,
+            "transient": transient + dequantized,
+        })
+    return units
+
+
+def _device_budgets(plan_config: MemoryPlanConfig) -> Dict[Device, int]:
+    budgets = plan_config.max_memory if plan_config.max_memory is not None else get_max_memory()
+    budgets = {
+        device: convert_file_size_to_int(size) if isinstance(size, str) else int(size)
+        for device, size in budgets.items()
+        if device != "disk"
+    }
+    usable = {device: int(size * (1 - plan_config.headroom)) for device, size in budgets.items()}
+    if plan_config.offload_folder:
+        usable["disk"] = sys.maxsize
+    return usable
+
+
+def _assign(units: List[Dict[str, Any]], budgets: Dict[Device, int], checkpointing: bool):
+    """Place units in order, first device with room; returns (device_map, usage, fits)"""
+    order = list(budgets)
+    gpus = [device for device in order if isinstance(device, int)]
+    compute_device = gpus[0] if gpus else "cpu"
+    activation_key = "checkpointed_activations" if checkpointing else "activations"
+    
+    reserve = 0
+    for _ in range(5):
+        usage = {device: {"budget": budgets[device], "weights": 0, "lora": 0, "activations": 0, "transient": 0, "units": 0} for device in order}
+        device_map: Dict[str, Device] = {}
+        fits = True
+        index = 0
+        offloaded_weights = 0
+        for unit in units:
+            while True:
+                device = order[index]
+                runs_on = device if device in gpus else compute_device
+                stored = unit["weights"] + unit["lora"] if device != "disk" else 0
+                on_device = usage[device]
+                # Activations of offloaded units land on the compute device, which set aside ``reserve`` for them
+                activations = unit[activation_key] if runs_on == device else 0
+                transient = max(on_device["transient"], unit["transient"]) if runs_on == device else on_device["transient"]
+                budget = budgets[device] - (reserve if device == compute_device and gpus else 0)
+                total = on_device["weights"] + on_device["lora"] + on_device["activations"] + stored + activations + transient
+                if total <= budget or index == len(order) - 1:
+                    if total > budget:
+                        fits = False
+                    break
+                index += 1
+            device_map[unit["name"]] = device
+            on_device["weights"] += unit["weights"] if device != "disk" else 0
+            on_device["lora"] += unit["lora"] if device != "disk" else 0
+            on_device["activations"] += activations
+            on_device["transient"] = transient
+            on_device["units"] += 1
+            if runs_on != device:
+                offloaded_weights = max(offloaded_weights, unit["weights"])
+                usage[compute_device]["activations"] += unit[activation_key]
+                usage[compute_device]["transient"] = max(usage[compute_device]["transient"], unit["transient"])
+        
+        if not gpus:
+            break
+        # Offloaded units are streamed to the compute device one at a time
+        needed = sum(unit[activation_key] for unit in units if device_map[unit["name"]] not in gpus) + offloaded_weights
+        if needed <= reserve:
+            break
+        reserve = needed
+    
+    if gpus:
+        usage[compute_device]["transient"] += offloaded_weights
+    for device, on_device in usage.items():
+        on_device["total"] = on_device["weights"] + on_device["lora"] + on_device["activations"] + on_device["transient"]
+        if device != "disk" and on_device["total"] > budgets[device]:
+            fits = False
+    return device_map, usage, fits
+
+
+def plan_memory(model_name_or_config: Any, plan_config: Optional[MemoryPlanConfig] = None) -> MemoryPlan:
+    """Plan weight placement for a model name, path or config without loading any weights"""
+    plan_config = plan_config or MemoryPlanConfig()
+    if isinstance(model_name_or_config, str):
+        config = AutoConfig.from_pretrained(model_name_or_config, trust_remote_code=plan_config.trust_remote_code)
+    else:
+        config = model_name_or_config
+    # Not init_empty_weights: GptOssExperts allocates its expert tensors before registering them as parameters
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config, trust_remote_code=plan_config.trust_remote_code)
+    
+    backend = resolve_backend(plan_config.quantization_backend) if plan_config.quantization else None
+    units = _estimate_units(model, plan_config, backend)
+    budgets = _device_budgets(plan_config)
+    
+    if not plan_config.training:
+        options = [False]
+    elif plan_config.gradient_checkpointing is None:
+        options = [False, True]
+    else:
+        options = [plan_config.gradient_checkpointing]
+    
+    best = None
+    for checkpointing in options:
+        device_map, usage, fits = _assign(units, budgets, checkpointing)
+        offloaded = sum(unit["weights"] for unit in units if not isinstance(device_map[unit["name"]], int))
+        candidate = (not fits, offloaded, checkpointing, device_map, usage, fits)
+        # Checkpointing costs a recomputed forward pass, so it has to fit better to be chosen
+        if best is None or candidate[:2] < best[:2]:
+            best = candidate
+    _, offloaded, checkpointing, device_map, usage, fits = best
+    
+    for unit in units:
+        unit["device"] = device_map[unit["name"]]
+        if checkpointing:
+            unit["activations"] = unit["checkpointed_activations"]
+        del unit["checkpointed_activations"]
+    
+    # What infer_auto_device_map may use for weights when device_map="auto" is given this max_memory
+    max_memory = {
+        device: max(0, budgets[device] - on_device["lora"] - on_device["activations"] - on_device["transient"])
+        for device, on_device in usage.items()
+        if device != "disk"
+    }
+    
+    notes = []
+    if any(device == "disk" for device in device_map.values()):
+        notes.append(f"some units are offloaded to disk in {plan_config.offload_folder}")
+    elif offloaded and not plan_config.offload_folder:
+        notes.append("set offload_folder to allow offloading to disk")
+    if backend == "reference":
+        notes.append("the reference backend loads weights in full precision before quantizing them layer by layer")
+    
+    model_name = getattr(config, "_name_or_path", "") or getattr(config, "model_type", "model")
+    settings = {
+        "model": model_name,
+        "batch_size": plan_config.batch_size,
+        "max_length": plan_config.max_length,
+        "gradient_accumulation_steps": plan_config.gradient_accumulation_steps,
+        "tokens_per_step": plan_config.batch_size * plan_config.max_length * plan_config.gradient_accumulation_steps,
+        "torch_dtype": plan_config.torch_dtype,
+        "quantization": f"{plan_config.quantization} ({backend})" if plan_config.quantization else None,
+        "training": plan_config.training,
+        "lora_params": sum(unit["lora_params"] for unit in units),
+        "weights": sum(unit["weights"] for unit in units),
+    }
+    return MemoryPlan(
+        device_map=device_map,
+        max_memory=max_memory,
+        gradient_checkpointing=checkpointing,
+        fits=fits,
+        devices={str(device): on_device for device, on_device in usage.items()},
+        units=units,
+        settings=settings,
+        notes=notes,
+    )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Plan device_map and max_memory for GPT-OSS fine-tuning without loading weights")
+    parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path (only the config is read)")
+    parser.add_argument("--num_gpus", type=int, help="Plan for this many GPUs instead of the ones detected")
+    parser.add_argument("--gpu_memory", type=str, default="80GiB", help="Memory per GPU when --num_gpus is given")
+    parser.add_argument("--cpu_memory", type=str, help="Host memory available for offloaded weights (default: detected)")
+    parser.add_argument("--offload_folder", type=str, help="Allow offloading to this directory")
+    parser.add_argument("--headroom", type=float, default=0.1, help="Fraction of each budget left free")
+    parser.add_argument("--batch_size", type=int, default=1, help="Per device micro-batch size")
+    parser.add_argument("--max_length", type=int, default=2048, help="Maximum sequence length")
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=8)
+    parser.add_argument("--torch_dtype", type=str, default="bfloat16", choices=sorted(DTYPE_BYTES))
+    parser.add_argument("--attn_implementation", type=str, default="flash_attention_2", help="Attention implementation")
+    parser.add_argument("--gradient_checkpointing", type=str, default="auto", choices=["auto", "on", "off"])
+    parser.add_argument("--quantization", type=str, choices=["int8", "nf4", "fp4"], help="Plan for a quantized base model")
+    parser.add_argument("--quantization_backend", type=str, default="auto", choices=["auto", "bitsandbytes", "reference"])
+    parser.add_argument("--no_double_quant", action="store_true", help="Keep the 4-bit block scales in full precision")
+    parser.add_argument("--lora_r", type=int, default=16, help="LoRA r parameter")
+    parser.add_argument("--lora_experts", type=int, default=0, help="Experts per layer with expert LoRA (-1: all)")
+    parser.add_argument("--inference", action="store_true", help="Plan for generation instead of training")
+    parser.add_argument("--per_layer", action="store_true", help="Also print the estimate of every placement unit")
+    parser.add_argument("--output", type=str, help="Write the plan as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    
+    max_memory = None
+    if args.num_gpus is not None:
+        max_memory = {index: args.gpu_memory for index in range(args.num_gpus)}
+        max_memory["cpu"] = args.cpu_memory or get_max_memory()["cpu"]
+    elif args.cpu_memory:
+        max_memory = {**get_max_memory(), "cpu": args.cpu_memory}
+    
+    plan_config = MemoryPlanConfig(
+        batch_size=args.batch_size,
+        max_length=args.max_length,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        torch_dtype=args.torch_dtype,
+        attn_implementation=args.attn_implementation,
+        training=not args.inference,
+        gradient_checkpointing={"auto": None, "on": True, "off": False}[args.gradient_checkpointing],
+        quantization=args.quantization,
+        quantization_backend=args.quantization_backend,
+        quant_double_quant=not args.no_double_quant,
+        lora_r=args.lora_r,
+        lora_experts=args.lora_experts,
+        max_memory=max_memory,
+        headroom=args.headroom,
+        offload_folder=args.offload_folder,
+    )
+    plan = plan_memory(args.model_name, plan_config)
+    print(plan.format(per_unit=args.per_layer))
+    
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(plan.to_dict(), f, indent=2)
+        logger.info(f"Plan written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+Zero-copy loading of frozen base weights from memory-mapped safetensors.
+
+``from_pretrained`` reads every weight into freshly allocated memory, so each
+DDP rank or server process on a node holds its own copy of the same frozen
+base model. Here the model is built without weights and every parameter is
+pointed at a read-only, copy-on-write mapping of the safetensors file
+instead. The pages belong to the kernel's page cache: processes that map the
+same files share one physical copy, and a process started while the files are
+still cached loads the model without reading from disk.
+
+Weights stay mapped only where they stay on the host in the checkpoint's
+dtype. Casting to another torch_dtype, moving to a GPU, quantizing or merging
+an adapter into a weight produces a private copy of that weight, as it would
+with ``from_pretrained``. Checkpoints that cannot be mapped as they are (a
+different dtype than the one trained in, or pre-quantized formats such as
+GPT-OSS's MXFP4 experts) can be converted once into a cache directory with
+``write_mmap_cache``; every later process maps the converted copy.
+
+``memory_usage`` reports resident (RSS) and proportional (PSS) memory; PSS
+splits shared pages between the processes that map them, so it is the host
+memory a worker actually costs.
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import time
+import resource
+import logging
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import torch
+import torch.nn as nn
+from accelerate import dispatch_model, infer_auto_device_map, init_empty_weights
+from transformers import AutoModelForCausalLM, GenerationConfig, PretrainedConfig
+
+logger = logging.getLogger(__name__)
+
+SAFETENSORS_INDEX_FILE = "model.safetensors.index.json"
+SAFETENSORS_FILE = "model.safetensors"
+
+# safetensors dtype names
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def resolve_model_dir(
+    model_name: str,
+    revision: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+    token: Optional[str] = None
+) -> str:
+    """Local directory holding the safetensors files of ``model_name``, downloading them if needed"""
+    if os.path.isdir(model_name):
+        return model_name
+    from huggingface_hub import snapshot_download
+    return snapshot_download(
+        model_name,
+        revision=revision,
+        cache_dir=cache_dir,
+        token=token,
+        allow_patterns=["*.safetensors", SAFETENSORS_INDEX_FILE, "*.json"]
+    )
+
+
+def safetensors_files(model_dir: str) -> List[str]:
+    """The safetensors files of a checkpoint directory, sharded or not"""
+    index_path = os.path.join(model_dir, SAFETENSORS_INDEX_FILE)
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(model_dir, name) for name in sorted(set(weight_map.values()))]
+    path = os.path.join(model_dir, SAFETENSORS_FILE)
+    if os.path.isfile(path):
+        return [path]
+    raise FileNotFoundError(f"No {SAFETENSORS_FILE} or {SAFETENSORS_INDEX_FILE} in {model_dir}")
+
+
+def mmap_safetensors(path: str) -> Tuple[Dict[str, torch.Tensor], int]:
+    """Tensors of one safetensors file as views of a copy-on-write mapping of it
+    
+    Returns the tensors and the number of bytes that had to be copied because
+    a tensor's offset was not aligned to its element size.
+    """
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+    
+    # shared=False maps the file MAP_PRIVATE: reads come from the page cache, writes stay in this process
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    file_bytes = torch.empty(0, dtype=torch.uint8).set_(storage)
+    
+    tensors = {}
+    copied = 0
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+        if dtype is None:
+            raise ValueError(f"{name} in {path} has unsupported dtype {info['dtype']}")
+        begin, end = (data_start + offset for offset in info["data_offsets"])
+        element_size = torch.empty(0, dtype=dtype).element_size()
+        if begin % element_size == 0:
+            tensor = torch.empty(0, dtype=dtype).set_(storage, begin // element_size, info["shape"])
+        else:
+            tensor = file_bytes[begin:end].clone().view(dtype).view(info["shape"])
+            copied += end - begin
+        tensors[name] = tensor
+    return tensors, copied
+
+
+def load_mmap_state_dict(model_dir: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, Any]]:
+    """Map every safetensors file of a checkpoint; returns the state dict and mapping stats"""
+    state_dict = {}
+    stats = {"files": 0, "mapped_bytes": 0, "copied_bytes": 0}
+    for path in safetensors_files(model_dir):
+        tensors, copied = mmap_safetensors(path)
+        state_dict.update(tensors)
+        stats["files"] += 1
+        stats["mapped_bytes"] += os.path.getsize(path)
+        stats["copied_bytes"] += copied
+    return state_dict, stats
+
+
+def load_model_mmap(
+    model_name: str,
+    config: PretrainedConfig,
+    torch_dtype: torch.dtype,
+    revision: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+    token: Optional[str] = None,
+    trust_remote_code: bool = False,
+    allow_cast: bool = True
+) -> Tuple[nn.Module, Dict[str, Any]]:
+    """Build a causal LM whose weights are views of its memory-mapped safetensors files
+    
+    Raises ValueError when the checkpoint's tensors do not match the model's
+    parameters one to one (renamed keys, pre-quantized formats such as MXFP4),
+    and, unless ``allow_cast``, when they are stored in another dtype than
+    ``torch_dtype``; such checkpoints need ``from_pretrained``.
+    """
+    start = time.perf_counter()
+    model_dir = resolve_model_dir(model_name, revision, cache_dir, token)
+    state_dict, stats = load_mmap_state_dict(model_dir)
+    
+    # Parameters are created on the meta device; buffers computed at init (rotary frequencies) are real
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch_dtype, trust_remote_code=trust_remote_code)
+    
+    expected = set(model.state_dict())
+    unexpected = sorted(set(state_dict) - expected)
+    if unexpected:
+        raise ValueError(f"Checkpoint tensors do not match the model, e.g. {unexpected[:3]}")
+    
+    for name, tensor in state_dict.items():
+        if tensor.dtype != torch_dtype and tensor.is_floating_point():
+            if not allow_cast:
+                raise ValueError(f"Checkpoint stores {name} as {tensor.dtype}, not {torch_dtype}")
+            state_dict[name] = tensor.to(torch_dtype)
+            stats["copied_bytes"] += state_dict[name].numel() * state_dict[name].element_size()
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    
+    missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+    if missing:
+        raise ValueError(f"Checkpoint has no weights for {len(missing)} parameters, e.g. {missing[:3]}")
+    
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_dir)
+    except OSError:
+        pass
+    model.eval()
+    
+    stats["load_s"] = time.perf_counter() - start
+    return model, stats
+
+
+def mmap_cache_path(cache_dir: str, model_name: str, revision: Optional[str], torch_dtype: torch.dtype) -> str:
+    """Directory in ``cache_dir`` for the weights of ``model_name`` converted to ``torch_dtype``"""
+    source = os.path.abspath(model_name) if os.path.isdir(model_name) else f"{model_name}@{revision}"
+    dtype_name = str(torch_dtype).replace("torch.", "")
+    key = hashlib.sha256(f"{source}:{dtype_name}".encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(model_name.rstrip('/'))}-{dtype_name}-{key}")
+
+
+def write_mmap_cache(model: nn.Module, path: str, max_shard_size: str = "5GB"):
+    """Save ``model``'s weights in their current dtype as safetensors that ``load_model_mmap`` can map
+    
+    The files are written to a staging directory and renamed into place, so
+    processes converting the same model concurrently never see a partial
+    cache; the first one to finish wins.
+    """
+    staging = f"{path}.staging-{os.getpid()}"
+    model.save_pretrained(staging, safe_serialization=True, max_shard_size=max_shard_size)
+    try:
+        os.rename(staging, path)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def dispatch_mmap_model(
+    model: nn.Module,
+    device_map: Union[str, Dict[str, Any]],
+    max_memory: Optional[Dict[Union[int, str], str]] = None,
+    offload_folder: Optional[str] = None
+) -> nn.Module:
+    """Place a model loaded by ``load_model_mmap`` like ``from_pretrained(device_map=...)`` would
+    
+    Modules mapped to "cpu" keep their shared, memory-mapped weights.
+    """
+    if isinstance(device_map, str) and device_map not in ("auto", "balanced", "balanced_low_0", "sequential"):
+        # A single device such as "cpu" or "cuda:1"
+        return model if device_map == "cpu" else model.to(device_map)
+    if isinstance(device_map, str):
+        device_map = infer_auto_device_map(
+            model,
+            max_memory=max_memory,
+            no_split_module_classes=getattr(model, "_no_split_modules", None) or []
+        )
+    if set(device_map.values()) <= {"cpu"}:
+        return model
+    return dispatch_model(model, device_map=device_map, offload_dir=offload_folder)
+
+
+def memory_usage() -> Dict[str, float]:
+    """Resident, proportional and shared memory of this process in MB
+    
+    PSS and the shared/private split come from /proc/self/smaps_rollup and are
+    only reported on Linux.
+    """
+    usage = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line and not line.startswith(" "))
+    except OSError:
+        # Without smaps only the peak is known; ru_maxrss is kilobytes on Linux and bytes on macOS
+        usage["rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024)
+        return usage
+    
+    def mb(key: str) -> float:
+        return int(fields.get(key, "0 kB").split()[0]) / 1024
+    
+    usage["rss_mb"] = mb("Rss")
+    usage["pss_mb"] = mb("Pss")
+    usage["shared_mb"] = mb("Shared_Clean") + mb("Shared_Dirty")
+    usage["private_mb"] = mb("Private_Clean") + mb("Private_Dirty")
+    return usage
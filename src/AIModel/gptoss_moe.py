@@ -0,0 +1,671 @@
+"""
+Expert-routing instrumentation and expert-aware LoRA targeting for GPT-OSS.
+
+RouterStats hooks the router of every mixture-of-experts layer and counts how
+many tokens each expert receives, together with the entropy of the router's
+softmax over all experts (low entropy: confident, peaked routing). The counts
+stay on the device the layer runs on, so recording adds no host
+synchronization to a step; the totals are read only when a summary is taken.
+Padding tokens are left out when the model is called with a 2-D attention
+mask, and layers recomputed by gradient checkpointing are counted once.
+RoutingStatsCallback logs the summary with the training loss and writes it to
+routing_stats.json when training ends; ``main`` collects it over a JSONL
+dataset without training:
+
+    python GptRoss.py routing-stats --data ./data.jsonl --output routing_stats.json
+
+For LoRA targeting, ``resolve_target_modules`` replaces "auto" with the
+attention and dense MLP projections the model actually has, and ExpertLoRA
+adds LoRA to the 3-D expert weights that target_modules cannot reach. It can
+be limited to the experts that receive the most tokens according to a
+routing_stats.json (``hot_experts``), which cuts the trainable parameters and
+the adapter compute of every expert layer to the adapted experts and the
+tokens routed to them. ExpertLoRA is a PEFT LoRA layer, so its weights are
+saved, checkpointed, switched between and merged along with the rest of the
+adapter.
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import logging
+import argparse
+import warnings
+import traceback
+from functools import partial
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from peft.tuners._buffer_dict import BufferDict
+from peft.tuners.lora import LoraLayer
+from peft.tuners.tuners_utils import check_adapters_to_merge
+from safetensors import safe_open
+from transformers import TrainerCallback
+
+from gptoss_quant import QuantExperts, gptoss_experts_forward, is_gptoss_experts
+
+logger = logging.getLogger(__name__)
+
+ROUTING_STATS_FILE = "routing_stats.json"
+EXPERT_LORA_MODES = ("none", "all", "hot")
+# Prefix of the adapter's tensor names in front of the base model's
+PEFT_PREFIX = "base_model.model."
+
+_LAYER_RE = re.compile(r"(?:^|\.)layers\.(\d+)\.")
+
+
+def _layer_index(name: str) -> Optional[int]:
+    match = _LAYER_RE.search(name)
+    return int(match.group(1)) if match else None
+
+
+def _base_model(model: nn.Module) -> nn.Module:
+    return model.get_base_model() if hasattr(model, "get_base_model") else model
+
+
+def find_routers(model: nn.Module) -> Dict[str, nn.Module]:
+    """Top-k routers of the mixture-of-experts layers, by module name"""
+    return {
+        name: module for name, module in model.named_modules()
+        if hasattr(module, "top_k") and hasattr(module, "num_experts") and isinstance(getattr(module, "weight", None), torch.Tensor)
+    }
+
+
+def _expert_weights(module: nn.Module) -> Dict[str, Tuple[int, ...]]:
+    """Shapes of the [num_experts, in_features, out_features] weights of an expert block"""
+    if isinstance(module, QuantExperts):
+        return {key[len("quantized_"):]: tuple(quantized.shape) for key, quantized in module.quantized.items()}
+    return {
+        name: tuple(param.shape) for name, param in module.named_parameters(recurse=False)
+        if param.dim() == 3 and param.is_floating_point()
+    }
+
+
+def find_expert_modules(model: nn.Module) -> Dict[str, nn.Module]:
+    """Expert blocks (ExpertLoRA, QuantExperts or plain modules with 3-D weights), by module name"""
+    found = {}
+    for name, module in model.named_modules():
+        if any(name.startswith(prefix + ".") for prefix in found):
+            continue
+        if isinstance(module, (ExpertLoRA, QuantExperts)) or _expert_weights(module):
+            found[name] = module
+    return found
+
+
+def discover_lora_targets(model: nn.Module) -> Dict[str, List[str]]:
+    """Names of the model's attention projections, dense MLP projections, expert weights and routers
+    
+    Attention and MLP entries are module names as target_modules takes them,
+    expert entries the parameter names ExpertLoRA adapts.
+    """
+    model = _base_model(model)
+    experts = find_expert_modules(model)
+    routers = find_routers(model)
+    attention, mlp = set(), set()
+    for name, module in model.named_modules():
+        if not isinstance(module, nn.Linear) or "lora_" in name or name in routers:
+            continue
+        if any(name.startswith(prefix + ".") for prefix in experts):
+            continue
+        parts = name.split(".")
+        if parts[-1] == "base_layer":
+            # A projection PEFT already wrapped
+            parts = parts[:-1]
+        if parts[-1] in ("gate", "router"):
+            continue
+        if any("attn" in part or "attention" in part for part in parts[:-1]):
+            attention.add(parts[-1])
+        elif any(part in ("mlp", "feed_forward", "ffn") for part in parts[:-1]):
+            mlp.add(parts[-1])
+    return {
+        "attention": sorted(attention),
+        "mlp": sorted(mlp),
+        "experts": sorted({weight for module in experts.values() for weight in _expert_weights(_unwrap(module))}),
+        "routers": sorted({name.split(".")[-1] for name in routers}),
+    }
+
+
+def resolve_target_modules(model: nn.Module, target_modules: Sequence[str]) -> List[str]:
+    """``target_modules`` with "auto" replaced by the attention and dense MLP projections found in ``model``"""
+    if "auto" not in target_modules:
+        return list(target_modules)
+    targets = discover_lora_targets(model)
+    resolved = [name for name in target_modules if name != "auto"] + targets["attention"] + targets["mlp"]
+    return list(dict.fromkeys(resolved))
+
+
+def _unwrap(module: nn.Module, quantized: bool = False) -> nn.Module:
+    """The block an ExpertLoRA wraps, and with ``quantized`` the module a QuantExperts wraps"""
+    module = module.get_base_layer() if isinstance(module, ExpertLoRA) else module
+    return module.experts if quantized and isinstance(module, QuantExperts) else module
+
+
+class RouterStats:
+    """Per-layer expert load and router entropy, collected with forward hooks
+    
+    Usage::
+        
+        stats = RouterStats()
+        stats.attach(model)
+        for batch in batches:
+            model(**batch)
+        stats.save("routing_stats.json")
+        stats.detach()
+    
+    Args:
+        entropy: also record the entropy of the router's softmax over all
+            experts; this recomputes the router logits, one [tokens, experts]
+            matmul per layer
+        training_only: only record forward passes of modules in training mode
+    """
+    
+    def __init__(self, entropy: bool = True, training_only: bool = False):
+        self.entropy = entropy
+        self.training_only = training_only
+        self.num_experts = 0
+        self.top_k = 0
+        # layer -> [expert token counts, summed entropy, token count], on the layer's device
+        self._totals: Dict[int, List[torch.Tensor]] = {}
+        self._handles = []
+        self._mask: Optional[torch.Tensor] = None
+        self._seen: Optional[set] = None
+    
+    def attach(self, model: nn.Module):
+        """Hook every router of ``model`` (a PEFT model or a causal LM)"""
+        base = _base_model(model)
+        routers = find_routers(base)
+        if not routers:
+            raise ValueError(f"{type(base).__name__} has no mixture-of-experts routers to record")
+        self._handles.append(base.register_forward_pre_hook(self._on_model_forward, with_kwargs=True))
+        for position, (name, router) in enumerate(routers.items()):
+            layer = _layer_index(name)
+            self._handles.append(router.register_forward_hook(self._hook(position if layer is None else layer)))
+            self.num_experts, self.top_k = router.num_experts, router.top_k
+        logger.info(f"Recording expert routing of {len(routers)} layers")
+    
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+    
+    def reset(self):
+        self._totals = {}
+    
+    def _on_model_forward(self, module, args, kwargs):
+        # One forward pass of the whole model: every router is counted once, not again when checkpointing recomputes it
+        self._seen = set()
+        mask = kwargs.get("attention_mask")
+        self._mask = mask if isinstance(mask, torch.Tensor) and mask.dim() == 2 else None
+    
+    def _hook(self, layer: int):
+        def hook(router, args, output):
+            if self.training_only and not router.training:
+                return
+            if self._seen is not None:
+                if layer in self._seen:
+                    return
+                self._seen.add(layer)
+            with torch.no_grad():
+                self._record(layer, router, args[0], output[1])
+        return hook
+    
+    def _record(self, layer: int, router: nn.Module, hidden_states: torch.Tensor, indices: torch.Tensor):
+        num_tokens = indices.shape[0]
+        keep = torch.ones(num_tokens, device=indices.device)
+        mask = self._mask
+        if mask is not None and num_tokens % mask.shape[0] == 0 and num_tokens // mask.shape[0] <= mask.shape[1]:
+            # With a KV cache the mask covers past tokens too; the current ones are the last
+            keep = mask[:, mask.shape[1] - num_tokens // mask.shape[0]:].reshape(-1).to(indices.device, torch.float32)
+        
+        if layer not in self._totals:
+            self._totals[layer] = [
+                torch.zeros(router.num_experts, dtype=torch.float64, device=indices.device),
+                torch.zeros((), dtype=torch.float64, device=indices.device),
+                torch.zeros((), dtype=torch.float64, device=indices.device),
+            ]
+        counts, entropy, tokens = self._totals[layer]
+        counts.index_add_(0, indices.reshape(-1), keep.repeat_interleave(indices.shape[1]).to(counts.dtype))
+        tokens += keep.sum()
+        if self.entropy:
+            logits = F.linear(hidden_states.reshape(-1, router.weight.shape[1]), router.weight, getattr(router, "bias", None)).float()
+            token_entropy = -(logits.softmax(-1) * logits.log_softmax(-1)).sum(-1)
+            entropy += (token_entropy * keep).sum()
+    
+    def state(self) -> Dict[int, List[torch.Tensor]]:
+        """Copy of the running totals, to summarize only what comes after it with ``summary(since=...)``"""
+        return {layer: [tensor.clone() for tensor in totals] for layer, totals in self._totals.items()}
+    
+    def summary(self, since: Optional[Dict[int, List[torch.Tensor]]] = None) -> Dict[str, Any]:
+        """Per-layer expert counts and load fractions, router entropy and load imbalance (max over mean load)"""
+        layers = {}
+        for layer in sorted(self._totals):
+            counts, entropy, tokens = self._totals[layer]
+            if since is not None and layer in since:
+                counts, entropy, tokens = (total - previous for total, previous in zip(self._totals[layer], since[layer]))
+            counts, entropy, tokens = counts.tolist(), entropy.item(), tokens.item()
+            routed = sum(counts)
+            if not tokens:
+                continue
+            mean_load = routed / len(counts)
+            layers[str(layer)] = {
+                "tokens": int(tokens),
+                "counts": [int(count) for count in counts],
+                "load": [count / routed for count in counts],
+                "load_imbalance": max(counts) / mean_load,
+                "unused_experts": sum(count == 0 for count in counts),
+                **({
+                    "entropy": entropy / tokens,
+                    "normalized_entropy": entropy / tokens / math.log(len(counts)),
+                } if self.entropy else {}),
+            }
+        summary = {
+            "num_experts": self.num_experts,
+            "top_k": self.top_k,
+            "tokens": max((stats["tokens"] for stats in layers.values()), default=0),
+            "load_imbalance": sum(stats["load_imbalance"] for stats in layers.values()) / max(len(layers), 1),
+        }
+        if self.entropy:
+            summary["normalized_entropy"] = sum(stats["normalized_entropy"] for stats in layers.values()) / max(len(layers), 1)
+        summary["layers"] = layers
+        return summary
+    
+    def save(self, path: str) -> Dict[str, Any]:
+        summary = self.summary()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        logger.info(f"Routing statistics of {len(summary['layers'])} layers written to {path}")
+        return summary
+
+
+class RoutingStatsCallback(TrainerCallback):
+    """Router entropy and expert load imbalance in the Trainer logs, and routing_stats.json at the end of training"""
+    
+    def __init__(self, output_path: str, entropy: bool = True):
+        self.output_path = output_path
+        self.stats = RouterStats(entropy=entropy, training_only=True)
+        self._last_log: Optional[Dict[int, List[torch.Tensor]]] = None
+    
+    def attach(self, trainer):
+        """Hook the routers of the trainer's model and register this callback"""
+        self.stats.attach(trainer.model)
+        # Ahead of the reporting callbacks so the router metrics reach wandb and the console
+        trainer.callback_handler.callbacks.insert(0, self)
+    
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is None or "loss" not in logs:
+            return
+        summary = self.stats.summary(since=self._last_log)
+        self._last_log = self.stats.state()
+        if not summary["layers"]:
+            return
+        logs["router/load_imbalance"] = round(summary["load_imbalance"], 4)
+        if "normalized_entropy" in summary:
+            logs["router/entropy"] = round(summary["normalized_entropy"], 4)
+    
+    def on_train_end(self, args, state, control, **kwargs):
+        if state.is_world_process_zero:
+            self.stats.save(self.output_path)
+
+
+def load_routing_stats(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def hot_experts(stats: Dict[str, Any], num_experts: int) -> Dict[int, List[int]]:
+    """The ``num_experts`` experts of every layer that received the most tokens, from a routing stats summary"""
+    hot = {}
+    for layer, layer_stats in stats["layers"].items():
+        counts = layer_stats["counts"]
+        ranked = sorted(range(len(counts)), key=lambda expert: counts[expert], reverse=True)
+        hot[int(layer)] = sorted(ranked[:num_experts])
+    return hot
+
+
+class ExpertLoRA(nn.Module, LoraLayer):
+    """LoRA on the 3-D weights of a mixture-of-experts block, for all or some of its experts
+    
+    Wraps a GPT-OSS expert block, plain or QuantExperts. Expert weights are
+    [num_experts, in_features, out_features] and applied as ``x @ W[e]``. For
+    every adapted expert ``e`` the adapter holds ``A[e]`` (r x in_features)
+    and ``B[e]`` (out_features x r) per weight, and the forward pass runs the
+    block's per-expert loop with ``scaling * x @ A[e].T @ B[e].T`` added to
+    the projections of the tokens routed to ``e``. No adapted copy of the
+    weights is built, so the adapter's compute and saved activations scale
+    with the tokens of the adapted experts; experts outside ``experts`` have
+    no adapter at all. The adapted experts are stored with the adapter as
+    ``lora_experts``. There is no dropout.
+    """
+    
+    adapter_layer_names = ("lora_A", "lora_B")
+    other_param_names = ("r", "lora_alpha", "scaling", "lora_dropout", "lora_experts")
+    
+    def __init__(
+        self,
+        base_layer: nn.Module,
+        adapter_name: str,
+        experts: Sequence[int],
+        r: int = 16,
+        lora_alpha: int = 32,
+        use_rslora: bool = False,
+        init_lora_weights: bool = True
+    ):
+        super().__init__()
+        with warnings.catch_warnings():
+            # PEFT warns about any layer it has no in/out features for; those differ per expert weight here
+            warnings.simplefilter("ignore", UserWarning)
+            LoraLayer.__init__(self, base_layer)
+        self.weight_shapes = _expert_weights(base_layer)
+        if set(self.weight_shapes) != {"gate_up_proj", "down_proj"} or not is_gptoss_experts(_unwrap(base_layer, quantized=True)):
+            raise ValueError(f"{type(base_layer).__name__} is not a GPT-OSS expert block (gate_up_proj and down_proj with biases)")
+        self.lora_experts = BufferDict(persistent=True)
+        self._active_adapter = adapter_name
+        self.update_layer(adapter_name, experts, r, lora_alpha, use_rslora, init_lora_weights)
+    
+    def update_layer(
+        self,
+        adapter_name: str,
+        experts: Sequence[int],
+        r: int,
+        lora_alpha: int,
+        use_rslora: bool = False,
+        init_lora_weights: bool = True
+    ):
+        if r <= 0:
+            raise ValueError(f"`r` should be a positive integer value but the value passed is {r}")
+        num_experts = next(iter(self.weight_shapes.values()))[0]
+        experts = sorted(set(experts))
+        if not experts or experts[0] < 0 or experts[-1] >= num_experts:
+            raise ValueError(f"Experts to adapt must be a non-empty subset of 0..{num_experts - 1}, got {experts}")
+        
+        device = self._base_device()
+        lora_a, lora_b = nn.ParameterDict(), nn.ParameterDict()
+        for name, (_, in_features, out_features) in self.weight_shapes.items():
+            lora_a[name] = nn.Parameter(torch.zeros(len(experts), r, in_features, device=device))
+            lora_b[name] = nn.Parameter(torch.zeros(len(experts), out_features, r, device=device))
+            if init_lora_weights:
+                # nn.Linear's default init of lora_A in PEFT, per expert; lora_B stays zero
+                bound = 1 / math.sqrt(in_features)
+                nn.init.uniform_(lora_a[name], -bound, bound)
+        
+        self.r[adapter_name] = r
+        self.lora_alpha[adapter_name] = lora_alpha
+        self.scaling[adapter_name] = lora_alpha / (math.sqrt(r) if use_rslora else r)
+        self.lora_dropout[adapter_name] = nn.Identity()
+        self.use_dora[adapter_name] = False
+        self.lora_bias[adapter_name] = False
+        self.lora_A[adapter_name] = lora_a
+        self.lora_B[adapter_name] = lora_b
+        self.lora_experts[adapter_name] = torch.tensor(experts, dtype=torch.long, device=device)
+        self.set_adapter(self.active_adapters)
+    
+    def _base_device(self) -> torch.device:
+        base = self.get_base_layer()
+        tensor = next(base.parameters(), None)
+        if tensor is None:
+            tensor = next(base.buffers())
+        return tensor.device
+    
+    def get_delta_weight(self, adapter_name: str, name: str) -> torch.Tensor:
+        """[adapted experts, in_features, out_features] delta of expert weight ``name``"""
+        lora_a = self.lora_A[adapter_name][name]
+        lora_b = self.lora_B[adapter_name][name]
+        return torch.einsum("eor,eri->eio", lora_b, lora_a) * self.scaling[adapter_name]
+    
+    def _base_project(self, x: torch.Tensor, name: str, expert: int) -> torch.Tensor:
+        base = self.get_base_layer()
+        if isinstance(base, QuantExperts):
+            return base.project(x, name, expert)
+        return x @ getattr(base, name)[expert]
+    
+    def _project(self, adapters: List[Tuple[str, Dict[int, int], Optional[torch.Tensor]]], x: torch.Tensor, name: str, expert: int, token_idx: torch.Tensor) -> torch.Tensor:
+        """Base projection of the tokens routed to ``expert`` plus the low-rank update of every adapter that adapts it"""
+        output = self._base_project(x, name, expert)
+        for adapter_name, slots, token_mask in adapters:
+            slot = slots.get(expert)
+            if slot is None:
+                continue
+            rows = None
+            if token_mask is not None:
+                rows = token_mask[token_idx].nonzero().flatten()
+                if not len(rows):
+                    continue
+            inputs = x if rows is None else x[rows]
+            lora_a = self.lora_A[adapter_name][name][slot]
+            lora_b = self.lora_B[adapter_name][name][slot]
+            delta = (inputs.to(lora_a.dtype) @ lora_a.T @ lora_b.T * self.scaling[adapter_name]).to(output.dtype)
+            output = output + delta if rows is None else output.index_add(0, rows, delta)
+        return output
+    
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        router_indices: Optional[torch.Tensor] = None,
+        routing_weights: Optional[torch.Tensor] = None,
+        adapter_names: Optional[List[str]] = None
+    ):
+        base = self.get_base_layer()
+        if self.disable_adapters:
+            if self.merged:
+                self.unmerge()
+            return base(hidden_states, router_indices=router_indices, routing_weights=routing_weights)
+        if self.merged:
+            return base(hidden_states, router_indices=router_indices, routing_weights=routing_weights)
+        
+        if adapter_names is None:
+            adapters = [(name, None) for name in self.active_adapters if name in self.lora_A]
+        else:
+            # One adapter per batch row; routing is per token, so rows become token masks
+            batch = hidden_states.shape[0]
+            if hidden_states.dim() < 3 or len(adapter_names) != batch:
+                raise ValueError("Mixed-adapter batches need [batch, seq, hidden] inputs with one adapter name per row")
+            adapters = [
+                (name, torch.tensor([row == name for row in adapter_names], device=hidden_states.device).repeat_interleave(hidden_states.shape[1]))
+                for name in dict.fromkeys(adapter_names) if name in self.lora_A
+            ]
+        if not adapters:
+            return base(hidden_states, router_indices=router_indices, routing_weights=routing_weights)
+        
+        # Position of each adapted expert in its adapter's A and B
+        adapters = [
+            (name, {expert: slot for slot, expert in enumerate(self.lora_experts[name].tolist())}, token_mask)
+            for name, token_mask in adapters
+        ]
+        return gptoss_experts_forward(
+            _unwrap(base, quantized=True),
+            hidden_states,
+            router_indices,
+            routing_weights,
+            partial(self._project, adapters)
+        )
+    
+    def merge(self, safe_merge: bool = False, adapter_names: Optional[List[str]] = None):
+        adapter_names = check_adapters_to_merge(self, adapter_names)
+        if not adapter_names:
+            return
+        base = self.get_base_layer()
+        if isinstance(base, QuantExperts):
+            raise ValueError("Expert adapters cannot be merged into quantized expert weights; dequantize the model first")
+        for adapter_name in adapter_names:
+            if adapter_name not in self.lora_A:
+                continue
+            experts = self.lora_experts[adapter_name]
+            for name in self.weight_shapes:
+                weight = getattr(base, name)
+                delta = self.get_delta_weight(adapter_name, name).to(weight.device, weight.dtype)
+                if safe_merge and not torch.isfinite(weight.data.index_add(0, experts, delta)).all():
+                    raise ValueError(f"NaNs detected in the merged weights. The adapter {adapter_name} seems to be broken")
+                weight.data.index_add_(0, experts, delta)
+            self.merged_adapters.append(adapter_name)
+    
+    def unmerge(self):
+        if not self.merged:
+            warnings.warn("Already unmerged. Nothing to do.")
+            return
+        base = self.get_base_layer()
+        while self.merged_adapters:
+            adapter_name = self.merged_adapters.pop()
+            experts = self.lora_experts[adapter_name]
+            for name in self.weight_shapes:
+                weight = getattr(base, name)
+                weight.data.index_add_(0, experts, -self.get_delta_weight(adapter_name, name).to(weight.device, weight.dtype))
+    
+    def __repr__(self) -> str:
+        return "lora." + super().__repr__()
+
+
+def add_expert_lora(
+    model: nn.Module,
+    r: int,
+    lora_alpha: int,
+    experts: Optional[Dict[int, Sequence[int]]] = None,
+    adapter_name: str = "default",
+    use_rslora: bool = False,
+    init_lora_weights: bool = True
+) -> int:
+    """Add an ExpertLoRA adapter to every expert block of ``model``; returns the number of blocks
+    
+    ``experts`` maps layer indices to the experts to adapt in that layer (see
+    ``hot_experts``); all experts are adapted when it is None.
+    """
+    base = _base_model(model)
+    blocks = find_expert_modules(base)
+    for name, module in blocks.items():
+        if experts is None:
+            selected = range(next(iter(_expert_weights(_unwrap(module)).values()))[0])
+        else:
+            layer = _layer_index(name)
+            if layer not in experts:
+                raise ValueError(f"No experts given for layer {layer} ({name})")
+            selected = experts[layer]
+        if isinstance(module, ExpertLoRA):
+            module.update_layer(adapter_name, selected, r, lora_alpha, use_rslora, init_lora_weights)
+        else:
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(base.get_submodule(parent_name), child_name, ExpertLoRA(module, adapter_name, selected, r, lora_alpha, use_rslora, init_lora_weights))
+    return len(blocks)
+
+
+def load_expert_lora(model: nn.Module, adapter_dir: str, adapter_name: str = "default") -> int:
+    """Add the expert blocks of a saved adapter to ``model`` before PEFT loads it; returns the number of blocks
+    
+    PEFT then loads their weights with the rest of the adapter.
+    """
+    weights_path = os.path.join(adapter_dir, "adapter_model.safetensors")
+    if not os.path.isfile(weights_path):
+        return 0
+    with safe_open(weights_path, framework="pt") as f:
+        keys = list(f.keys())
+        blocks = {
+            key[:-len(".lora_experts")]: f.get_tensor(key).tolist()
+            for key in keys if key.endswith(".lora_experts")
+        }
+        ranks = {
+            name: f.get_slice(next(key for key in keys if key.startswith(f"{name}.lora_A."))).get_shape()[1]
+            for name in blocks
+        }
+    if not blocks:
+        return 0
+    with open(os.path.join(adapter_dir, "adapter_config.json")) as f:
+        config = json.load(f)
+    
+    base = _base_model(model)
+    for key, experts in blocks.items():
+        name = key[len(PEFT_PREFIX):] if key.startswith(PEFT_PREFIX) else key
+        module = base.get_submodule(name)
+        if isinstance(module, ExpertLoRA):
+            module.update_layer(adapter_name, experts, ranks[key], config["lora_alpha"], config.get("use_rslora", False), init_lora_weights=False)
+        else:
+            parent_name, _, child_name = name.rpartition(".")
+            block = ExpertLoRA(module, adapter_name, experts, ranks[key], config["lora_alpha"], config.get("use_rslora", False), init_lora_weights=False)
+            setattr(base.get_submodule(parent_name), child_name, block)
+    return len(blocks)
+
+
+def main(argv: Optional[List[str]] = None):
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    parser = argparse.ArgumentParser(description="Expert load and router entropy of a mixture-of-experts model over a JSONL dataset")
+    parser.add_argument("--data", type=str, required=True, help="JSONL in the training data format")
+    parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    parser.add_argument("--load_model", type=str, help="Load fine-tuned adapters from this path")
+    parser.add_argument("--torch_dtype", type=str, default="bfloat16", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--attn_implementation", type=str, default="flash_attention_2", help="Attention implementation")
+    parser.add_argument("--mmap_weights", action="store_true", help="Map the base weights from safetensors")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--max_length", type=int, default=2048, help="Examples are truncated to this many tokens")
+    parser.add_argument("--max_examples", type=int, help="Use only the first N examples")
+    parser.add_argument("--reasoning_level", type=str, default="medium", choices=["low", "medium", "high"])
+    parser.add_argument("--no_reasoning_tokens", action="store_true", help="Format examples without the reasoning-level preamble")
+    parser.add_argument("--no_entropy", action="store_true", help="Only count expert load; skips recomputing the router logits")
+    parser.add_argument("--hot_experts", type=int, default=4, help="Experts per layer listed as hottest in the log")
+    parser.add_argument("--output", type=str, default=ROUTING_STATS_FILE)
+    args = parser.parse_args(argv)
+    
+    from torch.utils.data import DataLoader, Subset
+    from gptoss_finetune import ModelConfig, LoRAConfig, TrainingConfig, GPTOSSFineTuner, GPTOSSDataset, DataCollatorForHarmony
+    
+    try:
+        model_config = ModelConfig(
+            model_name=args.model_name,
+            torch_dtype=args.torch_dtype,
+            attn_implementation=args.attn_implementation,
+            mmap_weights=args.mmap_weights,
+            prefix_cache_mb=0
+        )
+        fine_tuner = GPTOSSFineTuner(model_config, LoRAConfig(inference_mode=True), TrainingConfig(report_to="none"))
+        fine_tuner.load_tokenizer()
+        if args.load_model:
+            fine_tuner.load_finetuned_model(args.load_model)
+        else:
+            fine_tuner.load_model()
+        model = fine_tuner.model
+        model.eval()
+        
+        dataset = GPTOSSDataset(
+            args.data,
+            fine_tuner.tokenizer,
+            max_length=args.max_length,
+            use_reasoning_tokens=not args.no_reasoning_tokens,
+            reasoning_level=args.reasoning_level,
+            padding="longest"
+        )
+        # The dataset may have added harmony special tokens the embeddings don't cover yet
+        if len(fine_tuner.tokenizer) > model.get_input_embeddings().num_embeddings:
+            model.resize_token_embeddings(len(fine_tuner.tokenizer))
+        if args.max_examples:
+            dataset = Subset(dataset, range(min(args.max_examples, len(dataset))))
+        loader = DataLoader(dataset, batch_size=args.batch_size, collate_fn=DataCollatorForHarmony(pad_token_id=fine_tuner.tokenizer.pad_token_id))
+        
+        stats = RouterStats(entropy=not args.no_entropy)
+        stats.attach(model)
+        device = next(model.parameters()).device
+        with torch.no_grad():
+            for batch in loader:
+                model(input_ids=batch["input_ids"].to(device), attention_mask=batch["attention_mask"].to(device))
+        stats.detach()
+        
+        summary = stats.save(args.output)
+        hot = hot_experts(summary, args.hot_experts)
+        for layer, layer_stats in summary["layers"].items():
+            entropy = f"entropy {layer_stats['normalized_entropy']:.3f}, " if "normalized_entropy" in layer_stats else ""
+            logger.info(
+                f"layer {layer}: {entropy}imbalance {layer_stats['load_imbalance']:.2f}, "
+                f"{layer_stats['unused_experts']} unused, hottest {hot[int(layer)]}"
+            )
+        logger.info(f"{summary['tokens']} tokens over {len(summary['layers'])} layers, mean load imbalance {summary['load_imbalance']:.2f}")
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+Low-memory AdamW for GPT-OSS LoRA fine-tuning.
+
+Plain AdamW keeps two fp32 moments, 8 bytes per trainable parameter, on the
+device of the parameter. With large LoRA ranks or ``modules_to_save`` (the
+embeddings and LM head of a ~200k vocabulary) that is gigabytes of device
+memory spent on optimizer state. Two options shrink it and can be combined:
+
+- ``adamw_8bit`` stores both moments as 8-bit codes of a dynamic (log-scale)
+  codebook with one fp32 absmax per block of ``block_size`` values, ~2.03
+  bytes per parameter. Moments are dequantized block-chunk by block-chunk,
+  updated in fp32 and requantized in every step. Parameters smaller than
+  ``min_8bit_size`` keep fp32 moments, where quantization saves nothing.
+- ``offload`` keeps the moments and an fp32 master copy of every trainable
+  parameter in host memory and runs the update on the CPU. Gradients are
+  copied to pinned host buffers from a side stream as the backward pass
+  produces them, so the transfers overlap with the rest of backward; the
+  updated weights are copied back asynchronously while the CPU updates the
+  next parameter.
+
+With the ``auto`` backend on a GPU, ``adamw_8bit`` without offload uses the
+fused bitsandbytes kernels when the package is installed; ``reference`` is
+the plain PyTorch implementation here, which runs anywhere, including on CPU.
+
+Gradient clipping has to see the gradients the update uses: with offload they
+are the host copies, so ``clip_grad_norm_`` of the optimizer replaces the
+Trainer's clipping (see GPTOSSTrainer.create_optimizer).
+"""
+
+import logging
+import importlib.util
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch.optim import Optimizer
+
+logger = logging.getLogger(__name__)
+
+OPTIMIZERS = ("adamw", "adamw_8bit")
+OPTIMIZER_BACKENDS = ("auto", "bitsandbytes", "reference")
+
+# Elements dequantized at a time, bounds the fp32 temporaries for large parameters
+CHUNK_ELEMENTS = 1 << 22
+
+
+def dynamic_code(signed: bool) -> torch.Tensor:
+    """The 256 levels of the 8-bit dynamic quantization map used for optimizer state
+    
+    Each decade from 1e-7 to 1 gets twice as many levels as the one below it,
+    so small moments keep their relative precision, as in bitsandbytes.
+    """
+    levels = [0.0, 1.0]
+    for exponent in range(7):
+        items = 2 ** exponent if signed else 2 ** (exponent + 1)
+        boundaries = torch.linspace(0.1, 1, items + 1)
+        means = ((boundaries[:-1] + boundaries[1:]) / 2 * 10 ** (exponent - 6)).tolist()
+        levels += means
+        if signed:
+            levels += [-mean for mean in means]
+    return torch.tensor(sorted(levels))
+
+
+class QuantizedState:
+    """Blockwise 8-bit codes of a flat fp32 tensor against a dynamic codebook"""
+    
+    def __init__(self, code: torch.Tensor, block_size: int):
+        self.code = code
+        self.midpoints = (code[1:] + code[:-1]) / 2
+        self.block_size = block_size
+    
+    def to(self, device: torch.device) -> "QuantizedState":
+        return QuantizedState(self.code.to(device), self.block_size)
+    
+    def empty(self, numel: int, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Codes and absmax of a zero tensor of ``numel`` values; a zero absmax decodes every code to zero"""
+        blocks = -(-numel // self.block_size)
+        codes = torch.zeros(blocks * self.block_size, dtype=torch.uint8, device=device)
+        return codes, torch.zeros(blocks, dtype=torch.float32, device=device)
+    
+    def dequantize(self, codes: torch.Tensor, absmax: torch.Tensor) -> torch.Tensor:
+        values = self.code[codes.long()].view(-1, self.block_size) * absmax[:, None]
+        return values.view(-1)
+    
+    def quantize_(self, values: torch.Tensor, codes: torch.Tensor, absmax: torch.Tensor):
+        """Write the codes and absmax of ``values`` (padded to whole blocks) into ``codes`` and ``absmax``"""
+        blocks = F.pad(values, (0, codes.numel() - values.numel())).view(-1, self.block_size)
+        torch.amax(blocks.abs(), dim=1, out=absmax)
+        normalized = blocks / absmax.clamp_min(1e-30)[:, None]
+        codes.copy_(torch.bucketize(normalized, self.midpoints).view(-1))
+
+
+class LowMemoryAdamW(Optimizer):
+    """AdamW (decoupled weight decay) with optional 8-bit moments and CPU offload
+    
+    ``optim_bits`` 8 stores the moments of parameters with at least
+    ``min_8bit_size`` elements as blockwise 8-bit codes. ``offload`` keeps the
+    state and an fp32 master copy of each parameter in host memory and runs
+    the update there; on a CPU-only machine the parameters already live on
+    the host and it only changes where the temporaries are.
+    """
+    
+    def __init__(
+        self,
+        params: Iterable,
+        lr: float = 1e-3,
+        betas: Tuple[float, float] = (0.9, 0.999),
+        eps: float = 1e-8,
+        weight_decay: float = 0.01,
+        optim_bits: int = 32,
+        offload: bool = False,
+        block_size: int = 256,
+        min_8bit_size: int = 4096
+    ):
+        if optim_bits not in (8, 32):
+            raise ValueError(f"optim_bits must be 8 or 32, got {optim_bits}")
+        super().__init__(params, dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay))
+        self.optim_bits = optim_bits
+        self.offload = offload
+        self.block_size = block_size
+        self.min_8bit_size = min_8bit_size
+        self._codes: Dict[Tuple[bool, torch.device], QuantizedState] = {}
+        
+        # Host copies of weights and gradients when offloading from an accelerator
+        self._host_params: Dict[torch.Tensor, torch.Tensor] = {}
+        self._host_grads: Dict[torch.Tensor, torch.Tensor] = {}
+        self._grad_events: Dict[torch.Tensor, torch.cuda.Event] = {}
+        self._copy_stream = None
+        self._upload_done = None
+        if offload and torch.cuda.is_available():
+            self._copy_stream = torch.cuda.Stream()
+            for param in self._params():
+                if param.device.type == "cuda":
+                    param.register_post_accumulate_grad_hook(self._download_grad)
+    
+    def _code(self, signed: bool, device: torch.device) -> QuantizedState:
+        if (signed, device) not in self._codes:
+            self._codes[signed, device] = QuantizedState(dynamic_code(signed), self.block_size).to(device)
+        return self._codes[signed, device]
+    
+    def _params(self) -> List[torch.Tensor]:
+        return [param for group in self.param_groups for param in group["params"]]
+    
+    def _state_device(self, param: torch.Tensor) -> torch.device:
+        return torch.device("cpu") if self.offload else param.device
+    
+    def _download_grad(self, param: torch.Tensor):
+        """Copy a finished gradient to host memory on the side stream while backward goes on"""
+        if param not in self._host_grads:
+            self._host_grads[param] = torch.empty(param.shape, dtype=param.grad.dtype, pin_memory=True)
+        self._copy_stream.wait_stream(torch.cuda.current_stream(param.device))
+        with torch.cuda.stream(self._copy_stream):
+            param.grad.record_stream(self._copy_stream)
+            self._host_grads[param].copy_(param.grad, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        self._grad_events[param] = event
+    
+    def _grad(self, param: torch.Tensor) -> Optional[torch.Tensor]:
+        """The gradient the update uses: the host copy when offloading from an accelerator"""
+        if param in self._grad_events:
+            self._grad_events.pop(param).synchronize()
+        if param in self._host_grads and param.grad is not None:
+            return self._host_grads[param]
+        return param.grad
+    
+    def _master(self, param: torch.Tensor) -> torch.Tensor:
+        """The fp32 weights the update writes to"""
+        if not self.offload or (param.device.type == "cpu" and param.dtype == torch.float32):
+            return param
+        if param not in self._host_params:
+            self._host_params[param] = param.detach().to("cpu", torch.float32, copy=True).pin_memory() if torch.cuda.is_available() else param.detach().float()
+        return self._host_params[param]
+    
+    def _init_state(self, param: torch.Tensor, state: Dict[str, Any]):
+        device = self._state_device(param)
+        state["step"] = torch.tensor(0.0)
+        if self.optim_bits == 8 and param.numel() >= self.min_8bit_size:
+            for key, signed in (("exp_avg", True), ("exp_avg_sq", False)):
+                state[key], state[f"{key}_absmax"] = self._code(signed, device).empty(param.numel(), device)
+        else:
+            state["exp_avg"] = torch.zeros(param.numel(), dtype=torch.float32, device=device)
+            state["exp_avg_sq"] = torch.zeros(param.numel(), dtype=torch.float32, device=device)
+    
+    @torch.no_grad()
+    def clip_grad_norm_(self, max_norm: float, norm_type: float = 2.0) -> torch.Tensor:
+        """Clip the gradients the next step uses to a total norm of ``max_norm``; returns the norm before clipping"""
+        grads = [grad for grad in (self._grad(param) for param in self._params()) if grad is not None]
+        if not grads:
+            return torch.tensor(0.0)
+        total_norm = torch.linalg.vector_norm(torch.stack([torch.linalg.vector_norm(grad.float(), norm_type) for grad in grads]), norm_type)
+        coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+        for grad in grads:
+            grad.mul_(coef.to(grad.device))
+        return total_norm
+    
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        if self._upload_done is not None:
+            # The previous step's uploads still read the host weights
+            self._upload_done.synchronize()
+        
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for param in group["params"]:
+                grad = self._grad(param)
+                if grad is None:
+                    continue
+                state = self.state[param]
+                if not state:
+                    self._init_state(param, state)
+                master = self._master(param)
+                state["step"] += 1
+                step = state["step"].item()
+                bias_correction1 = 1 - beta1 ** step
+                bias_correction2_sqrt = (1 - beta2 ** step) ** 0.5
+                step_size = group["lr"] / bias_correction1
+                
+                flat_param = master.view(-1)
+                flat_grad = grad.view(-1).to(flat_param.device)
+                quantized = state["exp_avg"].dtype == torch.uint8
+                chunk = CHUNK_ELEMENTS - CHUNK_ELEMENTS % self.block_size
+                for start in range(0, flat_param.numel(), chunk):
+                    end = min(start + chunk, flat_param.numel())
+                    values = flat_param[start:end]
+                    g = flat_grad[start:end].float()
+                    if quantized:
+                        blocks = slice(start // self.block_size, -(-end // self.block_size))
+                        codes = slice(blocks.start * self.block_size, blocks.stop * self.block_size)
+                        m_codes = self._code(True, values.device)
+                        v_codes = self._code(False, values.device)
+                        exp_avg = m_codes.dequantize(state["exp_avg"][codes], state["exp_avg_absmax"][blocks])[:end - start]
+                        exp_avg_sq = v_codes.dequantize(state["exp_avg_sq"][codes], state["exp_avg_sq_absmax"][blocks])[:end - start]
+                    else:
+                        exp_avg = state["exp_avg"][start:end]
+                        exp_avg_sq = state["exp_avg_sq"][start:end]
+                    
+                    exp_avg.lerp_(g, 1 - beta1)
+                    exp_avg_sq.mul_(beta2).addcmul_(g, g, value=1 - beta2)
+                    update = values.float().mul_(1 - group["lr"] * group["weight_decay"])
+                    update.addcdiv_(exp_avg, exp_avg_sq.sqrt().div_(bias_correction2_sqrt).add_(group["eps"]), value=-step_size)
+                    values.copy_(update)
+                    
+                    if quantized:
+                        m_codes.quantize_(exp_avg, state["exp_avg"][codes], state["exp_avg_absmax"][blocks])
+                        v_codes.quantize_(exp_avg_sq, state["exp_avg_sq"][codes], state["exp_avg_sq_absmax"][blocks])
+                
+                if master is not param:
+                    param.copy_(master, non_blocking=True)
+        
+        if self._host_params and torch.cuda.is_available():
+            self._upload_done = torch.cuda.Event()
+            self._upload_done.record()
+        return loss
+    
+    def load_state_dict(self, state_dict: Dict[str, Any]):
+        super().load_state_dict(state_dict)
+        # Optimizer.load_state_dict moves the state to the parameter's device and casts it to the parameter's dtype
+        for param, state in self.state.items():
+            for key, value in state.items():
+                if key != "step":
+                    dtype = torch.uint8 if f"{key}_absmax" in state else torch.float32
+                    state[key] = value.to(self._state_device(param), dtype)
+    
+    def state_memory(self) -> Dict[str, int]:
+        """Bytes of optimizer state and master weights by device type"""
+        usage: Dict[str, int] = {}
+        tensors = [value for state in self.state.values() for value in state.values() if torch.is_tensor(value)]
+        for tensor in tensors + list(self._host_params.values()) + list(self._host_grads.values()):
+            usage[tensor.device.type] = usage.get(tensor.device.type, 0) + tensor.numel() * tensor.element_size()
+        return usage
+
+
+def resolve_optimizer_backend(backend: str, optimizer: str, offload: bool) -> str:
+    """Pick bitsandbytes for on-device 8-bit AdamW when it can run here, the reference implementation otherwise"""
+    if backend not in OPTIMIZER_BACKENDS:
+        raise ValueError(f"Unknown optimizer backend {backend!r}, expected one of {OPTIMIZER_BACKENDS}")
+    if backend == "auto":
+        has_bitsandbytes = importlib.util.find_spec("bitsandbytes") is not None
+        usable = optimizer == "adamw_8bit" and not offload and has_bitsandbytes and torch.cuda.is_available()
+        return "bitsandbytes" if usable else "reference"
+    if backend == "bitsandbytes" and offload:
+        raise ValueError("bitsandbytes optimizers keep their state on the GPU; use the reference backend to offload")
+    return backend
+
+
+def optimizer_cls_and_kwargs(
+    optimizer: str,
+    backend: str = "auto",
+    offload: bool = False,
+    lr: float = 1e-3,
+    betas: Tuple[float, float] = (0.9, 0.999),
+    eps: float = 1e-8,
+    block_size: int = 256
+) -> Optional[Tuple[type, Dict[str, Any]]]:
+    """The Trainer's ``optimizer_cls_and_kwargs`` for ``optimizer``; None leaves the Trainer's own AdamW
+    
+    Weight decay is set per parameter group by the Trainer.
+    """
+    if optimizer not in OPTIMIZERS:
+        raise ValueError(f"Unknown optimizer {optimizer!r}, expected one of {OPTIMIZERS}")
+    if optimizer == "adamw" and not offload:
+        return None
+    
+    kwargs = dict(lr=lr, betas=betas, eps=eps)
+    if resolve_optimizer_backend(backend, optimizer, offload) == "bitsandbytes":
+        import bitsandbytes
+        
+        return bitsandbytes.optim.AdamW8bit, kwargs
+    kwargs.update(optim_bits=8 if optimizer == "adamw_8bit" else 32, offload=offload, block_size=block_size)
+    return LowMemoryAdamW, kwargs
+
+
+def optimizer_state_memory(optimizer: Optimizer) -> Dict[str, int]:
+    """Bytes of optimizer state by device type, for any torch optimizer"""
+    if hasattr(optimizer, "state_memory"):
+        return optimizer.state_memory()
+    usage: Dict[str, int] = {}
+    for state in optimizer.state.values():
+        for value in state.values():
+            if torch.is_tensor(value):
+                usage[value.device.type] = usage.get(value.device.type, 0) + value.numel() * value.element_size()
+    return usage
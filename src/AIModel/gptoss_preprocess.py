@@ -0,0 +1,310 @@
+"""
+Parallel preprocessing pipeline for GPT-OSS fine-tuning data.
+
+The input JSONL is split into byte-range shards that a process pool handles
+independently. Each worker parses its lines, drops malformed lines,
+conversations without a user message or assistant response and exact
+duplicates, formats the rest in the harmony format and tokenizes them in
+batches with the fast tokenizer, writing the shard's token ids to disk. The
+parent then merges the shards in file order into a token cache entry (see
+gptoss_cache), drops duplicates that span shards and combines the per-shard
+counts into statistics: drop counts, token totals, truncation and a length
+histogram.
+
+Only the merge runs in a single process and it just concatenates token files,
+so preprocessing time scales down with the number of cores.
+"""
+
+import os
+import json
+import math
+import time
+import shutil
+import hashlib
+import logging
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from gptoss_cache import TOKENS_FILE, TOKEN_DTYPE, write_cache_index, publish_cache_entry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SYSTEM_PROMPT = "You are a helpful AI assistant."
+SHARD_BYTES = 64 * 1024 * 1024
+# Length histogram buckets are powers of two: bucket i counts lengths in (2 ** (i - 1), 2 ** i]
+HISTOGRAM_BUCKETS = 32
+SHARD_COUNTERS = ["lines", "blank", "malformed", "invalid", "duplicates"]
+
+
+def format_harmony_prompt(item: Dict[str, str], use_reasoning_tokens: bool = True, reasoning_level: str = "medium") -> str:
+    """Format prompt according to harmony format"""
+    system_prompt = item.get("system", DEFAULT_SYSTEM_PROMPT)
+    user_message = item.get("user", item.get("prompt", ""))
+    assistant_message = item.get("assistant", item.get("response", ""))
+    
+    # Add reasoning level to system prompt
+    if use_reasoning_tokens:
+        system_prompt = f"Reasoning: {reasoning_level}\n\n{system_prompt}"
+    
+    # Format according to harmony format
+    formatted = f"<s>System: {system_prompt}\n\n"
+    formatted += f"User: {user_message}\n\n"
+    
+    if use_reasoning_tokens and "reasoning" in item:
+        formatted += f"<reasoning>\n{item['reasoning']}\n</reasoning>\n\n"
+    
+    formatted += f"Assistant: {assistant_message}</s>"
+    
+    return formatted
+
+
+def is_valid_item(item: Any) -> bool:
+    """A conversation needs a non-empty user message and assistant response to be trained on"""
+    if not isinstance(item, dict):
+        return False
+    user_message = item.get("user", item.get("prompt"))
+    assistant_message = item.get("assistant", item.get("response"))
+    return all(isinstance(message, str) and message.strip() for message in (user_message, assistant_message))
+
+
+def shard_byte_ranges(path: str, num_shards: int) -> List[Tuple[int, int]]:
+    """Split a file into ``num_shards`` contiguous byte ranges of roughly equal size"""
+    size = os.path.getsize(path)
+    num_shards = max(1, min(num_shards, size))
+    bounds = [size * i // num_shards for i in range(num_shards + 1)]
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def _iter_shard_lines(path: str, start: int, end: int) -> Iterator[bytes]:
+    """Yield the lines whose first byte lies in [start, end)"""
+    with open(path, "rb") as f:
+        if start > 0:
+            # Skip the rest of a line that began in the previous shard
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        while position < end:
+            line = f.readline()
+            if not line:
+                return
+            yield line
+            position += len(line)
+
+
+def text_hash(text: str) -> int:
+    """64-bit hash of a formatted conversation, used to find exact duplicates"""
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _tokenize_batch(tokenizer, texts: List[str], max_length: int) -> Tuple[List[List[int]], List[int]]:
+    """Token ids truncated to max_length, plus every text's untruncated length"""
+    encodings = tokenizer(texts)["input_ids"]
+    full_lengths = [len(ids) for ids in encodings]
+    too_long = [i for i, length in enumerate(full_lengths) if length > max_length]
+    if too_long:
+        # Re-encode with truncation so special tokens end up where the tokenizer puts them
+        truncated = tokenizer([texts[i] for i in too_long], truncation=True, max_length=max_length)["input_ids"]
+        for i, ids in zip(too_long, truncated):
+            encodings[i] = ids
+    return encodings, full_lengths
+
+
+_worker_tokenizer = None
+_worker_options: Dict[str, Any] = {}
+
+
+def _init_worker(tokenizer, options: Dict[str, Any]):
+    """Keep one tokenizer per worker process instead of pickling it per shard"""
+    global _worker_tokenizer, _worker_options
+    _worker_tokenizer = tokenizer
+    _worker_options = options
+
+
+def _process_shard(task: Tuple[int, str, int, int, str]) -> Dict[str, Any]:
+    """Parse, validate, deduplicate, format and tokenize one shard, writing its token ids to disk"""
+    index, data_path, start, end, work_dir = task
+    options = _worker_options
+    counts = dict.fromkeys(SHARD_COUNTERS, 0)
+    seen = set()
+    lengths, full_lengths, hashes = [], [], []
+    texts, text_hashes = [], []
+    prefix = os.path.join(work_dir, f"shard-{index:05d}")
+    
+    with open(f"{prefix}.tokens", "wb") as out:
+        def flush():
+            encodings, batch_full_lengths = _tokenize_batch(_worker_tokenizer, texts, options["max_length"])
+            batch_lengths = [len(ids) for ids in encodings]
+            out.write(np.fromiter(itertools.chain.from_iterable(encodings), dtype=TOKEN_DTYPE, count=sum(batch_lengths)).tobytes())
+            lengths.extend(batch_lengths)
+            full_lengths.extend(batch_full_lengths)
+            hashes.extend(text_hashes)
+            texts.clear()
+            text_hashes.clear()
+        
+        for line in _iter_shard_lines(data_path, start, end):
+            counts["lines"] += 1
+            if not line.strip():
+                counts["blank"] += 1
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                counts["malformed"] += 1
+                continue
+            if not is_valid_item(item):
+                counts["invalid"] += 1
+                continue
+            
+            text = format_harmony_prompt(item, options["use_reasoning_tokens"], options["reasoning_level"])
+            digest = text_hash(text)
+            if options["deduplicate"]:
+                if digest in seen:
+                    counts["duplicates"] += 1
+                    continue
+                seen.add(digest)
+            
+            texts.append(text)
+            text_hashes.append(digest)
+            if len(texts) >= options["batch_size"]:
+                flush()
+        if texts:
+            flush()
+    
+    np.save(f"{prefix}.lengths.npy", np.asarray(lengths, dtype=np.int64))
+    np.save(f"{prefix}.full_lengths.npy", np.asarray(full_lengths, dtype=np.int64))
+    np.save(f"{prefix}.hashes.npy", np.asarray(hashes, dtype=np.uint64))
+    return {"index": index, "prefix": prefix, "counts": counts}
+
+
+def length_histogram(lengths: np.ndarray) -> Dict[str, int]:
+    """Count lengths per power-of-two bucket, keyed by the bucket's upper bound"""
+    if not len(lengths):
+        return {}
+    buckets = np.ceil(np.log2(np.maximum(lengths, 1))).astype(np.int64)
+    counts = np.bincount(np.minimum(buckets, HISTOGRAM_BUCKETS - 1), minlength=HISTOGRAM_BUCKETS)
+    return {f"<={2 ** i}": int(count) for i, count in enumerate(counts) if count}
+
+
+def _merge_shards(
+    shards: List[Dict[str, Any]],
+    tokens_path: str,
+    deduplicate: bool
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Concatenate shard token files in order, dropping duplicates of earlier shards' examples
+    
+    Returns the kept examples' stored and untruncated lengths and the number of
+    cross-shard duplicates removed.
+    """
+    shard_lengths = [np.load(f"{shard['prefix']}.lengths.npy") for shard in shards]
+    shard_full_lengths = [np.load(f"{shard['prefix']}.full_lengths.npy") for shard in shards]
+    
+    keep = np.ones(sum(len(lengths) for lengths in shard_lengths), dtype=bool)
+    if deduplicate and len(keep):
+        hashes = np.concatenate([np.load(f"{shard['prefix']}.hashes.npy") for shard in shards])
+        # np.unique reports the first occurrence of every hash, which keeps file order
+        _, first = np.unique(hashes, return_index=True)
+        keep[:] = False
+        keep[first] = True
+    shard_keep = np.split(keep, np.cumsum([len(lengths) for lengths in shard_lengths])[:-1])
+    
+    with open(tokens_path, "wb") as out:
+        for shard, lengths, kept in zip(shards, shard_lengths, shard_keep):
+            path = f"{shard['prefix']}.tokens"
+            if kept.all():
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+            else:
+                tokens = np.fromfile(path, dtype=TOKEN_DTYPE)
+                out.write(tokens[np.repeat(kept, lengths)].tobytes())
+    
+    lengths = np.concatenate(shard_lengths)[keep] if shards else np.zeros(0, dtype=np.int64)
+    full_lengths = np.concatenate(shard_full_lengths)[keep] if shards else np.zeros(0, dtype=np.int64)
+    return lengths, full_lengths, int((~keep).sum())
+
+
+def preprocess_jsonl(
+    data_path: str,
+    tokenizer,
+    output_dir: str,
+    max_length: int,
+    use_reasoning_tokens: bool = True,
+    reasoning_level: str = "medium",
+    num_workers: Optional[int] = None,
+    deduplicate: bool = True,
+    batch_size: int = 1000,
+    shard_bytes: int = SHARD_BYTES,
+    metadata: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Turn a JSONL corpus into a token cache entry at ``output_dir`` and return its statistics
+    
+    The file is cut into at least four shards per worker, or ``shard_bytes``
+    sized ones for large files, so workers stay busy when shards differ in
+    cost. The entry is assembled in a temporary directory and renamed into
+    place, so a crashed or concurrent build never leaves a half-written cache
+    behind.
+    """
+    start_time = time.perf_counter()
+    num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+    num_shards = max(4 * num_workers, math.ceil(os.path.getsize(data_path) / shard_bytes))
+    ranges = shard_byte_ranges(data_path, num_shards)
+    
+    tmp_dir = f"{output_dir}.tmp-{os.getpid()}"
+    work_dir = os.path.join(tmp_dir, "shards")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    
+    options = {
+        "max_length": max_length,
+        "use_reasoning_tokens": use_reasoning_tokens,
+        "reasoning_level": reasoning_level,
+        "deduplicate": deduplicate,
+        "batch_size": batch_size,
+    }
+    tasks = [(index, data_path, start, end, work_dir) for index, (start, end) in enumerate(ranges)]
+    if num_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_worker,
+            initargs=(tokenizer, options)
+        ) as executor:
+            shards = list(executor.map(_process_shard, tasks))
+    else:
+        _init_worker(tokenizer, options)
+        shards = [_process_shard(task) for task in tasks]
+    
+    lengths, full_lengths, cross_shard_duplicates = _merge_shards(
+        shards, os.path.join(tmp_dir, TOKENS_FILE), deduplicate
+    )
+    shutil.rmtree(work_dir)
+    
+    stats = {name: sum(shard["counts"][name] for shard in shards) for name in SHARD_COUNTERS}
+    stats["duplicates"] += cross_shard_duplicates
+    truncated = full_lengths > max_length
+    stats.update({
+        "examples": int(len(lengths)),
+        "tokens": int(lengths.sum()),
+        "truncated": int(truncated.sum()),
+        "truncated_tokens": int((full_lengths - lengths)[truncated].sum()),
+        "length_percentiles": {
+            f"p{q}": float(np.percentile(full_lengths, q)) for q in (50, 90, 99)
+        } if len(full_lengths) else {},
+        "length_histogram": length_histogram(full_lengths),
+        "shards": len(shards),
+        "workers": num_workers,
+        "seconds": time.perf_counter() - start_time,
+    })
+    
+    meta = dict(metadata or {})
+    meta["preprocessing"] = stats
+    write_cache_index(tmp_dir, lengths, max_length, meta)
+    publish_cache_entry(tmp_dir, output_dir)
+    
+    logger.info(
+        f"Preprocessed {stats['lines']} lines of {data_path} into {stats['examples']} examples "
+        f"({stats['malformed']} malformed, {stats['invalid']} invalid, {stats['duplicates']} duplicates, "
+        f"{stats['truncated']} truncated) in {stats['seconds']:.1f}s with {num_workers} workers"
+    )
+    return stats
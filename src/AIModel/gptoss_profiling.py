@@ -0,0 +1,301 @@
+"""
+Training-loop instrumentation for GPT-OSS fine-tuning.
+
+TrainingProfiler is a Trainer callback that times every optimizer step and
+splits it into dataloader fetch, host-to-device transfer, forward, backward
+and optimizer step. Per-step records are appended to a JSONL file as training
+runs and a percentile summary is written when it ends, so stalls can be found
+without wandb. Averages since the last log line are also added to the Trainer
+logs.
+
+It can additionally capture a window of steps with torch.profiler, starting at
+a fixed step or when the process receives SIGUSR1, and writes each window as a
+Chrome trace (open in chrome://tracing or Perfetto) plus a JSON table of the
+most expensive operators.
+"""
+
+import os
+import json
+import time
+import signal
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from transformers import TrainerCallback
+
+logger = logging.getLogger(__name__)
+
+SECTIONS = ["dataloader", "h2d", "forward", "backward", "optimizer"]
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """Mean, median, tail percentiles and max of a list of measurements"""
+    if not values:
+        return {}
+    array = np.asarray(values, dtype=np.float64)
+    return {
+        "mean": float(array.mean()),
+        "p50": float(np.percentile(array, 50)),
+        "p90": float(np.percentile(array, 90)),
+        "p99": float(np.percentile(array, 99)),
+        "max": float(array.max()),
+    }
+
+
+class TimedDataLoader:
+    """Wraps a dataloader and reports how long every batch fetch took
+    
+    ``on_batch(batch, seconds)`` is called after each fetch. Every other
+    attribute is forwarded to the wrapped dataloader so the Trainer can keep
+    using it as before.
+    """
+    
+    def __init__(self, dataloader, on_batch: Callable[[Any, float], None]):
+        self.dataloader = dataloader
+        self.on_batch = on_batch
+    
+    def __len__(self):
+        return len(self.dataloader)
+    
+    def __getattr__(self, name):
+        return getattr(self.dataloader, name)
+    
+    def __iter__(self):
+        iterator = iter(self.dataloader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.on_batch(batch, time.perf_counter() - start)
+            yield batch
+
+
+def _rank() -> int:
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+class TrainingProfiler(TrainerCallback):
+    """Per-step timing breakdown and windowed torch.profiler capture
+    
+    Call ``attach(trainer)`` once the Trainer exists; it wraps the trainer's
+    dataloader, ``_prepare_inputs``, ``compute_loss`` and the accelerator's
+    ``backward`` with timers and registers the callback.
+    
+    When accelerate places batches on the device while iterating the
+    dataloader, the host-to-device copy is part of the dataloader time and
+    ``h2d`` only covers what ``_prepare_inputs`` still moves.
+    
+    Args:
+        output_dir: where the per-rank steps JSONL, summary JSON and traces are written
+        synchronize: wait for queued CUDA work at section boundaries so GPU
+            time is attributed to the section that launched it
+        profile_start_step: first optimizer step of a torch.profiler window
+        profile_num_steps: number of steps each profiler window covers
+        profile_on_signal: start a profiler window at the next step whenever
+            the process receives SIGUSR1
+    """
+    
+    def __init__(
+        self,
+        output_dir: str,
+        synchronize: bool = True,
+        profile_start_step: Optional[int] = None,
+        profile_num_steps: int = 3,
+        profile_on_signal: bool = False
+    ):
+        self.output_dir = output_dir
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.profile_start_step = profile_start_step
+        self.profile_num_steps = profile_num_steps
+        self.profile_on_signal = profile_on_signal
+        
+        self.steps: List[Dict[str, float]] = []
+        self.traces: List[str] = []
+        self._current: Dict[str, float] = defaultdict(float)
+        self._since_log: List[Dict[str, float]] = []
+        self._last_step_end: Optional[float] = None
+        self._optimizer_start: Optional[float] = None
+        self._profiler = None
+        self._profile_first_step = 0
+        self._signal_requested = False
+        self._steps_file = None
+    
+    def attach(self, trainer):
+        """Install the timers on ``trainer`` and register this callback"""
+        get_train_dataloader = trainer.get_train_dataloader
+        trainer.get_train_dataloader = lambda: TimedDataLoader(get_train_dataloader(), self._record_fetch)
+        
+        prepare_inputs = trainer._prepare_inputs
+        compute_loss = trainer.compute_loss
+        backward = trainer.accelerator.backward
+        
+        def timed_prepare_inputs(*args, **kwargs):
+            with self.section("h2d", enabled=trainer.model.training):
+                return prepare_inputs(*args, **kwargs)
+        
+        def timed_compute_loss(model, *args, **kwargs):
+            # Evaluation also runs compute_loss; only training steps are timed
+            with self.section("forward", enabled=model.training):
+                return compute_loss(model, *args, **kwargs)
+        
+        def timed_backward(*args, **kwargs):
+            with self.section("backward"):
+                return backward(*args, **kwargs)
+        
+        trainer._prepare_inputs = timed_prepare_inputs
+        trainer.compute_loss = timed_compute_loss
+        trainer.accelerator.backward = timed_backward
+        
+        # Ahead of the reporting callbacks so the timings reach wandb and the console
+        trainer.callback_handler.callbacks.insert(0, self)
+        
+        if self.profile_on_signal:
+            try:
+                signal.signal(signal.SIGUSR1, self._request_profile)
+                logger.info(f"Send SIGUSR1 to process {os.getpid()} to profile the next {self.profile_num_steps} steps")
+            except ValueError:
+                logger.warning("Profiling on SIGUSR1 needs the profiler to be attached from the main thread")
+    
+    def _request_profile(self, signum, frame):
+        self._signal_requested = True
+    
+    def _sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+    
+    @contextmanager
+    def section(self, name: str, enabled: bool = True):
+        """Add the wall time of the enclosed block to ``name`` for the current step"""
+        if not enabled:
+            yield
+            return
+        self._sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self._current[name] += time.perf_counter() - start
+    
+    def _record_fetch(self, batch, seconds: float):
+        self._current["dataloader"] += seconds
+    
+    def on_train_begin(self, args, state, control, **kwargs):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._steps_file = open(os.path.join(self.output_dir, f"steps_rank{_rank()}.jsonl"), "a", encoding="utf-8")
+        self._sync()
+        self._last_step_end = time.perf_counter()
+    
+    def on_step_begin(self, args, state, control, **kwargs):
+        if self._profiler is not None:
+            return
+        next_step = state.global_step + 1
+        if self._signal_requested or next_step == self.profile_start_step:
+            self._signal_requested = False
+            self._start_profiler(next_step)
+    
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._sync()
+        self._optimizer_start = time.perf_counter()
+    
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        if self._optimizer_start is not None:
+            self._sync()
+            self._current["optimizer"] += time.perf_counter() - self._optimizer_start
+            self._optimizer_start = None
+    
+    def on_step_end(self, args, state, control, **kwargs):
+        self._sync()
+        now = time.perf_counter()
+        total = now - self._last_step_end
+        self._last_step_end = now
+        
+        record = {"step": state.global_step, "step_ms": total * 1000}
+        for name in SECTIONS:
+            record[f"{name}_ms"] = self._current.get(name, 0.0) * 1000
+        record["other_ms"] = max(0.0, record["step_ms"] - sum(record[f"{name}_ms"] for name in SECTIONS))
+        self._current = defaultdict(float)
+        
+        self.steps.append(record)
+        self._since_log.append(record)
+        if self._steps_file is not None:
+            self._steps_file.write(json.dumps(record) + "\n")
+            self._steps_file.flush()
+        
+        if self._profiler is not None:
+            if state.global_step - self._profile_first_step + 1 >= self.profile_num_steps:
+                self._stop_profiler(state.global_step)
+    
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if logs is None or not self._since_log or "loss" not in logs:
+            return
+        for key in ["step_ms", "other_ms"] + [f"{name}_ms" for name in SECTIONS]:
+            logs[f"time/{key}"] = round(sum(record[key] for record in self._since_log) / len(self._since_log), 3)
+        self._since_log = []
+    
+    def on_train_end(self, args, state, control, **kwargs):
+        if self._profiler is not None:
+            self._stop_profiler(state.global_step)
+        if self._steps_file is not None:
+            self._steps_file.close()
+            self._steps_file = None
+        
+        path = os.path.join(self.output_dir, f"summary_rank{_rank()}.json")
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        logger.info(f"Step timing summary written to {path}")
+    
+    def _start_profiler(self, step: int):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self._profiler.start()
+        self._profile_first_step = step
+        logger.info(f"Profiling steps {step}-{step + self.profile_num_steps - 1}")
+    
+    def _stop_profiler(self, step: int):
+        profiler, self._profiler = self._profiler, None
+        profiler.stop()
+        
+        name = f"steps{self._profile_first_step}-{step}_rank{_rank()}"
+        trace_path = os.path.join(self.output_dir, f"trace_{name}.json")
+        profiler.export_chrome_trace(trace_path)
+        self.traces.append(trace_path)
+        
+        device_attr = "self_device_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        events = sorted(profiler.key_averages(), key=lambda event: getattr(event, device_attr, 0), reverse=True)
+        operators = [
+            {
+                "name": event.key,
+                "count": event.count,
+                "self_cpu_time_us": event.self_cpu_time_total,
+                "cpu_time_us": event.cpu_time_total,
+                "self_device_time_us": getattr(event, "self_device_time_total", 0),
+                "self_cpu_memory_bytes": event.self_cpu_memory_usage,
+            }
+            for event in events[:50]
+        ]
+        with open(os.path.join(self.output_dir, f"operators_{name}.json"), "w") as f:
+            json.dump(operators, f, indent=2)
+        logger.info(f"Chrome trace written to {trace_path}")
+    
+    def summary(self) -> Dict[str, Any]:
+        summary = {
+            "steps": len(self.steps),
+            "step_ms": percentiles([record["step_ms"] for record in self.steps]),
+            "traces": self.traces,
+        }
+        total = sum(record["step_ms"] for record in self.steps) or 1.0
+        for key in [f"{name}_ms" for name in SECTIONS] + ["other_ms"]:
+            values = [record[key] for record in self.steps]
+            summary[key] = percentiles(values)
+            summary[key.replace("_ms", "_fraction")] = sum(values) / total
+        return summary
@@ -0,0 +1,426 @@
+"""
+Weight-only quantization of the GPT-OSS base model for QLoRA fine-tuning.
+
+Two backends load the frozen base weights in int8 or 4-bit while the LoRA
+adapters train in full precision:
+
+- ``bitsandbytes`` quantizes the model's nn.Linear layers while it is loaded
+  through transformers' BitsAndBytesConfig. It needs CUDA and the
+  bitsandbytes package, and leaves the 3-D mixture-of-experts weights of
+  GPT-OSS in the load dtype.
+- ``reference`` is plain PyTorch and runs anywhere, including on CPU. It
+  replaces nn.Linear layers with QuantLinear and wraps mixture-of-experts
+  blocks in QuantExperts after loading. Weights are dequantized to the compute
+  dtype on every forward, one layer (or one GPT-OSS expert) at a time, so it
+  trades speed for memory. Autograd keeps only the quantized weights: the
+  backward pass dequantizes them again instead of holding full-precision
+  copies for every layer until then.
+
+Weights are quantized in blocks of ``block_size`` values that share an absmax
+scale. ``int8`` stores each value as a signed byte. ``nf4`` (the NormalFloat
+codebook of QLoRA) and ``fp4`` (E2M1) store two 4-bit codebook indices per
+byte; double quantization additionally stores their block scales as int8 with
+one float scale per 256 blocks.
+"""
+
+import logging
+import importlib.util
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+logger = logging.getLogger(__name__)
+
+QUANT_FORMATS = ("int8", "nf4", "fp4")
+QUANT_BACKENDS = ("auto", "bitsandbytes", "reference")
+
+# Normalized NormalFloat4 levels, as used by bitsandbytes
+NF4_CODE = [
+    -1.0, -0.6961928009986877, -0.5250730514526367, -0.39491748809814453,
+    -0.28444138169288635, -0.18477343022823334, -0.09105003625154495, 0.0,
+    0.07958029955625534, 0.16093020141124725, 0.24611230194568634, 0.33791524171829224,
+    0.44070982933044434, 0.5626170039176941, 0.7229568362236023, 1.0,
+]
+# E2M1 magnitudes {0, 0.5, 1, 1.5, 2, 3, 4, 6} scaled to [-1, 1]
+FP4_CODE = sorted({sign * value / 6 for sign in (-1, 1) for value in (0, 0.5, 1, 1.5, 2, 3, 4, 6)})
+
+# Block scales of 4-bit weights are double-quantized in groups of this many
+SCALE_BLOCK_SIZE = 256
+# Elements quantized at a time, bounds the float32 temporaries for large tensors
+CHUNK_ELEMENTS = 1 << 24
+
+
+def resolve_backend(backend: str) -> str:
+    """Pick bitsandbytes when it can run here, the reference kernels otherwise"""
+    if backend not in QUANT_BACKENDS:
+        raise ValueError(f"Unknown quantization backend {backend!r}, expected one of {QUANT_BACKENDS}")
+    if backend == "auto":
+        has_bitsandbytes = importlib.util.find_spec("bitsandbytes") is not None
+        return "bitsandbytes" if has_bitsandbytes and torch.cuda.is_available() else "reference"
+    return backend
+
+
+def bitsandbytes_config(
+    quantization: str,
+    compute_dtype: torch.dtype,
+    double_quant: bool = True,
+    skip_modules: Optional[Iterable[str]] = None
+):
+    """BitsAndBytesConfig for loading the base model with ``from_pretrained``"""
+    from transformers import BitsAndBytesConfig
+    
+    if quantization not in QUANT_FORMATS:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANT_FORMATS}")
+    skip = {"llm_int8_skip_modules": list(skip_modules)} if skip_modules else {}
+    if quantization == "int8":
+        return BitsAndBytesConfig(load_in_8bit=True, **skip)
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type=quantization,
+        bnb_4bit_compute_dtype=compute_dtype,
+        bnb_4bit_use_double_quant=double_quant,
+        **skip
+    )
+
+
+def quantized_bytes_per_element(quantization: str, block_size: int = 64, double_quant: bool = True) -> float:
+    """Storage per weight, including block scales, of a quantized tensor"""
+    if quantization == "int8":
+        return 1 + 4 / block_size
+    if double_quant:
+        return 0.5 + 1 / block_size + 4 / (block_size * SCALE_BLOCK_SIZE)
+    return 0.5 + 4 / block_size
+
+
+def _int8_blocks(values: torch.Tensor, block_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric absmax int8 quantization of a flat float tensor; returns (codes, per-block absmax)"""
+    pad = (-values.numel()) % block_size
+    blocks = F.pad(values, (0, pad)).view(-1, block_size)
+    absmax = blocks.abs().amax(dim=1)
+    codes = torch.round(blocks / absmax.clamp_min(1e-12)[:, None] * 127).to(torch.int8)
+    return codes.view(-1), absmax
+
+
+class QuantizedTensor(nn.Module):
+    """Blockwise quantized copy of a floating point tensor
+    
+    The codes and scales are buffers, so the tensor follows the module it
+    belongs to across ``.to()`` calls and into its state dict.
+    """
+    
+    def __init__(self, tensor: torch.Tensor, quantization: str, block_size: int = 64, double_quant: bool = False):
+        super().__init__()
+        if quantization not in QUANT_FORMATS:
+            raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANT_FORMATS}")
+        if block_size % 2:
+            raise ValueError("block_size must be even to pack two 4-bit codes per byte")
+        self.shape = tuple(tensor.shape)
+        self.quantization = quantization
+        self.block_size = block_size
+        self.double_quant = double_quant and quantization != "int8"
+        
+        if quantization != "int8":
+            code = torch.tensor(NF4_CODE if quantization == "nf4" else FP4_CODE, device=tensor.device)
+            self.register_buffer("code", code, persistent=False)
+            midpoints = (code[1:] + code[:-1]) / 2
+        
+        flat = tensor.detach().reshape(-1)
+        chunk = CHUNK_ELEMENTS - CHUNK_ELEMENTS % block_size
+        all_codes, all_absmax = [], []
+        for start in range(0, flat.numel(), chunk):
+            values = flat[start:start + chunk].float()
+            if quantization == "int8":
+                codes, absmax = _int8_blocks(values, block_size)
+            else:
+                pad = (-values.numel()) % block_size
+                blocks = F.pad(values, (0, pad)).view(-1, block_size)
+                absmax = blocks.abs().amax(dim=1)
+                index = torch.bucketize(blocks / absmax.clamp_min(1e-12)[:, None], midpoints).to(torch.uint8).view(-1)
+                codes = (index[0::2] << 4) | index[1::2]
+            all_codes.append(codes)
+            all_absmax.append(absmax)
+        self.register_buffer("codes", torch.cat(all_codes))
+        
+        absmax = torch.cat(all_absmax)
+        if self.double_quant:
+            offset = absmax.mean()
+            absmax_codes, absmax_scale = _int8_blocks(absmax - offset, SCALE_BLOCK_SIZE)
+            self.register_buffer("absmax_codes", absmax_codes)
+            self.register_buffer("absmax_scale", absmax_scale)
+            self.register_buffer("absmax_offset", offset)
+        else:
+            self.register_buffer("absmax", absmax)
+    
+    @property
+    def device(self) -> torch.device:
+        return self.codes.device
+    
+    @property
+    def dtype(self) -> torch.dtype:
+        return self.codes.dtype
+    
+    def numel(self) -> int:
+        numel = 1
+        for size in self.shape:
+            numel *= size
+        return numel
+    
+    def nbytes(self) -> int:
+        return sum(buffer.numel() * buffer.element_size() for buffer in self.buffers())
+    
+    def _block_absmax(self, start: int, end: int) -> torch.Tensor:
+        """Scales of blocks ``start`` to ``end``"""
+        if not self.double_quant:
+            return self.absmax[start:end]
+        groups = torch.arange(start, end, device=self.codes.device) // SCALE_BLOCK_SIZE
+        return self.absmax_codes[start:end].float() * (self.absmax_scale[groups] / 127) + self.absmax_offset
+    
+    def dequantize(self, dtype: torch.dtype = torch.float32, index: Optional[int] = None) -> torch.Tensor:
+        """Full tensor in ``dtype``, or only ``tensor[index]``
+        
+        A slice along the first dimension only decodes its own blocks when it
+        starts on a block boundary, e.g. one expert of a stacked expert weight.
+        """
+        shape, numel, start = self.shape, self.numel(), 0
+        if index is not None:
+            shape = self.shape[1:]
+            numel //= self.shape[0]
+            start = index * numel
+            if start % self.block_size:
+                return self.dequantize(dtype)[index]
+        first, num_blocks = start // self.block_size, -(-numel // self.block_size)
+        absmax = self._block_absmax(first, first + num_blocks)
+        values_per_byte = 1 if self.quantization == "int8" else 2
+        codes = self.codes[first * self.block_size // values_per_byte:(first + num_blocks) * self.block_size // values_per_byte]
+        if self.quantization == "int8":
+            values = codes.view(-1, self.block_size).to(dtype) * (absmax[:, None] / 127).to(dtype)
+        else:
+            nibbles = torch.stack((codes >> 4, codes & 0xF), dim=1).view(-1, self.block_size)
+            values = self.code.to(dtype)[nibbles.long()] * absmax[:, None].to(dtype)
+        return values.view(-1)[:numel].view(shape)
+    
+    def extra_repr(self) -> str:
+        return f"shape={self.shape}, quantization={self.quantization}, block_size={self.block_size}, double_quant={self.double_quant}"
+
+
+class _QuantizedMatmul(torch.autograd.Function):
+    """``x @ W`` (or ``x @ W.T``) for a quantized ``W``, dequantized again for the backward pass instead of saved"""
+    
+    @staticmethod
+    def forward(ctx, x: torch.Tensor, quantized: QuantizedTensor, index: Optional[int], transpose: bool) -> torch.Tensor:
+        ctx.quantized, ctx.index, ctx.transpose = quantized, index, transpose
+        weight = quantized.dequantize(x.dtype, index)
+        return x @ (weight.T if transpose else weight)
+    
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        weight = ctx.quantized.dequantize(grad_output.dtype, ctx.index)
+        return grad_output @ (weight if ctx.transpose else weight.T), None, None, None
+
+
+def quantized_matmul(x: torch.Tensor, quantized: QuantizedTensor, index: Optional[int] = None, transpose: bool = False) -> torch.Tensor:
+    """``x @ quantized[index]`` (``.T`` with ``transpose``) in the dtype of ``x``; only the quantized weight is kept for backward"""
+    return _QuantizedMatmul.apply(x, quantized, index, transpose)
+
+
+def is_gptoss_experts(module: nn.Module) -> bool:
+    """Whether ``module`` computes like transformers' GptOssExperts (GLU experts with biases, alpha and limit)"""
+    return all(hasattr(module, name) for name in ("gate_up_proj_bias", "down_proj_bias", "alpha", "limit"))
+
+
+def gptoss_experts_forward(
+    experts: nn.Module,
+    hidden_states: torch.Tensor,
+    router_indices: torch.Tensor,
+    routing_weights: torch.Tensor,
+    project: Callable[[torch.Tensor, str, int, torch.Tensor], torch.Tensor]
+) -> torch.Tensor:
+    """GptOssExperts' per-expert loop with the weights supplied by ``project``
+    
+    ``project(x, name, expert, token_idx)`` returns ``x @ W[expert]`` for the
+    ``gate_up_proj`` and ``down_proj`` weights, where ``token_idx`` are the
+    flat token positions of the rows of ``x``. Only experts that receive
+    tokens run, so no projection needs more than one expert's weight.
+    """
+    batch_size, hidden_size = hidden_states.shape[0], hidden_states.shape[-1]
+    hidden_states = hidden_states.reshape(-1, hidden_size)
+    next_states = torch.zeros_like(hidden_states)
+    with torch.no_grad():
+        expert_mask = F.one_hot(router_indices, num_classes=routing_weights.shape[1]).permute(2, 1, 0)
+        expert_hit = torch.greater(expert_mask.sum(dim=(-1, -2)), 0).nonzero().flatten().tolist()
+    for expert in expert_hit:
+        with torch.no_grad():
+            _, token_idx = torch.where(expert_mask[expert])
+        gate_up = project(hidden_states[token_idx], "gate_up_proj", expert, token_idx) + experts.gate_up_proj_bias[expert]
+        gate, up = gate_up[..., ::2], gate_up[..., 1::2]
+        gate = gate.clamp(min=None, max=experts.limit)
+        up = up.clamp(min=-experts.limit, max=experts.limit)
+        glu = gate * torch.sigmoid(gate * experts.alpha)
+        out = project((up + 1) * glu, "down_proj", expert, token_idx) + experts.down_proj_bias[expert]
+        next_states.index_add_(0, token_idx, (out * routing_weights[token_idx, expert, None]).to(hidden_states.dtype))
+    return next_states.view(batch_size, -1, hidden_size)
+
+
+class QuantLinear(nn.Linear):
+    """nn.Linear with a quantized, frozen weight that is dequantized on every forward
+    
+    It stays an nn.Linear so PEFT wraps it like any other linear layer; the
+    quantized weight is exposed as ``qweight`` and ``weight`` is None.
+    """
+    
+    def __init__(self, linear: nn.Linear, quantization: str, compute_dtype: torch.dtype, block_size: int = 64, double_quant: bool = False):
+        nn.Module.__init__(self)
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        self.compute_dtype = compute_dtype
+        self.qweight = QuantizedTensor(linear.weight, quantization, block_size, double_quant)
+        self.register_parameter("weight", None)
+        self.bias = linear.bias
+    
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        output = quantized_matmul(x.to(self.compute_dtype), self.qweight, transpose=True)
+        if self.bias is not None:
+            output = output + self.bias.to(self.compute_dtype)
+        return output.to(x.dtype)
+    
+    def dequantized(self) -> nn.Linear:
+        """Plain nn.Linear with the dequantized weight"""
+        linear = nn.Linear(self.in_features, self.out_features, bias=self.bias is not None, device="meta")
+        linear.weight = nn.Parameter(self.qweight.dequantize(self.compute_dtype), requires_grad=False)
+        linear.bias = self.bias
+        return linear
+
+
+class QuantExperts(nn.Module):
+    """Quantized storage for the 3-D expert weights of a mixture-of-experts block
+    
+    GPT-OSS expert blocks run their per-expert loop here, dequantizing one
+    expert's weight per projection. Other modules run unchanged with all
+    expert weights dequantized to the activation dtype, recomputed in the
+    backward pass so the dequantized weights are not kept until then. Biases
+    and other small parameters stay in place. The quantized tensors are
+    registered as ``quantized_<name>`` so LoRA target names never match them.
+    """
+    
+    def __init__(self, experts: nn.Module, quantization: str, block_size: int = 64, double_quant: bool = False):
+        super().__init__()
+        self.experts = experts
+        self.quantized = nn.ModuleDict()
+        for name, param in list(experts.named_parameters(recurse=False)):
+            if param.dim() >= 3:
+                self.quantized[f"quantized_{name}"] = QuantizedTensor(param, quantization, block_size, double_quant)
+                delattr(experts, name)
+    
+    def project(self, x: torch.Tensor, name: str, expert: int, token_idx: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """``x @ W[expert]`` for expert weight ``name``"""
+        return quantized_matmul(x, self.quantized[f"quantized_{name}"], index=expert)
+    
+    def forward(self, hidden_states: torch.Tensor, *args, **kwargs):
+        if is_gptoss_experts(self.experts):
+            routing = dict(zip(("router_indices", "routing_weights"), args), **kwargs)
+            return gptoss_experts_forward(self.experts, hidden_states, routing["router_indices"], routing["routing_weights"], self.project)
+        if torch.is_grad_enabled():
+            return checkpoint(self._dequantized_call, hidden_states, *args, use_reentrant=False, **kwargs)
+        return self._dequantized_call(hidden_states, *args, **kwargs)
+    
+    def _dequantized_call(self, hidden_states: torch.Tensor, *args, **kwargs):
+        weights = {
+            key[len("quantized_"):]: quantized.dequantize(hidden_states.dtype)
+            for key, quantized in self.quantized.items()
+        }
+        return torch.func.functional_call(self.experts, weights, (hidden_states,) + args, kwargs, strict=False)
+    
+    def dequantized(self) -> nn.Module:
+        """The wrapped module with its expert weights restored as parameters"""
+        dtype = next(self.experts.parameters(), torch.empty(0)).dtype
+        for key, quantized in self.quantized.items():
+            self.experts.register_parameter(key[len("quantized_"):], nn.Parameter(quantized.dequantize(dtype), requires_grad=False))
+        return self.experts
+
+
+def _has_expert_weights(module: nn.Module) -> bool:
+    return any(param.dim() >= 3 for param in module.parameters(recurse=False))
+
+
+def _skipped(name: str, skip_modules: Iterable[str]) -> bool:
+    return any(name == skip or name.endswith("." + skip) for skip in skip_modules)
+
+
+def weight_memory(model: nn.Module, dtype: torch.dtype) -> Tuple[int, int]:
+    """(bytes now, bytes with every quantized weight stored in ``dtype``) of a model's parameters and buffers"""
+    element_size = torch.empty(0, dtype=dtype).element_size()
+    current = full = 0
+    for module in model.modules():
+        if isinstance(module, QuantizedTensor):
+            current += module.nbytes()
+            full += module.numel() * element_size
+            continue
+        bnb_weight = type(module).__name__ in ("Linear4bit", "Linear8bitLt")
+        for name, tensor in list(module.named_parameters(recurse=False)) + list(module.named_buffers(recurse=False)):
+            size = tensor.numel() * tensor.element_size()
+            current += size
+            full += module.in_features * module.out_features * element_size if bnb_weight and name == "weight" else size
+    return current, full
+
+
+def quantize_model(
+    model: nn.Module,
+    quantization: str,
+    compute_dtype: torch.dtype,
+    block_size: int = 64,
+    double_quant: bool = True,
+    skip_modules: Iterable[str] = ("lm_head",)
+) -> Dict[str, Any]:
+    """Quantize the linear layers and expert weights of ``model`` in place with the reference kernels
+    
+    Modules whose name is, or ends with, one of ``skip_modules`` keep their
+    precision. Returns the number of quantized modules and the weight memory
+    before and after.
+    """
+    skip_modules = list(skip_modules)
+    before, _ = weight_memory(model, compute_dtype)
+    
+    num_linear = num_experts = 0
+    for parent_name, parent in list(model.named_modules()):
+        for name, child in list(parent.named_children()):
+            full_name = f"{parent_name}.{name}" if parent_name else name
+            if _skipped(full_name, skip_modules) or isinstance(child, (QuantLinear, QuantExperts)):
+                continue
+            if type(child) is nn.Linear:
+                setattr(parent, name, QuantLinear(child, quantization, compute_dtype, block_size, double_quant))
+                num_linear += 1
+            elif _has_expert_weights(child):
+                setattr(parent, name, QuantExperts(child, quantization, block_size, double_quant))
+                num_experts += 1
+    
+    after, _ = weight_memory(model, compute_dtype)
+    return {
+        "backend": "reference",
+        "quantization": quantization,
+        "double_quant": double_quant and quantization != "int8",
+        "linear_layers": num_linear,
+        "expert_blocks": num_experts,
+        "bytes_before": before,
+        "bytes_after": after,
+    }
+
+
+def dequantize_model(model: nn.Module) -> int:
+    """Replace QuantLinear and QuantExperts modules with full-precision ones; returns how many"""
+    count = 0
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, (QuantLinear, QuantExperts)):
+                setattr(parent, name, child.dequantized())
+                count += 1
+    return count
+
+
+def is_quantized(model: nn.Module) -> bool:
+    """Whether the weights of ``model`` are quantized by either backend"""
+    if getattr(model, "is_loaded_in_8bit", False) or getattr(model, "is_loaded_in_4bit", False):
+        return True
+    return any(isinstance(module, (QuantLinear, QuantExperts)) for module in model.modules())
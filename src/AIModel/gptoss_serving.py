@@ -0,0 +1,684 @@
+"""
+Continuous-batching inference server for GPT-OSS fine-tunes.
+
+Requests are queued and decoded together by a single engine thread that owns
+the model. New prompts are prefilled and join the running decode batch as soon
+as there is room, and finished sequences leave it immediately, so short
+requests never wait for long ones to drain. Every response reports its own
+queue time, time to first token, latency and decode throughput.
+
+Usage:
+    python gptoss_serving.py serve --load_model ./gpt-oss-120b-finetuned --port 8000
+    python GptRoss.py serve --load_model ./gpt-oss-120b-finetuned --port 8000  # same
+    python gptoss_serving.py loadgen --url http://127.0.0.1:8000 --num_requests 200 --concurrency 16
+"""
+
+import sys
+import json
+import time
+import uuid
+import queue
+import logging
+import argparse
+import threading
+import traceback
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Any
+
+import torch
+
+from gptoss_finetune import ModelConfig, LoRAConfig, TrainingConfig, GPTOSSFineTuner
+from gptoss_inference import (
+    LegacyCache,
+    cache_to_legacy,
+    cache_from_legacy,
+    empty_cache,
+    cache_length,
+    left_pad_cache,
+    concat_caches,
+    select_cache_rows,
+    trim_cache_left,
+    sample_next_tokens,
+)
+from gptoss_profiling import percentiles
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GenerationRequest:
+    """A single generation request submitted to the engine"""
+    prompt: str
+    max_new_tokens: int = 256
+    temperature: float = 0.7
+    top_p: float = 0.9
+    do_sample: bool = True
+    reasoning_level: str = "medium"
+    system_prompt: Optional[str] = None
+    adapter: Optional[str] = None  # registered LoRA adapter, None for the model's active one
+    request_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+
+
+@dataclass
+class GenerationResult:
+    """Generated text plus per-request latency and throughput metrics"""
+    request_id: str
+    text: str
+    finish_reason: str
+    prompt_tokens: int
+    completion_tokens: int
+    queue_ms: float
+    ttft_ms: float
+    latency_ms: float
+    tokens_per_s: float
+
+
+class _ActiveSequence:
+    """Bookkeeping for a request that is currently in the decode batch"""
+    
+    def __init__(self, request: GenerationRequest, future: Future, submitted_at: float):
+        self.request = request
+        self.future = future
+        self.submitted_at = submitted_at
+        self.started_at = 0.0
+        self.first_token_at = 0.0
+        self.prompt_tokens = 0
+        self.adapter: Optional[str] = None
+        self.generated: List[int] = []
+    
+    def finish_reason(self, eos_token_id: Optional[int]) -> Optional[str]:
+        if self.generated and eos_token_id is not None and self.generated[-1] == eos_token_id:
+            return "stop"
+        if len(self.generated) >= self.request.max_new_tokens:
+            return "length"
+        return None
+
+
+class ContinuousBatchingEngine:
+    """Iteration-level scheduler that runs one shared KV-cached decode batch
+    
+    The batch cache is kept left-aligned: rows are left-padded to a common
+    length, new rows are padded (or the batch is) when they join, and columns
+    that are padding in every remaining row are trimmed when rows leave.
+    
+    When the fine-tuner has an adapter registry, every row runs through the
+    LoRA adapter its request names, so one batch can mix fine-tunes.
+    """
+    
+    def __init__(
+        self,
+        fine_tuner: GPTOSSFineTuner,
+        max_batch_size: int = 16,
+        poll_interval: float = 0.01
+    ):
+        if fine_tuner.model is None or fine_tuner.tokenizer is None:
+            raise ValueError("Model and tokenizer must be loaded first")
+        
+        self.fine_tuner = fine_tuner
+        self.tokenizer = fine_tuner.tokenizer
+        self.device = fine_tuner.device
+        self.max_batch_size = max_batch_size
+        self.poll_interval = poll_interval
+        
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._active: List[_ActiveSequence] = []
+        self._cache: LegacyCache = []
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._next_tokens: Optional[torch.Tensor] = None
+        
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self._stats = {"completed": 0, "failed": 0, "completion_tokens": 0, "decode_steps": 0, "batch_rows": 0}
+        self._started = time.time()
+    
+    @property
+    def model(self):
+        # Loading the first adapter wraps the fine-tuner's model, so never hold on to it
+        return self.fine_tuner.model
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="gptoss-engine", daemon=True)
+        self._thread.start()
+        logger.info(f"Continuous batching engine started (max batch size {self.max_batch_size})")
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+    
+    def submit(self, request: GenerationRequest) -> Future:
+        """Queue a request; the returned future resolves to a GenerationResult"""
+        future: Future = Future()
+        self._queue.put((request, future, time.perf_counter()))
+        return future
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        elapsed = time.time() - self._started
+        stats.update({
+            "uptime_s": elapsed,
+            "active": len(self._active),
+            "queued": self._queue.qsize(),
+            "completion_tokens_per_s": stats["completion_tokens"] / max(elapsed, 1e-9),
+            "mean_batch_size": stats["batch_rows"] / max(stats["decode_steps"], 1),
+        })
+        if self.fine_tuner.prefix_cache is not None:
+            stats["prefix_cache"] = self.fine_tuner.prefix_cache.stats()
+        if self.fine_tuner.adapters is not None:
+            stats["adapters"] = self.fine_tuner.adapters.stats()
+        return stats
+    
+    def _run(self):
+        with torch.inference_mode():
+            while not self._stop.is_set():
+                try:
+                    self._admit()
+                    if self._active:
+                        self._decode_step()
+                except Exception as e:
+                    logger.error(f"Engine step failed: {e}")
+                    traceback.print_exc()
+                    self._fail_all(e)
+    
+    def _admit(self):
+        """Move queued requests into the batch while there is room"""
+        entries = []
+        while len(self._active) + len(entries) < self.max_batch_size:
+            # Only block when there is nothing else to do
+            block = not self._active and not entries
+            try:
+                entries.append(self._queue.get(block=block, timeout=self.poll_interval if block else None))
+            except queue.Empty:
+                break
+        
+        if entries:
+            self._prefill(entries)
+    
+    def _prefill(self, entries: List[tuple]):
+        """Run the prompts of newly admitted requests and merge them into the batch"""
+        sequences = []
+        prompt_ids = []
+        cacheable_prefixes = []
+        max_length = self.fine_tuner.training_config.max_length
+        for request, future, submitted_at in entries:
+            if not future.set_running_or_notify_cancel():
+                continue
+            sequence = _ActiveSequence(request, future, submitted_at)
+            sequence.started_at = time.perf_counter()
+            try:
+                sequence.adapter = self._acquire_adapter(request.adapter)
+            except (KeyError, ValueError) as e:
+                future.set_exception(e)
+                with self._stats_lock:
+                    self._stats["failed"] += 1
+                continue
+            try:
+                prefix_ids, suffix_ids = self.fine_tuner._tokenize_with_prefix(
+                    request.prompt, request.reasoning_level, request.system_prompt
+                )
+            except Exception as e:
+                # The entry is already off the queue; fail it here or its client waits forever
+                self._release_adapter(sequence)
+                future.set_exception(e)
+                with self._stats_lock:
+                    self._stats["failed"] += 1
+                continue
+            ids = (prefix_ids + suffix_ids)[:max_length]
+            cacheable = suffix_ids and len(prefix_ids) + len(suffix_ids) <= max_length
+            cacheable_prefixes.append(prefix_ids if cacheable else None)
+            sequence.prompt_tokens = len(ids)
+            sequences.append(sequence)
+            prompt_ids.append(ids)
+        
+        if not sequences:
+            return
+        
+        try:
+            self._prefill_rows(sequences, prompt_ids, cacheable_prefixes)
+        except Exception as e:
+            # Rows that never joined the batch would otherwise be left hanging
+            for sequence in sequences:
+                if sequence not in self._active:
+                    self._release_adapter(sequence)
+                    if not sequence.future.done():
+                        sequence.future.set_exception(e)
+            raise
+    
+    def _prefill_rows(self, sequences: List[_ActiveSequence], prompt_ids: List[List[int]], prefixes: List[Optional[List[int]]]):
+        prefix_caches = []
+        for sequence, prefix_ids in zip(sequences, prefixes):
+            if self.fine_tuner.prefix_cache is None or prefix_ids is None:
+                prefix_caches.append(None)
+                continue
+            prefix_caches.append(self.fine_tuner.prefix_cache.get(
+                self.model,
+                prefix_ids,
+                self.device,
+                namespace=self.fine_tuner._prefix_cache_namespace(sequence.adapter),
+                **self._adapter_kwargs([sequence])
+            ))
+        
+        # Rows are right-aligned with no gaps: the model reads the last ``input_len``
+        # tokens of every prompt and takes whatever precedes them from the cached
+        # preamble. A row whose uncached part is shorter than ``input_len`` re-reads
+        # the tail of its preamble instead of leaving padding between the two.
+        input_len = max(
+            len(ids) - (cache_length(cached) if cached is not None else 0)
+            for ids, cached in zip(prompt_ids, prefix_caches)
+        )
+        cached_lens = [max(0, len(ids) - input_len) for ids in prompt_ids]
+        past_len = max(cached_lens)
+        
+        past = []
+        if past_len:
+            # Rows without a cached preamble contribute empty slices (cached_len is 0 for them)
+            template = next(cached for cached in prefix_caches if cached is not None)
+            rows = [
+                left_pad_cache(
+                    [(key[:, :, :cached_len], value[:, :, :cached_len]) for key, value in (cached or template)],
+                    past_len - cached_len
+                )
+                for cached, cached_len in zip(prefix_caches, cached_lens)
+            ]
+            past = [
+                (torch.cat([row[layer][0] for row in rows]), torch.cat([row[layer][1] for row in rows]))
+                for layer in range(len(template))
+            ]
+        
+        # Left-pad the uncached prompt tails to a common length
+        pad_id = self.tokenizer.pad_token_id
+        input_ids = torch.full((len(prompt_ids), input_len), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompt_ids), past_len + input_len), dtype=torch.long)
+        for i, (ids, cached_len) in enumerate(zip(prompt_ids, cached_lens)):
+            tail = ids[cached_len:]
+            input_ids[i, input_len - len(tail):] = torch.tensor(tail, dtype=torch.long)
+            attention_mask[i, past_len + input_len - len(ids):] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, past_len:]
+        
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache_from_legacy(past) if past_len else empty_cache(),
+            use_cache=True,
+            **self._adapter_kwargs(sequences)
+        )
+        next_tokens = self._sample(outputs.logits[:, -1, :], sequences)
+        
+        now = time.perf_counter()
+        for sequence, token in zip(sequences, next_tokens.tolist()):
+            sequence.first_token_at = now
+            sequence.generated.append(token)
+        
+        self._merge(cache_to_legacy(outputs.past_key_values), attention_mask, next_tokens, sequences)
+        self._retire()
+    
+    def _merge(self, cache: LegacyCache, attention_mask: torch.Tensor, next_tokens: torch.Tensor, sequences: List[_ActiveSequence]):
+        """Append freshly prefilled rows to the running batch"""
+        if not self._active:
+            self._cache = cache
+            self._attention_mask = attention_mask
+            self._next_tokens = next_tokens
+            self._active = sequences
+            return
+        
+        current_len = self._attention_mask.shape[1]
+        new_len = attention_mask.shape[1]
+        self._cache = concat_caches(self._cache, cache)
+        self._attention_mask = torch.cat([
+            torch.nn.functional.pad(self._attention_mask, (max(0, new_len - current_len), 0)),
+            torch.nn.functional.pad(attention_mask, (max(0, current_len - new_len), 0)),
+        ], dim=0)
+        self._next_tokens = torch.cat([self._next_tokens, next_tokens], dim=0)
+        self._active.extend(sequences)
+    
+    def _decode_step(self):
+        """Decode one token for every active sequence"""
+        batch_size = len(self._active)
+        # Position of the incoming token is the number of real tokens already cached
+        position_ids = self._attention_mask.sum(-1, keepdim=True)
+        attention_mask = torch.cat([
+            self._attention_mask,
+            torch.ones((batch_size, 1), dtype=self._attention_mask.dtype, device=self._attention_mask.device)
+        ], dim=1)
+        
+        outputs = self.model(
+            input_ids=self._next_tokens.unsqueeze(-1),
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache_from_legacy(self._cache),
+            use_cache=True,
+            **self._adapter_kwargs(self._active)
+        )
+        self._cache = cache_to_legacy(outputs.past_key_values)
+        self._attention_mask = attention_mask
+        self._next_tokens = self._sample(outputs.logits[:, -1, :], self._active)
+        
+        for sequence, token in zip(self._active, self._next_tokens.tolist()):
+            sequence.generated.append(token)
+        
+        with self._stats_lock:
+            self._stats["decode_steps"] += 1
+            self._stats["batch_rows"] += batch_size
+        
+        self._retire()
+    
+    def _acquire_adapter(self, adapter: Optional[str]) -> Optional[str]:
+        if self.fine_tuner.adapters is None:
+            if adapter is not None:
+                raise ValueError("No adapters registered")
+            return None
+        return self.fine_tuner.adapters.acquire(adapter)
+    
+    def _release_adapter(self, sequence: _ActiveSequence):
+        if sequence.adapter is not None:
+            self.fine_tuner.adapters.release(sequence.adapter)
+            sequence.adapter = None
+    
+    def _adapter_kwargs(self, sequences: List[_ActiveSequence]) -> Dict[str, Any]:
+        if self.fine_tuner.adapters is None:
+            return {}
+        return self.fine_tuner.adapters.forward_kwargs([sequence.adapter for sequence in sequences])
+    
+    def _sample(self, logits: torch.Tensor, sequences: List[_ActiveSequence]) -> torch.Tensor:
+        device = logits.device
+        temperature = torch.tensor([s.request.temperature for s in sequences], device=device)
+        top_p = torch.tensor([s.request.top_p for s in sequences], device=device)
+        do_sample = torch.tensor([s.request.do_sample for s in sequences], device=device)
+        return sample_next_tokens(logits, temperature, top_p, do_sample)
+    
+    def _retire(self):
+        """Complete finished sequences and drop their rows from the batch"""
+        eos_token_id = self.tokenizer.eos_token_id
+        keep = []
+        for i, sequence in enumerate(self._active):
+            reason = sequence.finish_reason(eos_token_id)
+            if reason is None:
+                keep.append(i)
+            else:
+                self._complete(sequence, reason)
+        
+        if len(keep) == len(self._active):
+            return
+        if not keep:
+            self._reset()
+            return
+        
+        index = torch.tensor(keep, dtype=torch.long, device=self._attention_mask.device)
+        self._cache = select_cache_rows(self._cache, index)
+        self._attention_mask = self._attention_mask.index_select(0, index)
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._active = [self._active[i] for i in keep]
+        
+        # Columns that are padding in every remaining row no longer need to be cached
+        leading = int(self._attention_mask.any(dim=0).int().argmax())
+        if leading > 0:
+            self._cache = trim_cache_left(self._cache, leading)
+            self._attention_mask = self._attention_mask[:, leading:]
+    
+    def _complete(self, sequence: _ActiveSequence, reason: str):
+        finished_at = time.perf_counter()
+        self._release_adapter(sequence)
+        tokens = sequence.generated[:-1] if reason == "stop" else sequence.generated
+        text = self.tokenizer.decode(tokens, skip_special_tokens=True).strip()
+        result = GenerationResult(
+            request_id=sequence.request.request_id,
+            text=text,
+            finish_reason=reason,
+            prompt_tokens=sequence.prompt_tokens,
+            completion_tokens=len(sequence.generated),
+            queue_ms=(sequence.started_at - sequence.submitted_at) * 1000,
+            ttft_ms=(sequence.first_token_at - sequence.submitted_at) * 1000,
+            latency_ms=(finished_at - sequence.submitted_at) * 1000,
+            tokens_per_s=len(sequence.generated) / max(finished_at - sequence.started_at, 1e-9),
+        )
+        with self._stats_lock:
+            self._stats["completed"] += 1
+            self._stats["completion_tokens"] += len(sequence.generated)
+        sequence.future.set_result(result)
+    
+    def _fail_all(self, error: Exception):
+        for sequence in self._active:
+            self._release_adapter(sequence)
+            if not sequence.future.done():
+                sequence.future.set_exception(error)
+        with self._stats_lock:
+            self._stats["failed"] += len(self._active)
+        self._reset()
+    
+    def _reset(self):
+        self._active = []
+        self._cache = []
+        self._attention_mask = None
+        self._next_tokens = None
+
+
+class _GenerationHandler(BaseHTTPRequestHandler):
+    """JSON API: POST /generate, GET /stats, GET /health"""
+    
+    def do_POST(self):
+        if self.path != "/generate":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            defaults = self.server.defaults
+            request = GenerationRequest(
+                prompt=body["prompt"],
+                max_new_tokens=int(body.get("max_new_tokens", defaults["max_new_tokens"])),
+                temperature=float(body.get("temperature", defaults["temperature"])),
+                top_p=float(body.get("top_p", defaults["top_p"])),
+                do_sample=bool(body.get("do_sample", True)),
+                reasoning_level=body.get("reasoning_level", defaults["reasoning_level"]),
+                system_prompt=body.get("system_prompt"),
+                adapter=body.get("adapter"),
+            )
+        except (KeyError, ValueError, json.JSONDecodeError) as e:
+            self._send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        
+        try:
+            result = self.server.engine.submit(request).result(timeout=self.server.request_timeout)
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, asdict(result))
+    
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.server.engine.stats())
+        elif self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+    
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(
+    engine: ContinuousBatchingEngine,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    request_timeout: float = 600.0,
+    defaults: Optional[Dict[str, Any]] = None
+):
+    """Run the HTTP front end until interrupted"""
+    server = ThreadingHTTPServer((host, port), _GenerationHandler)
+    server.daemon_threads = True
+    server.engine = engine
+    server.request_timeout = request_timeout
+    server.defaults = {"max_new_tokens": 256, "temperature": 0.7, "top_p": 0.9, "reasoning_level": "medium"}
+    server.defaults.update(defaults or {})
+    
+    engine.start()
+    logger.info(f"Serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.stop()
+
+
+def run_load_test(
+    url: str,
+    prompts: List[str],
+    num_requests: int = 100,
+    concurrency: int = 8,
+    max_new_tokens: int = 128,
+    temperature: float = 0.7,
+    timeout: float = 600.0
+) -> Dict[str, Any]:
+    """Fire requests at a running server and summarize throughput and latency"""
+    endpoint = url.rstrip("/") + "/generate"
+    
+    def send(i: int) -> Dict[str, Any]:
+        payload = json.dumps({
+            "prompt": prompts[i % len(prompts)],
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+        }).encode("utf-8")
+        request = urllib.request.Request(endpoint, data=payload, headers={"Content-Type": "application/json"})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                result = json.loads(response.read())
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+        result["client_latency_ms"] = (time.perf_counter() - start) * 1000
+        result["ok"] = True
+        return result
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(num_requests)))
+    wall = time.perf_counter() - start
+    
+    succeeded = [r for r in results if r["ok"]]
+    completion_tokens = sum(r["completion_tokens"] for r in succeeded)
+    return {
+        "requests": num_requests,
+        "errors": num_requests - len(succeeded),
+        "concurrency": concurrency,
+        "wall_time_s": wall,
+        "requests_per_s": len(succeeded) / wall,
+        "completion_tokens_per_s": completion_tokens / wall,
+        "latency_ms": percentiles([r["client_latency_ms"] for r in succeeded]),
+        "ttft_ms": percentiles([r["ttft_ms"] for r in succeeded]),
+        "queue_ms": percentiles([r["queue_ms"] for r in succeeded]),
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Serve GPT-OSS models with continuous batching")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    serve_parser = subparsers.add_parser("serve", help="Start the HTTP inference server")
+    serve_parser.add_argument("--model_name", type=str, default="openai/gpt-oss-120b", help="Model name or path")
+    serve_parser.add_argument("--load_model", type=str, help="Load fine-tuned adapters from this path")
+    serve_parser.add_argument("--adapter", action="append", default=[], metavar="NAME=PATH", help="Register a LoRA adapter requests can select by name (repeatable)")
+    serve_parser.add_argument("--max_loaded_adapters", type=int, default=8, help="Adapters kept resident before least recently used ones are evicted")
+    serve_parser.add_argument("--merge", action="store_true", help="Merge LoRA weights into the base model before serving")
+    serve_parser.add_argument("--attn_implementation", type=str, default="flash_attention_2", help="Attention implementation")
+    serve_parser.add_argument("--quantization", type=str, choices=["int8", "nf4", "fp4"], help="Serve the base model with weight-only quantization")
+    serve_parser.add_argument("--quantization_backend", type=str, default="auto", choices=["auto", "bitsandbytes", "reference"], help="bitsandbytes needs CUDA; reference runs anywhere")
+    serve_parser.add_argument("--mmap_weights", action="store_true", help="Map the base weights from safetensors, shared by all servers on a node")
+    serve_parser.add_argument("--mmap_cache_dir", type=str, help="With --mmap_weights, convert checkpoints that cannot be mapped as they are (other dtype, MXFP4) here once")
+    serve_parser.add_argument("--prefix_cache_mb", type=int, default=1024, help="Memory budget for cached system-prompt key/values (0 disables)")
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.add_argument("--max_batch_size", type=int, default=16, help="Maximum sequences decoded together")
+    serve_parser.add_argument("--max_new_tokens", type=int, default=256, help="Default completion length")
+    serve_parser.add_argument("--reasoning_level", type=str, default="medium", choices=["low", "medium", "high"])
+    
+    load_parser = subparsers.add_parser("loadgen", help="Measure a running server's throughput and latency")
+    load_parser.add_argument("--url", type=str, default="http://127.0.0.1:8000")
+    load_parser.add_argument("--prompts", type=str, help="JSONL file with 'prompt' or 'user' fields")
+    load_parser.add_argument("--num_requests", type=int, default=100)
+    load_parser.add_argument("--concurrency", type=int, default=8)
+    load_parser.add_argument("--max_new_tokens", type=int, default=128)
+    load_parser.add_argument("--temperature", type=float, default=0.7)
+    load_parser.add_argument("--output", type=str, help="Write the summary to this JSON file")
+    
+    args = parser.parse_args(argv)
+    
+    if args.command == "loadgen":
+        prompts = ["How can I enable voice commands on my device?", "What are the benefits of regular exercise?"]
+        if args.prompts:
+            with open(args.prompts, "r", encoding="utf-8") as f:
+                items = [json.loads(line) for line in f if line.strip()]
+            prompts = [item.get("prompt", item.get("user", "")) for item in items]
+        summary = run_load_test(
+            args.url,
+            prompts,
+            num_requests=args.num_requests,
+            concurrency=args.concurrency,
+            max_new_tokens=args.max_new_tokens,
+            temperature=args.temperature
+        )
+        print(json.dumps(summary, indent=2))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(summary, f, indent=2)
+        return
+    
+    try:
+        model_config = ModelConfig(
+            model_name=args.model_name,
+            attn_implementation=args.attn_implementation,
+            prefix_cache_mb=args.prefix_cache_mb,
+            max_loaded_adapters=args.max_loaded_adapters,
+            quantization=args.quantization,
+            quantization_backend=args.quantization_backend,
+            mmap_weights=args.mmap_weights,
+            mmap_cache_dir=args.mmap_cache_dir
+        )
+        fine_tuner = GPTOSSFineTuner(model_config, LoRAConfig(inference_mode=True), TrainingConfig())
+        fine_tuner.load_tokenizer()
+        if args.load_model:
+            fine_tuner.load_finetuned_model(args.load_model)
+            if args.merge:
+                fine_tuner.model = fine_tuner.merge_and_unload()
+        else:
+            fine_tuner.load_model()
+        for spec in args.adapter:
+            name, sep, path = spec.partition("=")
+            if not sep:
+                raise ValueError(f"--adapter expects NAME=PATH, got {spec}")
+            fine_tuner.register_adapter(name, path)
+        fine_tuner.model.eval()
+        
+        engine = ContinuousBatchingEngine(fine_tuner, max_batch_size=args.max_batch_size)
+        serve(
+            engine,
+            host=args.host,
+            port=args.port,
+            defaults={"max_new_tokens": args.max_new_tokens, "reasoning_level": args.reasoning_level}
+        )
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()